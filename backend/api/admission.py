@@ -0,0 +1,374 @@
+"""
+Admission control for the endpoints that call OpenAI: per-user rate limits and per-class concurrency caps.
+
+Each admission class groups the POST routes of one kind of upstream work.
+A request to one of them:
+
+1. is rejected with a 429 at once if the class's slots are all taken and
+   its expected wait (its place in line over the slots, times the recent
+   mean time a request holds a slot) exceeds the class's `queue_slo`,
+   rather than being left to time out in line; it keeps its token;
+2. takes a token from its user's bucket for the class, refilled at `rate`
+   per second up to `burst`; with none left it gets a 429 whose
+   Retry-After says when the next token is due;
+3. waits for one of the class's `max_concurrency` slots, for at most
+   `queue_slo`, then holds it until its response is sent.
+
+The user ids requests carry are not authenticated, so buckets are keyed by
+the client address, the last X-Forwarded-For entry (the one Cloud Run's
+front end added), together with the user the client names: the `user_id` of
+a JSON body, else the X-User-ID header. Claiming another user's id from
+elsewhere then does not drain that user's bucket; rotating ids from one
+address gets a bucket per id, bounded by the class's slots and queue SLO.
+Buckets live in process memory, or in an SQLite file shared by the workers
+of an instance with ADMISSION_BUCKETS_PATH; another shared store (Redis,
+Firestore) plugs in as a backend with the same `take`.
+Slots are per process.
+
+Queue depth, slots in use, queue waits, admissions and rejections are
+exported as `admission_*` metrics.
+"""
+import asyncio
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+from cachetools import TTLCache
+from pydantic import BaseModel
+from api.tracing import _header, logger, metrics
+
+# Buckets untouched this long are full again for every class, so they can be dropped
+BUCKET_TTL_SECONDS = 3600
+BUCKETS_MAXSIZE = 100_000
+# Longest the event loop waits for another process's hold on the SQLite buckets before admitting the request untested
+BUCKET_LOCK_TIMEOUT_SECONDS = 0.05
+# Weight of the latest request in the mean time a slot is held
+SERVICE_TIME_SMOOTHING = 0.2
+# JSON bodies are read up to this size to find their user_id
+MAX_USER_BODY_BYTES = 64 * 1024
+USER_HEADER = b"x-user-id"
+
+
+class AdmissionClass(BaseModel):
+    paths: List[str]
+    # Requests per second per user, and how many may come at once
+    rate: float
+    burst: float
+    # None leaves concurrency to the handler, e.g. the job queue's workers
+    max_concurrency: Optional[int] = None
+    queue_slo: float = 5.0
+    # Time a request holds a slot, until measured
+    expected_seconds: float = 10.0
+
+
+ADMISSION_CLASSES: Dict[str, AdmissionClass] = {
+    'planning': AdmissionClass(
+        paths=['/generate_milestones_and_tasks', '/generate_milestones_and_tasks/stream'],
+        rate=2 / 60, burst=5, max_concurrency=16, queue_slo=5.0, expected_seconds=20.0,
+    ),
+    'planning_jobs': AdmissionClass(paths=['/jobs/generate_milestones_and_tasks'], rate=2 / 60, burst=5),
+    # No slots: its background task polls the batch for hours, which would hold a slot the whole time
+    'bulk_planning': AdmissionClass(paths=['/bulk/generate_milestones_and_tasks'], rate=1 / 60, burst=3),
+    'llm': AdmissionClass(
+        paths=['/smart_goal', '/profile_definition'],
+        rate=10 / 60, burst=20, max_concurrency=32, queue_slo=2.0, expected_seconds=3.0,
+    ),
+    'transcription': AdmissionClass(
+        paths=['/transcribe_voice'],
+        rate=6 / 60, burst=10, max_concurrency=8, queue_slo=5.0, expected_seconds=10.0,
+    ),
+}
+
+
+class MemoryBucketBackend:
+    """
+    Token buckets in process memory.
+    """
+
+    def __init__(self, maxsize: int = BUCKETS_MAXSIZE, ttl: float = BUCKET_TTL_SECONDS):
+        self._buckets = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        """
+        Take a token from the bucket. Returns 0, or the seconds until a token is due when there is none.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated_at) * rate)
+            self._buckets[key] = (tokens - 1, now) if tokens >= 1 else (tokens, now)
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteBucketBackend:
+    """
+    Token buckets in an SQLite file, shared by the processes that open it.
+
+    `take` runs on the event loop, between the overload check and joining a
+    class's line, so it must not wait: commits are not synced to disk (the
+    buckets are worth nothing after a crash), and if another process holds
+    the file for over `lock_timeout` the request is admitted without a
+    token, counted in `admission_bucket_errors_total`.
+    """
+
+    def __init__(self, path: str, ttl: float = BUCKET_TTL_SECONDS, lock_timeout: float = BUCKET_LOCK_TIMEOUT_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._takes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+        # Only the schema setup above may wait out another process
+        self._conn.execute(f"PRAGMA busy_timeout={int(lock_timeout * 1000)}")
+
+    def take(self, key: str, rate: float, burst: float) -> float:
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError:
+                logger.warning("Admission buckets busy, admitting without a token", extra={"key": key})
+                metrics.increment("admission_bucket_errors_total")
+                return 0.0
+            try:
+                now = time.time()
+                row = self._conn.execute("SELECT tokens, updated_at FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = min(burst, row[0] + (now - row[1]) * rate) if row else burst
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                    (key, tokens - 1 if tokens >= 1 else tokens, now),
+                )
+                self._takes += 1
+                if self._takes % 1000 == 0:
+                    self._conn.execute("DELETE FROM buckets WHERE updated_at < ?", (now - self.ttl,))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return 0.0 if tokens >= 1 else (1 - tokens) / rate
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM buckets").fetchone()[0]
+
+
+class AdmissionQueue:
+    """
+    The concurrency slots of one class and the requests waiting for them.
+    """
+
+    def __init__(self, name: str, max_concurrency: int, expected_seconds: float):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.service_seconds = expected_seconds
+        self.in_flight = 0
+        self.waiting = 0
+        self._semaphore = None
+
+    def expected_wait(self) -> float:
+        ahead = self.in_flight + self.waiting - self.max_concurrency + 1
+        return max(0, ahead) / self.max_concurrency * self.service_seconds
+
+    def _publish(self):
+        metrics.set_gauge("admission_queue_depth", self.waiting, **{"class": self.name})
+        metrics.set_gauge("admission_in_flight", self.in_flight, **{"class": self.name})
+
+    async def acquire(self, timeout: float) -> bool:
+        """
+        Wait up to `timeout` seconds for a slot. False if none came free.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        start = time.perf_counter()
+        self.waiting += 1
+        self._publish()
+        try:
+            if self._semaphore.locked():
+                await asyncio.wait_for(self._semaphore.acquire(), timeout)
+            else:
+                await self._semaphore.acquire()
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+            metrics.observe("admission_queue_wait_seconds", time.perf_counter() - start, **{"class": self.name})
+        self.in_flight += 1
+        self._publish()
+        return True
+
+    def release(self, held_seconds: float):
+        self.in_flight -= 1
+        self._semaphore.release()
+        self.service_seconds += SERVICE_TIME_SMOOTHING * (held_seconds - self.service_seconds)
+        self._publish()
+
+
+class AdmissionController:
+
+    def __init__(self, classes: Optional[Dict[str, AdmissionClass]] = None, buckets=None):
+        self.enabled = True
+        self.buckets = buckets if buckets is not None else MemoryBucketBackend()
+        self.configure(classes if classes is not None else ADMISSION_CLASSES)
+
+    def configure(self, classes: Dict[str, AdmissionClass]):
+        self.classes = dict(classes)
+        self._routes = {path: name for name, admission_class in self.classes.items() for path in admission_class.paths}
+        self.queues = {
+            name: AdmissionQueue(name, admission_class.max_concurrency, admission_class.expected_seconds)
+            for name, admission_class in self.classes.items() if admission_class.max_concurrency is not None
+        }
+        self._stats = {name: {"admitted": 0, "rejected": {}} for name in self.classes}
+
+    def classify(self, method: str, path: str) -> Optional[str]:
+        return self._routes.get(path) if method == "POST" else None
+
+    def admit(self, name: str):
+        self._stats[name]["admitted"] += 1
+        metrics.increment("admission_admitted_total", **{"class": name})
+
+    def reject(self, name: str, reason: str, retry_after: float) -> float:
+        rejected = self._stats[name]["rejected"]
+        rejected[reason] = rejected.get(reason, 0) + 1
+        metrics.increment("admission_rejected_total", **{"class": name, "reason": reason})
+        return retry_after
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "buckets": len(self.buckets),
+            "classes": {
+                name: {
+                    **stats,
+                    "in_flight": self.queues[name].in_flight if name in self.queues else None,
+                    "waiting": self.queues[name].waiting if name in self.queues else None,
+                    "service_seconds": round(self.queues[name].service_seconds, 3) if name in self.queues else None,
+                }
+                for name, stats in self._stats.items()
+            },
+        }
+
+
+admission_controller = AdmissionController()
+
+
+async def _buffered_body(receive):
+    """
+    Read the request body, up to MAX_USER_BODY_BYTES. Returns it with a receive that replays what was read.
+    """
+    messages = []
+    body = b""
+    while True:
+        message = await receive()
+        messages.append(message)
+        if message["type"] != "http.request":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body") or len(body) > MAX_USER_BODY_BYTES:
+            break
+
+    async def replay():
+        return messages.pop(0) if messages else await receive()
+
+    return body, replay
+
+
+def _client_address(scope) -> str:
+    # Cloud Run appends the address it saw to X-Forwarded-For; earlier entries come from the client
+    forwarded = (_header(scope, b"x-forwarded-for") or "").split(",")[-1].strip()
+    client = scope.get("client")
+    return forwarded or (client[0] if client else "unknown")
+
+
+async def _user(scope, receive):
+    address = _client_address(scope)
+    if (_header(scope, b"content-type") or "").startswith("application/json"):
+        body, receive = await _buffered_body(receive)
+        try:
+            user_id = json.loads(body).get("user_id")
+        except (ValueError, AttributeError):
+            user_id = None
+        if isinstance(user_id, str) and user_id:
+            return f"{address}:{user_id}", receive
+    if _header(scope, USER_HEADER):
+        return f"{address}:{_header(scope, USER_HEADER)}", receive
+    return address, receive
+
+
+async def _too_many_requests(send, detail: str, retry_after: float):
+    body = json.dumps({"detail": detail}).encode()
+    await send({"type": "http.response.start", "status": 429, "headers": [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+        (b"retry-after", str(max(1, math.ceil(retry_after))).encode()),
+    ]})
+    await send({"type": "http.response.body", "body": body})
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the admission_controller to the requests of its classes.
+    """
+
+    def __init__(self, app, controller: Optional[AdmissionController] = None):
+        self.app = app
+        self.controller = controller if controller is not None else admission_controller
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controller
+        name = controller.classify(scope["method"], scope["path"]) if scope["type"] == "http" and controller.enabled else None
+        if name is None:
+            await self.app(scope, receive, send)
+            return
+
+        admission_class = controller.classes[name]
+        user, receive = await _user(scope, receive)
+        # No await from the estimate to joining the line, so concurrent arrivals see each other
+        queue = controller.queues.get(name)
+        if queue is not None and queue.expected_wait() > admission_class.queue_slo:
+            retry_after = controller.reject(name, "overloaded", queue.expected_wait())
+            await _too_many_requests(send, "The server is busy, retry later", retry_after)
+            return
+        retry_after = controller.buckets.take(f"{name}:{user}", admission_class.rate, admission_class.burst)
+        if retry_after:
+            controller.reject(name, "rate_limited", retry_after)
+            logger.info("Rate limited", extra={"class": name, "user_id": user, "retry_after": round(retry_after, 1)})
+            await _too_many_requests(send, "Too many requests, retry later", retry_after)
+            return
+        if queue is not None and not await queue.acquire(admission_class.queue_slo):
+            retry_after = controller.reject(name, "queue_timeout", queue.expected_wait() or admission_class.queue_slo)
+            await _too_many_requests(send, "The server is busy, retry later", retry_after)
+            return
+        controller.admit(name)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            if queue is not None:
+                queue.release(time.perf_counter() - start)
+
+
+def configure_admission():
+    """
+    Apply admission settings from the environment.
+
+    ADMISSION_CONTROL=False turns it off. ADMISSION_CLASSES is a JSON object
+    of per-class AdmissionClass fields merged over the defaults, e.g.
+    {"planning": {"max_concurrency": 8, "rate": 0.05}}. ADMISSION_BUCKETS_PATH
+    keeps the buckets in an SQLite file shared by the workers.
+    """
+    admission_controller.enabled = os.getenv('ADMISSION_CONTROL', 'True') == 'True'
+    if os.getenv('ADMISSION_CLASSES'):
+        classes = dict(admission_controller.classes)
+        for name, fields in json.loads(os.getenv('ADMISSION_CLASSES')).items():
+            current = classes.get(name)
+            classes[name] = AdmissionClass(**{**(current.model_dump() if current is not None else {}), **fields})
+        admission_controller.configure(classes)
+    if os.getenv('ADMISSION_BUCKETS_PATH'):
+        admission_controller.buckets = SQLiteBucketBackend(os.getenv('ADMISSION_BUCKETS_PATH'))
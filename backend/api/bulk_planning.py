@@ -0,0 +1,327 @@
+"""
+Bulk goal planning through the OpenAI Batch API.
+
+A job plans many (user_id, validated_goal) items with the single-call
+planning prompt. Its state lives in Firestore so any process can resume it:
+
+    planningJobs/{job_id}                 status, batch ids, counts
+    planningJobs/{job_id}/items/{item_id} user_id, validated_goal, status, guid
+
+Item ids are derived from the item content, and an item's goal tree is
+committed in the same WriteBatch that marks it completed, so re-running a
+job never plans or saves an item twice. Items that got no result (the
+batch expired, was cancelled or failed) are resubmitted in a new batch up
+to MAX_SUBMISSIONS times. Plans get the same checks as on the synchronous
+path: milestones that fail them are re-requested one by one, and an item
+whose plan cannot be repaired fails. A job should be driven by one worker
+at a time.
+
+Run `python -m api.bulk_planning` to resume every unfinished job.
+"""
+import asyncio
+import hashlib
+import io
+import json
+import os
+import time
+import uuid
+from typing import List, Optional
+from pydantic import BaseModel, ValidationError
+from api.goal_to_tasks import Goal, GoalToTasks, PLANNING_MODEL
+from api.plan_validation import PlanValidationError
+from api.prompt_builder import goal_plan_messages, prompt_usage
+from api.persistence import GoalTreeWriter
+from api.tracing import logger
+
+JOBS_COLLECTION = "planningJobs"
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+POLL_INTERVAL_SECONDS = 30.0
+MAX_SUBMISSIONS = 3
+# Items saved per bulk Firestore write while persisting results
+PERSIST_CHUNK_SIZE = 100
+# Plans whose failing milestones are re-requested at once while persisting results
+MAX_CONCURRENT_REPAIRS = 8
+# Allowance for the difference between this clock and the Batch API's when looking for a batch by creation time
+BATCH_CLOCK_SKEW_SECONDS = 300
+
+# Batch statuses after which no more output will be produced
+BATCH_DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+# Job statuses from which the worker has nothing left to do
+JOB_DONE_STATUSES = ("completed", "failed")
+
+_running_jobs = set()
+
+
+class BulkPlanningItem(BaseModel):
+    user_id: str
+    validated_goal: str
+
+
+def item_id(item: BulkPlanningItem) -> str:
+    return hashlib.sha256(f"{item.user_id}\n{item.validated_goal}".encode()).hexdigest()[:20]
+
+
+def batch_request(custom_id: str, validated_goal: str) -> dict:
+    """
+    One line of the batch input file: the same request as the synchronous `parse` call.
+    """
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": PLANNING_MODEL,
+            "messages": goal_plan_messages(validated_goal),
+            "response_format": response_format(Goal),
+            "seed": 42,
+        },
+    }
+
+
+def response_format(model) -> dict:
+    """
+    Structured output `response_format` of a Pydantic model, with the strict JSON schema `parse` sends.
+    """
+    import openai
+
+    # The public tool helper builds the same strict schema as the SDK's internal response_format conversion
+    schema = openai.pydantic_function_tool(model)["function"]["parameters"]
+    return {"type": "json_schema", "json_schema": {"name": model.__name__, "schema": schema, "strict": True}}
+
+
+def parse_batch_result(line: dict) -> Goal:
+    """
+    Return the Goal of one output line, or raise ValueError describing why there is none.
+    """
+    if line.get("error"):
+        raise ValueError(line["error"].get("message") or str(line["error"]))
+    response = line.get("response") or {}
+    if response.get("status_code") != 200:
+        raise ValueError(f"Request failed with status {response.get('status_code')}: {response.get('body')}")
+    message = response["body"]["choices"][0]["message"]
+    if message.get("refusal"):
+        raise ValueError(f"Refused: {message['refusal']}")
+    try:
+        return Goal.model_validate_json(message["content"])
+    except ValidationError as e:
+        raise ValueError(f"Invalid plan: {e}")
+
+
+class BulkPlanningWorker:
+    """
+    Creates bulk planning jobs and drives them to completion.
+
+    `step` advances a job by one stage (submit, poll, persist) and is safe to
+    call repeatedly or from a fresh process; `run` loops it until the job is done.
+    """
+
+    def __init__(self, db, client, poll_interval: Optional[float] = None):
+        self.db = db
+        self.client = client
+        self.poll_interval = poll_interval if poll_interval is not None else float(os.getenv('BULK_PLANNING_POLL_SECONDS', POLL_INTERVAL_SECONDS))
+
+    def _job_ref(self, job_id: str):
+        return self.db.collection(JOBS_COLLECTION).document(job_id)
+
+    async def _update_job(self, job_id: str, **fields) -> dict:
+        fields["updated_at"] = time.time()
+        await self._job_ref(job_id).set(fields, merge=True)
+        return fields
+
+    async def _items(self, job_id: str) -> List[dict]:
+        return [doc.to_dict() async for doc in self._job_ref(job_id).collection("items").stream()]
+
+    async def create_job(self, items: List[BulkPlanningItem], job_id: Optional[str] = None) -> dict:
+        """
+        Record a job and its items, then submit its batch. Creating a job_id that already exists returns that job.
+        """
+        if job_id is not None:
+            existing = await self.job_status(job_id)
+            if existing is not None:
+                return existing
+        job_id = job_id or uuid.uuid4().hex
+
+        unique_items = {item_id(item): item for item in items}
+        job_ref = self._job_ref(job_id)
+        await GoalTreeWriter(self.db).commit([
+            (job_ref.collection("items").document(key), {"item_id": key, "user_id": item.user_id, "validated_goal": item.validated_goal, "status": "pending", "guid": None, "error": None})
+            for key, item in unique_items.items()
+        ])
+        # The job document is written last so a job is only visible once all its items are
+        now = time.time()
+        await job_ref.set({"job_id": job_id, "status": "created", "item_count": len(unique_items), "completed_count": 0, "failed_count": 0, "batch_id": None, "submissions": 0, "error": None, "created_at": now, "updated_at": now})
+
+        await self.step(job_id)
+        return await self.job_status(job_id)
+
+    async def job_status(self, job_id: str, include_items: bool = False) -> Optional[dict]:
+        job_doc = await self._job_ref(job_id).get()
+        if not job_doc.exists:
+            return None
+        job = job_doc.to_dict()
+        if include_items:
+            job["items"] = [{key: item[key] for key in ("item_id", "user_id", "status", "guid", "error")} for item in await self._items(job_id)]
+        return job
+
+    async def step(self, job_id: str) -> dict:
+        job = await self.job_status(job_id)
+        if job is None:
+            raise KeyError(f"No bulk planning job {job_id}")
+        if job["status"] in JOB_DONE_STATUSES:
+            return job
+        if job["batch_id"] is None:
+            return {**job, **await self._submit(job)}
+
+        batch = await self.client.batches.retrieve(job["batch_id"])
+        if batch.status not in BATCH_DONE_STATUSES:
+            counts = batch.request_counts
+            return {**job, **await self._update_job(job_id, status="in_progress", batch_status=batch.status, batch_completed=counts.completed if counts else 0, batch_failed=counts.failed if counts else 0)}
+        return {**job, **await self._finish(job, batch)}
+
+    async def run(self, job_id: str) -> dict:
+        """
+        Step the job until it is done. A job already running in this process is not run twice.
+        """
+        if job_id in _running_jobs:
+            return await self.job_status(job_id)
+        _running_jobs.add(job_id)
+        try:
+            while True:
+                job = await self.step(job_id)
+                if job["status"] in JOB_DONE_STATUSES:
+                    return job
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            _running_jobs.discard(job_id)
+
+    async def resume_all(self) -> List[dict]:
+        """
+        Run every job that is not done yet, concurrently.
+        """
+        jobs = [doc.to_dict() async for doc in self.db.collection(JOBS_COLLECTION).where("status", "in", ["created", "submitted", "in_progress"]).stream()]
+        return list(await asyncio.gather(*(self.run(job["job_id"]) for job in jobs)))
+
+    async def _find_batch(self, job_id: str, submission: int, since: Optional[float]):
+        """
+        The batch of this submission, if a previous run created it but died before recording its id.
+
+        `since` is when that run started submitting; batches are listed newest
+        first, so the listing stops at the first batch created before it.
+        """
+        if since is None:
+            return None
+        async for batch in self.client.batches.list(limit=100):
+            if batch.created_at < since - BATCH_CLOCK_SKEW_SECONDS:
+                return None
+            metadata = batch.metadata or {}
+            if metadata.get("job_id") == job_id and metadata.get("submission") == str(submission):
+                return batch
+        return None
+
+    async def _submit(self, job: dict) -> dict:
+        job_id = job["job_id"]
+        submission = job["submissions"] + 1
+        pending = [item for item in await self._items(job_id) if item["status"] == "pending"]
+        if not pending:
+            return await self._complete(job_id)
+
+        batch = await self._find_batch(job_id, submission, job.get("submitting_at"))
+        if batch is None:
+            await self._update_job(job_id, submitting_at=time.time())
+            lines = "".join(json.dumps(batch_request(item["item_id"], item["validated_goal"])) + "\n" for item in pending)
+            input_file = await self.client.files.create(file=(f"{job_id}-{submission}.jsonl", io.BytesIO(lines.encode())), purpose="batch")
+            batch = await self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint=BATCH_ENDPOINT,
+                completion_window=COMPLETION_WINDOW,
+                metadata={"job_id": job_id, "submission": str(submission)},
+            )
+        logger.info("Submitted bulk planning batch", extra={"job_id": job_id, "batch_id": batch.id, "items": len(pending), "submission": submission})
+        return await self._update_job(job_id, status="submitted", batch_id=batch.id, batch_status=batch.status, submissions=submission)
+
+    async def _read_file(self, file_id: Optional[str]) -> List[dict]:
+        if not file_id:
+            return []
+        content = await self.client.files.content(file_id)
+        return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+    async def _finish(self, job: dict, batch) -> dict:
+        """
+        Persist the results of a finished batch, then complete the job or resubmit what is left.
+        """
+        job_id = job["job_id"]
+        items = {item["item_id"]: item for item in await self._items(job_id)}
+        lines = await self._read_file(batch.output_file_id) + await self._read_file(batch.error_file_id)
+
+        goal_to_tasks = GoalToTasks(self.db, self.client, "")
+        items_ref = self._job_ref(job_id).collection("items")
+        parsed = []
+        failures = []
+        for line in lines:
+            item = items.get(line.get("custom_id"))
+            if item is None or item["status"] != "pending":
+                continue
+            try:
+                parsed.append((item, parse_batch_result(line)))
+                prompt_usage.record("bulk_generate_milestones_and_tasks", line["response"]["body"].get("usage"))
+            except ValueError as e:
+                failures.append((items_ref.document(item["item_id"]), {**item, "status": "failed", "error": str(e)}))
+
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REPAIRS)
+        repaired = await asyncio.gather(*(self._repair(item, goal_plan, semaphore) for item, goal_plan in parsed))
+        planned = []
+        for (item, _), (goal_plan, error) in zip(parsed, repaired):
+            if goal_plan is None:
+                failures.append((items_ref.document(item["item_id"]), {**item, "status": "failed", "error": error}))
+            else:
+                planned.append((item, goal_plan))
+
+        for start in range(0, len(planned), PERSIST_CHUNK_SIZE):
+            chunk = planned[start:start + PERSIST_CHUNK_SIZE]
+            await goal_to_tasks.save_goals_to_firestore(
+                [(goal_plan, item["user_id"]) for item, goal_plan in chunk],
+                # Mark each item completed in the same batch as its goal tree
+                lambda index, goal_plan: [(items_ref.document(chunk[index][0]["item_id"]), {**chunk[index][0], "status": "completed", "guid": goal_plan.guid})],
+            )
+        if failures:
+            await GoalTreeWriter(self.db).commit(failures)
+        logger.info("Persisted bulk planning batch", extra={"job_id": job_id, "batch_id": batch.id, "plans": len(planned), "failures": len(failures)})
+
+        if batch.status != "completed" and job["submissions"] < MAX_SUBMISSIONS:
+            # Items without a result are resubmitted in a fresh batch
+            return await self._update_job(job_id, status="created", batch_id=None, batch_status=batch.status)
+        return await self._complete(job_id, batch.status)
+
+    async def _repair(self, item: dict, goal_plan: Goal, semaphore: asyncio.Semaphore):
+        """
+        Return the plan with its failing milestones re-requested, and None or the reason it cannot be used.
+        """
+        validated_goal = item["validated_goal"]
+        try:
+            async with semaphore:
+                return await GoalToTasks(self.db, self.client, item["user_id"]).repair_plan(goal_plan, validated_goal, goal_plan_messages(validated_goal)), None
+        except PlanValidationError as e:
+            return None, str(e)
+
+    async def _complete(self, job_id: str, batch_status: Optional[str] = None) -> dict:
+        items = await self._items(job_id)
+        completed = sum(item["status"] == "completed" for item in items)
+        failed = sum(item["status"] == "failed" for item in items)
+        pending = len(items) - completed - failed
+        # Items still pending here never got a result from any submission
+        error = f"{pending} items got no result (last batch {batch_status})" if pending else None
+        status = "failed" if pending or (items and not completed) else "completed"
+        return await self._update_job(job_id, status=status, completed_count=completed, failed_count=failed, error=error)
+
+
+async def main():
+    from api.dependencies import firestore_db, openai_client
+
+    jobs = await BulkPlanningWorker(firestore_db(), openai_client()).resume_all()
+    for job in jobs:
+        print(f"Job {job['job_id']}: {job['status']} ({job['completed_count']} completed, {job['failed_count']} failed)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,119 @@
+"""
+Lazily constructed clients shared by the whole app.
+
+Nothing here runs at import time: the .env file is loaded, and the OpenAI and
+Firestore clients (and their heavy SDK imports) are built, on first use.
+The async `get_*` functions are the FastAPI dependencies; tests and
+benchmarks replace them through `app.dependency_overrides`.
+"""
+import os
+from dotenv import load_dotenv
+from api.embeddings import EmbeddingService, get_embedding_service, reset_embedding_service
+from api.upstream import MAX_CONCURRENT_LLM_CALLS, upstream_limiter
+
+_environment_loaded = False
+_openai_client = None
+_db = None
+
+
+def load_environment():
+    global _environment_loaded
+    if not _environment_loaded:
+        # Load environment variables from .env file
+        load_dotenv()
+        _environment_loaded = True
+
+
+def openai_client():
+    """
+    Return the shared AsyncOpenAI client, creating it on first use.
+
+    Its pooled HTTP client caps concurrent LLM calls at OPENAI_MAX_CONCURRENCY.
+    """
+    global _openai_client
+    if _openai_client is None:
+        load_environment()
+        from openai import AsyncOpenAI
+        from api.http_clients import DEFAULT_TIMEOUT, build_http_client
+        upstream_limiter.max_concurrency = int(os.getenv('OPENAI_MAX_CONCURRENCY', MAX_CONCURRENT_LLM_CALLS))
+        _openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=build_http_client("openai"), timeout=DEFAULT_TIMEOUT)
+    return _openai_client
+
+
+def initialize_firebase():
+    """
+    Initialize the Firebase app once, based on the platform.
+    """
+    import firebase_admin
+    from firebase_admin import credentials
+
+    load_environment()
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        if os.getenv('GCP_DEPLOYMENT', 'True') == 'True':
+            # Initialize Firestore for GCP
+            firebase_admin.initialize_app()
+        else:
+            # Initialize Firestore for other platforms
+            cred = credentials.Certificate("api/cred.json")
+            firebase_admin.initialize_app(cred)
+
+
+def firestore_db():
+    """
+    Return the shared async Firestore client, creating it on first use.
+    """
+    global _db
+    if _db is None:
+        initialize_firebase()
+        from firebase_admin import firestore_async
+        _db = firestore_async.client()
+    return _db
+
+
+def embedding_service() -> EmbeddingService:
+    load_environment()
+    if os.getenv('EMBEDDING_BACKEND', 'openai') == 'local':
+        return get_embedding_service()
+    return get_embedding_service(openai_client())
+
+
+def set_clients(client=None, db=None):
+    """
+    Replace the shared clients, e.g. with fakes. Background jobs use these
+    since they run outside any request and its dependency overrides.
+    """
+    global _openai_client, _db
+    if client is not None:
+        _openai_client = client
+        reset_embedding_service()
+    if db is not None:
+        _db = db
+
+
+async def close_clients():
+    global _openai_client, _db
+    if _openai_client is not None:
+        await _openai_client.close()
+        _openai_client = None
+    # Built on the client just closed
+    reset_embedding_service()
+    if _db is not None:
+        _db.close()
+        _db = None
+
+
+# FastAPI dependencies. They are async so FastAPI calls them on the event loop
+# instead of dispatching each one to the threadpool.
+
+async def get_openai_client():
+    return openai_client()
+
+
+async def get_db():
+    return firestore_db()
+
+
+async def get_embeddings() -> EmbeddingService:
+    return embedding_service()
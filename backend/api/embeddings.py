@@ -0,0 +1,190 @@
+import asyncio
+import hashlib
+import math
+import os
+import re
+from typing import List, Optional
+from cachetools import LRUCache
+from api.tracing import span
+
+# text-embedding-3 models can shorten their output to match the Pinecone index dimension
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIMENSION = 1024
+MAX_BATCH_SIZE = 256
+MAX_CONCURRENT_BATCHES = 4
+# How long the first queued text waits for others to join its batch
+BATCH_WINDOW_SECONDS = 0.005
+EMBEDDING_CACHE_SIZE = 10_000
+
+
+class OpenAIEmbeddingBackend:
+
+    def __init__(self, client, model: str = EMBEDDING_MODEL, dimension: int = EMBEDDING_DIMENSION):
+        self.client = client
+        self.model = model
+        self.dimension = dimension
+
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        with span("openai.embeddings", "openai", model=self.model, texts=len(texts)) as attributes:
+            response = await self.client.embeddings.create(input=texts, model=self.model, dimensions=self.dimension)
+            attributes["prompt_tokens"] = getattr(response.usage, "prompt_tokens", None)
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+class LocalEmbeddingBackend:
+    """
+    Feature-hashing embeddings of word unigrams and bigrams, computed on CPU.
+
+    No network and deterministic, for offline use and tests. Similar texts get
+    similar vectors, but there is no semantic understanding beyond shared words.
+    """
+
+    def __init__(self, dimension: int = EMBEDDING_DIMENSION):
+        self.dimension = dimension
+
+    async def embed_batch(self, texts: List[str]) -> List[List[float]]:
+        return [self.embed_one(text) for text in texts]
+
+    def embed_one(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimension
+        words = re.findall(r"\w+", text.lower())
+        for feature in words + [f"{a} {b}" for a, b in zip(words, words[1:])]:
+            digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector))
+        return [value / norm for value in vector] if norm else vector
+
+
+class EmbeddingService:
+    """
+    Embeds texts through a backend, coalescing concurrent requests into batches.
+
+    Single-text `embed` calls made within `batch_window` of each other are sent
+    as one `embed_batch` call of up to `max_batch_size` texts, with at most
+    `max_concurrent_batches` calls in flight. Results are cached by content
+    hash, and identical texts in flight share one request.
+    """
+
+    def __init__(self, backend, max_batch_size: int = MAX_BATCH_SIZE, batch_window: float = BATCH_WINDOW_SECONDS, cache_size: int = EMBEDDING_CACHE_SIZE, max_concurrent_batches: int = MAX_CONCURRENT_BATCHES):
+        self.backend = backend
+        self.dimension = backend.dimension
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_concurrent_batches = max_concurrent_batches
+        self._semaphore = None
+        self._cache = LRUCache(maxsize=cache_size)
+        self._pending = {}
+        self._queue = []
+        self._flush_handle = None
+        # The loop keeps only weak references to tasks; these keep running batches alive
+        self._batches = set()
+        self.requests = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.texts_embedded = 0
+
+    async def embed(self, text: str) -> List[float]:
+        self.requests += 1
+        key = hashlib.sha256(text.encode()).hexdigest()
+
+        vector = self._cache.get(key)
+        if vector is not None:
+            self.cache_hits += 1
+            return vector
+
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            self._queue.append((key, text, future))
+            self._schedule_flush()
+        return await asyncio.shield(future)
+
+    async def embed_many(self, texts: List[str]) -> List[List[float]]:
+        return list(await asyncio.gather(*(self.embed(text) for text in texts)))
+
+    def _schedule_flush(self):
+        if len(self._queue) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.batch_window, self._flush)
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._queue:
+            batch, self._queue = self._queue[:self.max_batch_size], self._queue[self.max_batch_size:]
+            task = asyncio.ensure_future(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent_batches)
+        self.batches += 1
+        try:
+            async with self._semaphore:
+                vectors = await self.backend.embed_batch([text for _, text, _ in batch])
+            for vector in vectors:
+                if len(vector) != self.dimension:
+                    raise ValueError(f"Embedding has dimension {len(vector)}, expected {self.dimension}")
+        except Exception as e:
+            for key, _, future in batch:
+                self._pending.pop(key, None)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        self.texts_embedded += len(batch)
+        for (key, _, future), vector in zip(batch, vectors):
+            self._cache[key] = vector
+            self._pending.pop(key, None)
+            if not future.done():
+                future.set_result(vector)
+
+    def check_dimension(self, index_dimension: int):
+        """
+        Fail fast when the vector index was created with a different dimension than the embeddings.
+        """
+        if index_dimension != self.dimension:
+            raise ValueError(f"Vector index dimension {index_dimension} does not match embedding dimension {self.dimension}")
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "batches": self.batches,
+            "texts_embedded": self.texts_embedded,
+            "mean_batch_size": self.texts_embedded / self.batches if self.batches else 0.0,
+        }
+
+
+_embedding_service: Optional[EmbeddingService] = None
+
+
+def get_embedding_service(client=None) -> EmbeddingService:
+    """
+    Return the process-wide embedding service, creating it on first use.
+
+    EMBEDDING_BACKEND=local selects the offline backend; otherwise OpenAI is
+    used through `client`, or the shared OpenAI client if none is given.
+    """
+    global _embedding_service
+    if _embedding_service is None:
+        if os.getenv('EMBEDDING_BACKEND', 'openai') == 'local':
+            backend = LocalEmbeddingBackend()
+        else:
+            from api.dependencies import openai_client
+            backend = OpenAIEmbeddingBackend(client or openai_client())
+        _embedding_service = EmbeddingService(backend)
+    return _embedding_service
+
+
+def reset_embedding_service():
+    """
+    Drop the process-wide embedding service, e.g. when the OpenAI client it holds is closed or replaced.
+    """
+    global _embedding_service
+    _embedding_service = None
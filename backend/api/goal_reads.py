@@ -0,0 +1,246 @@
+"""
+Reading goal trees back.
+
+Every saved goal has a denormalized snapshot document holding its whole
+tree (see GoalTreeWriter), so a goal is one document read and a user's
+dashboard is one query:
+
+    users/{uid}/goalSnapshots/{guid}    guid, etag, updated_at, goal[, task_completion, version]
+
+Task completions since the snapshot was written (see api.progress) are kept
+in its `task_completion` map and applied to the tree when it is read.
+
+Snapshots are stored documents, not cache entries, so they do not catch up
+with writes made to the goal documents directly. The web client follows
+each of its direct writes with POST /users/{uid}/goals/{guid}/reconcile,
+which rebuilds the snapshot (ProgressTracker.reconcile_goal), and deletes
+goals with DELETE /users/{uid}/goals/{guid}. Any other direct writer must
+do the same.
+
+Goals in the compact layout (see persistence.compact_goal) have no snapshot:
+their goal document is the tree. With GOAL_STORAGE_LAYOUT=compact, goals are
+looked up there first, and the dashboard queries compact goals and
+snapshots concurrently, so goals not migrated yet still show.
+
+Goals saved before snapshots existed are rebuilt from their documents with
+three concurrent queries (goal, milestones, and a collection-group query of
+the tasks) instead of one query per milestone, and their snapshot is
+written back when read. Run `python -m api.goal_reads <user_id>...` to
+backfill them so they show on the dashboard. The tasks query needs the
+collection-group index on `tasks.guid` defined in firestore.indexes.json
+at the repository root; deploy it with `firebase deploy --only firestore:indexes`.
+"""
+import asyncio
+import hashlib
+from typing import List, Optional
+from cachetools import TTLCache
+from api.persistence import COMPACT_LAYOUT, SNAPSHOTS_COLLECTION, GoalTreeWriter, expand_goal, goal_storage, is_compact, progress_counters, progress_percent
+from api.tracing import span
+
+GOAL_READ_CACHE_MAXSIZE = 10_000
+# Bounds staleness across instances; writes in this process invalidate at once
+GOAL_READ_CACHE_TTL_SECONDS = 30
+
+
+class GoalReadCache:
+    """
+    In-process TTL cache of goal snapshots and dashboards, keyed by user.
+    """
+
+    def __init__(self, maxsize: int = GOAL_READ_CACHE_MAXSIZE, ttl: float = GOAL_READ_CACHE_TTL_SECONDS):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple):
+        value = self._cache.get(key) if self.enabled else None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def set(self, key: tuple, value):
+        if self.enabled:
+            self._cache[key] = value
+
+    def invalidate(self, user_id: str, guid: Optional[str] = None):
+        self._cache.pop(("goals", user_id), None)
+        if guid is not None:
+            self._cache.pop(("goal", user_id, guid), None)
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._cache)}
+
+
+goal_read_cache = GoalReadCache()
+
+
+def dashboard_etag(snapshots: List[dict]) -> str:
+    return hashlib.sha256("".join(f"{snapshot['guid']}:{snapshot['etag']}," for snapshot in snapshots).encode()).hexdigest()[:20]
+
+
+def apply_task_completion(snapshot: dict) -> dict:
+    """
+    Snapshot with its `task_completion` changes applied to the tree and progress, and its version in the ETag.
+    """
+    task_completion = snapshot.get('task_completion')
+    if not task_completion or 'goal' not in snapshot:
+        return snapshot
+    goal = snapshot['goal']
+    milestones = []
+    for milestone in goal.get('milestones', []):
+        tasks = [{**task, 'completed': task_completion[task['tuid']]} if task.get('tuid') in task_completion else task for task in milestone['tasks']]
+        milestones.append({**milestone, 'tasks': tasks})
+    counters = progress_counters([task for milestone in milestones for task in milestone['tasks']])
+    goal = {**goal, 'progress': progress_percent(counters), 'milestones': milestones}
+    return {'guid': snapshot['guid'], 'etag': f"{snapshot['etag']}.{snapshot.get('version', 0)}", 'updated_at': snapshot.get('updated_at'), 'goal': goal}
+
+
+class GoalReader:
+
+    def __init__(self, db, cache: Optional[GoalReadCache] = None):
+        self.db = db
+        self.cache = cache if cache is not None else goal_read_cache
+
+    def _snapshots(self, user_id: str):
+        return self.db.collection('users', user_id, SNAPSHOTS_COLLECTION)
+
+    def _goals(self, user_id: str):
+        return self.db.collection('users', user_id, 'goals')
+
+    async def get_goal(self, user_id: str, guid: str) -> Optional[dict]:
+        """
+        Return the snapshot of a goal (`etag` and the `goal` tree), or None if there is no such goal.
+        """
+        key = ("goal", user_id, guid)
+        snapshot = self.cache.get(key)
+        if snapshot is not None:
+            return snapshot
+
+        snapshot = None
+        if goal_storage.layout == COMPACT_LAYOUT:
+            with span("firestore.get_compact_goal", "firestore"):
+                goal_doc = await self._goals(user_id).document(guid).get()
+            if is_compact(goal_doc.to_dict()):
+                snapshot = expand_goal(goal_doc.to_dict())
+        if snapshot is None:
+            with span("firestore.get_goal_snapshot", "firestore"):
+                snapshot_doc = await self._snapshots(user_id).document(guid).get()
+            # A completion can reach a goal before its snapshot (e.g. while it streams); rebuild it then
+            if snapshot_doc.exists and 'goal' in snapshot_doc.to_dict():
+                snapshot = apply_task_completion(snapshot_doc.to_dict())
+            else:
+                goal_doc, goal = await self.load_goal(user_id, guid)
+                if goal is None:
+                    return None
+                snapshot = expand_goal(goal_doc) if is_compact(goal_doc) else await self._backfill(user_id, goal)
+        self.cache.set(key, snapshot)
+        return snapshot
+
+    async def list_goals(self, user_id: str) -> dict:
+        """
+        Return every goal tree of a user from their snapshots, with an ETag covering all of them.
+        """
+        key = ("goals", user_id)
+        dashboard = self.cache.get(key)
+        if dashboard is not None:
+            return dashboard
+
+        with span("firestore.list_goal_snapshots", "firestore") as attributes:
+            if goal_storage.layout == COMPACT_LAYOUT:
+                snapshot_docs, goal_docs = await asyncio.gather(
+                    self._stream(self._snapshots(user_id)),
+                    self._stream(self._goals(user_id).where('layout', '==', COMPACT_LAYOUT)),
+                )
+            else:
+                snapshot_docs, goal_docs = await self._stream(self._snapshots(user_id)), []
+            # A compact goal is complete once its tree and ETag are written
+            compact = [expand_goal(doc.to_dict()) for doc in goal_docs if 'etag' in doc.to_dict()]
+            # A goal being migrated to the compact layout may still have its snapshot
+            migrated = {snapshot['guid'] for snapshot in compact}
+            snapshots = [apply_task_completion(doc.to_dict()) for doc in snapshot_docs if doc.id not in migrated]
+            snapshots = [snapshot for snapshot in snapshots if 'goal' in snapshot] + compact
+            attributes["goals"] = len(snapshots)
+        snapshots.sort(key=lambda snapshot: (snapshot["goal"].get("deadline") or "", snapshot["guid"]))
+        dashboard = {"etag": dashboard_etag(snapshots), "goals": [snapshot["goal"] for snapshot in snapshots]}
+        self.cache.set(key, dashboard)
+        return dashboard
+
+    async def load_tree(self, user_id: str, guid: str, transaction=None) -> Optional[dict]:
+        """
+        Assemble a goal tree from its goal, milestone and task documents in one round of concurrent queries.
+
+        The documents keep no position, so milestones come back ordered by deadline.
+        A compact goal's tree is read from its goal document alone.
+        """
+        return (await self.load_goal(user_id, guid, transaction))[1]
+
+    async def load_goal(self, user_id: str, guid: str, transaction=None):
+        """
+        The goal document and the goal tree, or (None, None) if there is no such goal.
+        """
+        goal_ref = self._goals(user_id).document(guid)
+        if goal_storage.layout == COMPACT_LAYOUT:
+            with span("firestore.get_compact_goal", "firestore"):
+                goal_doc = await goal_ref.get(transaction=transaction)
+            if is_compact(goal_doc.to_dict()):
+                return goal_doc.to_dict(), expand_goal(goal_doc.to_dict())['goal']
+
+        with span("firestore.load_goal_tree", "firestore"):
+            goal_doc, milestone_docs, task_docs = await asyncio.gather(
+                goal_ref.get(transaction=transaction),
+                self._stream(goal_ref.collection('milestones'), transaction),
+                self._stream(self.db.collection_group('tasks').where('guid', '==', guid), transaction),
+            )
+        if not goal_doc.exists:
+            return None, None
+        if is_compact(goal_doc.to_dict()):
+            return goal_doc.to_dict(), expand_goal(goal_doc.to_dict())['goal']
+
+        tasks = {}
+        for task_doc in task_docs:
+            task = {**task_doc.to_dict(), 'tuid': task_doc.id}
+            tasks.setdefault(task['muid'], []).append(task)
+        milestones = [{**milestone_doc.to_dict(), 'guid': guid, 'tasks': tasks.get(milestone_doc.id, [])} for milestone_doc in milestone_docs]
+        milestones.sort(key=lambda milestone: milestone.get('deadline') or '')
+        return goal_doc.to_dict(), {**goal_doc.to_dict(), 'milestones': milestones}
+
+    async def backfill_snapshots(self, user_id: str) -> int:
+        """
+        Write the missing snapshots of a user's goals and return how many were written.
+        """
+        # Compact goals need no snapshot
+        guids = [doc.id async for doc in self._goals(user_id).stream() if not is_compact(doc.to_dict())]
+        existing = {doc.id async for doc in self._snapshots(user_id).stream() if 'goal' in doc.to_dict()}
+        goals = await asyncio.gather(*(self.load_tree(user_id, guid) for guid in guids if guid not in existing))
+        for goal in goals:
+            if goal is not None:
+                await self._backfill(user_id, goal)
+        return sum(goal is not None for goal in goals)
+
+    async def _stream(self, query, transaction=None) -> list:
+        return [doc async for doc in query.stream(transaction=transaction)]
+
+    async def _backfill(self, user_id: str, goal: dict) -> dict:
+        ref, snapshot = GoalTreeWriter(self.db).snapshot_write(user_id, goal)
+        await ref.set(snapshot)
+        self.cache.invalidate(user_id)
+        return snapshot
+
+
+async def main(user_ids: List[str]):
+    from api.dependencies import firestore_db
+
+    reader = GoalReader(firestore_db())
+    for user_id in user_ids:
+        print(f"User {user_id}: {await reader.backfill_snapshots(user_id)} snapshots written")
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(main(sys.argv[1:]))
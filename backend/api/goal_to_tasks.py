@@ -1,11 +1,39 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List
+import asyncio
+import time
+from pydantic import BaseModel, Field, ValidationError, model_validator
+from typing import Callable, Optional, List, Tuple
 from api.prompts import (
-                     ENRICHED_GOAL_SYS_MSG,
-                     ENRICHED_GOAL_USR_MSG,
-                     GOAL_TO_TASK_SYS_MSG,
-                     GOAL_TO_TASK_USR_MSG,
+                     GOAL_TO_MILESTONE_SYS_MSG,
+                     GOAL_TO_MILESTONE_USR_MSG,
+                     MILESTONE_TO_TASK_SYS_MSG,
+                     MILESTONE_TO_TASK_USR_MSG,
                      )
+from api.plan_validation import (
+                     MAX_MILESTONE_RETRIES,
+                     Deadline,
+                     OptionalDeadline,
+                     Percent,
+                     PlanValidationError,
+                     Score,
+                     TaskHours,
+                     clamp_milestone_deadlines,
+                     milestone_issue,
+                     plan_issues,
+                     )
+from api.prompt_builder import count_message_tokens, count_tokens, goal_plan_messages, prompt_usage, smart_goal_messages
+from api.goal_reads import goal_read_cache
+from api.model_router import PLANNING_MODEL, model_router
+from api.persistence import GoalTreeWriter, progress_counters, progress_percent
+from api.prioritization import priority_index
+from api.profile_cache import profile_cache
+from api.scheduling import schedule_index
+from api.response_cache import response_cache
+from api.streaming import GoalStreamParser
+from api.structured_output import parse_structured, validation_summary
+from api.tracing import logger, metrics, record_span, span
+
+# Upper bound on per-milestone task calls in flight when planning in fan-out mode
+MAX_CONCURRENT_TASK_CALLS = 4
 
 class PreGoal(BaseModel):
     what: str
@@ -16,30 +44,50 @@ class PreGoal(BaseModel):
 class Task(BaseModel):
     name: str
     description: Optional[str] = Field(None, description="Detailed description of the task")
-    duration_hours: int = Field(..., description="Duration of the task in hours")
-    simplicity: int = Field(..., description="Simplicity score (1-5)")
-    importance: int = Field(..., description="Importance score (1-5)")
-    urgency: int = Field(..., description="Urgency score (1-5)")
+    duration_hours: TaskHours = Field(..., description="Duration of the task in hours")
+    simplicity: Score = Field(..., description="Simplicity score (1-5)")
+    importance: Score = Field(..., description="Importance score (1-5)")
+    urgency: Score = Field(..., description="Urgency score (1-5)")
     completed: bool = Field(..., description="Whether the task has been completed")
     guid: str
     muid: str
+    tuid: Optional[str] = Field(None, description="Task document id, set when the task is saved")
 
 class Milestone(BaseModel):
     muid: str
     name: str
     description: Optional[str] = Field(None, description="Detailed description of the milestone")
     tasks: List[Task] = Field(..., description="List of tasks associated with this milestone")
-    deadline: Optional[str] = Field(None, description="Deadline for the milestone in ISO format")
+    deadline: OptionalDeadline = Field(None, description="Deadline for the milestone in ISO format")
     guid: str
 
 class Goal(BaseModel):
     guid: str
     name: str 
     description: Optional[str] = Field(None, description="Detailed description of the goal")
-    deadline: str = Field(..., description="Target date for achieving the goal in ISO format")
-    progress: int = Field(..., description="Progress of the goal in percentage")
+    deadline: Deadline = Field(..., description="Target date for achieving the goal in ISO format")
+    progress: Percent = Field(..., description="Progress of the goal in percentage")
     milestones: List[Milestone] = Field(..., description="List of milestones associated with this goal")
 
+    @model_validator(mode="after")
+    def milestones_before_deadline(self):
+        return clamp_milestone_deadlines(self)
+
+class MilestoneOutline(BaseModel):
+    name: str
+    description: Optional[str] = Field(None, description="Detailed description of the milestone")
+    deadline: OptionalDeadline = Field(None, description="Deadline for the milestone in ISO format")
+
+class GoalOutline(BaseModel):
+    name: str
+    description: Optional[str] = Field(None, description="Detailed description of the goal")
+    deadline: Deadline = Field(..., description="Target date for achieving the goal in ISO format")
+    progress: Percent = Field(..., description="Progress of the goal in percentage")
+    milestones: List[MilestoneOutline] = Field(..., description="List of milestones associated with this goal, without their tasks")
+
+class MilestoneTasks(BaseModel):
+    tasks: List[Task] = Field(..., description="List of tasks associated with the milestone")
+
 class TasksGeneration:
 
     def __init__(self, db, client, user_id: str):
@@ -72,80 +120,314 @@ class GoalToTasks:
 
 
     
-    def smart_goal(self, pre_goal: PreGoal):
+    async def fetch_user_profile(self) -> dict:
+        return await profile_cache.get(self.user_id, self._load_user_profile)
+
+    async def _load_user_profile(self) -> dict:
+        # Fetch the first document of the user profile collection
+        with span("firestore.get_profile", "firestore"):
+            async for user_profile_doc in self.db.collection("users").document(self.user_id).collection("userProfile").limit(1).stream():
+                return user_profile_doc.to_dict()
+            return {}
+
+    async def _complete(self, endpoint: str, messages: list) -> str:
+        """
+        Text completion on the model model_router picks for the endpoint, hedged and with fallback.
+        """
+        choice = model_router.choose(endpoint, count_message_tokens(messages))
+
+        async def call(model):
+            with span(f"openai.{endpoint}", "openai", model=model):
+                completion = await self.client.chat.completions.create(model=model, messages=messages, seed=42)
+                prompt_usage.record(endpoint, completion.usage)
+            return completion.choices[0].message.content
+
+        return await response_cache.get_or_call(endpoint, choice.model, messages, lambda: model_router.call(choice, call))
+
+    async def _parse(self, endpoint: str, messages: list, response_format, validate: Optional[Callable] = None):
+        """
+        Structured output call, routed like _complete. Refusals, invalid answers and results for which `validate` returns a reason raise PlanValidationError and are not cached.
+        """
+        return await parse_structured(self.client, endpoint, messages, response_format, validate, error=PlanValidationError)
+
+    async def smart_goal(self, pre_goal: PreGoal):
+
+        # Fetch user profile data
+        self.user_profile_data = await self.fetch_user_profile()
+
+        return await self._complete(
+            "smart_goal",
+            smart_goal_messages(pre_goal, self.user_profile_data)
+        )
+    
+    async def generate_milestones_and_tasks(self, validated_smart_goal: str, planning_mode: str = "monolithic"):
 
         # Fetch user profile data
-        user_profile_docs = self.db.collection("users").document(self.user_id).collection("userProfile").stream()
-        user_profile_doc = next(user_profile_docs, None)  # Get the first document
-        self.user_profile_data = user_profile_doc.to_dict() if user_profile_doc else {}
+        self.user_profile_data = await self.fetch_user_profile()
 
-        
-        completion = self.client.chat.completions.create(
-            model="gpt-4o-mini",
+        if planning_mode == "fan_out":
+            goal_plan = await self.fan_out_plan(validated_smart_goal)
+            await self.save_goal_to_firestore(goal_plan, self.user_id)
+            return goal_plan
+
+        messages = goal_plan_messages(validated_smart_goal)
+        goal_plan = await self._parse("generate_milestones_and_tasks", messages, Goal)
+        goal_plan = await self.repair_plan(goal_plan, validated_smart_goal, messages)
+        await self.save_goal_to_firestore(goal_plan, self.user_id)
+
+        return goal_plan
+
+    async def repair_plan(self, goal_plan: Goal, validated_smart_goal: str, plan_messages: list) -> Goal:
+        """
+        Re-request the tasks of every milestone that failed validation, instead of the whole plan.
+
+        Field values were already repaired in place when the plan was parsed.
+        Reports the retries and the tokens saved against regenerating the plan
+        (`plan_messages` and its output) as metrics.
+        """
+        if not goal_plan.milestones:
+            raise PlanValidationError("The plan has no milestones")
+        issues = plan_issues(goal_plan)
+        if not issues:
+            return goal_plan
+
+        retried = await asyncio.gather(*(self._retry_milestone(goal_plan.milestones[index], issue, validated_smart_goal) for index, issue in issues.items()))
+        for index, (tasks, _) in zip(issues, retried):
+            goal_plan.milestones[index].tasks = tasks
+        plan_tokens = count_message_tokens(plan_messages) + count_tokens(goal_plan.model_dump_json())
+        tokens_saved = max(0, plan_tokens - sum(tokens for _, tokens in retried))
+        metrics.increment("plan_retry_tokens_saved_total", tokens_saved)
+        logger.info("Repaired goal plan", extra={"user_id": self.user_id, "milestones_retried": len(issues), "tokens_saved": tokens_saved})
+        return goal_plan
+
+    async def _retry_milestone(self, milestone, issue: str, validated_smart_goal: str) -> Tuple[List[Task], int]:
+        """
+        Request the tasks of one milestone again. Returns them with the tokens the retries used.
+        """
+        milestone_text = f"{milestone.name}: {milestone.description} (deadline: {milestone.deadline})"
+        tokens = 0
+        for _ in range(MAX_MILESTONE_RETRIES):
+            metrics.increment("plan_milestone_retries_total")
             messages = [
-                {"role": "system", "content": ENRICHED_GOAL_SYS_MSG},
-                {"role": "user", "content": ENRICHED_GOAL_USR_MSG.replace("$WHAT",str(pre_goal.what)).replace("$WHY", str(pre_goal.why)).replace("$WHEN", str(pre_goal.when)).replace("$PROFILE", str(self.user_profile_data))}
+                {"role": "system", "content": MILESTONE_TO_TASK_SYS_MSG},
+                {"role": "user", "content": MILESTONE_TO_TASK_USR_MSG.replace("$MILESTONE", milestone_text).replace("$GOAL", validated_smart_goal)
+                    + f"\n\nA previous answer for this milestone was rejected because {issue}."}
+            ]
+            tokens += count_message_tokens(messages)
+            try:
+                planned = await self._parse(
+                    "milestone_to_tasks", messages, MilestoneTasks,
+                    validate=lambda planned: milestone_issue(milestone.model_copy(update={"tasks": planned.tasks}))
+                )
+            except PlanValidationError as e:
+                issue = str(e)
+                continue
+            return planned.tasks, tokens + count_tokens(planned.model_dump_json())
+        raise PlanValidationError(f"Milestone {milestone.name!r} is still invalid after {MAX_MILESTONE_RETRIES} retries: {issue}")
+    
+    async def fan_out_plan(self, validated_smart_goal: str, max_concurrency: int = MAX_CONCURRENT_TASK_CALLS) -> Goal:
+        """
+        Two-stage planning: one call outlines the milestones, then the tasks of
+        every milestone are generated by concurrent per-milestone calls.
+        """
+        outline = await self._parse(
+            "goal_to_milestones",
+            [
+                {"role": "system", "content": GOAL_TO_MILESTONE_SYS_MSG},
+                {"role": "user", "content": GOAL_TO_MILESTONE_USR_MSG.replace("$GOAL", validated_smart_goal)}
             ],
-            seed=42
+            GoalOutline
         )
 
-        return completion.choices[0].message.content
-    
-    def generate_milestones_and_tasks(self, validated_smart_goal: str):
+        semaphore = asyncio.Semaphore(max_concurrency)
 
-        # Fetch user profile data
-        user_profile_docs = self.db.collection("users").document(self.user_id).collection("userProfile").stream()
-        user_profile_doc = next(user_profile_docs, None)  # Get the first document
-        self.user_profile_data = user_profile_doc.to_dict() if user_profile_doc else {}
+        async def milestone_tasks(milestone: MilestoneOutline) -> List[Task]:
+            milestone_text = f"{milestone.name}: {milestone.description} (deadline: {milestone.deadline})"
+            async with semaphore:
+                planned = await self._parse(
+                    "milestone_to_tasks",
+                    [
+                        {"role": "system", "content": MILESTONE_TO_TASK_SYS_MSG},
+                        {"role": "user", "content": MILESTONE_TO_TASK_USR_MSG.replace("$MILESTONE", milestone_text).replace("$GOAL", validated_smart_goal)}
+                    ],
+                    MilestoneTasks
+                )
+            return planned.tasks
 
+        task_lists = await asyncio.gather(*(milestone_tasks(milestone) for milestone in outline.milestones))
 
-        completion = self.client.beta.chat.completions.parse(
-            model='gpt-4o-2024-08-06',
-            messages=[
-                {"role": "system", "content": GOAL_TO_TASK_SYS_MSG},
-                {"role": "user", "content": GOAL_TO_TASK_USR_MSG.replace("$SMART_GOAL", validated_smart_goal)}
-                       ],
-            response_format=Goal,
-            seed=42
+        goal_plan = Goal(
+            guid="",
+            name=outline.name,
+            description=outline.description,
+            deadline=outline.deadline,
+            progress=outline.progress,
+            milestones=[
+                Milestone(muid="", guid="", name=milestone.name, description=milestone.description, deadline=milestone.deadline, tasks=tasks)
+                for milestone, tasks in zip(outline.milestones, task_lists)
+            ]
         )
-        
-        goal_plan = completion.choices[0].message.parsed
-        self.save_goal_to_firestore(goal_plan, self.user_id)
+        return await self.repair_plan(goal_plan, validated_smart_goal, goal_plan_messages(validated_smart_goal))
+
+    async def _settle_commits(self, commits: list, guid: str):
+        """
+        Wait for the batch commits of a streamed tree, even when the caller is cancelled, and log the ones that failed.
+        """
+        if not commits:
+            return
+        results = await asyncio.shield(asyncio.gather(*commits, return_exceptions=True))
+        failures = [result for result in results if isinstance(result, BaseException)]
+        if failures:
+            logger.error("Streamed goal plan writes failed", extra={"guid": guid, "user_id": self.user_id, "failed_commits": len(failures), "error": repr(failures[0])})
+
+    async def stream_milestones_and_tasks(self, validated_smart_goal: str):
+        """
+        Streaming variant of generate_milestones_and_tasks.
+
+        Yields a `goal` event once the goal fields are known, a `milestone`
+        event (with its tasks) as soon as each milestone is complete, and a
+        final `done` event with the full plan and timing metrics. Documents
+        are written to Firestore as they arrive rather than at the end.
+        """
+        start = time.perf_counter()
+
+        # Fetch user profile data
+        self.user_profile_data = await self.fetch_user_profile()
+
+        writer = GoalTreeWriter(self.db)
+        goal_ref = writer.new_goal_ref(self.user_id)
+        parser = GoalStreamParser()
+        commits = []
+        milestones = []
+        header = None
+        time_to_first_milestone = None
+
+        # Routed, but neither hedged nor retried on another model: milestones already sent could not be taken back
+        messages = goal_plan_messages(validated_smart_goal)
+        model = model_router.choose("stream_milestones_and_tasks", count_message_tokens(messages)).model
+        error = None
+        try:
+            stream_start = time.perf_counter()
+            async with self.client.beta.chat.completions.stream(
+                model=model,
+                messages=messages,
+                response_format=Goal,
+                seed=42,
+                stream_options={"include_usage": True}
+            ) as stream:
+                async for event in stream:
+                    if event.type != "content.delta":
+                        continue
+
+                    completed = parser.feed(event.delta)
+
+                    if header is None and parser.header is not None:
+                        # Validated, and its fields repaired, before the goal is written or announced
+                        header = Goal(**{**parser.header, "guid": goal_ref.id, "milestones": []}).dict()
+                        commits.append(asyncio.ensure_future(writer.commit([writer.goal_write(goal_ref, header)])))
+                        yield {"type": "goal", "goal": header}
 
+                    for milestone_data in completed:
+                        milestone = Milestone(**milestone_data)
+                        issue = milestone_issue(milestone)
+                        if issue is not None:
+                            milestone.tasks, _ = await self._retry_milestone(milestone, issue, validated_smart_goal)
+                        commits.append(asyncio.ensure_future(writer.commit(writer.milestone_writes(goal_ref, milestone, len(milestones)))))
+                        milestones.append(milestone)
+                        if time_to_first_milestone is None:
+                            time_to_first_milestone = time.perf_counter() - start
+                        yield {"type": "milestone", "milestone": milestone.dict()}
+
+                completion = await stream.get_final_completion()
+                usage = completion.usage
+                prompt_usage.record("stream_milestones_and_tasks", usage)
+            if header is None:
+                metrics.increment("llm_refusals_total", endpoint="stream_milestones_and_tasks")
+                raise PlanValidationError(f"Refused: {completion.choices[0].message.refusal}")
+            # The stream spans yields to the caller, so it is timed by hand rather than with `span`
+            model_router.observe("stream_milestones_and_tasks", model, time.perf_counter() - stream_start)
+            record_span("openai.stream_milestones_and_tasks", "openai", time.perf_counter() - stream_start, {
+                "model": model, "milestones": len(milestones),
+                "prompt_tokens": getattr(usage, "prompt_tokens", None), "completion_tokens": getattr(usage, "completion_tokens", None),
+            })
+
+            with span("firestore.stream_commits", "firestore", commits=len(commits)):
+                await asyncio.gather(*commits)
+        except (PlanValidationError, ValidationError) as e:
+            # The response started with the first event, so an HTTP error status can no longer be sent
+            error = e
+        finally:
+            # On a client disconnect or an error, still wait for the batches already sent, so no write is lost unnoticed
+            await self._settle_commits(commits, goal_ref.id)
+
+        if error is not None:
+            logger.warning("Streamed goal plan failed", extra={"guid": goal_ref.id, "user_id": self.user_id, "milestones": len(milestones), "error": str(error)})
+            if header is not None:
+                # Keep the goal with the milestones already sent, consistent with what the client has shown
+                try:
+                    await self._finish_stream(writer, goal_ref, header, milestones)
+                except Exception:
+                    logger.exception("Could not finish the partly streamed goal", extra={"guid": goal_ref.id, "user_id": self.user_id})
+            detail = f"Invalid Goal: {validation_summary(error)}" if isinstance(error, ValidationError) else str(error)
+            yield {"type": "error", "detail": detail, "guid": goal_ref.id if header is not None else None}
+            return
+
+        goal_plan = await self._finish_stream(writer, goal_ref, header, milestones)
+        timings = {
+            "time_to_first_milestone_ms": round(time_to_first_milestone * 1000) if time_to_first_milestone is not None else None,
+            "total_ms": round((time.perf_counter() - start) * 1000),
+        }
+        logger.info("Streamed goal plan", extra={"guid": goal_ref.id, "user_id": self.user_id, **timings})
+
+        yield {"type": "done", "goal": goal_plan.dict(), "metrics": timings}
+
+    async def _finish_stream(self, writer: GoalTreeWriter, goal_ref, header: dict, milestones: List[Milestone]) -> Goal:
+        """
+        Write the goal document's counters and the snapshot of a streamed tree, and index it.
+        """
+        goal_plan = Goal(**{**header, "guid": goal_ref.id, "milestones": milestones})
+        # The goal was written before its tasks were known; add its progress counters with the snapshot
+        counters = progress_counters([task.dict() for milestone in milestones for task in milestone.tasks])
+        goal_plan.progress = progress_percent(counters)
+        await writer.commit(writer.finish_writes(self.user_id, goal_ref, goal_plan.dict()))
+        goal_read_cache.invalidate(self.user_id, goal_ref.id)
+        priority_index.add_goal(self.user_id, goal_plan.dict())
+        schedule_index.add_goal(self.user_id, goal_plan.dict())
         return goal_plan
-    
+
     # Save Goal with Nested Data to Firestore
-    def save_goal_to_firestore(self, goal_plan: Goal, user_id: str):
-        print(f"Saving goal plan for user {user_id}")
-        print(f"Goal details: {goal_plan.name}, Deadline: {goal_plan.deadline}")
-        
-        goal_ref = self.db.collection('users', user_id, 'goals').document()
-        goal_ref.set({
-            'guid': goal_ref.id,
-            'name': goal_plan.name,
-            'description': goal_plan.description,
-            'deadline': goal_plan.deadline,
-            'progress': goal_plan.progress
-        })
-        print(f"Created goal document with ID: {goal_ref.id}")
-
-        for milestone in goal_plan.milestones:
-            print(f"Processing milestone: {milestone.name}")
-            milestone.guid = goal_ref.id
-            milestone_ref = goal_ref.collection('milestones').document()
-            milestone_ref.set({
-                'muid': milestone_ref.id,
-                'name': milestone.name,
-                'description': milestone.description,
-                'deadline': milestone.deadline
-            })
-            print(f"Created milestone document with ID: {milestone_ref.id}")
-
-            for task in milestone.tasks:
-                print(f"Processing task: {task.name}")
-                task.guid = goal_ref.id
-                task.muid = milestone_ref.id
-                task_ref = milestone_ref.collection('tasks').document()
-                task_ref.set(task.dict())
-                
-                print(f"Created task document with ID: {task_ref.id}")
\ No newline at end of file
+    async def save_goal_to_firestore(self, goal_plan: Goal, user_id: str):
+        writer = GoalTreeWriter(self.db)
+        with span("firestore.save_goal", "firestore") as attributes:
+            writes = writer.build_writes(goal_plan, user_id)
+            commits = await writer.commit(writes)
+            attributes.update(documents=len(writes), commits=commits)
+        goal_read_cache.invalidate(user_id, goal_plan.guid)
+        priority_index.add_goal(user_id, goal_plan.dict())
+        schedule_index.add_goal(user_id, goal_plan.dict())
+
+        logger.info("Saved goal plan", extra={"guid": goal_plan.guid, "user_id": user_id, "goal": goal_plan.name, "deadline": goal_plan.deadline, "documents": len(writes), "commits": commits})
+
+    async def save_goals_to_firestore(self, goal_plans: List[Tuple[Goal, str]], extra_writes: Optional[Callable[[int, Goal], list]] = None):
+        """
+        Bulk variant of save_goal_to_firestore for (goal_plan, user_id) pairs.
+
+        Plans share WriteBatches, but a plan is never split across two unless
+        it is larger than a batch. `extra_writes(index, goal_plan)` returns
+        writes committed in the same batch as that plan (its guid is set by
+        then), so bookkeeping about a plan is atomic with it.
+        """
+        writer = GoalTreeWriter(self.db)
+        groups = []
+        with span("firestore.save_goals", "firestore") as attributes:
+            for index, (goal_plan, user_id) in enumerate(goal_plans):
+                writes = writer.build_writes(goal_plan, user_id)
+                groups.append(writes + (extra_writes(index, goal_plan) if extra_writes else []))
+            commits = await writer.commit_groups(groups)
+            attributes.update(goal_plans=len(goal_plans), documents=sum(len(group) for group in groups), commits=commits)
+        for goal_plan, user_id in goal_plans:
+            goal_read_cache.invalidate(user_id, goal_plan.guid)
+            priority_index.add_goal(user_id, goal_plan.dict())
+            schedule_index.add_goal(user_id, goal_plan.dict())
+
+        logger.info("Saved goal plans", extra=attributes)
@@ -0,0 +1,130 @@
+"""
+Factory of the pooled httpx clients used to reach upstream APIs.
+
+Every client gets keep-alive connection pooling, HTTP/2 when the `h2`
+package is installed, and per-endpoint timeouts. LLM endpoints also go
+through the UpstreamLimiter, which caps concurrent calls and backs off
+when the `x-ratelimit-*` headers say the rate limit is nearly spent.
+"""
+import importlib.util
+import os
+from typing import Optional
+import httpx
+from api.tracing import annotate
+from api.upstream import UpstreamLimiter, upstream_limiter
+
+MAX_CONNECTIONS = 100
+MAX_KEEPALIVE_CONNECTIONS = 20
+KEEPALIVE_EXPIRY_SECONDS = 30.0
+DEFAULT_TIMEOUT = httpx.Timeout(60.0, connect=5.0)
+# Matched against the request path after the API base path, e.g. /v1, including sub-resources such as
+# /files/{id}/content; the first match wins
+ENDPOINT_TIMEOUTS = {
+    "/chat/completions": httpx.Timeout(120.0, connect=5.0),
+    "/embeddings": httpx.Timeout(30.0, connect=5.0),
+    "/audio/transcriptions": httpx.Timeout(300.0, connect=5.0),
+    "/files": httpx.Timeout(120.0, connect=5.0),
+}
+# Paths that take a slot of the UpstreamLimiter; batch and file management calls do not
+LIMITED_PATHS = ("/chat/completions", "/embeddings", "/audio/transcriptions")
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+def endpoint_timeout(path: str) -> httpx.Timeout:
+    for endpoint, timeout in ENDPOINT_TIMEOUTS.items():
+        if path.endswith(endpoint) or f"{endpoint}/" in path:
+            return timeout
+    return DEFAULT_TIMEOUT
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    """
+    Response body that frees its limiter slot when closed.
+    """
+
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._release = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                release, self._release = self._release, None
+                release()
+
+
+class LimitedTransport(httpx.AsyncBaseTransport):
+    """
+    Applies the endpoint timeout, and on LLM endpoints the limiter, around an inner transport.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, limiter: UpstreamLimiter):
+        self.transport = transport
+        self.limiter = limiter
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path
+        request.extensions["timeout"] = endpoint_timeout(path).as_dict()
+        if not path.endswith(LIMITED_PATHS):
+            return await self.transport.handle_async_request(request)
+
+        waited = await self.limiter.acquire()
+        annotate(upstream_wait_ms=round(waited * 1000, 1))
+        try:
+            response = await self.transport.handle_async_request(request)
+        except BaseException:
+            self.limiter.release()
+            raise
+        self.limiter.rate_limits.update(response.status_code, response.headers)
+        if response.is_stream_consumed:
+            # Responses built from bytes (e.g. by a MockTransport) are read already and never closed
+            self.limiter.release()
+        else:
+            response.stream = _ReleasingStream(response.stream, self.limiter.release)
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+def pool_stats(transport: httpx.AsyncBaseTransport, max_connections: int, http2: bool) -> dict:
+    # httpx does not expose its httpcore pool publicly
+    pool = getattr(transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    active = sum(not connection.is_idle() for connection in connections)
+    return {
+        "http2": http2,
+        "max_connections": max_connections,
+        "connections": len(connections),
+        "active_connections": active,
+        "idle_connections": len(connections) - active,
+        "utilization": active / max_connections if max_connections else 0.0,
+    }
+
+
+def build_http_client(name: str, limiter: Optional[UpstreamLimiter] = None, transport: Optional[httpx.AsyncBaseTransport] = None,
+                      max_connections: int = MAX_CONNECTIONS, http2: Optional[bool] = None) -> httpx.AsyncClient:
+    """
+    Return a pooled AsyncClient whose pool stats are reported by the limiter under `name`.
+
+    `transport` replaces the network transport, e.g. with an httpx.MockTransport.
+    """
+    limiter = limiter if limiter is not None else upstream_limiter
+    if http2 is None:
+        http2 = os.getenv('HTTP2', 'True') == 'True' and http2_available()
+    if transport is None:
+        transport = httpx.AsyncHTTPTransport(
+            http2=http2,
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS, keepalive_expiry=KEEPALIVE_EXPIRY_SECONDS),
+        )
+    limiter.pools[name] = lambda: pool_stats(transport, max_connections, http2)
+    return httpx.AsyncClient(transport=LimitedTransport(transport, limiter), timeout=DEFAULT_TIMEOUT, follow_redirects=True)
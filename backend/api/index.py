@@ -1,41 +1,132 @@
 import os
-import io
-from dotenv import load_dotenv
+import json
+from contextlib import asynccontextmanager
+from datetime import date
+from typing import List, Literal, Optional
 from pydantic import BaseModel
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, BackgroundTasks, Header, Response
 from fastapi.middleware.cors import CORSMiddleware
-from openai import OpenAI
-import firebase_admin
-from firebase_admin import credentials, firestore
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from api.admission import AdmissionMiddleware, admission_controller, configure_admission
 from api.goal_to_tasks import GoalToTasks, Goal
+from api.plan_validation import PlanValidationError
+from api.structured_output import StructuredOutputError
+from api.goal_reads import GoalReader, goal_read_cache
+from api.model_router import configure_model_router, model_router
+from api.persistence import configure_goal_storage
+from api.progress import ProgressTracker, reconcile_progress_job
+from api.prioritization import configure_priorities, priority_index
+from api.scheduling import Availability, replan_schedules_job, schedule_index
 from api.profiling import ProfileDefinition, RawProfile
+from api.profile_cache import profile_cache
+from api.response_cache import response_cache, DiskCacheBackend
+from api.transcription import UnsupportedAudioError, transcribe_audio
+from api.bulk_planning import BulkPlanningItem, BulkPlanningWorker, JOB_DONE_STATUSES
+from api.jobs import JobFailed, job_queue, SQLiteJobBackend
+from api.prompt_builder import prompt_usage
+from api.upstream import upstream_limiter
+from api.tracing import TracingMiddleware, configure_logging, configure_tracing, metrics
+from api.dependencies import (
+                     close_clients,
+                     embedding_service,
+                     firestore_db,
+                     get_db,
+                     get_embeddings,
+                     get_openai_client,
+                     load_environment,
+                     openai_client,
+                     )
 
-# Load environment variables from .env file
-load_dotenv()
+def configure_caches():
+    """
+    Apply cache settings from the environment.
+    """
+    response_cache.enabled = os.getenv('RESPONSE_CACHE', 'True') == 'True'
+
+    if os.getenv('RESPONSE_CACHE_PATH'):
+        # Persist cached LLM responses on disk instead of in memory
+        response_cache.backend = DiskCacheBackend(os.getenv('RESPONSE_CACHE_PATH'))
+
+    if os.getenv('RESPONSE_CACHE_SEMANTIC', 'False') == 'True':
+        async def embed(text):
+            return await embedding_service().embed(text)
+
+        response_cache.embed = embed
 
-# Initialize the OpenAI client
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+async def generate_plan_job(payload: dict, progress):
+    """
+    Background job for /jobs/generate_milestones_and_tasks.
 
-app = FastAPI()
+    Monolithic plans are streamed so progress is reported per milestone.
+    Refusals and invalid plans are not retried, nor is a stream that failed
+    after its goal was written: another attempt would save a second goal.
+    """
+    goal_to_tasks = GoalToTasks(firestore_db(), openai_client(), payload["user_id"])
+    guid = None
+    try:
+        if payload["planning_mode"] == "fan_out":
+            progress("Planning milestones and tasks")
+            goal_plan = await goal_to_tasks.generate_milestones_and_tasks(payload["validated_goal"], "fan_out")
+            return goal_plan.dict()
 
-GCP_DEPLOYMENT = os.getenv('GCP_DEPLOYMENT', 'True') == 'True'
+        progress("Planning goal")
+        async for event in goal_to_tasks.stream_milestones_and_tasks(payload["validated_goal"]):
+            if event["type"] == "goal":
+                guid = event["goal"]["guid"]
+                progress(f"Planning milestones for {event['goal']['name']}")
+            elif event["type"] == "milestone":
+                progress(f"Planned milestone {event['milestone']['name']}")
+            elif event["type"] == "done":
+                return event["goal"]
+            elif event["type"] == "error":
+                kept = f"; goal {event['guid']} was kept with the milestones planned" if event["guid"] else ""
+                raise JobFailed(event["detail"] + kept)
+    except JobFailed:
+        raise
+    except PlanValidationError as e:
+        raise JobFailed(str(e)) from e
+    except Exception as e:
+        if guid is None:
+            raise
+        raise JobFailed(f"Goal {guid} was partly saved") from e
 
-def initialize_firestore():
+def configure_jobs():
     """
-    Initialize Firestore based on the platform.
+    Apply job queue settings from the environment and register the job handlers.
     """
-    if GCP_DEPLOYMENT:
-        # Initialize Firestore for GCP
-        firebase_admin.initialize_app()
-    else:
-        # Initialize Firestore for other platforms
-        cred = credentials.Certificate("api/cred.json")
-        firebase_admin.initialize_app(cred)
-    
-    return firestore.client()
+    if os.getenv('JOB_QUEUE_PATH'):
+        # Keep jobs in SQLite so unfinished ones resume after a restart
+        job_queue.backend = SQLiteJobBackend(os.getenv('JOB_QUEUE_PATH'))
+    if os.getenv('JOB_CONCURRENCY'):
+        job_queue.concurrency = int(os.getenv('JOB_CONCURRENCY'))
+
+job_queue.register("generate_milestones_and_tasks", generate_plan_job)
+job_queue.register("reconcile_progress", reconcile_progress_job)
+job_queue.register("replan_schedules", replan_schedules_job)
 
-db = initialize_firestore()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    load_environment()
+    configure_logging()
+    configure_tracing()
+    configure_caches()
+    configure_goal_storage()
+    configure_jobs()
+    configure_priorities()
+    configure_model_router()
+    configure_admission()
+    # Imported here: the vector stores import numpy, which most requests do not need
+    from api.rag import configure_vector_store
+    configure_vector_store()
+    job_queue.start()
+    yield
+    await job_queue.stop()
+    await close_clients()
 
+app = FastAPI(lifespan=lifespan)
+
+# Inside CORS, so browsers can read its 429s
+app.add_middleware(AdmissionMiddleware)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Adjust this to the origins you want to allow
@@ -43,6 +134,13 @@ app.add_middleware(
     allow_methods=["*"],  # Allow all HTTP methods
     allow_headers=["*"],  # Allow all headers
 )
+# Outermost, so request timings include the other middleware
+app.add_middleware(TracingMiddleware)
+
+@app.exception_handler(StructuredOutputError)
+async def structured_output_error(request, exc: StructuredOutputError):
+    # The upstream model gave no usable plan or profile
+    return JSONResponse({"detail": str(exc)}, status_code=502)
 
 class ProfileFormData(BaseModel):
     user_id: str
@@ -61,6 +159,12 @@ class PreGoalFormData(BaseModel):
 class ValidatedGoalFormData(BaseModel):
     user_id: str
     validated_goal: str
+    planning_mode: Literal["monolithic", "fan_out"] = "monolithic"
+
+class BulkPlanningFormData(BaseModel):
+    items: List[ValidatedGoalFormData]
+    # Client-chosen id that makes retried submissions return the same job
+    job_id: Optional[str] = None
 
 class MilestoneFormInfo(BaseModel):
     user_id: str
@@ -68,11 +172,59 @@ class MilestoneFormInfo(BaseModel):
     muid: str
 
 @app.get('/')
-def root():
+async def root():
     return {"message": "Hello World"}
 
+@app.get('/stats/profile_cache')
+async def profile_cache_stats():
+    return profile_cache.stats()
+
+@app.get('/stats/response_cache')
+async def response_cache_stats():
+    return response_cache.stats()
+
+@app.get('/metrics')
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+@app.get('/stats/goal_reads')
+async def goal_read_cache_stats():
+    return goal_read_cache.stats()
+
+@app.get('/stats/priorities')
+async def priority_index_stats():
+    return priority_index.stats()
+
+@app.get('/stats/schedules')
+async def schedule_index_stats():
+    return schedule_index.stats()
+
+@app.get('/stats/upstream')
+async def upstream_stats():
+    return upstream_limiter.stats()
+
+@app.get('/stats/models')
+async def model_router_stats():
+    return model_router.stats()
+
+@app.get('/stats/admission')
+async def admission_stats():
+    return admission_controller.stats()
+
+@app.get('/stats/prompt_usage')
+async def prompt_usage_stats():
+    return prompt_usage.stats()
+
+@app.get('/stats/jobs')
+async def job_stats():
+    return job_queue.stats()
+
+@app.get('/stats/embeddings')
+async def embedding_stats(embeddings=Depends(get_embeddings)):
+    return embeddings.stats()
+
 @app.post('/transcribe_voice')
-def transcribe_voice(voice_memo: UploadFile = File(...)):
+async def transcribe_voice(voice_memo: UploadFile = File(...), client=Depends(get_openai_client)):
     """
     Endpoint to transcribe a voice memo for a given user.
 
@@ -85,40 +237,200 @@ def transcribe_voice(voice_memo: UploadFile = File(...)):
 
     prompt = ""
     try:
-        # Open the audio file
-        audio_file = voice_memo.file.read()
-        buffer = io.BytesIO(audio_file)
-
-        buffer.name = voice_memo.filename
-        # Transcribe the audio file using OpenAI's Whisper model
-        transcription = client.audio.transcriptions.create(
-            model="whisper-1", 
-            file=buffer,
-            response_format="text"
-        )
+        # Transcribe the spooled upload with OpenAI's Whisper model, in chunks if it is too long
+        transcription = await transcribe_audio(client, voice_memo.file, voice_memo.filename)
         
         # Return the transcription text
         return {"transcription": transcription}
-    
+
+    except UnsupportedAudioError as e:
+        raise HTTPException(status_code=422, detail=str(e))
     except Exception as e:
         # Handle exceptions and return an error message
         return {"error": str(e)}
 
 @app.post('/profile_definition')
-def profile_definition(profile_form_data: ProfileFormData):
+async def profile_definition(profile_form_data: ProfileFormData, client=Depends(get_openai_client), db=Depends(get_db)):
     profile = ProfileDefinition(client, db, profile_form_data.user_id)
-    refined_profile = profile.profile_definition(profile_form_data.profile_data)
-    profile.save_profile(refined_profile)
+    refined_profile = await profile.profile_definition(profile_form_data.profile_data)
+    await profile.save_profile(refined_profile)
     return refined_profile
 
 @app.post('/smart_goal')
-def smart_goal(pre_goal_form_data: PreGoalFormData):
+async def smart_goal(pre_goal_form_data: PreGoalFormData, client=Depends(get_openai_client), db=Depends(get_db)):
     goal_to_tasks = GoalToTasks(db, client, pre_goal_form_data.user_id)
-    goal = goal_to_tasks.smart_goal(pre_goal_form_data.pre_goal_data)
+    goal = await goal_to_tasks.smart_goal(pre_goal_form_data.pre_goal_data)
     return goal
 
 @app.post('/generate_milestones_and_tasks')
-def generate_milestones_and_tasks(validated_goal_form_data: ValidatedGoalFormData):
+async def generate_milestones_and_tasks(validated_goal_form_data: ValidatedGoalFormData, client=Depends(get_openai_client), db=Depends(get_db)):
     goal_to_tasks = GoalToTasks(db, client, validated_goal_form_data.user_id)
-    milestones_and_tasks = goal_to_tasks.generate_milestones_and_tasks(validated_goal_form_data.validated_goal)
-    return milestones_and_tasks
\ No newline at end of file
+    milestones_and_tasks = await goal_to_tasks.generate_milestones_and_tasks(validated_goal_form_data.validated_goal, validated_goal_form_data.planning_mode)
+    return milestones_and_tasks
+
+@app.post('/generate_milestones_and_tasks/stream')
+async def stream_milestones_and_tasks(validated_goal_form_data: ValidatedGoalFormData, client=Depends(get_openai_client), db=Depends(get_db)):
+    """
+    Stream the plan as newline-delimited JSON events: `goal`, one `milestone` per milestone, then `done`.
+
+    A plan that fails once the response has started ends with an `error`
+    event instead of `done`; its `guid` names the goal kept with the
+    milestones already sent, if any were.
+    """
+    goal_to_tasks = GoalToTasks(db, client, validated_goal_form_data.user_id)
+    events = goal_to_tasks.stream_milestones_and_tasks(validated_goal_form_data.validated_goal)
+    return StreamingResponse((json.dumps(event) + "\n" async for event in events), media_type="application/x-ndjson")
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/").strip('"') for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+def conditional_response(content: dict, etag: str, if_none_match: Optional[str]):
+    # JSONResponse directly skips FastAPI's jsonable_encoder pass over large trees
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "private, no-cache"}
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content, headers=headers)
+
+@app.get('/users/{user_id}/goals')
+async def list_goals(user_id: str, if_none_match: Optional[str] = Header(None), db=Depends(get_db)):
+    """
+    Every goal tree of the user, for the dashboard. Send the returned ETag as If-None-Match to get a 304 when nothing changed.
+    """
+    dashboard = await GoalReader(db).list_goals(user_id)
+    return conditional_response({"goals": dashboard["goals"]}, dashboard["etag"], if_none_match)
+
+@app.get('/users/{user_id}/goals/{guid}')
+async def get_goal(user_id: str, guid: str, if_none_match: Optional[str] = Header(None), db=Depends(get_db)):
+    snapshot = await GoalReader(db).get_goal(user_id, guid)
+    if snapshot is None:
+        raise HTTPException(status_code=404, detail=f"No goal {guid}")
+    return conditional_response(snapshot["goal"], snapshot["etag"], if_none_match)
+
+class TaskCompletion(BaseModel):
+    completed: bool
+
+@app.post('/users/{user_id}/goals/{guid}/milestones/{muid}/tasks/{tuid}/completion')
+async def set_task_completion(user_id: str, guid: str, muid: str, tuid: str, task_completion: TaskCompletion, db=Depends(get_db)):
+    """
+    Complete (or reopen) a task. Returns the progress of its milestone and goal.
+    """
+    progress = await ProgressTracker(db).set_task_completed(user_id, guid, muid, tuid, task_completion.completed)
+    if progress is None:
+        raise HTTPException(status_code=404, detail=f"No task {tuid}")
+    return progress
+
+@app.get('/users/{user_id}/goals/{guid}/progress')
+async def goal_progress(user_id: str, guid: str, db=Depends(get_db)):
+    progress = await ProgressTracker(db).goal_progress(user_id, guid)
+    if progress is None:
+        raise HTTPException(status_code=404, detail=f"No goal {guid}")
+    return progress
+
+@app.post('/users/{user_id}/goals/{guid}/reconcile')
+async def reconcile_goal(user_id: str, guid: str, db=Depends(get_db)):
+    """
+    Bring a goal's progress counters and snapshot up to date after its documents were written directly, as the web client does. Returns its progress.
+    """
+    progress = await ProgressTracker(db).reconcile_goal(user_id, guid)
+    if progress is None:
+        raise HTTPException(status_code=404, detail=f"No goal {guid}")
+    return progress
+
+@app.delete('/users/{user_id}/goals/{guid}', status_code=204)
+async def delete_goal(user_id: str, guid: str, db=Depends(get_db)):
+    """
+    Delete a goal with its milestones, tasks and snapshot.
+    """
+    if not await ProgressTracker(db).delete_goal(user_id, guid):
+        raise HTTPException(status_code=404, detail=f"No goal {guid}")
+    return Response(status_code=204)
+
+@app.get('/users/{user_id}/tasks/next')
+async def next_tasks(user_id: str, k: int = 10, db=Depends(get_db)):
+    """
+    The user's k best open tasks across all goals, by Eisenhower-weighted score.
+    """
+    return {"tasks": await priority_index.top_tasks(db, user_id, k)}
+
+class ScheduleFormData(BaseModel):
+    availability: Availability = Availability()
+    start: Optional[date] = None
+
+class ReplanFormData(BaseModel):
+    user_ids: List[str]
+    availability: Availability = Availability()
+
+@app.post('/users/{user_id}/schedule')
+async def schedule(user_id: str, schedule_form_data: ScheduleFormData, db=Depends(get_db)):
+    """
+    Pack the user's open tasks into dated slots, earliest deadline first. `feasible` is false when some task ends after its deadline.
+    """
+    user_schedule = await schedule_index.schedule(db, user_id, schedule_form_data.availability, schedule_form_data.start)
+    return user_schedule.plan()
+
+@app.post('/jobs/replan_schedules', status_code=202)
+async def enqueue_replan_schedules(replan_form_data: ReplanFormData):
+    """
+    Rebuild the schedules of many users in the background. Poll /jobs/{job_id} for a summary per user.
+    """
+    return await job_queue.submit("replan_schedules", replan_form_data.dict())
+
+@app.post('/users/{user_id}/progress/reconcile', status_code=202)
+async def reconcile_progress(user_id: str):
+    """
+    Recompute the progress counters of every goal of the user in the background. Poll /jobs/{job_id} for the result.
+    """
+    return await job_queue.submit("reconcile_progress", {"user_id": user_id})
+
+@app.post('/bulk/generate_milestones_and_tasks')
+async def bulk_generate_milestones_and_tasks(bulk_planning_form_data: BulkPlanningFormData, background_tasks: BackgroundTasks, client=Depends(get_openai_client), db=Depends(get_db)):
+    """
+    Plan many goals at once through the OpenAI Batch API.
+
+    Returns the job as soon as its batch is submitted; poll /bulk/jobs/{job_id}
+    for progress. Plans are saved to Firestore when the batch completes. All
+    items use the monolithic planning prompt.
+    """
+    worker = BulkPlanningWorker(db, client)
+    items = [BulkPlanningItem(user_id=item.user_id, validated_goal=item.validated_goal) for item in bulk_planning_form_data.items]
+    job = await worker.create_job(items, bulk_planning_form_data.job_id)
+    if job["status"] not in JOB_DONE_STATUSES:
+        background_tasks.add_task(worker.run, job["job_id"])
+    return job
+
+@app.get('/bulk/jobs/{job_id}')
+async def bulk_job_status(job_id: str, include_items: bool = False, client=Depends(get_openai_client), db=Depends(get_db)):
+    job = await BulkPlanningWorker(db, client).job_status(job_id, include_items)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No bulk planning job {job_id}")
+    return job
+
+@app.post('/jobs/generate_milestones_and_tasks', status_code=202)
+async def enqueue_milestones_and_tasks(validated_goal_form_data: ValidatedGoalFormData):
+    """
+    Queue plan generation and return the job at once, instead of holding the connection for the whole call.
+
+    Poll /jobs/{job_id} or follow /jobs/{job_id}/events for progress and the
+    resulting plan. Identical submissions in flight share one job.
+    """
+    return await job_queue.submit("generate_milestones_and_tasks", validated_goal_form_data.dict())
+
+@app.get('/jobs/{job_id}')
+async def job_status(job_id: str):
+    job = job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}")
+    return job
+
+@app.get('/jobs/{job_id}/events')
+async def job_events(job_id: str):
+    """
+    Push job updates as server-sent events until the job succeeds or fails.
+    """
+    if job_queue.get(job_id) is None:
+        raise HTTPException(status_code=404, detail=f"No job {job_id}")
+    events = job_queue.events(job_id)
+    return StreamingResponse((f"data: {json.dumps(job)}\n\n" async for job in events), media_type="text/event-stream")
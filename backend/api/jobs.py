@@ -0,0 +1,387 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+JOB_CONCURRENCY = 4
+JOB_MAX_ATTEMPTS = 3
+# Retry n waits about JOB_BACKOFF_SECONDS * 2**(n - 1), capped at JOB_BACKOFF_MAX_SECONDS
+JOB_BACKOFF_SECONDS = 1.0
+JOB_BACKOFF_MAX_SECONDS = 30.0
+# Finished jobs, results included, are kept this long for polling, and at most this many of them
+JOB_RETENTION_SECONDS = 24 * 60 * 60
+MAX_FINISHED_JOBS = 10_000
+# A process holds the jobs it queued or runs for this long, and renews its hold every third of it
+JOB_LEASE_SECONDS = 60.0
+# Listeners re-read a job this often, to see updates made by another process
+JOB_EVENTS_POLL_SECONDS = 1.0
+
+ACTIVE_STATUSES = ("queued", "running")
+DONE_STATUSES = ("succeeded", "failed")
+
+
+class JobFailed(Exception):
+    """
+    Raised by a handler to fail its job at once, for errors that another attempt would not fix or must not repeat.
+
+    The job's error reports the exception it was raised from, if any.
+    """
+
+
+def dedup_key(kind: str, payload: dict) -> str:
+    return hashlib.sha256(json.dumps([kind, payload], sort_keys=True).encode()).hexdigest()
+
+
+class MemoryJobBackend:
+    """
+    In-process job store; jobs are lost on restart.
+
+    Finished jobs are dropped after `retention` seconds, oldest first once
+    there are more than `max_finished`. Leases (see SQLiteJobBackend) only
+    matter when a queue is stopped and started again in the same process.
+    """
+
+    def __init__(self, retention: float = JOB_RETENTION_SECONDS, max_finished: int = MAX_FINISHED_JOBS):
+        self.retention = retention
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._active = {}
+        # Finished job ids and when they finished, oldest first
+        self._finished = OrderedDict()
+        # job_id: (owner, lease expiry)
+        self._leases = {}
+        self._lock = threading.Lock()
+
+    def save(self, job: dict, owner: Optional[str] = None, lease: float = JOB_LEASE_SECONDS):
+        with self._lock:
+            self._jobs[job["job_id"]] = dict(job)
+            if owner is not None:
+                self._leases[job["job_id"]] = (owner, time.time() + lease)
+            if job["status"] in ACTIVE_STATUSES:
+                self._active[job["dedup_key"]] = job["job_id"]
+            elif self._active.get(job["dedup_key"]) == job["job_id"]:
+                del self._active[job["dedup_key"]]
+            self._finished.pop(job["job_id"], None)
+            if job["status"] in DONE_STATUSES:
+                self._finished[job["job_id"]] = time.time()
+            self._evict()
+
+    def _evict(self):
+        expired = time.time() - self.retention
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if finished_at > expired and len(self._finished) <= self.max_finished:
+                return
+            del self._finished[job_id]
+            self._jobs.pop(job_id, None)
+            self._leases.pop(job_id, None)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def find_active(self, key: str) -> Optional[dict]:
+        with self._lock:
+            job_id = self._active.get(key)
+        return self.get(job_id) if job_id else None
+
+    def claim(self, owner: str, lease: float = JOB_LEASE_SECONDS) -> List[dict]:
+        """
+        Take over the unfinished jobs no live owner holds and return them.
+        """
+        now = time.time()
+        with self._lock:
+            jobs = [dict(job) for job_id, job in self._jobs.items()
+                    if job["status"] in ACTIVE_STATUSES and self._leases.get(job_id, (None, 0.0))[1] <= now]
+            for job in jobs:
+                self._leases[job["job_id"]] = (owner, now + lease)
+            return jobs
+
+    def renew(self, owner: str, lease: float = JOB_LEASE_SECONDS):
+        expires = time.time() + lease
+        with self._lock:
+            for job_id, (holder, _) in self._leases.items():
+                if holder == owner:
+                    self._leases[job_id] = (owner, expires)
+
+    def release(self, owner: str):
+        with self._lock:
+            for job_id, (holder, _) in list(self._leases.items()):
+                if holder == owner:
+                    del self._leases[job_id]
+
+    def __len__(self):
+        return len(self._jobs)
+
+
+class SQLiteJobBackend:
+    """
+    SQLite job store that survives restarts, so unfinished jobs are picked up again.
+
+    Finished jobs are deleted like in MemoryJobBackend. Several processes
+    can share the file: each holds a lease on the jobs it queued or runs and
+    renews it while alive, and only jobs whose lease ran out, e.g. those of a
+    process that died, are claimed by another. A process whose event loop is
+    blocked for longer than the lease can have its jobs run a second time.
+    """
+
+    def __init__(self, path: str, retention: float = JOB_RETENTION_SECONDS, max_finished: int = MAX_FINISHED_JOBS):
+        self.retention = retention
+        self.max_finished = max_finished
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, dedup_key TEXT NOT NULL, status TEXT NOT NULL, data TEXT NOT NULL, updated_at REAL NOT NULL,"
+            " owner TEXT, lease_until REAL NOT NULL DEFAULT 0)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedup_key ON jobs (dedup_key, status)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def save(self, job: dict, owner: Optional[str] = None, lease: float = JOB_LEASE_SECONDS):
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO jobs (job_id, dedup_key, status, data, updated_at) VALUES (?, ?, ?, ?, ?)"
+                    " ON CONFLICT (job_id) DO UPDATE SET dedup_key = excluded.dedup_key, status = excluded.status, data = excluded.data, updated_at = excluded.updated_at",
+                    (job["job_id"], job["dedup_key"], job["status"], json.dumps(job), job["updated_at"]),
+                )
+                if owner is not None:
+                    self._conn.execute("UPDATE jobs SET owner = ?, lease_until = ? WHERE job_id = ?", (owner, time.time() + lease, job["job_id"]))
+                if job["status"] in DONE_STATUSES:
+                    self._conn.execute("DELETE FROM jobs WHERE status IN ('succeeded', 'failed') AND updated_at <= ?", (time.time() - self.retention,))
+                    self._conn.execute(
+                        "DELETE FROM jobs WHERE job_id IN (SELECT job_id FROM jobs WHERE status IN ('succeeded', 'failed') ORDER BY updated_at DESC LIMIT -1 OFFSET ?)",
+                        (self.max_finished,),
+                    )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def find_active(self, key: str) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM jobs WHERE dedup_key = ? AND status IN ('queued', 'running') ORDER BY updated_at DESC LIMIT 1", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim(self, owner: str, lease: float = JOB_LEASE_SECONDS) -> List[dict]:
+        """
+        Take over the unfinished jobs whose lease ran out and return them, in one transaction so no two processes claim the same job.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                rows = self._conn.execute(
+                    "SELECT job_id, data FROM jobs WHERE status IN ('queued', 'running') AND lease_until <= ? ORDER BY updated_at", (now,)
+                ).fetchall()
+                self._conn.executemany("UPDATE jobs SET owner = ?, lease_until = ? WHERE job_id = ?", [(owner, now + lease, row[0]) for row in rows])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [json.loads(row[1]) for row in rows]
+
+    def renew(self, owner: str, lease: float = JOB_LEASE_SECONDS):
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET lease_until = ? WHERE owner = ? AND status IN ('queued', 'running')", (time.time() + lease, owner)
+            )
+
+    def release(self, owner: str):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET lease_until = 0 WHERE owner = ? AND status IN ('queued', 'running')", (owner,))
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+
+class JobQueue:
+    """
+    Runs registered handlers as background jobs on a pool of asyncio workers.
+
+    `submit` returns at once with the job record; identical submissions
+    (same kind and payload) share the job while it is queued or running. A
+    handler is `async handler(payload, progress) -> result`, where
+    `progress(message, fraction=None)` publishes progress and `result` must
+    be JSON-serializable. Failed attempts are retried with exponential
+    backoff and jitter up to `max_attempts`, unless the handler raised
+    JobFailed. Job state goes through the backend, and `events` pushes every
+    update of a job to listeners. The queue leases the jobs it holds from the
+    backend, so processes sharing one (SQLiteJobBackend) run each job once.
+    """
+
+    def __init__(self, backend=None, concurrency: int = JOB_CONCURRENCY, max_attempts: int = JOB_MAX_ATTEMPTS, backoff: float = JOB_BACKOFF_SECONDS, backoff_max: float = JOB_BACKOFF_MAX_SECONDS):
+        self.backend = backend if backend is not None else MemoryJobBackend()
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self._handlers: Dict[str, Callable[..., Awaitable]] = {}
+        self._queue = None
+        self._workers = []
+        self._owner = None
+        self._lease_keeper = None
+        self._listeners: Dict[str, List[asyncio.Queue]] = {}
+        self._stats = {"submitted": 0, "deduplicated": 0, "succeeded": 0, "failed": 0, "retries": 0}
+
+    def register(self, kind: str, handler: Callable[..., Awaitable]):
+        self._handlers[kind] = handler
+
+    def start(self):
+        """
+        Start the workers on the running loop and requeue jobs left unfinished by a previous process.
+        """
+        if self._workers:
+            return
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._queue = asyncio.Queue()
+        self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.concurrency)]
+        self._claim()
+        self._lease_keeper = asyncio.ensure_future(self._keep_leases())
+
+    async def stop(self):
+        for task in [*self._workers, self._lease_keeper]:
+            task.cancel()
+        await asyncio.gather(*self._workers, self._lease_keeper, return_exceptions=True)
+        # Jobs left queued can be claimed by the next start, or another process, at once
+        self.backend.release(self._owner)
+        self._workers = []
+        self._lease_keeper = None
+        self._queue = None
+
+    def _claim(self):
+        for job in self.backend.claim(self._owner):
+            self._save({**job, "status": "queued"})
+            self._queue.put_nowait(job["job_id"])
+
+    async def _keep_leases(self):
+        while True:
+            await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+            self.backend.renew(self._owner)
+            # Jobs of a process that died
+            self._claim()
+
+    async def submit(self, kind: str, payload: dict) -> dict:
+        if kind not in self._handlers:
+            raise ValueError(f"No handler registered for job kind {kind}")
+        self.start()
+        key = dedup_key(kind, payload)
+        existing = self.backend.find_active(key)
+        if existing is not None:
+            self._stats["deduplicated"] += 1
+            return existing
+
+        now = time.time()
+        job = {
+            "job_id": uuid.uuid4().hex, "kind": kind, "payload": payload, "dedup_key": key, "status": "queued",
+            "attempts": 0, "progress": None, "message": None, "result": None, "error": None,
+            "created_at": now, "updated_at": now,
+        }
+        self._save(job)
+        self._stats["submitted"] += 1
+        self._queue.put_nowait(job["job_id"])
+        return job
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.backend.get(job_id)
+
+    async def events(self, job_id: str):
+        """
+        Yield the job, then every update to it, until it succeeds or fails.
+        """
+        listener = asyncio.Queue()
+        self._listeners.setdefault(job_id, []).append(listener)
+        try:
+            job = self.get(job_id)
+            while job is not None:
+                yield job
+                if job["status"] in DONE_STATUSES:
+                    return
+                last = job
+                while job is last:
+                    try:
+                        job = await asyncio.wait_for(listener.get(), JOB_EVENTS_POLL_SECONDS)
+                    except asyncio.TimeoutError:
+                        # The job may be run by another process sharing the backend
+                        polled = self.get(job_id)
+                        if polled is None or polled["updated_at"] != last["updated_at"]:
+                            job = polled
+        finally:
+            self._listeners[job_id].remove(listener)
+            if not self._listeners[job_id]:
+                del self._listeners[job_id]
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "queued": self._queue.qsize() if self._queue else 0,
+            "workers": len(self._workers),
+            "jobs": len(self.backend),
+        }
+
+    def _save(self, job: dict) -> dict:
+        job["updated_at"] = time.time()
+        self.backend.save(job, owner=self._owner)
+        for listener in self._listeners.get(job["job_id"], []):
+            listener.put_nowait(dict(job))
+        return job
+
+    async def _work(self):
+        while True:
+            job = self.get(await self._queue.get())
+            if job is not None and job["status"] == "queued":
+                await self._run(job)
+
+    async def _run(self, job: dict):
+        job = self._save({**job, "status": "running", "attempts": job["attempts"] + 1, "error": None})
+
+        def progress(message: str, fraction: Optional[float] = None):
+            job.update(message=message, progress=fraction)
+            self._save(job)
+
+        try:
+            result = await self._handlers[job["kind"]](job["payload"], progress)
+        except asyncio.CancelledError:
+            # Shutting down: leave the job queued for the next start
+            self._save({**job, "status": "queued"})
+            raise
+        except Exception as e:
+            final = isinstance(e, JobFailed)
+            cause = e.__cause__ if final and e.__cause__ is not None else e
+            error = f"{type(cause).__name__}: {cause}" + (f" ({e})" if cause is not e and str(e) != str(cause) else "")
+            if not final and job["attempts"] < self.max_attempts:
+                self._stats["retries"] += 1
+                delay = min(self.backoff_max, self.backoff * 2 ** (job["attempts"] - 1)) * random.uniform(0.5, 1.0)
+                self._save({**job, "status": "queued", "error": error, "message": f"Retrying in {delay:.1f}s"})
+                asyncio.get_running_loop().call_later(delay, self._requeue, job["job_id"])
+            else:
+                self._stats["failed"] += 1
+                self._save({**job, "status": "failed", "error": error})
+            return
+
+        self._stats["succeeded"] += 1
+        self._save({**job, "status": "succeeded", "progress": 1.0, "message": "Done", "result": result})
+
+    def _requeue(self, job_id: str):
+        if self._queue is not None:
+            self._queue.put_nowait(job_id)
+
+
+job_queue = JobQueue()
@@ -0,0 +1,248 @@
+"""
+Per-request model choice, hedged requests and fallback for LLM calls.
+
+Each endpoint has a Route: its models in order of preference, a latency
+budget, an optional cost budget per call and a timeout. `choose` takes the
+first model whose context window fits the prompt, whose estimated cost
+(prompt tokens plus the route's expected output) fits the cost budget and
+whose recent p95 latency on that endpoint fits the latency budget. If none
+is fast enough, the fastest one is taken. The next fitting model of the
+route becomes the fallback.
+
+`call` runs the request on the chosen model. If it has not answered by the
+model's recent p95 on the endpoint, an identical request is fired and the
+first answer wins; at most `hedge_ratio` of calls are hedged, so a slow
+upstream is not sent twice the load. A timeout, a connection error or a
+5xx moves on to the fallback model; other errors (refusals, 4xx) are raised.
+
+Latencies are kept per endpoint and model in a window of recent calls,
+which is what the decisions use, and observed into the `llm_call_seconds`
+histogram served at /metrics.
+"""
+import asyncio
+import json
+import math
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, NamedTuple, Optional
+from pydantic import BaseModel
+from api.tracing import logger, metrics
+
+PLANNING_MODEL = 'gpt-4o-2024-08-06'
+SMART_GOAL_MODEL = 'gpt-4o-mini'
+# Share of calls that may send a hedged duplicate
+HEDGE_RATIO = 0.1
+# Calls on a model and endpoint before its p95 is trusted for routing and hedging
+MIN_LATENCY_SAMPLES = 10
+LATENCY_WINDOW = 200
+
+
+class ModelProfile(BaseModel):
+    # USD per million tokens
+    input_cost: float
+    output_cost: float
+    context_tokens: int = 128_000
+
+    def cost(self, input_tokens: int, output_tokens: int) -> float:
+        return (input_tokens * self.input_cost + output_tokens * self.output_cost) / 1_000_000
+
+
+class Route(BaseModel):
+    models: List[str]
+    latency_budget: float
+    timeout: float
+    expected_output_tokens: int
+    max_cost: Optional[float] = None
+
+
+MODELS: Dict[str, ModelProfile] = {
+    'gpt-4o-2024-08-06': ModelProfile(input_cost=2.5, output_cost=10.0),
+    'gpt-4o-mini': ModelProfile(input_cost=0.15, output_cost=0.6),
+}
+
+ROUTES: Dict[str, Route] = {
+    'smart_goal': Route(models=[SMART_GOAL_MODEL, PLANNING_MODEL], latency_budget=5.0, timeout=30.0, expected_output_tokens=100),
+    'generate_milestones_and_tasks': Route(models=[PLANNING_MODEL, SMART_GOAL_MODEL], latency_budget=60.0, timeout=120.0, expected_output_tokens=3000),
+    'stream_milestones_and_tasks': Route(models=[PLANNING_MODEL, SMART_GOAL_MODEL], latency_budget=60.0, timeout=120.0, expected_output_tokens=3000),
+    'goal_to_milestones': Route(models=[PLANNING_MODEL, SMART_GOAL_MODEL], latency_budget=20.0, timeout=60.0, expected_output_tokens=500),
+    'milestone_to_tasks': Route(models=[PLANNING_MODEL, SMART_GOAL_MODEL], latency_budget=20.0, timeout=60.0, expected_output_tokens=600),
+    'profile_definition': Route(models=[PLANNING_MODEL, SMART_GOAL_MODEL], latency_budget=20.0, timeout=60.0, expected_output_tokens=300),
+}
+
+
+class ModelChoice(NamedTuple):
+    endpoint: str
+    model: str
+    fallback: Optional[str]
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """
+    Whether another model may succeed: timeouts, connection errors and 5xx responses.
+    """
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    status_code = getattr(error, 'status_code', None)
+    if status_code is not None:
+        return status_code >= 500
+    import openai
+    return isinstance(error, openai.APIConnectionError)
+
+
+class LatencyWindow:
+    """
+    Latencies of the most recent calls, for percentiles that follow current upstream conditions.
+    """
+
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self._samples = deque(maxlen=size)
+
+    def observe(self, seconds: float):
+        self._samples.append(seconds)
+
+    def __len__(self):
+        return len(self._samples)
+
+    def quantile(self, q: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, math.ceil(q * len(ordered)) - 1)]
+
+
+class ModelRouter:
+
+    def __init__(self, routes: Optional[Dict[str, Route]] = None, models: Optional[Dict[str, ModelProfile]] = None, hedge_ratio: float = HEDGE_RATIO):
+        self.routes = dict(routes if routes is not None else ROUTES)
+        self.models = dict(models if models is not None else MODELS)
+        self.hedge_ratio = hedge_ratio
+        self._latencies: Dict[tuple, LatencyWindow] = {}
+        self._stats = {"calls": 0, "hedges": 0, "hedge_wins": 0, "fallbacks": 0, "timeouts": 0}
+
+    def latencies(self, endpoint: str, model: str) -> LatencyWindow:
+        return self._latencies.setdefault((endpoint, model), LatencyWindow())
+
+    def p95(self, endpoint: str, model: str) -> Optional[float]:
+        window = self.latencies(endpoint, model)
+        return window.quantile(0.95) if len(window) >= MIN_LATENCY_SAMPLES else None
+
+    def observe(self, endpoint: str, model: str, seconds: float):
+        self.latencies(endpoint, model).observe(seconds)
+        metrics.observe("llm_call_seconds", seconds, endpoint=endpoint, model=model)
+
+    def choose(self, endpoint: str, input_tokens: int) -> ModelChoice:
+        route = self.routes[endpoint]
+        fitting = [model for model in route.models if input_tokens <= self.models[model].context_tokens]
+        if not fitting:
+            raise ValueError(f"A {input_tokens}-token prompt fits no model of {endpoint}")
+        affordable = [
+            model for model in fitting
+            if route.max_cost is None or self.models[model].cost(input_tokens, route.expected_output_tokens) <= route.max_cost
+        ]
+        if not affordable:
+            affordable = [min(fitting, key=lambda model: self.models[model].cost(input_tokens, route.expected_output_tokens))]
+        fast = [model for model in affordable if (self.p95(endpoint, model) or 0.0) <= route.latency_budget]
+        model = fast[0] if fast else min(affordable, key=lambda model: self.p95(endpoint, model))
+        fallback = next((other for other in affordable + fitting if other != model), None)
+        return ModelChoice(endpoint, model, fallback)
+
+    async def call(self, choice: ModelChoice, invoke: Callable[[str], Awaitable]):
+        """
+        Await `invoke(model)` for the chosen model, hedged, then for the fallback model if it failed upstream.
+
+        Returns the model that answered and its result.
+        """
+        self._stats["calls"] += 1
+        models = [choice.model] + ([choice.fallback] if choice.fallback else [])
+        for index, model in enumerate(models):
+            try:
+                return model, await self._hedged(choice.endpoint, model, invoke)
+            except Exception as e:
+                if index == len(models) - 1 or not is_upstream_failure(e):
+                    raise
+                self._stats["fallbacks"] += 1
+                metrics.increment("llm_fallbacks_total", endpoint=choice.endpoint, model=model)
+                logger.warning("Falling back to another model", extra={"endpoint": choice.endpoint, "model": model, "fallback": models[index + 1], "error": type(e).__name__})
+
+    async def _attempt(self, endpoint: str, model: str, invoke: Callable[[str], Awaitable]):
+        start = time.perf_counter()
+        result = await invoke(model)
+        self.observe(endpoint, model, time.perf_counter() - start)
+        return result
+
+    def _may_hedge(self) -> bool:
+        return self._stats["hedges"] < self.hedge_ratio * self._stats["calls"] + 1
+
+    async def _hedged(self, endpoint: str, model: str, invoke: Callable[[str], Awaitable]):
+        timeout = self.routes[endpoint].timeout
+        hedge_after = self.p95(endpoint, model)
+        deadline = time.monotonic() + timeout
+        attempts = [asyncio.ensure_future(self._attempt(endpoint, model, invoke))]
+        hedge = None
+        error = None
+        try:
+            if hedge_after is not None and hedge_after < timeout and self.hedge_ratio > 0:
+                done, _ = await asyncio.wait(attempts, timeout=hedge_after)
+                if not done and self._may_hedge():
+                    self._stats["hedges"] += 1
+                    metrics.increment("llm_hedges_total", endpoint=endpoint, model=model)
+                    hedge = asyncio.ensure_future(self._attempt(endpoint, model, invoke))
+                    attempts.append(hedge)
+            while attempts:
+                done, _ = await asyncio.wait(attempts, timeout=max(0.0, deadline - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    self._stats["timeouts"] += 1
+                    # Count the timeout as a latency, so routing steers away from a model that stopped answering
+                    self.observe(endpoint, model, timeout)
+                    raise asyncio.TimeoutError(f"{model} gave no answer for {endpoint} within {timeout} s")
+                for attempt in done:
+                    attempts.remove(attempt)
+                    if attempt.exception() is None:
+                        if attempt is hedge:
+                            self._stats["hedge_wins"] += 1
+                        return attempt.result()
+                    error = attempt.exception()
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def clear(self):
+        self._latencies = {}
+        self._stats = {name: 0 for name in self._stats}
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "latencies": {
+                f"{endpoint}/{model}": {"samples": len(window), "p50_ms": _ms(window.quantile(0.5)), "p95_ms": _ms(window.quantile(0.95))}
+                for (endpoint, model), window in self._latencies.items()
+            },
+        }
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+model_router = ModelRouter()
+
+
+def configure_model_router():
+    """
+    Apply routing settings from the environment.
+
+    MODEL_ROUTES is a JSON object of per-endpoint Route fields, e.g.
+    {"smart_goal": {"latency_budget": 3, "max_cost": 0.001}}, merged over the
+    defaults. MODEL_HEDGE_RATIO=0 turns hedging off.
+    """
+    if os.getenv('MODEL_ROUTES'):
+        for endpoint, fields in json.loads(os.getenv('MODEL_ROUTES')).items():
+            route = model_router.routes.get(endpoint)
+            model_router.routes[endpoint] = Route(**{**(route.model_dump() if route is not None else {}), **fields})
+            unknown = set(model_router.routes[endpoint].models) - set(model_router.models)
+            if unknown:
+                raise ValueError(f"MODEL_ROUTES uses unknown models {sorted(unknown)} for {endpoint}")
+    if os.getenv('MODEL_HEDGE_RATIO'):
+        model_router.hedge_ratio = float(os.getenv('MODEL_HEDGE_RATIO'))
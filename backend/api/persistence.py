@@ -0,0 +1,340 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import List, Optional, Tuple
+from api.tracing import span
+
+# Firestore rejects a WriteBatch with more than 500 writes
+MAX_BATCH_WRITES = 500
+# Upper bound on batch commits in flight at once for very large trees
+MAX_CONCURRENT_COMMITS = 8
+# Denormalized copy of each goal tree, read back by api.goal_reads
+SNAPSHOTS_COLLECTION = 'goalSnapshots'
+
+# Goal, milestone and task documents, plus a snapshot of the tree
+DOCUMENTS_LAYOUT = 'documents'
+# The whole tree in the goal document, see compact_goal
+COMPACT_LAYOUT = 'compact'
+LAYOUTS = (DOCUMENTS_LAYOUT, COMPACT_LAYOUT)
+# Firestore documents are limited to 1 MiB; larger trees are kept in the documents layout
+MAX_COMPACT_BYTES = 900_000
+GOAL_FIELDS = ('guid', 'name', 'description', 'deadline')
+MILESTONE_FIELDS = ('name', 'description', 'deadline')
+TASK_FIELDS = ('name', 'description', 'duration_hours', 'simplicity', 'importance', 'urgency', 'completed')
+
+
+class GoalStorage:
+    """
+    Layout new goal trees are written in. Goals in either layout are read, completed and reconciled alike.
+    """
+
+    def __init__(self, layout: str = DOCUMENTS_LAYOUT):
+        self.layout = layout
+
+
+goal_storage = GoalStorage()
+
+
+def configure_goal_storage():
+    """
+    Apply GOAL_STORAGE_LAYOUT, `documents` (default) or `compact`.
+    """
+    layout = os.getenv('GOAL_STORAGE_LAYOUT', DOCUMENTS_LAYOUT)
+    if layout not in LAYOUTS:
+        raise ValueError(f"GOAL_STORAGE_LAYOUT must be one of {', '.join(LAYOUTS)}, not {layout!r}")
+    goal_storage.layout = layout
+
+
+def progress_counters(tasks: List[dict]) -> dict:
+    """
+    Duration-weighted progress counters of a milestone or goal, kept up to date by api.progress.
+    """
+    return {
+        'total_hours': sum(task['duration_hours'] for task in tasks),
+        'completed_hours': sum(task['duration_hours'] for task in tasks if task.get('completed')),
+        'total_tasks': len(tasks),
+        'completed_tasks': sum(bool(task.get('completed')) for task in tasks),
+    }
+
+
+def progress_percent(counters: dict) -> int:
+    if not counters.get('total_hours'):
+        return 0
+    return round(100 * counters.get('completed_hours', 0) / counters['total_hours'])
+
+
+def goal_snapshot(goal: dict) -> dict:
+    """
+    Snapshot document of a goal tree, with an ETag derived from its content.
+    """
+    etag = hashlib.sha256(json.dumps(goal, sort_keys=True, default=str).encode()).hexdigest()[:20]
+    return {'guid': goal['guid'], 'etag': etag, 'updated_at': time.time(), 'goal': goal}
+
+
+def is_compact(doc: Optional[dict]) -> bool:
+    return doc is not None and doc.get('layout') == COMPACT_LAYOUT
+
+
+def compact_milestone(milestone: dict, position: int) -> dict:
+    return {
+        'position': position,
+        **{field: milestone.get(field) for field in MILESTONE_FIELDS},
+        **progress_counters(milestone['tasks']),
+        'tasks': {
+            task['tuid']: {'position': index, **{field: task.get(field) for field in TASK_FIELDS}}
+            for index, task in enumerate(milestone['tasks'])
+        },
+    }
+
+
+def compact_goal(goal: dict, version: int = 0) -> dict:
+    """
+    Goal document holding the whole tree.
+
+    Milestones and tasks are maps keyed by muid and tuid, so one task can be
+    updated by field path, and tasks no longer repeat their guid and muid.
+    `etag` covers the tree as written and `version` counts the changes since.
+    """
+    counters = progress_counters([task for milestone in goal['milestones'] for task in milestone['tasks']])
+    return {
+        'layout': COMPACT_LAYOUT,
+        **{field: goal.get(field) for field in GOAL_FIELDS},
+        'progress': progress_percent(counters),
+        **counters,
+        'etag': goal_snapshot(goal)['etag'],
+        'version': version,
+        'updated_at': time.time(),
+        'milestones': {milestone['muid']: compact_milestone(milestone, index) for index, milestone in enumerate(goal['milestones'])},
+    }
+
+
+def expand_goal(doc: dict) -> dict:
+    """
+    Snapshot (`guid`, `etag`, `updated_at` and the `goal` tree) of a compact goal document.
+    """
+    guid = doc['guid']
+    milestones = []
+    for muid, milestone in sorted(doc.get('milestones', {}).items(), key=lambda item: item[1].get('position', 0)):
+        tasks = sorted(milestone.get('tasks', {}).items(), key=lambda item: item[1].get('position', 0))
+        milestones.append({
+            'muid': muid,
+            **{field: milestone.get(field) for field in MILESTONE_FIELDS},
+            'tasks': [{**{field: task.get(field) for field in TASK_FIELDS}, 'guid': guid, 'muid': muid, 'tuid': tuid} for tuid, task in tasks],
+            'guid': guid,
+        })
+    goal = {
+        **{field: doc.get(field) for field in GOAL_FIELDS},
+        'progress': progress_percent(doc),
+        'milestones': milestones,
+    }
+    return {'guid': guid, 'etag': f"{doc.get('etag', '')}.{doc.get('version', 0)}", 'updated_at': doc.get('updated_at'), 'goal': goal}
+
+
+def document_size(path: Tuple[str, ...], data) -> int:
+    """
+    Stored size of a document, following Firestore's storage size calculation.
+    """
+    def value_size(value) -> int:
+        if isinstance(value, str):
+            return len(value.encode()) + 1
+        if isinstance(value, dict):
+            return sum(len(key.encode()) + 1 + value_size(item) for key, item in value.items())
+        if isinstance(value, (list, tuple)):
+            return sum(value_size(item) for item in value)
+        if isinstance(value, bool) or value is None:
+            return 1
+        return 8
+
+    return sum(len(segment.encode()) + 1 for segment in path) + 16 + value_size(data) + 32
+
+
+def stage(batch, writes: List[tuple]):
+    """
+    Add writes to a WriteBatch or Transaction: `(reference, data)` sets a
+    document, `(reference, data, True)` merges into it and `(reference, None)`
+    deletes it.
+    """
+    for ref, data, *merge in writes:
+        if data is None:
+            batch.delete(ref)
+        else:
+            batch.set(ref, data, merge=bool(merge and merge[0]))
+
+
+class GoalTreeWriter:
+    """
+    Persists a goal/milestone/task tree in as few round trips as possible.
+
+    Document IDs are allocated client side, so the whole tree can be built
+    up front and committed as chunked WriteBatches (atomic per batch). When
+    the tree needs several batches they are committed concurrently. In the
+    documents layout a denormalized snapshot of the tree is written alongside
+    it; in the compact layout the tree is a single goal document.
+    """
+
+    def __init__(self, db, max_batch_writes: int = MAX_BATCH_WRITES, max_concurrent_commits: int = MAX_CONCURRENT_COMMITS, layout: Optional[str] = None):
+        self.db = db
+        self.max_batch_writes = max_batch_writes
+        self.max_concurrent_commits = max_concurrent_commits
+        self.layout = layout or goal_storage.layout
+
+    def build_writes(self, goal_plan, user_id: str) -> List[tuple]:
+        """
+        Allocate document IDs for the whole tree and return the (reference, data) writes.
+
+        The plan is updated in place with the allocated guid/muid/tuid values.
+        """
+        goal_ref = self.new_goal_ref(user_id)
+        goal_plan.guid = goal_ref.id
+        for milestone in goal_plan.milestones:
+            milestone_ref = goal_ref.collection('milestones').document()
+            milestone.guid = goal_ref.id
+            milestone.muid = milestone_ref.id
+            for task in milestone.tasks:
+                task.guid = goal_ref.id
+                task.muid = milestone_ref.id
+                task.tuid = milestone_ref.collection('tasks').document().id
+        counters = progress_counters([task.dict() for milestone in goal_plan.milestones for task in milestone.tasks])
+        # Progress follows from the tasks, whatever the plan said
+        goal_plan.progress = progress_percent(counters)
+        return self.tree_writes(user_id, goal_plan.dict())
+
+    def tree_writes(self, user_id: str, goal: dict, layout: Optional[str] = None) -> List[tuple]:
+        """
+        Writes storing a goal tree whose ids are allocated, in the writer's layout or `layout`.
+
+        In the documents layout the goal document comes last, after its milestones, tasks and snapshot.
+        """
+        goal_ref = self.db.collection('users', user_id, 'goals').document(goal['guid'])
+        if (layout or self.layout) == COMPACT_LAYOUT:
+            document = compact_goal(goal)
+            if document_size(('users', user_id, 'goals', goal['guid']), document) <= MAX_COMPACT_BYTES:
+                return [(goal_ref, document)]
+
+        writes = []
+        for milestone in goal['milestones']:
+            milestone_ref = goal_ref.collection('milestones').document(milestone['muid'])
+            writes.append((milestone_ref, self.milestone_document(milestone)))
+            writes.extend((milestone_ref.collection('tasks').document(task['tuid']), task) for task in milestone['tasks'])
+        writes.append(self.snapshot_write(user_id, goal))
+        counters = progress_counters([task for milestone in goal['milestones'] for task in milestone['tasks']])
+        # Also when a compact tree was too large: its goal document must not claim to hold the tree
+        writes.append(self.goal_write(goal_ref, goal, counters, layout=DOCUMENTS_LAYOUT))
+        return writes
+
+    def new_goal_ref(self, user_id: str):
+        return self.db.collection('users', user_id, 'goals').document()
+
+    def snapshot_ref(self, user_id: str, guid: str):
+        return self.db.collection('users', user_id, SNAPSHOTS_COLLECTION).document(guid)
+
+    def snapshot_write(self, user_id: str, goal: dict) -> Tuple[object, dict]:
+        return (self.snapshot_ref(user_id, goal['guid']), goal_snapshot(goal))
+
+    def goal_write(self, goal_ref, goal: dict, counters: Optional[dict] = None, layout: Optional[str] = None) -> tuple:
+        """
+        Write of the goal document's own fields, in the writer's layout or `layout`.
+        """
+        data = {
+            'guid': goal_ref.id,
+            'name': goal.get('name'),
+            'description': goal.get('description'),
+            'deadline': goal.get('deadline'),
+            'progress': goal.get('progress'),
+            **(counters or {})
+        }
+        if (layout or self.layout) == COMPACT_LAYOUT:
+            # The goal document is the tree; milestones are merged into it as they arrive
+            return (goal_ref, {**data, 'layout': COMPACT_LAYOUT}, True)
+        return (goal_ref, data)
+
+    def delete_writes(self, user_id: str, guid: str, milestones: List[dict]) -> List[tuple]:
+        """
+        Writes deleting a goal: the documents of its `milestones` and their tasks, then its snapshot and goal document.
+        """
+        goal_ref = self.db.collection('users', user_id, 'goals').document(guid)
+        writes = []
+        for milestone in milestones:
+            milestone_ref = goal_ref.collection('milestones').document(milestone['muid'])
+            writes.extend((milestone_ref.collection('tasks').document(task['tuid']), None) for task in milestone['tasks'])
+            writes.append((milestone_ref, None))
+        return writes + [(self.snapshot_ref(user_id, guid), None), (goal_ref, None)]
+
+    def milestone_document(self, milestone: dict) -> dict:
+        return {
+            'muid': milestone['muid'],
+            'name': milestone.get('name'),
+            'description': milestone.get('description'),
+            'deadline': milestone.get('deadline'),
+            **progress_counters(milestone['tasks'])
+        }
+
+    def milestone_writes(self, goal_ref, milestone, position: int = 0) -> List[tuple]:
+        """
+        Allocate the ids of a milestone and its tasks and return their writes, for trees written milestone by milestone.
+        """
+        milestone_ref = goal_ref.collection('milestones').document()
+        milestone.guid = goal_ref.id
+        milestone.muid = milestone_ref.id
+        for task in milestone.tasks:
+            task.guid = goal_ref.id
+            task.muid = milestone_ref.id
+            task.tuid = milestone_ref.collection('tasks').document().id
+
+        if self.layout == COMPACT_LAYOUT:
+            return [(goal_ref, {'milestones': {milestone.muid: compact_milestone(milestone.dict(), position)}}, True)]
+        return [(milestone_ref, self.milestone_document(milestone.dict()))] + [
+            (milestone_ref.collection('tasks').document(task.tuid), task.dict()) for task in milestone.tasks
+        ]
+
+    def finish_writes(self, user_id: str, goal_ref, goal: dict) -> List[tuple]:
+        """
+        Writes completing a tree whose milestones were written one by one with milestone_writes.
+        """
+        if self.layout == COMPACT_LAYOUT:
+            return [(goal_ref, compact_goal(goal))]
+        counters = progress_counters([task for milestone in goal['milestones'] for task in milestone['tasks']])
+        return [
+            self.goal_write(goal_ref, {key: value for key, value in goal.items() if key != 'milestones'}, counters, layout=DOCUMENTS_LAYOUT),
+            self.snapshot_write(user_id, goal),
+        ]
+
+    async def commit(self, writes: List[tuple]) -> int:
+        """
+        Commit the writes and return the number of commit round trips used.
+        """
+        chunks = [writes[start:start + self.max_batch_writes] for start in range(0, len(writes), self.max_batch_writes)]
+        return await self._commit_chunks(chunks)
+
+    async def commit_groups(self, groups: List[List[tuple]]) -> int:
+        """
+        Commit several independent groups of writes, packing whole groups into batches.
+
+        A group only spans batches when it alone exceeds the batch size, so
+        each smaller group is committed atomically.
+        """
+        chunks = []
+        for group in groups:
+            if chunks and len(chunks[-1]) + len(group) <= self.max_batch_writes:
+                chunks[-1].extend(group)
+            else:
+                chunks.extend(list(group[start:start + self.max_batch_writes]) for start in range(0, len(group), self.max_batch_writes))
+        return await self._commit_chunks(chunks)
+
+    async def _commit_chunks(self, chunks: List[List[tuple]]) -> int:
+        semaphore = asyncio.Semaphore(self.max_concurrent_commits)
+
+        async def commit_chunk(chunk):
+            batch = self.db.batch()
+            stage(batch, chunk)
+            async with semaphore:
+                with span("firestore.commit", "firestore", writes=len(chunk)):
+                    await batch.commit()
+
+        await asyncio.gather(*(commit_chunk(chunk) for chunk in chunks))
+        return len(chunks)
+
+    async def save_goal(self, goal_plan, user_id: str) -> int:
+        return await self.commit(self.build_writes(goal_plan, user_id))
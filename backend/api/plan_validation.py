@@ -0,0 +1,153 @@
+"""
+Validation and local repair of the plans returned by the model.
+
+The field types below are used by the Task/Milestone/Goal models. Each one
+declares its constraint in the JSON schema sent to the model, and repairs
+out-of-range values before Pydantic checks them: scores are clamped to
+1-5, durations to 1-MAX_TASK_HOURS, and dates are normalized to
+YYYY-MM-DD. A plan therefore never fails validation over a value that can
+be fixed in place, and every repair is counted in `plan_repairs_total`.
+A milestone deadline that is not a date is dropped; a goal deadline that is
+not one fails validation, since the whole plan is scheduled against it.
+
+What cannot be repaired in place (a milestone without tasks) is reported
+by `plan_issues`, so that GoalToTasks re-requests only those milestones.
+"""
+import calendar
+import math
+import re
+from datetime import date, datetime
+from typing import Annotated, Dict, Optional
+from pydantic import BeforeValidator, Field
+from api.structured_output import StructuredOutputError
+from api.tracing import metrics
+
+MIN_SCORE = 1
+MAX_SCORE = 5
+MAX_TASK_HOURS = 200
+# Re-requests of a failing milestone before the plan is rejected
+MAX_MILESTONE_RETRIES = 2
+
+DATE_FORMATS = ("%Y-%m-%d", "%Y/%m/%d", "%Y.%m.%d", "%B %d, %Y", "%b %d, %Y", "%d %B %Y", "%d %b %Y", "%B %d %Y")
+_YEAR_MONTH = re.compile(r"^(\d{4})-(\d{1,2})$")
+
+
+class PlanValidationError(StructuredOutputError):
+    """
+    The model refused, or returned a plan that could not be repaired.
+    """
+
+
+def _repaired(field: str):
+    metrics.increment("plan_repairs_total", field=field)
+
+
+def _number(value, field: str):
+    if isinstance(value, str):
+        try:
+            value = float(value.strip())
+        except ValueError:
+            return value
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return value
+        if not value.is_integer():
+            _repaired(field)
+            value = math.ceil(value) if field == "duration_hours" else round(value)
+        value = int(value)
+    return value
+
+
+def _clamp(field: str, low: int, high: int):
+    def clamp(value):
+        value = _number(value, field)
+        if isinstance(value, int) and not isinstance(value, bool) and not low <= value <= high:
+            _repaired(field)
+            value = min(max(value, low), high)
+        return value
+    return clamp
+
+
+def parse_deadline(value) -> Optional[date]:
+    """
+    The date in a deadline as written by the model: ISO dates or datetimes, year-month, or spelled-out months.
+    """
+    if isinstance(value, date):
+        return value
+    if not isinstance(value, str) or not value.strip():
+        return None
+    text = value.strip()
+    try:
+        return date.fromisoformat(text[:10])
+    except ValueError:
+        pass
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    match = _YEAR_MONTH.match(text)
+    if match and 1 <= int(match.group(2)) <= 12:
+        # A month means by the end of it
+        year, month = int(match.group(1)), int(match.group(2))
+        return date(year, month, calendar.monthrange(year, month)[1])
+    return None
+
+
+def _normalize_date(field: str, required: bool):
+    def normalize(value):
+        parsed = parse_deadline(value)
+        if parsed is None:
+            if value is None:
+                # A missing goal deadline fails validation as before
+                return value
+            if required:
+                raise ValueError(f"{value!r} is not a date")
+            _repaired(field)
+            return None
+        if parsed.isoformat() != value:
+            _repaired(field)
+        return parsed.isoformat()
+    return normalize
+
+
+Score = Annotated[int, BeforeValidator(_clamp("score", MIN_SCORE, MAX_SCORE)), Field(ge=MIN_SCORE, le=MAX_SCORE)]
+TaskHours = Annotated[int, BeforeValidator(_clamp("duration_hours", 1, MAX_TASK_HOURS)), Field(ge=1, le=MAX_TASK_HOURS)]
+Percent = Annotated[int, BeforeValidator(_clamp("progress", 0, 100)), Field(ge=0, le=100)]
+Deadline = Annotated[str, BeforeValidator(_normalize_date("goal_deadline", required=True))]
+OptionalDeadline = Annotated[Optional[str], BeforeValidator(_normalize_date("milestone_deadline", required=False))]
+
+
+def clamp_milestone_deadlines(goal):
+    """
+    Bring milestone deadlines after the goal's deadline back to it.
+    """
+    goal_deadline = parse_deadline(goal.deadline)
+    if goal_deadline is None:
+        return goal
+    for milestone in goal.milestones:
+        if milestone.deadline is not None and milestone.deadline > goal_deadline.isoformat():
+            _repaired("milestone_deadline")
+            milestone.deadline = goal_deadline.isoformat()
+    return goal
+
+
+def milestone_issue(milestone) -> Optional[str]:
+    """
+    Why a milestone cannot be used as is, if it cannot.
+    """
+    if not milestone.tasks:
+        return "it has no tasks"
+    if not milestone.name.strip():
+        return "it has no name"
+    if any(not task.name.strip() for task in milestone.tasks):
+        return "some of its tasks have no name"
+    return None
+
+
+def plan_issues(goal) -> Dict[int, str]:
+    """
+    Index and reason of every milestone of the plan that must be re-requested.
+    """
+    issues = {index: milestone_issue(milestone) for index, milestone in enumerate(goal.milestones)}
+    return {index: issue for index, issue in issues.items() if issue is not None}
@@ -0,0 +1,250 @@
+"""
+"What should I do next": ranking a user's open tasks across all their goals.
+
+Tasks are scored from their importance, urgency, simplicity and duration
+(see PriorityScorer) and kept per user in a TaskRanking, a heap that is
+updated in place when a task is completed, reopened or added, so a top-k
+query pops k entries instead of sorting every task. Rankings are built
+lazily from the goal snapshots (one query) and cached per user.
+
+Scoring functions only use arithmetic on their arguments, so the same
+function scores one task or NumPy arrays of millions of them at once
+(`score_batch`), e.g. to rescore every cached ranking when the weights
+change.
+"""
+import heapq
+import itertools
+import json
+import os
+from typing import Callable, Dict, List, Optional
+from cachetools import TTLCache
+from api.tracing import span
+
+PRIORITY_INDEX_MAXSIZE = 10_000
+# Bounds staleness across instances; changes made through this process update the rankings at once
+PRIORITY_INDEX_TTL_SECONDS = 5 * 60
+# Scores on the 1-5 scales from which a task counts as important / urgent
+IMPORTANT_FROM = 4
+URGENT_FROM = 4
+QUADRANTS = {(True, True): "do", (True, False): "schedule", (False, True): "delegate", (False, False): "eliminate"}
+SCORE_FIELDS = ('importance', 'urgency', 'simplicity', 'duration_hours')
+
+
+def quadrant(task: dict) -> str:
+    return QUADRANTS[(task['importance'] >= IMPORTANT_FROM, task['urgency'] >= URGENT_FROM)]
+
+
+class PriorityScorer:
+    """
+    Weighted Eisenhower score: important and urgent tasks first, quick easy wins before long ones.
+
+    Called with the score fields of one task, or with NumPy arrays of them.
+    """
+
+    def __init__(self, importance: float = 2.0, urgency: float = 1.5, simplicity: float = 0.5,
+                 duration: float = 0.25, do_first_bonus: float = 3.0):
+        self.importance = importance
+        self.urgency = urgency
+        self.simplicity = simplicity
+        self.duration = duration
+        self.do_first_bonus = do_first_bonus
+
+    def __call__(self, importance, urgency, simplicity, duration_hours):
+        # `&` and `*` on the comparisons work for scalars and arrays alike
+        do_first = (importance >= IMPORTANT_FROM) & (urgency >= URGENT_FROM)
+        return (self.importance * importance + self.urgency * urgency + self.simplicity * simplicity
+                - self.duration * duration_hours + self.do_first_bonus * do_first)
+
+
+Scorer = Callable[..., float]
+
+
+def score_batch(columns: Dict[str, object], scorer: Scorer):
+    """
+    Scores of many tasks at once, from arrays (or lists) of each score field.
+    """
+    import numpy as np
+
+    return np.asarray(scorer(**{field: np.asarray(columns[field], dtype=np.float32) for field in SCORE_FIELDS}), dtype=np.float32)
+
+
+def top_k_batch(scores, k: int):
+    """
+    Indices of the k highest scores, best first, without sorting all of them.
+    """
+    import numpy as np
+
+    k = min(k, len(scores))
+    if k == 0:
+        return np.empty(0, dtype=np.int64)
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top], kind="stable")]
+
+
+def task_key(task: dict) -> str:
+    return task.get('tuid') or f"{task['muid']}/{task['name']}"
+
+
+class TaskRanking:
+    """
+    Open tasks of one user, best first.
+
+    A heap with lazy deletion: changing or removing a task leaves its old
+    entry in the heap, stale once it is no longer the task's current entry,
+    and stale entries are dropped as they surface or when they outnumber the
+    live ones. Entries are tuples, which the garbage collector untracks, so
+    large rankings do not slow collections down.
+    """
+
+    def __init__(self, scorer: Scorer):
+        self.scorer = scorer
+        self.tasks: Dict[str, dict] = {}
+        self._entries: Dict[str, list] = {}
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def add_goal(self, goal: dict):
+        for milestone in goal.get('milestones', []):
+            for task in milestone.get('tasks', []):
+                self.upsert({**task, 'goal_name': goal.get('name'), 'milestone_name': milestone.get('name'), 'milestone_deadline': milestone.get('deadline')})
+
+    def upsert(self, task: dict):
+        key = task_key(task)
+        self.tasks[key] = task
+        self._discard(key)
+        if task.get('completed'):
+            return
+        score = float(self.scorer(**{field: task[field] for field in SCORE_FIELDS}))
+        entry = (-score, next(self._counter), key)
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+
+    def set_completed(self, key: str, completed: bool) -> bool:
+        """
+        Move a known task in or out of the ranking. Returns False if the task is unknown.
+        """
+        task = self.tasks.get(key)
+        if task is None:
+            return False
+        if bool(task.get('completed')) != completed:
+            self.upsert({**task, 'completed': completed})
+        return True
+
+    def remove(self, key: str):
+        self.tasks.pop(key, None)
+        self._discard(key)
+
+    def top(self, k: int) -> List[dict]:
+        """
+        The k best open tasks, with their score and quadrant, in O(k log n).
+        """
+        entries = []
+        while self._heap and len(entries) < k:
+            entry = heapq.heappop(self._heap)
+            if self._entries.get(entry[2]) is entry:
+                entries.append(entry)
+        for entry in entries:
+            heapq.heappush(self._heap, entry)
+        return [{**self.tasks[key], 'score': round(-neg_score, 3), 'quadrant': quadrant(self.tasks[key])} for neg_score, _, key in entries]
+
+    def open_keys(self) -> List[str]:
+        return [key for key, task in self.tasks.items() if not task.get('completed')]
+
+    def rebuild(self, keys: List[str], scores: List[float]):
+        """
+        Rebuild the heap from precomputed scores of the open tasks `keys`.
+        """
+        self._heap = [(-score, next(self._counter), key) for key, score in zip(keys, scores)]
+        self._entries = {entry[2]: entry for entry in self._heap}
+        heapq.heapify(self._heap)
+
+    def _discard(self, key: str):
+        if self._entries.pop(key, None) is not None and len(self._heap) > 2 * len(self._entries) + 64:
+            self._heap = [entry for entry in self._heap if self._entries.get(entry[2]) is entry]
+            heapq.heapify(self._heap)
+
+
+class PriorityIndex:
+    """
+    Process-wide TTL cache of the task rankings of users.
+    """
+
+    def __init__(self, scorer: Optional[Scorer] = None, maxsize: int = PRIORITY_INDEX_MAXSIZE, ttl: float = PRIORITY_INDEX_TTL_SECONDS):
+        self.scorer = scorer if scorer is not None else PriorityScorer()
+        self._rankings = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def top_tasks(self, db, user_id: str, k: int = 10) -> List[dict]:
+        ranking = self._rankings.get(user_id)
+        if ranking is None:
+            self.misses += 1
+            ranking = await self._load(db, user_id)
+        else:
+            self.hits += 1
+        with span("priority.top_tasks", tasks=len(ranking)):
+            return ranking.top(k)
+
+    async def _load(self, db, user_id: str) -> TaskRanking:
+        from api.goal_reads import GoalReader
+
+        dashboard = await GoalReader(db).list_goals(user_id)
+        ranking = TaskRanking(self.scorer)
+        for goal in dashboard['goals']:
+            ranking.add_goal(goal)
+        self._rankings[user_id] = ranking
+        return ranking
+
+    def add_goal(self, user_id: str, goal: dict):
+        """
+        Add the tasks of a newly saved goal to the user's ranking, if it is cached.
+        """
+        ranking = self._rankings.get(user_id)
+        if ranking is not None:
+            ranking.add_goal(goal)
+
+    def set_completed(self, user_id: str, tuid: str, completed: bool):
+        ranking = self._rankings.get(user_id)
+        if ranking is not None and not ranking.set_completed(tuid, completed):
+            # A task this instance has not seen yet: reload on the next query
+            self.invalidate(user_id)
+
+    def invalidate(self, user_id: str):
+        self._rankings.pop(user_id, None)
+
+    def clear(self):
+        self._rankings.clear()
+
+    def rescore(self, scorer: Optional[Scorer] = None):
+        """
+        Switch to another scorer and rescore every cached ranking in one vectorized pass.
+        """
+        if scorer is not None:
+            self.scorer = scorer
+        rankings = list(self._rankings.values())
+        keys = [ranking.open_keys() for ranking in rankings]
+        open_tasks = [ranking.tasks[key] for ranking, ranking_keys in zip(rankings, keys) for key in ranking_keys]
+        scores = score_batch({field: [task[field] for task in open_tasks] for field in SCORE_FIELDS}, self.scorer).tolist()
+        start = 0
+        for ranking, ranking_keys in zip(rankings, keys):
+            ranking.scorer = self.scorer
+            ranking.rebuild(ranking_keys, scores[start:start + len(ranking_keys)])
+            start += len(ranking_keys)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "users": len(self._rankings),
+                "tasks": sum(len(ranking) for ranking in self._rankings.values())}
+
+
+priority_index = PriorityIndex()
+
+
+def configure_priorities():
+    """
+    Apply PRIORITY_WEIGHTS, a JSON object of PriorityScorer weights, e.g. {"importance": 3, "duration": 0}.
+    """
+    if os.getenv('PRIORITY_WEIGHTS'):
+        priority_index.rescore(PriorityScorer(**json.loads(os.getenv('PRIORITY_WEIGHTS'))))
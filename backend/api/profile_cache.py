@@ -0,0 +1,86 @@
+import asyncio
+import threading
+from cachetools import TTLCache
+
+PROFILE_CACHE_MAXSIZE = 10_000
+PROFILE_CACHE_TTL_SECONDS = 15 * 60
+
+
+class ProfileCache:
+    """
+    Process-wide TTL/LRU cache of user profiles.
+
+    Profiles only change when /profile_definition runs, which invalidates the
+    entry explicitly; the TTL bounds staleness across Cloud Run instances.
+    There is no snapshot listener: one on every profile would stream every
+    user's changes to each instance, and one per cached user would hold up
+    to `maxsize` watches open. Concurrent misses for the same user share a
+    single Firestore read.
+    """
+
+    def __init__(self, maxsize: int = PROFILE_CACHE_MAXSIZE, ttl: float = PROFILE_CACHE_TTL_SECONDS):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._loading = {}
+        self.hits = 0
+        self.misses = 0
+        # Firestore reads actually issued; lower than misses when concurrent misses coalesce
+        self.loads = 0
+
+    async def get(self, user_id: str, loader) -> dict:
+        """
+        Return the cached profile, or await `loader()` to fetch and cache it.
+        """
+        with self._lock:
+            profile = self._cache.get(user_id)
+        if profile is not None:
+            self.hits += 1
+            return profile
+
+        self.misses += 1
+        loading = self._loading.get(user_id)
+        if loading is None:
+            loading = asyncio.ensure_future(self._load(user_id, loader))
+            self._loading[user_id] = loading
+        return await asyncio.shield(loading)
+
+    async def _load(self, user_id: str, loader) -> dict:
+        loading = asyncio.current_task()
+        self.loads += 1
+        try:
+            profile = await loader()
+            # Skip caching if the entry was invalidated while the read was in flight
+            if self._loading.get(user_id) is loading:
+                self.set(user_id, profile)
+            return profile
+        finally:
+            if self._loading.get(user_id) is loading:
+                del self._loading[user_id]
+
+    def set(self, user_id: str, profile: dict):
+        with self._lock:
+            self._cache[user_id] = profile
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._cache.pop(user_id, None)
+        self._loading.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "loads": self.loads,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "size": len(self._cache),
+            "maxsize": self._cache.maxsize,
+            "ttl": self._cache.ttl,
+        }
+
+
+profile_cache = ProfileCache()
@@ -1,6 +1,8 @@
-import openai
 from pydantic import BaseModel
-from api.prompts import NEW_PROFILE_SYS_MSG, NEW_PROFILE_USR_MSG
+from api.prompt_builder import profile_messages
+from api.profile_cache import profile_cache
+from api.structured_output import parse_structured
+from api.tracing import span
 
 class RawProfile(BaseModel):
     openness: str
@@ -23,25 +25,17 @@ class ProfileDefinition:
         self.db = db
         self.user_id = user_id
 
-    def profile_definition(self, profile_form_data: RawProfile):
-        
-        completion = self.client.beta.chat.completions.parse(
-            model='gpt-4o-2024-08-06',
-            messages=[
-                {"role": "system", "content": NEW_PROFILE_SYS_MSG},
-                {"role": "user", "content": NEW_PROFILE_USR_MSG.replace("$PROFILE", str(profile_form_data))}
-                       ],
-            response_format=RefinedProfile,
-            seed=42
-        )
-
-        refined_profile = completion.choices[0].message.parsed
+    async def profile_definition(self, profile_form_data: RawProfile):
+        messages = profile_messages(profile_form_data)
+        refined_profile = await parse_structured(self.client, "profile_definition", messages, RefinedProfile)
         return refined_profile
     
-    def save_profile(self, refined_profile: RefinedProfile):
+    async def save_profile(self, refined_profile: RefinedProfile):
         summary = refined_profile.profile_summary
         opportunities = refined_profile.growth_opportunities
-        self.db.collection("users").document(self.user_id).collection("userProfile").document("profile").set({
-            "summary": summary,
-            "opportunities": opportunities
-        })
\ No newline at end of file
+        with span("firestore.save_profile", "firestore"):
+            await self.db.collection("users").document(self.user_id).collection("userProfile").document("profile").set({
+                "summary": summary,
+                "opportunities": opportunities
+            })
+        profile_cache.invalidate(self.user_id)
@@ -0,0 +1,281 @@
+"""
+Incremental goal progress.
+
+Goal and milestone documents carry duration-weighted progress counters
+(see persistence.progress_counters):
+
+    total_hours, completed_hours, total_tasks, completed_tasks
+
+Completing or reopening a task updates them in the same transaction as the
+task, with atomic increments, so reading a goal's progress is one document
+read instead of a scan of its tasks. The goal snapshot records the change
+in its `task_completion` map, applied by GoalReader when it is read back.
+
+A compact goal (see persistence.compact_goal) keeps the same counters at
+the top of its document and in each milestone of its tree; completing a
+task updates the task, both counters and the version by field path in one
+transaction on that document.
+
+Counters and snapshots only drift if writes bypass this module (or predate
+it), as the web client's direct writes to goal, milestone and task
+documents do: after those it calls reconcile_goal, which recomputes the
+counters, rebuilds the snapshot from the documents and drops the snapshot
+of a goal that is gone. Deleting a goal goes through delete_goal. Run
+`python -m api.progress <user_id>...`, or the `reconcile_progress` job, to
+reconcile every goal of a user.
+"""
+import asyncio
+from typing import List, Optional
+from api.goal_reads import GoalReader, goal_read_cache
+from api.persistence import COMPACT_LAYOUT, SNAPSHOTS_COLLECTION, GoalTreeWriter, compact_goal, goal_storage, is_compact, progress_counters, progress_percent
+from api.prioritization import priority_index
+from api.scheduling import schedule_index
+from api.tracing import span
+
+COUNTER_FIELDS = ('total_hours', 'completed_hours', 'total_tasks', 'completed_tasks')
+# Returned when a goal turns out to be stored in the documents layout
+NOT_COMPACT = object()
+# Completions of one compact goal all contend for its document, and each attempt lets at least one through
+COMPACT_COMPLETION_ATTEMPTS = 20
+
+
+def progress_view(doc: dict) -> dict:
+    """
+    The counters of a goal or milestone document, with its progress percentage.
+    """
+    counters = {field: doc.get(field, 0) for field in COUNTER_FIELDS}
+    return {**counters, 'progress': progress_percent(counters)}
+
+
+class ProgressTracker:
+
+    def __init__(self, db):
+        self.db = db
+
+    def _goal_ref(self, user_id: str, guid: str):
+        return self.db.collection('users', user_id, 'goals').document(guid)
+
+    def _snapshot_ref(self, user_id: str, guid: str):
+        return self.db.collection('users', user_id, SNAPSHOTS_COLLECTION).document(guid)
+
+    async def set_task_completed(self, user_id: str, guid: str, muid: str, tuid: str, completed: bool) -> Optional[dict]:
+        """
+        Mark a task completed (or not) and update the progress counters of its milestone and goal.
+
+        Returns the progress of the milestone and goal afterwards, or None if there is no such task.
+        Setting a task to the state it is already in changes nothing, so retried
+        or concurrent duplicate requests count once.
+        """
+        # Goals are looked up in the configured layout first, then in the other one
+        if goal_storage.layout == COMPACT_LAYOUT:
+            progress = await self._set_compact_task_completed(user_id, guid, muid, tuid, completed)
+            if progress is NOT_COMPACT:
+                progress = await self._set_task_document_completed(user_id, guid, muid, tuid, completed)
+        else:
+            progress = await self._set_task_document_completed(user_id, guid, muid, tuid, completed)
+            if progress is None:
+                progress = await self._set_compact_task_completed(user_id, guid, muid, tuid, completed)
+        if progress is None or progress is NOT_COMPACT:
+            return None
+        if progress['changed']:
+            goal_read_cache.invalidate(user_id, guid)
+            priority_index.set_completed(user_id, tuid, completed)
+            schedule_index.set_completed(user_id, tuid, completed)
+        return progress
+
+    async def _set_task_document_completed(self, user_id: str, guid: str, muid: str, tuid: str, completed: bool) -> Optional[dict]:
+        from google.cloud.firestore import Increment, async_transactional
+
+        goal_ref = self._goal_ref(user_id, guid)
+        milestone_ref = goal_ref.collection('milestones').document(muid)
+        task_ref = milestone_ref.collection('tasks').document(tuid)
+
+        @async_transactional
+        async def update(transaction):
+            task_doc = await task_ref.get(transaction=transaction)
+            if not task_doc.exists:
+                return None
+            task = task_doc.to_dict()
+            if bool(task.get('completed')) == completed:
+                return False
+
+            sign = 1 if completed else -1
+            increments = {
+                'completed_hours': Increment(sign * task['duration_hours']),
+                'completed_tasks': Increment(sign),
+            }
+            transaction.set(task_ref, {'completed': completed}, merge=True)
+            transaction.set(milestone_ref, increments, merge=True)
+            transaction.set(goal_ref, increments, merge=True)
+            transaction.set(self._snapshot_ref(user_id, guid), {'task_completion': {tuid: completed}, 'version': Increment(1)}, merge=True)
+            return True
+
+        with span("firestore.complete_task", "firestore") as attributes:
+            changed = await update(self.db.transaction())
+            attributes["changed"] = changed
+        if changed is None:
+            return None
+
+        goal_doc, milestone_doc = await asyncio.gather(goal_ref.get(), milestone_ref.get())
+        return {
+            'guid': guid, 'muid': muid, 'tuid': tuid, 'completed': completed, 'changed': changed,
+            'milestone': progress_view(milestone_doc.to_dict()),
+            'goal': progress_view(goal_doc.to_dict()),
+        }
+
+    async def _set_compact_task_completed(self, user_id: str, guid: str, muid: str, tuid: str, completed: bool):
+        """
+        set_task_completed for a compact goal; NOT_COMPACT if the goal is stored in the documents layout.
+        """
+        from google.cloud.firestore import Increment, async_transactional
+
+        goal_ref = self._goal_ref(user_id, guid)
+
+        @async_transactional
+        async def update(transaction):
+            goal_doc = await goal_ref.get(transaction=transaction)
+            goal = goal_doc.to_dict()
+            if goal is None:
+                return None
+            if not is_compact(goal):
+                return NOT_COMPACT
+            milestone = goal.get('milestones', {}).get(muid)
+            task = milestone.get('tasks', {}).get(tuid) if milestone is not None else None
+            if task is None:
+                return None
+            if bool(task.get('completed')) == completed:
+                return False, goal, milestone
+
+            sign = 1 if completed else -1
+            delta = {'completed_hours': sign * task['duration_hours'], 'completed_tasks': sign}
+            increments = {field: Increment(value) for field, value in delta.items()}
+            transaction.set(goal_ref, {
+                **increments,
+                'version': Increment(1),
+                'milestones': {muid: {**increments, 'tasks': {tuid: {'completed': completed}}}},
+            }, merge=True)
+            # The commit fails if the document changed since it was read, so this is its new state
+            return True, add_counters(goal, delta), add_counters(milestone, delta)
+
+        with span("firestore.complete_task", "firestore", layout=COMPACT_LAYOUT) as attributes:
+            result = await update(self.db.transaction(max_attempts=COMPACT_COMPLETION_ATTEMPTS))
+            attributes["changed"] = result[0] if isinstance(result, tuple) else None
+        if result is None or result is NOT_COMPACT:
+            return result
+        changed, goal, milestone = result
+        return {
+            'guid': guid, 'muid': muid, 'tuid': tuid, 'completed': completed, 'changed': changed,
+            'milestone': progress_view(milestone),
+            'goal': progress_view(goal),
+        }
+
+    async def goal_progress(self, user_id: str, guid: str) -> Optional[dict]:
+        """
+        Progress of a goal from its counters, reconciling goals saved before they had any.
+        """
+        with span("firestore.get_goal_progress", "firestore"):
+            goal_doc = await self._goal_ref(user_id, guid).get()
+        if not goal_doc.exists:
+            return None
+        goal = goal_doc.to_dict()
+        if 'total_hours' not in goal:
+            return await self.reconcile_goal(user_id, guid)
+        return {'guid': guid, **progress_view(goal)}
+
+    async def reconcile_goal(self, user_id: str, guid: str) -> Optional[dict]:
+        """
+        Recompute the counters of a goal and its milestones from its tasks, rebuild its snapshot and return the goal's progress.
+
+        Returns None, after deleting any snapshot left behind, if there is no such goal.
+        """
+        from google.cloud.firestore import async_transactional
+
+        goal_ref = self._goal_ref(user_id, guid)
+        reader = GoalReader(self.db)
+        writer = GoalTreeWriter(self.db)
+
+        @async_transactional
+        async def reconcile(transaction):
+            goal_doc, goal = await reader.load_goal(user_id, guid, transaction=transaction)
+            if goal is None:
+                transaction.delete(self._snapshot_ref(user_id, guid))
+                return None
+            if is_compact(goal_doc):
+                # Rewriting the document recomputes every counter from its tasks
+                document = compact_goal(goal, version=goal_doc.get('version', 0) + 1)
+                transaction.set(goal_ref, document)
+                return {'guid': guid, **progress_view(document)}
+
+            for milestone in goal['milestones']:
+                counters = progress_counters(milestone['tasks'])
+                milestone.update(counters)
+                transaction.set(goal_ref.collection('milestones').document(milestone['muid']), counters, merge=True)
+            counters = progress_counters([task for milestone in goal['milestones'] for task in milestone['tasks']])
+            goal.update(counters, progress=progress_percent(counters))
+            transaction.set(goal_ref, {**counters, 'progress': goal['progress']}, merge=True)
+            # The documents may have been edited directly, so the tree is rebuilt, not only its completions
+            transaction.set(*writer.snapshot_write(user_id, goal))
+            return {'guid': guid, **progress_view(goal)}
+
+        with span("firestore.reconcile_progress", "firestore"):
+            progress = await reconcile(self.db.transaction())
+        self._invalidate(user_id, guid)
+        return progress
+
+    async def reconcile_user(self, user_id: str) -> List[dict]:
+        """
+        Reconcile every goal of a user, and drop the snapshots of goals deleted directly.
+        """
+        guids = [doc.id async for doc in self.db.collection('users', user_id, 'goals').stream()]
+        existing = set(guids)
+        for guid in [doc.id async for doc in self.db.collection('users', user_id, SNAPSHOTS_COLLECTION).stream() if doc.id not in existing]:
+            await self.reconcile_goal(user_id, guid)
+        return [await self.reconcile_goal(user_id, guid) for guid in guids]
+
+    async def delete_goal(self, user_id: str, guid: str) -> bool:
+        """
+        Delete a goal with its milestones, tasks and snapshot. False if there was no such goal.
+        """
+        goal_doc, goal = await GoalReader(self.db).load_goal(user_id, guid)
+        writer = GoalTreeWriter(self.db)
+        milestones = goal['milestones'] if goal is not None and not is_compact(goal_doc) else []
+        writes = writer.delete_writes(user_id, guid, milestones)
+        with span("firestore.delete_goal", "firestore", writes=len(writes)):
+            # The goal document goes last, so a failed delete leaves a goal that can be deleted again
+            await writer.commit(writes[:-2])
+            await writer.commit(writes[-2:])
+        self._invalidate(user_id, guid)
+        return goal is not None
+
+    def _invalidate(self, user_id: str, guid: str):
+        goal_read_cache.invalidate(user_id, guid)
+        priority_index.invalidate(user_id)
+        schedule_index.invalidate(user_id)
+
+
+def add_counters(doc: dict, delta: dict) -> dict:
+    return {**doc, **{field: doc.get(field, 0) + value for field, value in delta.items()}}
+
+
+async def reconcile_progress_job(payload: dict, progress):
+    """
+    Background job recomputing the progress counters of every goal of `payload["user_id"]`.
+    """
+    from api.dependencies import firestore_db
+
+    progress("Reconciling goal progress")
+    goals = await ProgressTracker(firestore_db()).reconcile_user(payload["user_id"])
+    return {"goals": goals}
+
+
+async def main(user_ids: List[str]):
+    from api.dependencies import firestore_db
+
+    tracker = ProgressTracker(firestore_db())
+    for user_id in user_ids:
+        print(f"User {user_id}: {len(await tracker.reconcile_user(user_id))} goals reconciled")
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(main(sys.argv[1:]))
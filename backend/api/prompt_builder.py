@@ -0,0 +1,190 @@
+"""
+Token-aware assembly of the LLM prompts.
+
+Messages are ordered from most to least stable: the static system prompt,
+then per-user context (the profile), then the per-request input. OpenAI
+caches prompt prefixes of 1024+ tokens, so keeping the stable parts first
+and byte-identical between calls lets later calls hit the cache.
+"""
+import re
+import threading
+from functools import lru_cache
+from typing import List, Optional
+from api.prompts import (
+                     ENRICHED_GOAL_SYS_MSG,
+                     ENRICHED_GOAL_USR_MSG,
+                     GOAL_TO_TASK_EXAMPLE,
+                     GOAL_TO_TASK_EXAMPLE_MILESTONES,
+                     GOAL_TO_TASK_INSTRUCTIONS,
+                     GOAL_TO_TASK_USR_MSG,
+                     NEW_PROFILE_SYS_MSG,
+                     NEW_PROFILE_USR_MSG,
+                     )
+from api.tracing import annotate, logger, metrics
+
+DEFAULT_MODEL = "gpt-4o-2024-08-06"
+# Used when tiktoken or its encoding files are unavailable
+CHARS_PER_TOKEN = 4
+# Chat formatting overhead per message, and for the reply primer
+TOKENS_PER_MESSAGE = 3
+# Token budget of the planning system prompt: few-shot milestones are added until it is spent
+PLANNING_PROMPT_BUDGET = 1_600
+# Token budget of a serialized user profile
+PROFILE_TOKEN_BUDGET = 400
+
+
+@lru_cache(maxsize=None)
+def _encoding(model: str):
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # The encoding files are downloaded on first use, which fails offline
+        return None
+
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    encoding = _encoding(model)
+    if encoding is None:
+        return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages: List[dict], model: str = DEFAULT_MODEL) -> int:
+    return sum(count_tokens(message["content"], model) + TOKENS_PER_MESSAGE for message in messages) + TOKENS_PER_MESSAGE
+
+
+def truncate_to_budget(text: str, budget: int, model: str = DEFAULT_MODEL) -> str:
+    """
+    Cut text at the last sentence boundary that fits within `budget` tokens.
+    """
+    if count_tokens(text, model) <= budget:
+        return text
+    kept = ""
+    for sentence in re.split(r"(?<=[.!?])\s+", text):
+        candidate = f"{kept} {sentence}" if kept else sentence
+        if count_tokens(candidate, model) > budget:
+            break
+        kept = candidate
+    return kept or text[:budget * CHARS_PER_TOKEN]
+
+
+def compact_profile(profile: Optional[dict], budget: int = PROFILE_TOKEN_BUDGET, model: str = DEFAULT_MODEL) -> str:
+    """
+    Serialize a profile as `key: value` lines instead of a dict repr.
+
+    Keys are sorted and whitespace collapsed so the same profile always
+    gives the same text; empty fields are dropped and the result is cut to
+    `budget` tokens, shrinking the longest field first.
+    """
+    fields = {
+        str(key): " ".join(str(value).split())
+        for key, value in sorted((profile or {}).items())
+        if value not in (None, "", [], {})
+    }
+    if not fields:
+        return "Not provided"
+
+    def render():
+        return "\n".join(f"{key}: {value}" for key, value in fields.items())
+
+    while count_tokens(render(), model) > budget:
+        longest = max(fields, key=lambda key: len(fields[key]))
+        excess = count_tokens(render(), model) - budget
+        target = max(1, count_tokens(fields[longest], model) - excess)
+        shortened = truncate_to_budget(fields[longest], target, model)
+        if shortened == fields[longest]:
+            shortened = fields[longest][:max(1, len(shortened) - 1)]
+        fields[longest] = shortened
+    return render()
+
+
+@lru_cache(maxsize=16)
+def planning_system_prompt(budget: int = PLANNING_PROMPT_BUDGET, model: str = DEFAULT_MODEL) -> str:
+    """
+    Planning instructions plus as many few-shot milestones as fit in `budget` tokens (at least one).
+
+    Cached, so every call with the same budget sends a byte-identical prefix.
+    """
+    for count in range(len(GOAL_TO_TASK_EXAMPLE_MILESTONES), 0, -1):
+        prompt = GOAL_TO_TASK_INSTRUCTIONS + GOAL_TO_TASK_EXAMPLE.replace("$MILESTONES", "".join(GOAL_TO_TASK_EXAMPLE_MILESTONES[:count]))
+        if count_tokens(prompt, model) <= budget or count == 1:
+            return prompt
+
+
+def goal_plan_messages(validated_smart_goal: str, budget: int = PLANNING_PROMPT_BUDGET) -> List[dict]:
+    """
+    Messages of the single-call planning prompt, shared by the sync, streaming and batch paths.
+    """
+    return [
+        {"role": "system", "content": planning_system_prompt(budget)},
+        {"role": "user", "content": GOAL_TO_TASK_USR_MSG.replace("$SMART_GOAL", validated_smart_goal)}
+    ]
+
+
+def smart_goal_messages(pre_goal, user_profile: Optional[dict]) -> List[dict]:
+    return [
+        {"role": "system", "content": ENRICHED_GOAL_SYS_MSG},
+        {"role": "user", "content": ENRICHED_GOAL_USR_MSG.replace("$PROFILE", compact_profile(user_profile)).replace("$WHAT", str(pre_goal.what)).replace("$WHY", str(pre_goal.why)).replace("$WHEN", str(pre_goal.when))}
+    ]
+
+
+def profile_messages(raw_profile) -> List[dict]:
+    return [
+        {"role": "system", "content": NEW_PROFILE_SYS_MSG},
+        {"role": "user", "content": NEW_PROFILE_USR_MSG.replace("$RESPONSES", "\n" + compact_profile(raw_profile.dict()))}
+    ]
+
+
+class PromptUsage:
+    """
+    Per-endpoint token counts from the `usage` of each completion, including the cached share of the prompt.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def record(self, endpoint: str, usage):
+        if usage is None:
+            return
+        get = usage.get if isinstance(usage, dict) else lambda key, default=None: getattr(usage, key, default)
+        prompt_tokens = get("prompt_tokens", 0) or 0
+        completion_tokens = get("completion_tokens", 0) or 0
+        details = get("prompt_tokens_details")
+        cached_tokens = (details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", 0)) or 0
+
+        with self._lock:
+            stats = self._stats.setdefault(endpoint, {"calls": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0})
+            stats["calls"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["cached_tokens"] += cached_tokens
+            stats["completion_tokens"] += completion_tokens
+        annotate(prompt_tokens=prompt_tokens, cached_tokens=cached_tokens, completion_tokens=completion_tokens)
+        metrics.increment("llm_tokens_total", prompt_tokens - cached_tokens, endpoint=endpoint, type="prompt")
+        metrics.increment("llm_tokens_total", cached_tokens, endpoint=endpoint, type="cached_prompt")
+        metrics.increment("llm_tokens_total", completion_tokens, endpoint=endpoint, type="completion")
+        logger.debug("LLM usage", extra={"endpoint": endpoint, "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens, "completion_tokens": completion_tokens})
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    **stats,
+                    "mean_prompt_tokens": stats["prompt_tokens"] / stats["calls"],
+                    "cached_ratio": stats["cached_tokens"] / stats["prompt_tokens"] if stats["prompt_tokens"] else 0.0,
+                }
+                for endpoint, stats in self._stats.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._stats = {}
+
+
+prompt_usage = PromptUsage()
@@ -130,14 +130,16 @@ but also on his profile.
 </example>
 """
 
+# The profile comes first: with the system prompt it forms a prefix that is stable per user, so prompt caching can hit
 ENRICHED_GOAL_USR_MSG = """
+Profile:
+$PROFILE
+
 Input:
 Goal:
 What: $WHAT
 Why: $WHY
 When: $WHEN
-Profile:
-$PROFILE
 
 Let's think step by step
 
@@ -184,7 +186,7 @@ Let's think step by step
 
 #--------------------------------
 
-GOAL_TO_TASK_SYS_MSG = """
+GOAL_TO_TASK_INSTRUCTIONS = """
 You are an expert in project management. You are tasked to use your skillset especially WBS to help with the following goal .
 
 <instructions>
@@ -204,14 +206,22 @@ You are an expert in project management. You are tasked to use your skillset esp
 	- Make sure that it is finishable and not an immeasurable process
 </instructions>
 
-<example>
+"""
+
+# Few-shot example of the planning prompt; api.prompt_builder keeps as many of its milestones as the token budget allows
+GOAL_TO_TASK_EXAMPLE = """<example>
 	Input:
 
 	Goal: Increase the company's social media engagement by 25% within the next 3 months.
 
 	Output:
 
-	Milestone 1: Content Strategy Development
+$MILESTONES  
+</example>
+"""
+
+GOAL_TO_TASK_EXAMPLE_MILESTONES = [
+"""	Milestone 1: Content Strategy Development
 
 	- Task 1: Analyze Audience Demographics
 		- Description: Research and identify the demographics of the current and target audience to tailor content effectively.
@@ -255,7 +265,8 @@ You are an expert in project management. You are tasked to use your skillset esp
 		- Importance Score: 5
 		- Urgency Score: 3
 
-	Milestone 2: Content Creation
+""",
+"""	Milestone 2: Content Creation
 
 	- Task 1: Design Post Graphics
 		- Description: Create visually appealing graphics for social media posts to attract and engage the audience.
@@ -299,7 +310,8 @@ You are an expert in project management. You are tasked to use your skillset esp
 		- Importance Score: 5
 		- Urgency Score: 4
 
-	Milestone 3: Audience Engagement
+""",
+"""	Milestone 3: Audience Engagement
 
 	- Task 1: Respond to Comments
 		- Description: Actively reply to comments on social media posts to foster community and engagement.
@@ -343,7 +355,8 @@ You are an expert in project management. You are tasked to use your skillset esp
 		- Importance Score: 5
 		- Urgency Score: 3
 
-	Milestone 4: Performance Analysis
+""",
+"""	Milestone 4: Performance Analysis
 
 	- Task 1: Gather Engagement Data
 		- Description: Collect data on likes, shares, comments, and other engagement metrics from social media platforms.
@@ -380,7 +393,8 @@ You are an expert in project management. You are tasked to use your skillset esp
 		- Importance Score: 5
 		- Urgency Score: 2
 
-	Milestone 5: Continuous Improvement
+""",
+"""	Milestone 5: Continuous Improvement
 
 	- Task 1: Solicit Team Feedback
 		- Description: Gather input from team members on the social media strategy and implementation.
@@ -416,9 +430,11 @@ You are an expert in project management. You are tasked to use your skillset esp
 		- Simplicity Score: 3
 		- Importance Score: 4
 		- Urgency Score: 2
-  
-</example>
-"""
+""",
+]
+
+# The full prompt, with every example milestone
+GOAL_TO_TASK_SYS_MSG = GOAL_TO_TASK_INSTRUCTIONS + GOAL_TO_TASK_EXAMPLE.replace("$MILESTONES", "".join(GOAL_TO_TASK_EXAMPLE_MILESTONES))
 
 GOAL_TO_TASK_USR_MSG = """
 Goal: $SMART_GOAL
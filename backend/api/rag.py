@@ -1,33 +1,70 @@
 import os
-from openai import OpenAI
-from pinecone import Pinecone, ServerlessSpec
 from dotenv import load_dotenv
+from api.embeddings import EMBEDDING_DIMENSION, get_embedding_service
+from api.tracing import span
+from api.vector_store import LocalVectorStore, PineconeVectorStore, VectorStore
 
-load_dotenv()
+index_name = "goal-tracker"
 
-pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+_pinecone = None
 
-index_name = "goal-tracker"
+def get_pinecone():
+    """
+    Return the Pinecone client, creating the index (or checking its dimension) on first use.
+    """
+    global _pinecone
+    if _pinecone is None:
+        from pinecone import Pinecone, ServerlessSpec
+
+        load_dotenv()
+        pc = Pinecone(api_key=os.environ.get("PINECONE_API_KEY"))
+
+        if not pc.has_index(index_name):
+            pc.create_index(
+                name=index_name,
+                dimension=EMBEDDING_DIMENSION,
+                metric="cosine",
+                spec=ServerlessSpec(
+                    cloud="gcp",
+                    region="europe-west4"
+                )
+            )
+        else:
+            get_embedding_service().check_dimension(pc.describe_index(index_name).dimension)
+        _pinecone = pc
+    return _pinecone
+
+def configure_vector_store():
+    """
+    Open the Pinecone index at startup when it is configured (PINECONE_API_KEY set, VECTOR_STORE not `local`).
+
+    A dimension mismatch between the index and the embeddings then stops the
+    server from starting instead of failing its first vector request.
+    """
+    if os.getenv('VECTOR_STORE', 'pinecone') != 'local' and os.getenv('PINECONE_API_KEY'):
+        get_pinecone()
+
+vector_stores = {}
 
-if not pc.has_index(index_name):
-    pc.create_index(
-        name=index_name,
-        dimension=1024, 
-        metric="cosine", 
-        spec=ServerlessSpec(
-            cloud="gcp", 
-            region="europe-west4"
-        ) 
-    ) 
+def get_vector_store(index_name) -> VectorStore:
+    """
+    Return the store for an index, opening the Pinecone handle once; VECTOR_STORE=local uses an in-process store instead.
+    """
+    if index_name not in vector_stores:
+        if os.getenv('VECTOR_STORE', 'pinecone') == 'local':
+            vector_stores[index_name] = LocalVectorStore(EMBEDDING_DIMENSION)
+        else:
+            vector_stores[index_name] = PineconeVectorStore(get_pinecone(), index_name)
+    return vector_stores[index_name]
 
 def upsert_to_pinecone(index_name, data):
-    index = pc.Index(index_name)
-    index.upsert(data)
+    with span("pinecone.upsert", "pinecone", index=index_name, vectors=len(data)):
+        get_vector_store(index_name).upsert(data)
 
-def query_pinecone(index_name, query):
-    index = pc.Index(index_name)
-    return index.query(query)
+def query_pinecone(index_name, query, top_k=10, filter=None):
+    with span("pinecone.query", "pinecone", index=index_name, top_k=top_k):
+        return get_vector_store(index_name).query(query, top_k, filter)
 
-def create_embeddings(text):
-    client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-    return client.embeddings.create(input=text, model="text-embedding-ada-002").data[0].embedding
+async def create_embeddings(text):
+    with span("embedding.embed", "embedding"):
+        return await get_embedding_service().embed(text)
@@ -0,0 +1,257 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Optional
+from cachetools import TTLCache
+
+RESPONSE_CACHE_MAXSIZE = 2_000
+RESPONSE_CACHE_TTL_SECONDS = 24 * 60 * 60
+# DiskCacheBackend drops expired and excess entries at most this often
+DISK_CACHE_SWEEP_SECONDS = 60
+# Cosine similarity above which two inputs are treated as the same request
+SEMANTIC_SIMILARITY_THRESHOLD = 0.97
+SEMANTIC_MAX_ENTRIES = 1_000
+
+
+def _normalize(text: str) -> str:
+    return " ".join(str(text).split()).lower()
+
+
+def cache_key(model: str, messages: list, response_format=None) -> str:
+    """
+    Stable hash of the model, prompt and inputs, insensitive to case and whitespace.
+    """
+    payload = {
+        "model": model,
+        "messages": [[message["role"], _normalize(message["content"])] for message in messages],
+        "response_format": response_format.__name__ if response_format else None,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+
+class SemanticEntries:
+    """
+    Embeddings of the most recent entries of one scope, normalized into the rows of a NumPy matrix.
+
+    Rows are reused oldest first once `size` entries are held, and a lookup
+    scores all of them with one matrix product.
+    """
+
+    def __init__(self, size: int = SEMANTIC_MAX_ENTRIES):
+        self.size = size
+        self._matrix = None
+        self._keys = []
+        self._added = 0
+
+    @staticmethod
+    def _unit(vector):
+        import numpy as np
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def add(self, vector, key: str):
+        import numpy as np
+        unit = self._unit(vector)
+        if unit is None:
+            return
+        if self._matrix is None:
+            self._matrix = np.zeros((self.size, len(unit)), dtype=np.float32)
+        row = self._added % self.size
+        self._matrix[row] = unit
+        if row < len(self._keys):
+            self._keys[row] = key
+        else:
+            self._keys.append(key)
+        self._added += 1
+
+    def best(self, vector, threshold: float) -> Optional[str]:
+        """
+        Key of the entry most similar to `vector`, if its cosine similarity reaches `threshold`.
+        """
+        import numpy as np
+        unit = self._unit(vector)
+        if unit is None or not self._keys:
+            return None
+        scores = self._matrix[:len(self._keys)] @ unit
+        row = int(np.argmax(scores))
+        return self._keys[row] if scores[row] >= threshold else None
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class MemoryCacheBackend:
+    """
+    In-process backend with LRU size and TTL eviction.
+    """
+    # Cheap enough to call on the event loop
+    blocking = False
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_MAXSIZE, ttl: float = RESPONSE_CACHE_TTL_SECONDS):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            self._cache[key] = value
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class DiskCacheBackend:
+    """
+    SQLite-backed backend that survives restarts, with TTL and oldest-first size eviction.
+
+    Expired entries are never returned, but are only deleted, with the
+    entries over `maxsize`, every `sweep_interval` seconds.
+    """
+    # ResponseCache calls it from a thread, so disk waits do not stall the event loop
+    blocking = True
+
+    def __init__(self, path: str, maxsize: int = RESPONSE_CACHE_MAXSIZE, ttl: float = RESPONSE_CACHE_TTL_SECONDS, sweep_interval: float = DISK_CACHE_SWEEP_SECONDS):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._swept_at = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+        self._conn.commit()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM responses WHERE key = ? AND created_at > ?", (key, time.time() - self.ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str):
+        with self._lock:
+            now = time.time()
+            self._conn.execute("INSERT OR REPLACE INTO responses (key, value, created_at) VALUES (?, ?, ?)", (key, value, now))
+            if now - self._swept_at >= self.sweep_interval:
+                self._swept_at = now
+                self._conn.execute("DELETE FROM responses WHERE created_at <= ?", (now - self.ttl,))
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)", (self.maxsize,)
+                )
+            self._conn.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+
+class ResponseCache:
+    """
+    Cache of LLM responses keyed on a normalized hash of the model, prompt and inputs.
+
+    With an `embed` coroutine set, misses fall back to a semantic tier: the
+    last user message is embedded and compared against recent entries of the
+    same endpoint, model and system prompt.
+
+    Entries are keyed on the model that answered, which is the fallback
+    model when the chosen one failed. Empty (None) results are not cached.
+    """
+
+    def __init__(self, backend=None, embed=None, similarity_threshold: float = SEMANTIC_SIMILARITY_THRESHOLD, max_semantic_entries: int = SEMANTIC_MAX_ENTRIES, enabled: bool = True):
+        self.enabled = enabled
+        self.backend = backend if backend is not None else MemoryCacheBackend()
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.max_semantic_entries = max_semantic_entries
+        self._semantic = {}
+        self._stats = {}
+
+    def _endpoint_stats(self, endpoint: str) -> dict:
+        return self._stats.setdefault(endpoint, {"hits": 0, "semantic_hits": 0, "misses": 0, "latency_saved_s": 0.0})
+
+    async def get_or_call(self, endpoint: str, model: str, messages: list, call, response_format=None):
+        """
+        Return the cached response for these inputs on `model`, or await `call()` and cache its result.
+
+        `call()` returns the model that answered and its response, as
+        ModelRouter.call does. `response_format` is the Pydantic model of
+        structured outputs; plain text is cached as is.
+        """
+        if not self.enabled:
+            _, result = await call()
+            return result
+
+        stats = self._endpoint_stats(endpoint)
+        key = cache_key(model, messages, response_format)
+
+        entry = await self._get(key)
+        if entry is not None:
+            stats["hits"] += 1
+            return self._decode(entry, stats, response_format)
+
+        vector = None
+        if self.embed is not None:
+            vector = await self.embed(_normalize(messages[-1]["content"]))
+            best_key = self._semantic_entries(endpoint, model, messages, response_format).best(vector, self.similarity_threshold)
+            entry = await self._get(best_key) if best_key else None
+            if entry is not None:
+                stats["semantic_hits"] += 1
+                return self._decode(entry, stats, response_format)
+
+        stats["misses"] += 1
+        start = time.perf_counter()
+        answered_by, result = await call()
+        latency = time.perf_counter() - start
+        if result is None:
+            return result
+
+        if answered_by != model:
+            key = cache_key(answered_by, messages, response_format)
+        value = result.model_dump_json() if response_format else result
+        await self._set(key, json.dumps({"value": value, "latency": latency}))
+        if vector is not None:
+            self._semantic_entries(endpoint, answered_by, messages, response_format).add(vector, key)
+        return result
+
+    async def _get(self, key: str) -> Optional[str]:
+        if getattr(self.backend, "blocking", False):
+            return await asyncio.to_thread(self.backend.get, key)
+        return self.backend.get(key)
+
+    async def _set(self, key: str, value: str):
+        if getattr(self.backend, "blocking", False):
+            await asyncio.to_thread(self.backend.set, key, value)
+        else:
+            self.backend.set(key, value)
+
+    def _semantic_entries(self, endpoint: str, model: str, messages: list, response_format) -> SemanticEntries:
+        scope = cache_key(model, [message for message in messages if message["role"] == "system"], response_format)
+        entries = self._semantic.get((endpoint, scope))
+        if entries is None:
+            entries = self._semantic[(endpoint, scope)] = SemanticEntries(self.max_semantic_entries)
+        return entries
+
+    def _decode(self, entry: str, stats: dict, response_format):
+        entry = json.loads(entry)
+        stats["latency_saved_s"] += entry["latency"]
+        return response_format.model_validate_json(entry["value"]) if response_format else entry["value"]
+
+    def stats(self) -> dict:
+        report = {}
+        for endpoint, stats in self._stats.items():
+            requests = stats["hits"] + stats["semantic_hits"] + stats["misses"]
+            report[endpoint] = {
+                **stats,
+                "hit_rate": (stats["hits"] + stats["semantic_hits"]) / requests if requests else 0.0,
+            }
+        return {"entries": len(self.backend), "endpoints": report}
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,247 @@
+"""
+Production server: pre-forked uvicorn workers sharing one listening socket.
+
+    python -m api.runtime
+
+The master process imports the app once, binds the socket and forks the
+workers, which inherit both, so api.index's imports are not repeated per
+worker and the imported modules stay shared copy-on-write. Nothing that
+holds connections is built at import time (see api.dependencies), so each
+worker's lifespan creates its own clients, caches and job queue after the
+fork. A worker that dies is replaced; one that dies while starting stops
+the server, since its replacements would too.
+
+On SIGTERM, which Cloud Run sends before stopping an instance, or SIGINT,
+each worker stops accepting connections, finishes the requests in flight
+for up to GRACEFUL_SHUTDOWN_SECONDS, then runs the lifespan shutdown.
+Workers still running a second after that are killed. Cloud Run kills the
+container 10 s after SIGTERM, so keep the timeout under that.
+
+Settings come from the environment, see configure_runtime. It serves one
+worker per available CPU. With several workers, JOB_QUEUE_PATH and
+ADMISSION_BUCKETS_PATH default to SQLite files shared by them (see
+shared_state_paths), so a job is seen, and run once, whichever worker
+accepted it, and rate limits hold across workers. Read caches stay per
+worker: a read through one worker may lag a write made through another by
+up to the cache TTLs.
+"""
+import gc
+import math
+import os
+import signal
+import sys
+import tempfile
+import time
+from typing import Dict, Optional
+from pydantic import BaseModel
+from api.tracing import configure_logging, logger
+
+GRACEFUL_SHUTDOWN_SECONDS = 8
+KEEPALIVE_SECONDS = 5
+# A worker exiting sooner than this after its fork failed to start
+MIN_WORKER_UPTIME_SECONDS = 5
+# SQLite stores the workers share unless their variables are set
+SHARED_STATE_FILES = {'JOB_QUEUE_PATH': 'jobs.sqlite3', 'ADMISSION_BUCKETS_PATH': 'admission.sqlite3'}
+HANDLED_SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+
+class RuntimeSettings(BaseModel):
+    app: str = "api.index:app"
+    host: str = "0.0.0.0"
+    port: int = 8080
+    workers: int = 1
+    preload: bool = True
+    graceful_shutdown_seconds: float = GRACEFUL_SHUTDOWN_SECONDS
+    keepalive_seconds: int = KEEPALIVE_SECONDS
+    log_level: str = "info"
+
+
+def _cgroup_cpu_quota() -> Optional[float]:
+    """
+    CPUs allowed by the cgroup CPU quota (cgroup v2, then v1), or None without a quota.
+    """
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as cpu_max:
+            quota, period = cpu_max.read().split()
+        return None if quota == 'max' else int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as quota_file, open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as period_file:
+            quota, period = int(quota_file.read()), int(period_file.read())
+        return None if quota <= 0 else quota / period
+    except (OSError, ValueError):
+        return None
+
+
+def available_cpus() -> int:
+    """
+    CPUs this process can run on: its affinity mask, capped by a container CPU quota.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = _cgroup_cpu_quota()
+    if quota is not None:
+        cpus = min(cpus, max(1, math.ceil(quota)))
+    return cpus
+
+
+def configure_runtime() -> RuntimeSettings:
+    """
+    Read the server settings from the environment.
+
+    APP_MODULE, HOST and PORT choose what is served where. WEB_CONCURRENCY
+    sets the worker count, one per available CPU by default. PRELOAD_APP=False
+    imports the app in each worker instead of the master.
+    GRACEFUL_SHUTDOWN_SECONDS and KEEPALIVE_SECONDS bound draining and idle
+    connections; LOG_LEVEL also sets uvicorn's level.
+    """
+    settings = RuntimeSettings(
+        app=os.getenv('APP_MODULE', RuntimeSettings().app),
+        host=os.getenv('HOST', '0.0.0.0'),
+        port=int(os.getenv('PORT', 8080)),
+        workers=int(os.getenv('WEB_CONCURRENCY', available_cpus())),
+        preload=os.getenv('PRELOAD_APP', 'True') == 'True',
+        graceful_shutdown_seconds=float(os.getenv('GRACEFUL_SHUTDOWN_SECONDS', GRACEFUL_SHUTDOWN_SECONDS)),
+        keepalive_seconds=int(os.getenv('KEEPALIVE_SECONDS', KEEPALIVE_SECONDS)),
+        log_level=os.getenv('LOG_LEVEL', 'INFO').lower(),
+    )
+    if settings.workers < 1:
+        raise ValueError(f"WEB_CONCURRENCY must be at least 1, not {settings.workers}")
+    return settings
+
+
+def shared_state_paths() -> Dict[str, str]:
+    """
+    Point the job queue and admission buckets of every worker at the same SQLite files, unless configured already.
+
+    Set in the master before the fork, so each worker's lifespan reads them.
+    """
+    directory = None
+    paths = {}
+    for variable, filename in SHARED_STATE_FILES.items():
+        if not os.getenv(variable):
+            directory = directory or tempfile.mkdtemp(prefix='goal-tracker-')
+            os.environ[variable] = paths[variable] = os.path.join(directory, filename)
+    return paths
+
+
+class Supervisor:
+    """
+    Forks the workers, replaces the ones that die and forwards shutdown signals to them.
+    """
+
+    def __init__(self, config, settings: RuntimeSettings):
+        self.config = config
+        self.settings = settings
+        self.socket = None
+        self.workers: Dict[int, float] = {}
+        self.stopping = False
+        self.exit_code = 0
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.workers[pid] = time.monotonic()
+            return
+        # Worker: its own process group, so a terminal's Ctrl-C reaches only the master, which forwards it once
+        os.setpgid(0, 0)
+        for sig in HANDLED_SIGNALS:
+            signal.signal(sig, signal.SIG_DFL)
+        code = 0
+        try:
+            import uvicorn
+            uvicorn.Server(self.config).run(sockets=[self.socket])
+        except SystemExit as error:
+            # uvicorn has logged why
+            code = error.code if isinstance(error.code, int) else 1
+        except BaseException:
+            logger.exception("Worker %s failed", os.getpid())
+            code = 1
+        finally:
+            os._exit(code)
+
+    def stop(self, sig=signal.SIGTERM, frame=None):
+        if not self.stopping:
+            logger.info("Stopping %s workers", len(self.workers))
+        self.stopping = True
+        for pid in self.workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while self.workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                return
+            started = self.workers.pop(pid, None)
+            if started is None or self.stopping:
+                continue
+            if time.monotonic() - started < MIN_WORKER_UPTIME_SECONDS:
+                logger.error("Worker %s exited while starting (status %s)", pid, status)
+                self.exit_code = 1
+                self.stop()
+            else:
+                logger.warning("Worker %s exited (status %s), replacing it", pid, status)
+                self.spawn()
+
+    def run(self, socket) -> int:
+        self.socket = socket
+        for sig in HANDLED_SIGNALS:
+            signal.signal(sig, self.stop)
+        for _ in range(self.settings.workers):
+            self.spawn()
+        logger.info("Serving %s on %s:%s with %s workers", self.settings.app, self.settings.host, self.settings.port, self.settings.workers)
+        deadline = None
+        while self.workers:
+            self.reap()
+            if self.stopping and deadline is None:
+                deadline = time.monotonic() + self.settings.graceful_shutdown_seconds + 1
+            if deadline is not None and time.monotonic() > deadline:
+                for pid in self.workers:
+                    logger.warning("Worker %s still running after the graceful shutdown timeout, killing it", pid)
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        pass
+                deadline = float('inf')
+            time.sleep(0.1)
+        return self.exit_code
+
+
+def serve(settings: RuntimeSettings) -> int:
+    """
+    Serve `settings.app`: in this process with one worker, else through a Supervisor.
+    """
+    import uvicorn
+
+    configure_logging()
+    app = settings.app
+    if settings.preload:
+        from uvicorn.importer import import_from_string
+        app = import_from_string(settings.app)
+    config = uvicorn.Config(
+        app,
+        host=settings.host,
+        port=settings.port,
+        log_level=settings.log_level,
+        timeout_keep_alive=settings.keepalive_seconds,
+        timeout_graceful_shutdown=settings.graceful_shutdown_seconds,
+    )
+    socket = config.bind_socket()
+    if settings.workers == 1:
+        uvicorn.Server(config).run(sockets=[socket])
+        return 0
+    for variable, path in shared_state_paths().items():
+        logger.info("%s=%s, shared by the workers", variable, path)
+    # Imported objects are never collected; keeping them out of collections saves their pages from copy-on-write
+    gc.freeze()
+    return Supervisor(config, settings).run(socket)
+
+
+if __name__ == "__main__":
+    sys.exit(serve(configure_runtime()))
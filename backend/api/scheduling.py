@@ -0,0 +1,311 @@
+"""
+Deadline-aware scheduling of a user's open tasks into dated slots.
+
+Open tasks are ordered earliest deadline first (milestone deadline, then
+goal deadline), keeping the plan's order within a goal, and packed back to
+back into the hours available each day. Earliest deadline first meets
+every deadline whenever any order can, so a task that still ends after its
+deadline makes the plan infeasible for that availability.
+
+A Schedule only stores each task's start as an offset in available hours;
+dates and slots are derived from the calendar when the plan is read. When
+a task completes, is reopened or slips, only the tasks after it are
+shifted, and moving the start date (unfinished work slips) changes no
+offsets at all.
+"""
+import asyncio
+import bisect
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Sequence
+from cachetools import TTLCache
+from pydantic import BaseModel, Field, conint
+from api.tracing import span
+
+SCHEDULE_INDEX_MAXSIZE = 10_000
+# Bounds staleness across instances; changes made through this process update the schedules at once
+SCHEDULE_INDEX_TTL_SECONDS = 5 * 60
+MAX_CONCURRENT_REPLANS = 16
+
+
+class Availability(BaseModel):
+    weekly_hours: float = Field(10.0, gt=0, description="Hours available for tasks per week")
+    weekdays: List[conint(ge=0, le=6)] = Field([0, 1, 2, 3, 4, 5, 6], min_length=1, description="Days the hours are spread over, 0 for Monday")
+
+    def hours_per_weekday(self) -> List[float]:
+        days = set(self.weekdays)
+        return [self.weekly_hours / len(days) if weekday in days else 0.0 for weekday in range(7)]
+
+    def key(self) -> tuple:
+        return (self.weekly_hours, tuple(sorted(set(self.weekdays))))
+
+
+def parse_date(value) -> Optional[date]:
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+class Calendar:
+    """
+    Available hours from a start date, as cumulative hours before each day, extended as needed.
+    """
+
+    def __init__(self, start: date, hours_per_weekday: Sequence[float]):
+        if sum(hours_per_weekday) <= 0:
+            raise ValueError("No available hours")
+        self.start = start
+        self.hours_per_weekday = list(hours_per_weekday)
+        self._cumulative = [0.0]
+
+    def _extend(self, offset: float):
+        while self._cumulative[-1] <= offset:
+            day = self.start + timedelta(days=len(self._cumulative) - 1)
+            self._cumulative.append(self._cumulative[-1] + self.hours_per_weekday[day.weekday()])
+
+    def day(self, index: int) -> date:
+        return self.start + timedelta(days=index)
+
+    def slots(self, start: float, duration: float) -> List[dict]:
+        """
+        Dated slots covering `duration` hours from offset `start`.
+        """
+        end = start + duration
+        self._extend(end)
+        slots = []
+        index = bisect.bisect_right(self._cumulative, start) - 1
+        while self._cumulative[index] < end:
+            hours = min(self._cumulative[index + 1], end) - max(self._cumulative[index], start)
+            if hours > 0:
+                slots.append({'date': self.day(index).isoformat(), 'hours': round(hours, 2)})
+            index += 1
+        return slots
+
+    def end_date(self, end: float) -> date:
+        """
+        Date on which work ending at offset `end` finishes.
+        """
+        self._extend(end)
+        return self.day(max(bisect.bisect_left(self._cumulative, end) - 1, 0))
+
+
+class Schedule:
+    """
+    Open tasks of one user in deadline order, with their start offsets in available hours.
+    """
+
+    def __init__(self, calendar: Calendar):
+        self.calendar = calendar
+        self.tasks: Dict[str, dict] = {}
+        self._order = []
+        self._keys = []
+        self._starts = []
+        # Tasks whose start was recomputed, to tell incremental updates from full replans
+        self.repacked = 0
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def add_goal(self, goal: dict):
+        goal_deadline = parse_date(goal.get('deadline')) or date.max
+        added = []
+        for milestone_index, milestone in enumerate(goal.get('milestones', [])):
+            deadline = parse_date(milestone.get('deadline')) or goal_deadline
+            for task_index, task in enumerate(milestone.get('tasks', [])):
+                key = task.get('tuid') or f"{milestone.get('muid')}/{task_index}"
+                if key in self.tasks:
+                    continue
+                self.tasks[key] = {
+                    **task, 'goal_name': goal.get('name'), 'milestone_name': milestone.get('name'),
+                    'deadline': deadline if deadline != date.max else None,
+                    'order': (deadline, goal_deadline, goal.get('guid') or '', milestone_index, task_index, key),
+                }
+                if not task.get('completed'):
+                    added.append(self.tasks[key]['order'])
+        if not added:
+            return
+        # Timsort merges the two sorted runs in linear time
+        order = sorted(self._order + added)
+        first = bisect.bisect_left(order, min(added))
+        self._order = order
+        self._keys = [item[-1] for item in order]
+        self._starts = self._starts[:first] + [0.0] * (len(order) - first)
+        self._repack(first)
+
+    def set_completed(self, key: str, completed: bool) -> bool:
+        """
+        Take a task out of the schedule, or put it back. Returns False if the task is unknown.
+        """
+        task = self.tasks.get(key)
+        if task is None:
+            return False
+        if bool(task.get('completed')) == completed:
+            return True
+        task['completed'] = completed
+        index = bisect.bisect_left(self._order, task['order'])
+        if completed:
+            del self._order[index], self._keys[index], self._starts[index]
+        else:
+            self._order.insert(index, task['order'])
+            self._keys.insert(index, key)
+            self._starts.insert(index, 0.0)
+        self._repack(index)
+        return True
+
+    def slip(self, key: str, hours: float):
+        """
+        A task needs `hours` more than planned: push back the tasks after it.
+        """
+        task = self.tasks[key]
+        task['duration_hours'] = task['duration_hours'] + hours
+        if not task.get('completed'):
+            self._repack(bisect.bisect_left(self._order, task['order']) + 1)
+
+    def advance(self, start: date):
+        """
+        Replan from `start`: open tasks keep their order and slip to the hours available from then on.
+        """
+        self.calendar = Calendar(start, self.calendar.hours_per_weekday)
+
+    def _repack(self, first: int):
+        offset = self._starts[first - 1] + self.tasks[self._keys[first - 1]]['duration_hours'] if first > 0 else 0.0
+        for index in range(first, len(self._keys)):
+            self._starts[index] = offset
+            offset += self.tasks[self._keys[index]]['duration_hours']
+        self.repacked += len(self._keys) - first
+
+    def plan(self, include_tasks: bool = True) -> dict:
+        tasks = []
+        late = 0
+        finish = None
+        for key, start in zip(self._keys, self._starts):
+            task = self.tasks[key]
+            end_date = self.calendar.end_date(start + task['duration_hours'])
+            days_late = (end_date - task['deadline']).days if task['deadline'] is not None and end_date > task['deadline'] else 0
+            late += days_late > 0
+            finish = end_date
+            if include_tasks:
+                tasks.append({
+                    'tuid': key, 'guid': task.get('guid'), 'muid': task.get('muid'), 'name': task.get('name'),
+                    'goal_name': task['goal_name'], 'milestone_name': task['milestone_name'],
+                    'duration_hours': task['duration_hours'],
+                    'deadline': task['deadline'].isoformat() if task['deadline'] is not None else None,
+                    'slots': self.calendar.slots(start, task['duration_hours']),
+                    'end': end_date.isoformat(), 'days_late': days_late,
+                })
+        plan = {
+            'start': self.calendar.start.isoformat(),
+            'feasible': late == 0,
+            'late_tasks': late,
+            'open_tasks': len(self._keys),
+            'total_hours': sum(self.tasks[key]['duration_hours'] for key in self._keys),
+            'finish': finish.isoformat() if finish is not None else None,
+        }
+        if include_tasks:
+            plan['tasks'] = tasks
+        return plan
+
+
+def build_schedule(goals: List[dict], availability: Availability, start: date) -> Schedule:
+    schedule = Schedule(Calendar(start, availability.hours_per_weekday()))
+    for goal in goals:
+        schedule.add_goal(goal)
+    return schedule
+
+
+class ScheduleIndex:
+    """
+    Process-wide TTL cache of the schedules of users, per availability.
+    """
+
+    def __init__(self, maxsize: int = SCHEDULE_INDEX_MAXSIZE, ttl: float = SCHEDULE_INDEX_TTL_SECONDS):
+        self._schedules = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.hits = 0
+        self.misses = 0
+
+    async def schedule(self, db, user_id: str, availability: Availability, start: Optional[date] = None) -> Schedule:
+        start = start or date.today()
+        schedules = self._schedules.setdefault(user_id, {})
+        schedule = schedules.get(availability.key())
+        if schedule is None:
+            self.misses += 1
+            goals = await self._load_goals(db, user_id)
+            with span("schedule.build", goals=len(goals)):
+                schedule = build_schedule(goals, availability, start)
+            schedules[availability.key()] = schedule
+        else:
+            self.hits += 1
+            if schedule.calendar.start != start:
+                schedule.advance(start)
+        return schedule
+
+    async def _load_goals(self, db, user_id: str) -> List[dict]:
+        from api.goal_reads import GoalReader
+
+        return (await GoalReader(db).list_goals(user_id))['goals']
+
+    async def replan_users(self, db, user_ids: List[str], availability: Availability, start: Optional[date] = None,
+                           concurrency: int = MAX_CONCURRENT_REPLANS) -> Dict[str, dict]:
+        """
+        Batch mode: rebuild the schedules of many users from their snapshots and return a summary of each.
+        """
+        start = start or date.today()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def replan(user_id):
+            async with semaphore:
+                goals = await self._load_goals(db, user_id)
+            schedule = build_schedule(goals, availability, start)
+            self._schedules.setdefault(user_id, {})[availability.key()] = schedule
+            return schedule.plan(include_tasks=False)
+
+        with span("schedule.replan_users", users=len(user_ids)):
+            plans = await asyncio.gather(*(replan(user_id) for user_id in user_ids))
+        return dict(zip(user_ids, plans))
+
+    def add_goal(self, user_id: str, goal: dict):
+        for schedule in self._schedules.get(user_id, {}).values():
+            schedule.add_goal(goal)
+
+    def set_completed(self, user_id: str, tuid: str, completed: bool):
+        for schedule in self._schedules.get(user_id, {}).values():
+            if not schedule.set_completed(tuid, completed):
+                # A task this instance has not seen yet: rebuild on the next request
+                self.invalidate(user_id)
+                return
+
+    def invalidate(self, user_id: str):
+        self._schedules.pop(user_id, None)
+
+    def clear(self):
+        self._schedules.clear()
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "users": len(self._schedules)}
+
+
+schedule_index = ScheduleIndex()
+
+
+async def replan_schedules_job(payload: dict, progress):
+    """
+    Background job rebuilding the schedules of `payload["user_ids"]` for `payload["availability"]`.
+    """
+    from api.dependencies import firestore_db
+
+    progress(f"Replanning {len(payload['user_ids'])} schedules")
+    plans = await schedule_index.replan_users(firestore_db(), payload["user_ids"], Availability(**payload.get("availability", {})))
+    return {"schedules": plans}
+
+
+async def main(user_ids: List[str]):
+    from api.dependencies import firestore_db
+
+    plans = await schedule_index.replan_users(firestore_db(), user_ids, Availability())
+    for user_id, plan in plans.items():
+        print(f"User {user_id}: {plan['open_tasks']} tasks, finish {plan['finish']}, {plan['late_tasks']} late")
+
+
+if __name__ == "__main__":
+    import sys
+    asyncio.run(main(sys.argv[1:]))
@@ -0,0 +1,177 @@
+"""
+Conversion of stored goal trees between the storage layouts of api.persistence.
+
+    python -m api.storage_migration compact [user_id ...]
+    python -m api.storage_migration documents [user_id ...]
+
+User ids are read from stdin, one per line, when none are given, so the
+list can be piped from an export. Each user's goals are converted as they
+come from the goals query, at most MAX_CONCURRENT_MIGRATIONS at once, so
+memory use does not grow with the number of goals. Goals already in the
+target layout are skipped, which makes an interrupted run safe to restart.
+
+A goal is converted in one transaction when its writes fit in one. Larger
+trees are written in batches that keep the goal readable throughout: to
+the compact layout the goal document is written first and the old
+documents deleted after; to the documents layout the milestones, tasks and
+snapshot come first and the goal document last.
+
+Set GOAL_STORAGE_LAYOUT=compact before migrating to the compact layout;
+with the documents layout, dashboards only list goals that have a snapshot.
+"""
+import asyncio
+import sys
+from collections import Counter
+from typing import Iterable, List, Optional
+from api.goal_reads import GoalReader, goal_read_cache
+from api.persistence import (COMPACT_LAYOUT, DOCUMENTS_LAYOUT, LAYOUTS, MAX_BATCH_WRITES, MAX_COMPACT_BYTES,
+                             SNAPSHOTS_COLLECTION, GoalTreeWriter, compact_goal, document_size, is_compact, stage)
+from api.tracing import span
+
+MAX_CONCURRENT_MIGRATIONS = 8
+
+
+def plan_order(goal: dict, snapshot: Optional[dict]) -> dict:
+    """
+    The tree with milestones and tasks in the order of its snapshot, the order they were planned in.
+
+    Milestone and task documents keep no position, so load_tree orders milestones by deadline.
+    """
+    planned = (snapshot or {}).get('goal') or {}
+    positions = {}
+    for index, milestone in enumerate(planned.get('milestones', [])):
+        positions[milestone.get('muid')] = index
+        for task_index, task in enumerate(milestone.get('tasks', [])):
+            positions[task.get('tuid')] = task_index
+    last = len(positions)
+    milestones = sorted(goal['milestones'], key=lambda milestone: positions.get(milestone['muid'], last))
+    return {**goal, 'milestones': [
+        {**milestone, 'tasks': sorted(milestone['tasks'], key=lambda task: positions.get(task['tuid'], last))}
+        for milestone in milestones
+    ]}
+
+
+class StorageMigrator:
+
+    def __init__(self, db, concurrency: int = MAX_CONCURRENT_MIGRATIONS):
+        self.db = db
+        self.concurrency = concurrency
+        self.reader = GoalReader(db)
+
+    def _goal_ref(self, user_id: str, guid: str):
+        return self.db.collection('users', user_id, 'goals').document(guid)
+
+    def _snapshot_ref(self, user_id: str, guid: str):
+        return self.db.collection('users', user_id, SNAPSHOTS_COLLECTION).document(guid)
+
+    def conversion_writes(self, user_id: str, goal: dict, layout: str) -> Optional[List[tuple]]:
+        """
+        Writes converting a documents-layout tree to the compact layout or back, in a safe commit order.
+
+        None if the tree is too large for a compact document.
+        """
+        goal_ref = self._goal_ref(user_id, goal['guid'])
+        if layout == DOCUMENTS_LAYOUT:
+            return GoalTreeWriter(self.db, layout=DOCUMENTS_LAYOUT).tree_writes(user_id, goal)
+
+        document = compact_goal(goal)
+        if document_size(('users', user_id, 'goals', goal['guid']), document) > MAX_COMPACT_BYTES:
+            return None
+        deletes = [(self._snapshot_ref(user_id, goal['guid']), None)]
+        for milestone in goal['milestones']:
+            milestone_ref = goal_ref.collection('milestones').document(milestone['muid'])
+            deletes.append((milestone_ref, None))
+            deletes.extend((milestone_ref.collection('tasks').document(task['tuid']), None) for task in milestone['tasks'])
+        return [(goal_ref, document)] + deletes
+
+    async def migrate_goal(self, user_id: str, guid: str, layout: str) -> str:
+        """
+        Convert one goal to `layout`. Returns `converted`, `skipped` (already in it), `too_large` or `missing`.
+        """
+        from google.cloud.firestore import async_transactional
+
+        @async_transactional
+        async def convert(transaction):
+            (goal_doc, goal), snapshot_doc = await asyncio.gather(
+                self.reader.load_goal(user_id, guid, transaction=transaction),
+                self._snapshot_ref(user_id, guid).get(transaction=transaction),
+            )
+            if goal is None:
+                return "missing", None
+            if is_compact(goal_doc) == (layout == COMPACT_LAYOUT):
+                return "skipped", None
+            writes = self.conversion_writes(user_id, plan_order(goal, snapshot_doc.to_dict()), layout)
+            if writes is None:
+                return "too_large", None
+            if len(writes) > MAX_BATCH_WRITES:
+                return "converted", writes
+            stage(transaction, writes)
+            return "converted", None
+
+        with span("firestore.migrate_goal", "firestore", layout=layout) as attributes:
+            status, writes = await convert(self.db.transaction())
+            if writes is not None:
+                # Too many writes for a transaction; the first (to compact) or last (to documents) one switches layouts
+                writer = GoalTreeWriter(self.db)
+                if layout == COMPACT_LAYOUT:
+                    await writer.commit(writes[:1])
+                    await writer.commit(writes[1:])
+                else:
+                    await writer.commit(writes[:-1])
+                    await writer.commit(writes[-1:])
+            attributes.update(status=status, writes=len(writes) if writes is not None else None)
+        if status == "converted":
+            goal_read_cache.invalidate(user_id, guid)
+        return status
+
+    async def migrate_user(self, user_id: str, layout: str) -> Counter:
+        """
+        Convert every goal of a user, as the goals query streams them in.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        counts = Counter()
+
+        async def migrate(guid):
+            try:
+                counts[await self.migrate_goal(user_id, guid, layout)] += 1
+            finally:
+                semaphore.release()
+
+        migrations = []
+        async for goal_doc in self.db.collection('users', user_id, 'goals').stream():
+            if is_compact(goal_doc.to_dict()) == (layout == COMPACT_LAYOUT):
+                counts["skipped"] += 1
+                continue
+            await semaphore.acquire()
+            migrations.append(asyncio.ensure_future(migrate(goal_doc.id)))
+        await asyncio.gather(*migrations)
+        return counts
+
+    async def migrate_users(self, user_ids: Iterable[str], layout: str):
+        """
+        Convert the goals of each user in turn, yielding (user_id, counts) as each one is done.
+        """
+        for user_id in user_ids:
+            yield user_id, await self.migrate_user(user_id, layout)
+
+
+def read_user_ids(lines: Iterable[str]):
+    for line in lines:
+        if line.strip():
+            yield line.strip()
+
+
+async def main(layout: str, user_ids: List[str]):
+    from api.dependencies import firestore_db
+
+    if layout not in LAYOUTS:
+        raise SystemExit(f"Layout must be one of {', '.join(LAYOUTS)}")
+    totals = Counter()
+    async for user_id, counts in StorageMigrator(firestore_db()).migrate_users(user_ids or read_user_ids(sys.stdin), layout):
+        totals.update(counts)
+        print(f"User {user_id}: {dict(counts)}")
+    print(f"Total: {dict(totals)}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main(sys.argv[1], sys.argv[2:]))
@@ -0,0 +1,64 @@
+import json
+from typing import List, Optional
+
+
+class GoalStreamParser:
+    """
+    Incremental parser for the JSON text of a streamed `Goal`.
+
+    Feed it content deltas as they arrive; it scans each character once and
+    hands back every element of the top-level `milestones` array as soon as
+    its closing brace is seen. `header` holds the goal fields that precede
+    the milestones once the array opens.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.header: Optional[dict] = None
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._last_key = None
+        self._in_milestones = False
+        self._element_start = None
+
+    def feed(self, chunk: str) -> List[dict]:
+        self.buffer += chunk
+        completed = []
+        buffer = self.buffer
+
+        while self._pos < len(buffer):
+            char = buffer[self._pos]
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_key = buffer[self._string_start + 1:self._pos]
+            elif char == '"':
+                self._in_string = True
+                self._string_start = self._pos
+            elif char in '{[':
+                self._depth += 1
+                if char == '[' and self._depth == 2 and self._last_key == 'milestones':
+                    self._in_milestones = True
+                    self.header = json.loads(buffer[:self._pos] + '[]}')
+                elif char == '{' and self._depth == 3 and self._in_milestones:
+                    self._element_start = self._pos
+            elif char in '}]':
+                if char == '}' and self._depth == 3 and self._element_start is not None:
+                    completed.append(json.loads(buffer[self._element_start:self._pos + 1]))
+                    self._element_start = None
+                elif char == ']' and self._depth == 2:
+                    self._in_milestones = False
+                self._depth -= 1
+
+            self._pos += 1
+
+        return completed
@@ -0,0 +1,51 @@
+"""
+Structured output calls: the model's answer parsed into a Pydantic model.
+
+`parse_structured` routes the call with model_router and caches it with
+response_cache like any completion. A refusal, an answer that does not
+validate against `response_format`, or one for which `validate` returns a
+reason raises StructuredOutputError (or the subclass the caller passes)
+and is not cached. Refusals are counted in `llm_refusals_total`.
+"""
+from typing import Callable, Optional, Type
+from pydantic import ValidationError
+from api.model_router import model_router
+from api.prompt_builder import count_message_tokens, prompt_usage
+from api.response_cache import response_cache
+from api.tracing import metrics, span
+
+
+class StructuredOutputError(ValueError):
+    """
+    The model refused, or returned an answer that could not be used.
+    """
+
+
+def validation_summary(error: ValidationError) -> str:
+    """
+    The failing fields of a ValidationError and why, on one line.
+    """
+    return "; ".join(f"{'.'.join(str(part) for part in detail['loc']) or 'value'}: {detail['msg']}" for detail in error.errors())
+
+
+async def parse_structured(client, endpoint: str, messages: list, response_format, validate: Optional[Callable] = None,
+                           error: Type[StructuredOutputError] = StructuredOutputError):
+    choice = model_router.choose(endpoint, count_message_tokens(messages))
+
+    async def call(model):
+        with span(f"openai.{endpoint}", "openai", model=model):
+            try:
+                completion = await client.beta.chat.completions.parse(model=model, messages=messages, response_format=response_format, seed=42)
+            except ValidationError as e:
+                raise error(f"Invalid {response_format.__name__}: {validation_summary(e)}") from e
+            prompt_usage.record(endpoint, completion.usage)
+        message = completion.choices[0].message
+        if message.parsed is None:
+            metrics.increment("llm_refusals_total", endpoint=endpoint)
+            raise error(f"Refused: {message.refusal}")
+        issue = validate(message.parsed) if validate is not None else None
+        if issue is not None:
+            raise error(issue)
+        return message.parsed
+
+    return await response_cache.get_or_call(endpoint, choice.model, messages, lambda: model_router.call(choice, call), response_format)
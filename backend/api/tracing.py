@@ -0,0 +1,340 @@
+"""
+Request tracing: spans, latency histograms and structured logs.
+
+`span(name, kind)` times a block (a Firestore read, an OpenAI call...) into
+the `span_duration_seconds` histogram and into the trace of the current
+request, which TracingMiddleware returns as a `Server-Timing` header and
+logs when the request ends. Histograms, counters and gauges are served in
+the Prometheus text format at /metrics; with OTEL_TRACING=True and the
+OpenTelemetry API installed, spans are also opened as OpenTelemetry spans.
+
+With PROFILING_ENABLED=True and pyinstrument installed, a request sent with
+an `X-Profile: true` header is run under the sampling profiler and answered
+with its HTML report instead of the normal response.
+"""
+import contextvars
+import json
+import logging
+import math
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+PROFILE_HEADER = b"x-profile"
+REQUEST_ID_HEADER = b"x-request-id"
+# Route label of requests that matched no route
+UNMATCHED_ROUTE = "<unmatched>"
+
+logger = logging.getLogger("goal_tracker")
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+_tracer = None
+
+
+class Histogram:
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: dict) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(labels) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+class Metrics:
+    """
+    Process-wide histograms, counters and gauges, keyed by name and labels.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms: Dict[str, Dict[tuple, Histogram]] = {}
+        self.counters: Dict[str, Dict[tuple, float]] = {}
+        self.gauges: Dict[str, Dict[tuple, float]] = {}
+
+    def observe(self, name: str, value: float, **labels):
+        with self._lock:
+            series = self.histograms.setdefault(name, {})
+            key = _labels(labels)
+            if key not in series:
+                series[key] = Histogram()
+            series[key].observe(value)
+
+    def increment(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            series = self.counters.setdefault(name, {})
+            key = _labels(labels)
+            series[key] = series.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self._lock:
+            self.gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def histogram(self, name: str, **labels) -> Optional[Histogram]:
+        return self.histograms.get(name, {}).get(_labels(labels))
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            for name, series in sorted(self.histograms.items()):
+                lines.append(f"# TYPE {name} histogram")
+                for labels, histogram in series.items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bound == math.inf else repr(bound)
+                        lines.append(f"{name}_bucket{_format_labels(labels, ('le', le))} {cumulative}")
+                    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+                    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            for name, series in sorted(self.counters.items()):
+                lines.append(f"# TYPE {name} counter")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for name, series in sorted(self.gauges.items()):
+                lines.append(f"# TYPE {name} gauge")
+                for labels, value in series.items():
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+            self.gauges = {}
+
+
+metrics = Metrics()
+
+
+class Trace:
+    """
+    Spans recorded while handling one request.
+    """
+
+    def __init__(self, request_id: str):
+        self.request_id = request_id
+        self.spans = []
+
+    def breakdown(self) -> Dict[str, dict]:
+        """
+        Total time and count per span name.
+        """
+        totals = {}
+        for name, _, duration, _ in self.spans:
+            total = totals.setdefault(name, {"count": 0, "ms": 0.0})
+            total["count"] += 1
+            total["ms"] += duration * 1000
+        return {name: {"count": total["count"], "ms": round(total["ms"], 1)} for name, total in totals.items()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f'{name.replace(".", "-")};dur={total["ms"]:.1f};desc="{total["count"]}x"' for name, total in self.breakdown().items())
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+def configure_tracing():
+    global _tracer
+    if os.getenv('OTEL_TRACING', 'False') == 'True':
+        try:
+            from opentelemetry import trace
+        except ImportError:
+            logger.warning("OTEL_TRACING is set but opentelemetry-api is not installed")
+            return
+        _tracer = trace.get_tracer("goal_tracker")
+
+
+def record_span(name: str, kind: str, duration: float, attributes: dict):
+    """
+    Record a span timed by the caller, e.g. one that spans the yields of a generator.
+    """
+    metrics.observe("span_duration_seconds", duration, span=name, kind=kind)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.spans.append((name, kind, duration, attributes))
+
+
+@contextmanager
+def span(name: str, kind: str = "internal", **attributes):
+    """
+    Time the enclosed block as a span. Yields its attribute dict, which the block (or `annotate`) can add to.
+    """
+    attributes = dict(attributes)
+    otel = _tracer.start_as_current_span(name) if _tracer is not None else None
+    otel_span = otel.__enter__() if otel is not None else None
+    token = _current_span.set(attributes)
+    start = time.perf_counter()
+    try:
+        yield attributes
+    except BaseException as e:
+        attributes["error"] = type(e).__name__
+        raise
+    finally:
+        _current_span.reset(token)
+        record_span(name, kind, time.perf_counter() - start, attributes)
+        if otel is not None:
+            otel_span.set_attributes({key: value for key, value in attributes.items() if isinstance(value, (str, int, float, bool))})
+            otel.__exit__(*sys.exc_info())
+
+
+def annotate(**attributes):
+    """
+    Add attributes to the innermost open span, if any.
+    """
+    current = _current_span.get()
+    if current is not None:
+        current.update(attributes)
+
+
+# --------------------------------
+# Structured logging
+
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line, with the `extra` fields of the call and the current request id.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        trace = _current_trace.get()
+        if trace is not None:
+            entry["request_id"] = trace.request_id
+        entry.update({key: value for key, value in vars(record).items() if key not in _RECORD_FIELDS})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure_logging():
+    """
+    Log as JSON lines to stderr, or as plain text with LOG_FORMAT=text.
+    """
+    handler = logging.StreamHandler()
+    if os.getenv('LOG_FORMAT', 'json') == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+    logger.handlers = [handler]
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO'))
+    logger.propagate = False
+
+
+# --------------------------------
+# Middleware
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", []):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+class TracingMiddleware:
+    """
+    ASGI middleware that traces each HTTP request.
+
+    Records `http_request_duration_seconds` by route template, with requests
+    that matched no route under one `<unmatched>` label, adds `X-Request-ID`
+    and `Server-Timing` (span breakdown) headers, and logs one line per
+    request with its spans.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace(_header(scope, REQUEST_ID_HEADER) or uuid.uuid4().hex)
+        token = _current_trace.set(trace)
+        status = 500
+        start = time.perf_counter()
+
+        async def send_with_headers(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", trace.request_id.encode()))
+                if trace.spans:
+                    headers.append((b"server-timing", trace.server_timing().encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            if _profiling_requested(scope):
+                status = await self._profile(scope, receive, send)
+            else:
+                await self.app(scope, receive, send_with_headers)
+        finally:
+            duration = time.perf_counter() - start
+            # Raw paths of unmatched requests would add a label value per URL a client makes up
+            route = getattr(scope.get("route"), "path", UNMATCHED_ROUTE)
+            metrics.observe("http_request_duration_seconds", duration, method=scope["method"], route=route, status=status)
+            logger.info("request", extra={
+                "method": scope["method"], "route": route, "path": scope["path"], "status": status,
+                "duration_ms": round(duration * 1000, 1), "spans": trace.breakdown(),
+            })
+            _current_trace.reset(token)
+
+    async def _profile(self, scope, receive, send):
+        from pyinstrument import Profiler
+
+        async def discard(message):
+            pass
+
+        profiler = Profiler(async_mode="enabled")
+        profiler.start()
+        try:
+            await self.app(scope, receive, discard)
+        finally:
+            profiler.stop()
+        body = profiler.output_html().encode()
+        await send({"type": "http.response.start", "status": 200, "headers": [(b"content-type", b"text/html; charset=utf-8"), (b"content-length", str(len(body)).encode())]})
+        await send({"type": "http.response.body", "body": body})
+        return 200
+
+
+def _profiling_requested(scope) -> bool:
+    if os.getenv('PROFILING_ENABLED', 'False') != 'True' or _header(scope, PROFILE_HEADER) not in ("1", "true"):
+        return False
+    try:
+        import pyinstrument  # noqa: F401
+    except ImportError:
+        return False
+    return True
@@ -0,0 +1,230 @@
+import asyncio
+import io
+import mmap
+import os
+import re
+import shutil
+import struct
+import tempfile
+from typing import BinaryIO, List
+
+TRANSCRIPTION_MODEL = "whisper-1"
+# Whisper rejects uploads over 25 MB; stay below it with room for the multipart envelope
+MAX_UPLOAD_BYTES = 24 * 1024 * 1024
+CHUNK_SECONDS = 600
+# Consecutive chunks share this much audio so words cut at a boundary appear whole in one of them
+OVERLAP_SECONDS = 2
+MAX_CONCURRENT_TRANSCRIPTIONS = 4
+# Longest run of duplicated words searched for when stitching two chunk transcripts
+MAX_OVERLAP_WORDS = 40
+
+
+class UnsupportedAudioError(ValueError):
+    """
+    The upload is too long to send whole and could not be decoded to WAV for splitting.
+    """
+
+
+class WavSlice(io.RawIOBase):
+    """
+    Read-only file object presenting a range of PCM frames as a standalone WAV file.
+
+    The bytes come straight from `buffer` (usually an mmap of the upload), so
+    building a chunk copies nothing beyond its header.
+    """
+
+    def __init__(self, header: bytes, buffer, start: int, end: int):
+        self._header = header
+        self._data = memoryview(buffer)[start:end]
+        self._size = len(header) + len(self._data)
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self._size
+        self._position = max(0, min(offset, self._size))
+        return self._position
+
+    def readinto(self, b):
+        written = 0
+        target = memoryview(b).cast("B")
+        while written < len(target) and self._position < self._size:
+            if self._position < len(self._header):
+                source = self._header[self._position:]
+            else:
+                source = self._data[self._position - len(self._header):]
+            count = min(len(source), len(target) - written)
+            target[written:written + count] = source[:count]
+            written += count
+            self._position += count
+        return written
+
+    def close(self):
+        self._data.release()
+        super().close()
+
+
+class WavLayout:
+    """
+    The `fmt ` chunk and PCM data range of a WAV file.
+    """
+
+    def __init__(self, fmt_chunk: bytes, data_start: int, data_end: int):
+        self.fmt_chunk = fmt_chunk
+        self.data_start = data_start
+        self.data_end = data_end
+        self.byte_rate, self.block_align = struct.unpack("<IH", fmt_chunk[16:22])
+
+    @property
+    def seconds(self) -> float:
+        return (self.data_end - self.data_start) / self.byte_rate
+
+    def header(self, data_size: int) -> bytes:
+        return b"RIFF" + struct.pack("<I", 4 + len(self.fmt_chunk) + 8 + data_size) + b"WAVE" + self.fmt_chunk + b"data" + struct.pack("<I", data_size)
+
+
+def parse_wav(file: BinaryIO, size: int):
+    """
+    Return the WavLayout of `file`, or None if it is not a WAV file.
+    """
+    file.seek(0)
+    if file.read(4) != b"RIFF" or file.read(8)[4:] != b"WAVE":
+        return None
+    fmt_chunk = None
+    while True:
+        chunk_header = file.read(8)
+        if len(chunk_header) < 8:
+            return None
+        chunk_id, chunk_size = chunk_header[:4], struct.unpack("<I", chunk_header[4:])[0]
+        if chunk_id == b"fmt ":
+            fmt_chunk = chunk_header + file.read(chunk_size + chunk_size % 2)
+        elif chunk_id == b"data":
+            if fmt_chunk is None:
+                return None
+            data_start = file.tell()
+            # Recorders that stream WAV often leave the size unset; trust the file length instead
+            data_end = min(size, data_start + chunk_size) if chunk_size not in (0, 0xFFFFFFFF) else size
+            layout = WavLayout(fmt_chunk, data_start, data_end)
+            return layout if layout.byte_rate and layout.block_align else None
+        else:
+            file.seek(chunk_size + chunk_size % 2, io.SEEK_CUR)
+
+
+def wav_chunks(buffer, layout: WavLayout, chunk_seconds: float = CHUNK_SECONDS, overlap_seconds: float = OVERLAP_SECONDS, max_bytes: int = MAX_UPLOAD_BYTES) -> List[WavSlice]:
+    """
+    Split the PCM data into overlapping WAV slices of at most `max_bytes` each.
+    """
+    header_size = len(layout.header(0))
+    chunk_bytes = min(int(chunk_seconds * layout.byte_rate), max_bytes - header_size)
+    chunk_bytes -= chunk_bytes % layout.block_align
+    overlap_bytes = int(overlap_seconds * layout.byte_rate)
+    overlap_bytes -= overlap_bytes % layout.block_align
+    step = max(layout.block_align, chunk_bytes - overlap_bytes)
+
+    chunks = []
+    start = layout.data_start
+    while True:
+        end = min(start + chunk_bytes, layout.data_end)
+        chunks.append(WavSlice(layout.header(end - start), buffer, start, end))
+        if end >= layout.data_end:
+            return chunks
+        start += step
+
+
+def _normalize(word: str) -> str:
+    return re.sub(r"[^\w']", "", word.lower())
+
+
+def stitch_transcripts(transcripts: List[str], max_overlap_words: int = MAX_OVERLAP_WORDS) -> str:
+    """
+    Join chunk transcripts in order, dropping the words each chunk repeats from the end of the previous one.
+    """
+    words = []
+    for transcript in transcripts:
+        chunk_words = transcript.split()
+        tail = [_normalize(word) for word in words[-max_overlap_words:]]
+        head = [_normalize(word) for word in chunk_words[:max_overlap_words]]
+        overlap = 0
+        for size in range(min(len(tail), len(head)), 0, -1):
+            if tail[-size:] == head[:size]:
+                overlap = size
+                break
+        words.extend(chunk_words[overlap:])
+    return " ".join(words)
+
+
+async def _convert_to_wav(file: BinaryIO) -> BinaryIO:
+    """
+    Decode a compressed upload to 16 kHz mono WAV with ffmpeg, into a temporary file.
+    """
+    if shutil.which("ffmpeg") is None:
+        raise UnsupportedAudioError(f"Audio over {MAX_UPLOAD_BYTES // (1024 * 1024)} MB must be WAV, or ffmpeg must be installed to split it")
+    output = tempfile.NamedTemporaryFile(suffix=".wav")
+    file.seek(0)
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", "pipe:0", "-ac", "1", "-ar", "16000", "-f", "wav", output.name,
+        stdin=file.fileno(), stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        output.close()
+        raise UnsupportedAudioError(f"Could not decode audio: {stderr.decode(errors='replace').strip()}")
+    return output
+
+
+async def transcribe_audio(client, file: BinaryIO, filename: str, model: str = TRANSCRIPTION_MODEL, max_concurrency: int = MAX_CONCURRENT_TRANSCRIPTIONS) -> str:
+    """
+    Transcribe an uploaded audio file without reading it into memory.
+
+    Files under the upload limit are sent as they are. Longer WAV files are
+    memory-mapped and split into overlapping chunks that are transcribed
+    concurrently, at most `max_concurrency` at a time, and stitched back in
+    order. Other formats are first decoded to WAV with ffmpeg; audio that
+    cannot be decoded raises UnsupportedAudioError.
+    """
+    file.seek(0, io.SEEK_END)
+    size = file.tell()
+    file.seek(0)
+    if size <= MAX_UPLOAD_BYTES:
+        return await client.audio.transcriptions.create(model=model, file=(filename, file), response_format="text")
+
+    converted = None
+    layout = parse_wav(file, size)
+    if layout is None:
+        converted = file = await _convert_to_wav(file)
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+        layout = parse_wav(file, size)
+        if layout is None:
+            converted.close()
+            raise UnsupportedAudioError("ffmpeg did not produce a readable WAV file")
+    name = os.path.splitext(filename)[0]
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def transcribe_chunk(index: int, chunk: WavSlice) -> str:
+        async with semaphore:
+            return await client.audio.transcriptions.create(model=model, file=(f"{name}-{index}.wav", chunk), response_format="text")
+
+    buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    chunks = wav_chunks(buffer, layout)
+    try:
+        transcripts = await asyncio.gather(*(transcribe_chunk(index, chunk) for index, chunk in enumerate(chunks)))
+    finally:
+        for chunk in chunks:
+            chunk.close()
+        buffer.close()
+        if converted is not None:
+            converted.close()
+    return stitch_transcripts(transcripts)
+
@@ -0,0 +1,177 @@
+"""
+Concurrency cap and adaptive rate limiting of upstream LLM calls.
+
+Kept free of httpx so importing it (e.g. for the stats route) stays cheap;
+api.http_clients plugs it into the transport of the shared HTTP clients.
+"""
+import asyncio
+import re
+import time
+from typing import Callable, Dict, Optional
+
+MAX_CONCURRENT_LLM_CALLS = 32
+# Pause new calls until the window resets once less than this share of a rate limit remains
+RATE_LIMIT_LOW_WATERMARK = 0.05
+# Pause after a 429 that says neither when to retry nor when the limit resets
+DEFAULT_RATE_LIMIT_PAUSE_SECONDS = 1.0
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"h": 3600.0, "m": 60.0, "s": 1.0, "ms": 0.001}
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Seconds in an `x-ratelimit-reset-*` value such as "20ms", "1s" or "6m0s".
+    """
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(number) * _DURATION_UNITS[unit] for number, unit in parts)
+
+
+def retry_after(headers) -> Optional[float]:
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    return None
+
+
+def _number(value: Optional[str]) -> Optional[float]:
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class RateLimitState:
+    """
+    Rate limit budget reported by the `x-ratelimit-*` response headers.
+
+    When a budget is nearly spent, or a call gets a 429, every new call waits
+    until the reported reset instead of adding to a storm of 429s and retries.
+    """
+
+    def __init__(self, low_watermark: float = RATE_LIMIT_LOW_WATERMARK):
+        self.low_watermark = low_watermark
+        self.paused_until = 0.0
+        self.budgets = {}
+        self.rate_limited = 0
+        self.pauses = 0
+
+    def update(self, status_code: int, headers):
+        pause = 0.0
+        for kind in ("requests", "tokens"):
+            limit = _number(headers.get(f"x-ratelimit-limit-{kind}"))
+            remaining = _number(headers.get(f"x-ratelimit-remaining-{kind}"))
+            reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+            if limit is None or remaining is None:
+                continue
+            self.budgets[kind] = {"limit": limit, "remaining": remaining, "reset_seconds": reset}
+            if reset and remaining <= limit * self.low_watermark:
+                pause = max(pause, reset)
+
+        if status_code == 429:
+            self.rate_limited += 1
+            resets = [budget["reset_seconds"] or 0.0 for budget in self.budgets.values()]
+            pause = max(pause, retry_after(headers) or max(resets, default=0.0) or DEFAULT_RATE_LIMIT_PAUSE_SECONDS)
+
+        if pause:
+            paused_until = time.monotonic() + pause
+            if paused_until > self.paused_until:
+                self.paused_until = paused_until
+                self.pauses += 1
+
+    async def wait(self):
+        while True:
+            delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        return {
+            "rate_limited": self.rate_limited,
+            "pauses": self.pauses,
+            "paused_for_seconds": max(0.0, self.paused_until - time.monotonic()),
+            "budgets": self.budgets,
+        }
+
+
+class UpstreamLimiter:
+    """
+    Caps concurrent upstream LLM calls and records how long calls queue for a slot.
+
+    A slot is held from before the request is sent until its response body is
+    closed, so streamed completions count for as long as they stream. HTTP
+    clients register their connection pool stats under a name to be reported
+    alongside.
+    """
+
+    def __init__(self, max_concurrency: int = MAX_CONCURRENT_LLM_CALLS, rate_limits: Optional[RateLimitState] = None):
+        self.max_concurrency = max_concurrency
+        self.rate_limits = rate_limits if rate_limits is not None else RateLimitState()
+        self.pools: Dict[str, Callable[[], dict]] = {}
+        self._semaphore = None
+        self.calls = 0
+        self.waiting = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def acquire(self) -> float:
+        """
+        Wait for a free slot, then for any rate limit pause to end. Returns the seconds waited.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        start = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        try:
+            await self.rate_limits.wait()
+        except BaseException:
+            self._semaphore.release()
+            raise
+        waited = time.perf_counter() - start
+        self.calls += 1
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        return waited
+
+    def release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "calls": self.calls,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "waiting": self.waiting,
+            "mean_wait_ms": self.total_wait / self.calls * 1000 if self.calls else 0.0,
+            "max_wait_ms": self.max_wait * 1000,
+            "rate_limits": self.rate_limits.stats(),
+            "pools": {name: pool_stats() for name, pool_stats in self.pools.items()},
+        }
+
+
+upstream_limiter = UpstreamLimiter()
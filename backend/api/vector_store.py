@@ -0,0 +1,268 @@
+import json
+import os
+from abc import ABC, abstractmethod
+from typing import Dict, List, Optional
+import numpy as np
+
+# Metadata fields the local store indexes for filtering
+FILTER_FIELDS = ("user_id", "guid")
+# Pinecone recommends upserting at most 100 vectors per request
+PINECONE_UPSERT_BATCH_SIZE = 100
+
+
+class VectorStore(ABC):
+    """
+    Similarity search over goal and task embeddings.
+
+    Vectors are dicts of `id`, `values` and optional `metadata`, as in Pinecone.
+    Query results are dicts of `id`, `score` (cosine similarity) and `metadata`.
+    `filter` is an equality match on metadata, e.g. `{"user_id": "abc"}`.
+    """
+
+    @abstractmethod
+    def upsert(self, vectors: List[dict]):
+        pass
+
+    def query(self, vector, top_k: int = 10, filter: Optional[Dict[str, str]] = None) -> List[dict]:
+        return self.query_batch([vector], top_k, filter)[0]
+
+    @abstractmethod
+    def query_batch(self, vectors, top_k: int = 10, filter: Optional[Dict[str, str]] = None) -> List[List[dict]]:
+        pass
+
+    @abstractmethod
+    def delete(self, ids: List[str]):
+        pass
+
+
+class PineconeVectorStore(VectorStore):
+    """
+    VectorStore backed by a Pinecone index, reusing a single index handle.
+    """
+
+    def __init__(self, pc, index_name: str):
+        self.index = pc.Index(index_name)
+
+    def upsert(self, vectors: List[dict]):
+        for start in range(0, len(vectors), PINECONE_UPSERT_BATCH_SIZE):
+            self.index.upsert(vectors=vectors[start:start + PINECONE_UPSERT_BATCH_SIZE])
+
+    def query_batch(self, vectors, top_k: int = 10, filter: Optional[Dict[str, str]] = None) -> List[List[dict]]:
+        pinecone_filter = {field: {"$eq": value} for field, value in filter.items()} if filter else None
+        results = []
+        for vector in vectors:
+            response = self.index.query(vector=list(vector), top_k=top_k, filter=pinecone_filter, include_metadata=True)
+            results.append([{"id": match.id, "score": match.score, "metadata": match.metadata} for match in response.matches])
+        return results
+
+    def delete(self, ids: List[str]):
+        self.index.delete(ids=ids)
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process VectorStore: brute-force cosine search over a NumPy matrix.
+
+    Vectors are normalized on upsert so a query is one matrix product. `user_id`
+    and `guid` are stored as integer codes so filters are vectorized masks.
+    `build_ivf` adds an approximate inverted-file index that only scores the
+    `n_probe` closest clusters. `save`/`load` persist the store, and a loaded
+    store can be memory-mapped instead of read into RAM.
+    """
+
+    def __init__(self, dimension: int, capacity: int = 1024):
+        self.dimension = dimension
+        self._vectors = np.zeros((capacity, dimension), dtype=np.float32)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self._codes = {field: np.full(capacity, -1, dtype=np.int32) for field in FILTER_FIELDS}
+        self._code_of = {field: {} for field in FILTER_FIELDS}
+        self._ids: List[Optional[str]] = []
+        self._metadata: List[Optional[dict]] = []
+        self._row_of: Dict[str, int] = {}
+        self._centroids = None
+        self._assignments = None
+        self.n_probe = 0
+
+    def __len__(self):
+        return len(self._row_of)
+
+    def _ensure_capacity(self, size: int):
+        capacity = len(self._alive)
+        if size <= capacity and self._vectors.flags.writeable:
+            return
+        capacity = max(size, capacity * 2)
+        used = len(self._alive)
+        vectors = np.zeros((capacity, self.dimension), dtype=np.float32)
+        vectors[:used] = self._vectors[:used]
+        self._vectors = vectors
+        alive = np.zeros(capacity, dtype=bool)
+        alive[:used] = self._alive
+        self._alive = alive
+        for field in FILTER_FIELDS:
+            codes = np.full(capacity, -1, dtype=np.int32)
+            codes[:used] = self._codes[field][:used]
+            self._codes[field] = codes
+        if self._assignments is not None:
+            assignments = np.full(capacity, -1, dtype=np.int32)
+            assignments[:used] = self._assignments[:used]
+            self._assignments = assignments
+
+    def upsert(self, vectors: List[dict]):
+        if not vectors:
+            return
+        rows = []
+        for vector in vectors:
+            row = self._row_of.get(vector["id"])
+            if row is None:
+                row = len(self._ids)
+                self._ids.append(vector["id"])
+                self._metadata.append(None)
+                self._row_of[vector["id"]] = row
+            rows.append(row)
+        self._ensure_capacity(len(self._ids))
+
+        rows = np.asarray(rows)
+        values = np.asarray([vector["values"] for vector in vectors], dtype=np.float32)
+        if values.shape[1] != self.dimension:
+            raise ValueError(f"Vector dimension {values.shape[1]} does not match store dimension {self.dimension}")
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        self._vectors[rows] = values / np.where(norms == 0, 1, norms)
+        self._alive[rows] = True
+
+        for row, vector in zip(rows, vectors):
+            metadata = vector.get("metadata") or {}
+            self._metadata[row] = metadata
+            for field in FILTER_FIELDS:
+                value = metadata.get(field)
+                self._codes[field][row] = -1 if value is None else self._code_of[field].setdefault(value, len(self._code_of[field]))
+
+        if self._centroids is not None:
+            self._assignments[rows] = np.argmax(self._vectors[rows] @ self._centroids.T, axis=1)
+
+    def delete(self, ids: List[str]):
+        for id in ids:
+            row = self._row_of.pop(id, None)
+            if row is not None:
+                self._alive[row] = False
+                self._ids[row] = None
+                self._metadata[row] = None
+
+    def _filter_mask(self, filter: Optional[Dict[str, str]]):
+        size = len(self._ids)
+        mask = self._alive[:size].copy()
+        for field, value in (filter or {}).items():
+            if field not in self._codes:
+                raise ValueError(f"Cannot filter on {field}; filterable fields are {FILTER_FIELDS}")
+            code = self._code_of[field].get(value)
+            if code is None:
+                return np.zeros(size, dtype=bool)
+            mask &= self._codes[field][:size] == code
+        return mask
+
+    def query_batch(self, vectors, top_k: int = 10, filter: Optional[Dict[str, str]] = None) -> List[List[dict]]:
+        queries = np.asarray(vectors, dtype=np.float32).reshape(-1, self.dimension)
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        mask = self._filter_mask(filter)
+
+        if self._centroids is None:
+            candidates = np.flatnonzero(mask)
+            # Bound the (queries x candidates) score matrix to about 16M floats
+            step = max(1, 16_000_000 // max(1, len(candidates)))
+            results = []
+            for start in range(0, len(queries), step):
+                results.extend(self._top_k(queries[start:start + step], candidates, top_k))
+            return results
+
+        # Approximate search: only score rows in the n_probe closest clusters of each query
+        probes = np.argsort(-(queries @ self._centroids.T), axis=1)[:, :self.n_probe]
+        assignments = self._assignments[:len(self._ids)]
+        results = []
+        for query, probe in zip(queries, probes):
+            selected = np.zeros(len(self._centroids), dtype=bool)
+            selected[probe] = True
+            candidates = np.flatnonzero(mask & selected[assignments])
+            results.extend(self._top_k(query[None, :], candidates, top_k))
+        return results
+
+    def _top_k(self, queries, candidates, top_k: int) -> List[List[dict]]:
+        if len(candidates) == 0:
+            return [[] for _ in queries]
+        if len(candidates) == len(self._ids):
+            # Nothing filtered out: score the matrix in place instead of gathering a copy
+            scores = queries @ self._vectors[:len(candidates)].T
+        else:
+            scores = queries @ self._vectors[candidates].T
+        k = min(top_k, len(candidates))
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        results = []
+        for query_scores, query_top in zip(scores, top):
+            query_top = query_top[np.argsort(-query_scores[query_top])]
+            results.append([
+                {"id": self._ids[candidates[i]], "score": float(query_scores[i]), "metadata": self._metadata[candidates[i]]}
+                for i in query_top
+            ])
+        return results
+
+    def build_ivf(self, n_lists: Optional[int] = None, n_probe: int = 8, iterations: int = 10, sample_size: int = 50_000, seed: int = 0):
+        """
+        Cluster the vectors with spherical k-means and switch queries to approximate IVF search.
+
+        `n_lists` defaults to about sqrt(n), and is capped at the vectors
+        sampled. More `n_probe` trades latency for recall. Raises ValueError
+        on a store without vectors, which has nothing to cluster.
+        """
+        rows = np.flatnonzero(self._alive[:len(self._ids)])
+        if not len(rows):
+            raise ValueError("Cannot build an IVF index on an empty vector store")
+        rng = np.random.default_rng(seed)
+        sample = self._vectors[rng.choice(rows, size=min(sample_size, len(rows)), replace=False)]
+        n_lists = min(n_lists or max(1, int(np.sqrt(len(rows)))), len(sample))
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)]
+
+        for _ in range(iterations):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Keep the previous centroid for clusters that lost all their points
+            centroids = np.where(norms > 0, sums / np.where(norms == 0, 1, norms), centroids)
+
+        self._ensure_capacity(len(self._ids))
+        self._centroids = centroids.astype(np.float32)
+        self._assignments = np.full(len(self._alive), -1, dtype=np.int32)
+        for start in range(0, len(self._ids), 65_536):
+            block = self._vectors[start:min(start + 65_536, len(self._ids))]
+            self._assignments[start:start + len(block)] = np.argmax(block @ self._centroids.T, axis=1)
+        self.n_probe = min(n_probe, n_lists)
+
+    def drop_ivf(self):
+        self._centroids = None
+        self._assignments = None
+
+    def save(self, path: str):
+        os.makedirs(path, exist_ok=True)
+        size = len(self._ids)
+        np.save(os.path.join(path, "vectors.npy"), self._vectors[:size])
+        np.save(os.path.join(path, "alive.npy"), self._alive[:size])
+        for field in FILTER_FIELDS:
+            np.save(os.path.join(path, f"{field}.npy"), self._codes[field][:size])
+        with open(os.path.join(path, "metadata.json"), "w") as f:
+            json.dump({"dimension": self.dimension, "ids": self._ids, "metadata": self._metadata, "codes": self._code_of}, f)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "LocalVectorStore":
+        """
+        Load a saved store. With `mmap`, vectors stay on disk and are paged in on demand (read-only until the next upsert).
+        """
+        with open(os.path.join(path, "metadata.json")) as f:
+            saved = json.load(f)
+        store = cls(saved["dimension"], capacity=0)
+        store._vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r" if mmap else None)
+        store._alive = np.load(os.path.join(path, "alive.npy"))
+        store._codes = {field: np.load(os.path.join(path, f"{field}.npy")) for field in FILTER_FIELDS}
+        store._code_of = saved["codes"]
+        store._ids = saved["ids"]
+        store._metadata = saved["metadata"]
+        store._row_of = {id: row for row, id in enumerate(store._ids) if id is not None}
+        return store
@@ -0,0 +1,190 @@
+"""
+Admission control under a noisy client and under overload.
+
+The fake OpenAI account serves `--capacity` calls at once, `--latency`
+seconds each; calls beyond that queue at the fake, like an exhausted quota.
+
+- noisy neighbour: one user bursts `--burst` /smart_goal requests while
+  `--users` other users each send a few. Without admission control the
+  burst fills the upstream and everyone waits behind it; with it, the burst
+  is cut at the user's bucket and the others keep their latency.
+- overload: `--overload` distinct users (each within their rate) arrive at
+  once. Without admission control every request waits its turn; with it,
+  requests whose expected queue wait exceeds the SLO get a 429 and a
+  Retry-After at once, and admitted requests stay within the SLO.
+
+Then checks the Retry-After values, the metrics, that shed requests keep
+their token, that a user id claimed from another address gets its own
+bucket, the user of a multipart upload (X-User-ID header) and a bucket
+shared by two workers through SQLite, which admits without a token rather
+than stall the event loop while another process holds it.
+
+Usage (from backend/):
+    python -m benchmarks.bench_admission [--capacity 8] [--latency 0.2] [--burst 200] [--users 10] [--overload 200]
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+
+import httpx
+
+from api.admission import AdmissionClass, AdmissionController, SQLiteBucketBackend, admission_controller
+from api.model_router import model_router
+from api.tracing import metrics
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, load_app
+
+PRE_GOAL = {"what": "Run a marathon", "why": "Health", "when": "April 2027"}
+
+
+def limited_client(capacity: int, latency: float) -> FakeAsyncOpenAI:
+    """
+    A fake client that serves at most `capacity` chat calls at once.
+    """
+    client = FakeAsyncOpenAI(latency=latency)
+    semaphore = asyncio.Semaphore(capacity)
+    create = client.chat.completions.create
+
+    async def limited(**kwargs):
+        async with semaphore:
+            return await create(**kwargs)
+
+    client.chat.completions.create = limited
+    return client
+
+
+def bench_classes(capacity: int, latency: float, slo: float) -> dict:
+    return {"llm": AdmissionClass(paths=["/smart_goal"], rate=1.0, burst=5, max_concurrency=capacity, queue_slo=slo, expected_seconds=latency)}
+
+
+async def post(http, user_id: str, results: list):
+    start = time.perf_counter()
+    response = await http.post("/smart_goal", json={"user_id": user_id, "pre_goal_data": PRE_GOAL})
+    results.append((user_id, response.status_code, time.perf_counter() - start, response.headers.get("retry-after")))
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))] * 1000 if values else 0.0
+
+
+async def noisy_neighbour(app, capacity: int, latency: float, burst: int, users: int):
+    print(f"Noisy neighbour: one user sends {burst} requests at once, {users} others 3 each; upstream serves {capacity} at {latency * 1000:.0f} ms")
+    print(f"{'admission':>10} {'others p50':>11} {'others p95':>11} {'noisy ok':>9} {'noisy 429':>10} {'upstream calls':>15}")
+    for enabled in (False, True):
+        client = limited_client(capacity, latency)
+        load_app(client, FakeFirestore())
+        admission_controller.configure(bench_classes(capacity, latency, slo=2.0))
+        admission_controller.enabled = enabled
+        results = []
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=120) as http:
+            noisy = [asyncio.ensure_future(post(http, "noisy", results)) for _ in range(burst)]
+            await asyncio.sleep(0.05)
+            for _ in range(3):
+                await asyncio.gather(*(post(http, f"user-{index}", results) for index in range(users)))
+            await asyncio.gather(*noisy)
+        others = [elapsed for user, status, elapsed, _ in results if user != "noisy" and status == 200]
+        noisy_statuses = [status for user, status, _, _ in results if user == "noisy"]
+        assert len(others) == 3 * users
+        print(f"{'on' if enabled else 'off':>10} {percentile(others, 0.5):>11.1f} {percentile(others, 0.95):>11.1f} "
+              f"{noisy_statuses.count(200):>9} {noisy_statuses.count(429):>10} {client.calls:>15}")
+    print()
+
+
+async def overload(app, capacity: int, latency: float, requests: int, slo: float):
+    print(f"Overload: {requests} users send one request each at once, queue SLO {slo * 1000:.0f} ms")
+    print(f"{'admission':>10} {'ok':>5} {'429':>5} {'shed early':>11} {'ok p50':>8} {'ok p99':>8} {'429 p50':>8} {'retry-after s':>14}")
+    for enabled in (False, True):
+        load_app(limited_client(capacity, latency), FakeFirestore())
+        admission_controller.configure(bench_classes(capacity, latency, slo))
+        admission_controller.enabled = enabled
+        results = []
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench", timeout=120) as http:
+            await asyncio.gather(*(post(http, f"user-{index}", results) for index in range(requests)))
+        ok = [elapsed for _, status, elapsed, _ in results if status == 200]
+        shed = [elapsed for _, status, elapsed, _ in results if status == 429]
+        retry_afters = sorted({int(retry_after) for _, status, _, retry_after in results if status == 429})
+        early = admission_controller.stats()["classes"]["llm"]["rejected"].get("overloaded", 0)
+        print(f"{'on' if enabled else 'off':>10} {len(ok):>5} {len(shed):>5} {early:>11} {percentile(ok, 0.5):>8.1f} {percentile(ok, 0.99):>8.1f} "
+              f"{percentile(shed, 0.5):>8.1f} {str(retry_afters[:1] + retry_afters[-1:]) if retry_afters else '-':>14}")
+        if enabled:
+            assert shed and max(ok) < slo + 2 * latency + 0.5, (len(shed), max(ok))
+    print()
+
+
+async def check_outcomes(app, latency: float):
+    # Instant answers, so the bucket does not refill between requests
+    load_app(FakeAsyncOpenAI(), FakeFirestore())
+    admission_controller.configure(bench_classes(4, latency, 2.0))
+    admission_controller.enabled = True
+    metrics.clear()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        statuses = [(await http.post("/smart_goal", json={"user_id": "alice", "pre_goal_data": PRE_GOAL})) for _ in range(6)]
+        assert [response.status_code for response in statuses] == [200] * 5 + [429]
+        assert statuses[-1].headers["retry-after"] == "1", statuses[-1].headers
+        print(f"bucket of 5 at 1/s: 6th request 429, Retry-After {statuses[-1].headers['retry-after']} s, {statuses[-1].json()}")
+
+        # The proxy appends the caller's address; the client-supplied entry before it is ignored
+        elsewhere = await http.post("/smart_goal", json={"user_id": "alice", "pre_goal_data": PRE_GOAL}, headers={"X-Forwarded-For": "127.0.0.1, 203.0.113.7"})
+        assert elsewhere.status_code == 200, elsewhere.status_code
+        print("alice's id claimed from another address: 200, it does not share her bucket")
+
+        prometheus = (await http.get("/metrics")).text
+        assert 'admission_rejected_total{class="llm",reason="rate_limited"} 1' in prometheus
+        assert 'admission_queue_depth{class="llm"}' in prometheus and 'admission_in_flight{class="llm"}' in prometheus
+        print("metrics: admission_rejected_total, admission_queue_depth, admission_in_flight exported")
+
+    # Shed requests keep their token: of a bucket of 2, one is spent on a request admitted after the shed ones
+    load_app(FakeAsyncOpenAI(latency=0.3), FakeFirestore())
+    admission_controller.configure({"llm": AdmissionClass(paths=["/smart_goal"], rate=0.001, burst=2, max_concurrency=1, queue_slo=0.1, expected_seconds=0.3)})
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        burst = await asyncio.gather(*(http.post("/smart_goal", json={"user_id": "erin", "pre_goal_data": PRE_GOAL}) for _ in range(3)))
+        after = await http.post("/smart_goal", json={"user_id": "erin", "pre_goal_data": PRE_GOAL})
+    codes = sorted(response.status_code for response in burst) + [after.status_code]
+    assert codes == [200, 429, 429, 200], codes
+    print(f"overload sheds before the bucket: burst of 3 -> {codes[:3]}, next request {codes[3]}")
+
+    admission_controller.configure({"transcription": AdmissionClass(paths=["/transcribe_voice"], rate=1.0, burst=1, max_concurrency=2)})
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        files = {"voice_memo": ("memo.webm", b"audio", "audio/webm")}
+        codes = [(await http.post("/transcribe_voice", files=files, headers={"X-User-ID": user})).status_code for user in ("bob", "bob", "carol")]
+    assert codes == [200, 429, 200], codes
+    print(f"multipart upload keyed by X-User-ID: bob, bob, carol -> {codes}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "buckets.sqlite")
+        workers = [AdmissionController(bench_classes(4, latency, 2.0), SQLiteBucketBackend(path)) for _ in range(2)]
+        waits = [workers[index % 2].buckets.take("llm:dave", 1.0, 5) for index in range(6)]
+        # Another process holding the file does not stall the event loop: the request is let through
+        holder = sqlite3.connect(path, isolation_level=None)
+        holder.execute("BEGIN IMMEDIATE")
+        start = time.perf_counter()
+        busy_wait = workers[0].buckets.take("llm:dave", 1.0, 5)
+        busy_ms = (time.perf_counter() - start) * 1000
+        holder.execute("ROLLBACK")
+        holder.close()
+    assert waits[:5] == [0.0] * 5 and waits[5] > 0, waits
+    print(f"SQLite buckets shared by two workers: 5 requests admitted across both, the 6th waits {waits[5]:.2f} s")
+    assert busy_wait == 0.0 and busy_ms < 500, busy_ms
+    print(f"SQLite buckets held by another process: admitted without a token after {busy_ms:.0f} ms")
+
+
+async def run(capacity: int, latency: float, burst: int, users: int, requests: int):
+    model_router.hedge_ratio = 0.0
+    from api.index import app
+    await noisy_neighbour(app, capacity, latency, burst, users)
+    await overload(app, capacity, latency, requests, slo=1.0)
+    await check_outcomes(app, latency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--capacity", type=int, default=8, help="Concurrent calls the upstream serves")
+    parser.add_argument("--latency", type=float, default=0.2, help="Simulated seconds per upstream call")
+    parser.add_argument("--burst", type=int, default=200, help="Requests of the noisy user")
+    parser.add_argument("--users", type=int, default=10, help="Other users")
+    parser.add_argument("--overload", type=int, default=200, help="Users arriving at once in the overload scenario")
+    args = parser.parse_args()
+    asyncio.run(run(args.capacity, args.latency, args.burst, args.users, args.overload))
@@ -0,0 +1,167 @@
+"""
+End-to-end check of bulk planning against the fake Batch API, fully offline.
+
+Scenarios:
+- endpoint: POST /bulk/generate_milestones_and_tasks with `--items` goals
+  (some duplicated), let the background worker finish, read the job status.
+- resume: the first batch expires halfway and some requests fail; the
+  worker resubmits only the items without a result.
+- idempotent: re-posting the same job_id, stepping a finished job and a
+  crash between creating a batch and recording it create nothing twice.
+- checks: every plan has a milestone without tasks; its tasks are
+  re-requested like on the synchronous path, and the item whose retries
+  keep failing is marked failed instead of being saved.
+
+Each scenario asserts its outcome and reports batches, Firestore commits
+and time, next to the number of synchronous planning calls it replaces.
+
+Usage (from backend/):
+    python -m benchmarks.bench_bulk_planning [--items 200]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import re
+import time
+
+import httpx
+
+from api.bulk_planning import BulkPlanningItem, BulkPlanningWorker, item_id
+from api.goal_to_tasks import Goal, MilestoneTasks
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, default_parsed, load_app, make_goal
+
+
+def goals_saved(db) -> int:
+    return sum(1 for path in db.documents if len(path) == 4 and path[0] == "users" and path[2] == "goals")
+
+
+def make_items(count: int):
+    items = []
+    for i in range(count):
+        # Every tenth item repeats the previous one and is deduplicated by the job
+        source = i - 1 if i % 10 == 9 else i
+        items.append(BulkPlanningItem(user_id=f"user-{source}", validated_goal=f"Goal {source}"))
+    return items
+
+
+async def endpoint_scenario(count: int, completion_seconds: float):
+    os.environ["BULK_PLANNING_POLL_SECONDS"] = str(completion_seconds / 4)
+    client, db = FakeAsyncOpenAI(), FakeFirestore()
+    client.batch_server.completion_seconds = completion_seconds
+    app = load_app(client, db)
+    items = make_items(count)
+    unique = len({item_id(item) for item in items})
+
+    start = time.perf_counter()
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as http:
+        # ASGITransport returns once the background worker has finished too
+        response = await http.post("/bulk/generate_milestones_and_tasks", json={"items": [item.dict() for item in items], "job_id": "bench-job"})
+        assert response.status_code == 200, response.text
+        status = (await http.get("/bulk/jobs/bench-job", params={"include_items": True})).json()
+    elapsed = time.perf_counter() - start
+
+    assert status["status"] == "completed", status
+    assert status["completed_count"] == unique == len(status["items"]) == goals_saved(db), (status["completed_count"], unique, goals_saved(db))
+    assert all(item["guid"] for item in status["items"])
+    return {"items": count, "unique": unique, "batches": len(client.batch_server.batches), "commits": db.round_trips, "seconds": elapsed}
+
+
+async def resume_scenario(count: int):
+    client, db = FakeAsyncOpenAI(), FakeFirestore()
+    items = make_items(count)
+    unique = {item_id(item) for item in items}
+    failing = set(sorted(unique)[:3])
+    client.batch_server.failing_custom_ids = failing
+    client.batch_server.expire_next_batch_after = len(unique) // 2
+    worker = BulkPlanningWorker(db, client, poll_interval=0)
+
+    start = time.perf_counter()
+    await worker.create_job(items, "resume-job")
+    job = await worker.run("resume-job")
+    elapsed = time.perf_counter() - start
+
+    assert job["status"] == "completed", job
+    assert job["submissions"] == 2, job
+    assert job["failed_count"] == len(failing) and job["completed_count"] == len(unique) - len(failing) == goals_saved(db), job
+    assert client.batch_server.requests_answered == len(unique), client.batch_server.requests_answered
+    return {"items": count, "unique": len(unique), "batches": len(client.batch_server.batches), "commits": db.round_trips, "seconds": elapsed}
+
+
+async def idempotent_scenario(count: int):
+    client, db = FakeAsyncOpenAI(), FakeFirestore()
+    items = make_items(count)
+    worker = BulkPlanningWorker(db, client, poll_interval=0)
+
+    start = time.perf_counter()
+    await worker.create_job(items, "crash-job")
+    # Simulate a worker that died after creating the batch but before recording it
+    await db.collection("planningJobs").document("crash-job").set({"batch_id": None, "submissions": 0, "status": "created"}, merge=True)
+    job = await worker.run("crash-job")
+    saved = goals_saved(db)
+    assert len(client.batch_server.batches) == 1, "resumed job created a second batch"
+
+    again = await worker.create_job(items, "crash-job")
+    await worker.step("crash-job")
+    elapsed = time.perf_counter() - start
+
+    assert again["job_id"] == job["job_id"] and again["status"] == "completed"
+    assert len(client.batch_server.batches) == 1 and goals_saved(db) == saved == job["completed_count"], (len(client.batch_server.batches), goals_saved(db), saved)
+    return {"items": count, "unique": job["item_count"], "batches": len(client.batch_server.batches), "commits": db.round_trips, "seconds": elapsed}
+
+
+def plans_missing_tasks(failing_goal: str):
+    """
+    Parsed factory whose plans have a first milestone without tasks; its retries fail for `failing_goal` only.
+    """
+    def parsed_factory(response_format, messages):
+        if response_format is Goal:
+            goal = make_goal()
+            goal.milestones[0].tasks = []
+            return goal
+        if response_format is MilestoneTasks and re.search(rf"{failing_goal}\b", messages[-1]["content"]):
+            return MilestoneTasks(tasks=[])
+        return default_parsed(response_format, messages)
+    return parsed_factory
+
+
+async def checks_scenario(count: int):
+    client, db = FakeAsyncOpenAI(parsed_factory=plans_missing_tasks("Goal 7")), FakeFirestore()
+    items = make_items(count)
+    unique = {item_id(item) for item in items}
+    worker = BulkPlanningWorker(db, client, poll_interval=0)
+
+    start = time.perf_counter()
+    await worker.create_job(items, "checks-job")
+    job = await worker.run("checks-job")
+    elapsed = time.perf_counter() - start
+
+    status = await worker.job_status("checks-job", include_items=True)
+    failed = [item for item in status["items"] if item["status"] == "failed"]
+    assert job["failed_count"] == 1 and "still invalid" in failed[0]["error"], failed
+    assert job["completed_count"] == len(unique) - 1 == goals_saved(db), job
+    assert all(path[-2] != "milestones" or db.documents[path]["total_tasks"] for path in db.documents)
+    return {"items": count, "unique": len(unique), "batches": len(client.batch_server.batches), "commits": db.round_trips, "seconds": elapsed}
+
+
+async def run(count: int, completion_seconds: float):
+    print(f"{'scenario':>11} {'items':>6} {'unique':>6} {'sync calls':>10} {'batches':>7} {'commits':>7} {'seconds':>8}")
+    for name, scenario in (
+        ("endpoint", endpoint_scenario(count, completion_seconds)),
+        ("resume", resume_scenario(count)),
+        ("idempotent", idempotent_scenario(count)),
+        ("checks", checks_scenario(count)),
+    ):
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = await scenario
+        print(f"{name:>11} {result['items']:>6} {result['unique']:>6} {result['unique']:>10} {result['batches']:>7} {result['commits']:>7} {result['seconds']:>8.2f}")
+    print("All scenarios passed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--items", type=int, default=200)
+    parser.add_argument("--completion-seconds", type=float, default=0.5, help="How long the fake batch stays in progress")
+    args = parser.parse_args()
+    asyncio.run(run(args.items, args.completion_seconds))
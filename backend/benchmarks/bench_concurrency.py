@@ -0,0 +1,80 @@
+"""
+Load test of the request path with stubbed OpenAI and Firestore backends.
+
+Fires N simultaneous /smart_goal requests at the ASGI app and reports how many
+were in flight at once and how long the burst took. The baseline is the
+former sync-handler shape: a `def` endpoint blocking its threadpool thread
+for the same upstream latency. Both count handlers running at once: the
+async app's upstream calls, with hedging off so each request makes one.
+
+Usage (from backend/):
+    python -m benchmarks.bench_concurrency [--latency 0.5]
+"""
+import argparse
+import asyncio
+import threading
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from api.admission import admission_controller
+from api.model_router import model_router
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, load_app
+
+PAYLOAD = {"user_id": "bench-user", "pre_goal_data": {"what": "Run a marathon", "why": "Health", "when": "April 2027"}}
+
+
+def make_sync_app(latency: float):
+    app = FastAPI()
+    state = {"in_flight": 0, "peak_in_flight": 0}
+    lock = threading.Lock()
+
+    @app.post('/smart_goal')
+    def smart_goal(payload: dict):
+        with lock:
+            state["in_flight"] += 1
+            state["peak_in_flight"] = max(state["peak_in_flight"], state["in_flight"])
+        time.sleep(latency)
+        with lock:
+            state["in_flight"] -= 1
+        return "ok"
+
+    return app, lambda: state["peak_in_flight"]
+
+
+def make_async_app(latency: float):
+    client = FakeAsyncOpenAI(latency=latency)
+    app = load_app(client, FakeFirestore())
+    # One user's burst measures the request path, not its rate limit; benchmarks.bench_admission covers that
+    admission_controller.enabled = False
+    # A hedged duplicate would count as a second request in flight
+    model_router.hedge_ratio = 0.0
+    return app, lambda: client.peak_in_flight
+
+
+async def burst(app, concurrency: int):
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as http:
+        start = time.perf_counter()
+        responses = await asyncio.gather(*(http.post('/smart_goal', json=PAYLOAD) for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    assert all(response.status_code == 200 for response in responses)
+    return elapsed
+
+
+async def run(latency: float, levels):
+    print(f"{'handler':>8} {'requests':>9} {'peak in-flight':>15} {'wall s':>8} {'req/s':>8}")
+    for name, factory in (("sync", make_sync_app), ("async", make_async_app)):
+        for concurrency in levels:
+            app, peak = factory(latency)
+            elapsed = await burst(app, concurrency)
+            print(f"{name:>8} {concurrency:>9} {peak():>15} {elapsed:>8.2f} {concurrency / elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated seconds per upstream LLM call")
+    parser.add_argument("--levels", type=int, nargs="+", default=[10, 40, 100, 400])
+    args = parser.parse_args()
+    asyncio.run(run(args.latency, args.levels))
@@ -0,0 +1,45 @@
+"""
+Embedding throughput (texts/sec) of the EmbeddingService at batch sizes 1 to 256.
+
+Submits `--texts` concurrent single-text embed() calls, which the service
+coalesces into batches of at most the given size. The OpenAI backend runs
+against a fake client with a fixed latency per HTTP request; the local
+backend runs for real on CPU.
+
+Usage (from backend/):
+    python -m benchmarks.bench_embeddings [--latency 0.1] [--texts 2048]
+"""
+import argparse
+import asyncio
+import time
+
+from api.embeddings import EmbeddingService, LocalEmbeddingBackend, OpenAIEmbeddingBackend
+from benchmarks.fakes import FakeAsyncOpenAI
+
+BATCH_SIZES = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+
+async def throughput(backend, batch_size: int, texts: int) -> float:
+    service = EmbeddingService(backend, max_batch_size=batch_size)
+    inputs = [f"Task {i}: practice interval runs for the marathon" for i in range(texts)]
+    start = time.perf_counter()
+    await service.embed_many(inputs)
+    elapsed = time.perf_counter() - start
+    assert service.texts_embedded == texts
+    return texts / elapsed
+
+
+async def run(latency: float, texts: int):
+    print(f"{'batch size':>10} {'openai (fake) texts/s':>22} {'local texts/s':>14}")
+    for batch_size in BATCH_SIZES:
+        remote = await throughput(OpenAIEmbeddingBackend(FakeAsyncOpenAI(latency=latency)), batch_size, texts)
+        local = await throughput(LocalEmbeddingBackend(), batch_size, texts)
+        print(f"{batch_size:>10} {remote:>22.1f} {local:>14.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.1, help="Simulated seconds per embeddings request")
+    parser.add_argument("--texts", type=int, default=2048)
+    args = parser.parse_args()
+    asyncio.run(run(args.latency, args.texts))
@@ -0,0 +1,154 @@
+"""
+Firestore round trips, documents read and latency of one dashboard load.
+
+"client walk" is what clients did without a read API: query the goals,
+then the milestones of each goal, then the tasks of each milestone, one
+query at a time. "tree queries" rebuilds every tree with GoalReader.load_tree
+(three concurrent queries per goal). "snapshots" reads the denormalized
+snapshots with one query, and "cached" serves them from the in-process
+cache. The "http" rows go through GET /users/{user_id}/goals, the second
+with the ETag of the first as If-None-Match. The fake's queries scan every
+stored document, which inflates the CPU time of "tree queries" at 200 goals.
+
+Then checks that goals the web client writes directly show once it calls
+POST .../reconcile, and that deleted goals leave the dashboard.
+
+Usage (from backend/):
+    python -m benchmarks.bench_goal_reads [--goals 10 50 200] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from api.goal_reads import GoalReadCache, GoalReader, goal_read_cache
+from api.persistence import GoalTreeWriter
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, load_app, make_goal
+
+USER_ID = "bench-user"
+
+
+async def client_walk(db, user_id: str) -> list:
+    goals = []
+    async for goal_doc in db.collection('users', user_id, 'goals').stream():
+        goal = {**goal_doc.to_dict(), 'milestones': []}
+        async for milestone_doc in goal_doc.reference.collection('milestones').stream():
+            tasks = [task_doc.to_dict() async for task_doc in milestone_doc.reference.collection('tasks').stream()]
+            goal['milestones'].append({**milestone_doc.to_dict(), 'tasks': tasks})
+        goals.append(goal)
+    return goals
+
+
+async def tree_queries(db, user_id: str) -> list:
+    reader = GoalReader(db, GoalReadCache())
+    guids = [doc.id async for doc in db.collection('users', user_id, 'goals').stream()]
+    return await asyncio.gather(*(reader.load_tree(user_id, guid) for guid in guids))
+
+
+async def snapshots(db, user_id: str) -> list:
+    cache = GoalReadCache()
+    cache.enabled = False
+    return (await GoalReader(db, cache).list_goals(user_id))["goals"]
+
+
+async def measure(db, load, prepare=None):
+    if prepare is not None:
+        await prepare()
+    round_trips, documents_read = db.round_trips, db.documents_read
+    start = time.perf_counter()
+    goals = await load()
+    elapsed = (time.perf_counter() - start) * 1000
+    return goals, db.round_trips - round_trips, db.documents_read - documents_read, elapsed
+
+
+async def check_client_writes():
+    goal_read_cache.clear()
+    db = FakeFirestore()
+    writer = GoalTreeWriter(db)
+    edited, deleted, removed = make_goal(2, 3), make_goal(2, 3), make_goal(2, 3)
+    for goal in (edited, deleted, removed):
+        await writer.save_goal(goal, USER_ID)
+    app = load_app(FakeAsyncOpenAI(), db)
+    goals = db.collection("users", USER_ID, "goals")
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+
+        async def dashboard():
+            return {goal["guid"]: goal for goal in (await http.get(f"/users/{USER_ID}/goals")).json()["goals"]}
+
+        assert len(await dashboard()) == 3
+        # Direct writes as the web client makes them: edit a goal, add a task, add a goal
+        await goals.document(edited.guid).set({"name": "Renamed"}, merge=True)
+        milestone = edited.milestones[0]
+        task = {**milestone.tasks[0].dict(), "name": "Added", "completed": True}
+        await goals.document(edited.guid).collection("milestones").document(milestone.muid).collection("tasks").document("added").set(task)
+        added = goals.document()
+        await added.set({"guid": added.id, "name": "Added goal", "deadline": "2027-01-01", "progress": 0})
+        for guid in (edited.guid, added.id):
+            assert (await http.post(f"/users/{USER_ID}/goals/{guid}/reconcile")).status_code == 200
+
+        # One goal deleted through the API, one by deleting its documents and reconciling
+        assert (await http.delete(f"/users/{USER_ID}/goals/{deleted.guid}")).status_code == 204
+        assert (await http.delete(f"/users/{USER_ID}/goals/{deleted.guid}")).status_code == 404
+        await goals.document(removed.guid).delete()
+        assert (await http.post(f"/users/{USER_ID}/goals/{removed.guid}/reconcile")).status_code == 404
+
+        goals_after = await dashboard()
+        assert set(goals_after) == {edited.guid, added.id}, goals_after.keys()
+        assert goals_after[edited.guid]["name"] == "Renamed" and sum(len(m["tasks"]) for m in goals_after[edited.guid]["milestones"]) == 7
+        assert goals_after[edited.guid]["progress"] > 0
+        assert not any(path[:3] == ("users", USER_ID, "goals") and deleted.guid in path for path in db.documents)
+    print("client writes: edits, added tasks and goals show after reconcile; deleted goals leave the dashboard")
+
+
+async def run(goal_counts, latency: float):
+    print(f"{'goals':>6} {'mode':>14} {'round trips':>12} {'docs read':>10} {'ms':>9}")
+    for goal_count in goal_counts:
+        db = FakeFirestore()
+        writer = GoalTreeWriter(db)
+        for _ in range(goal_count):
+            await writer.save_goal(make_goal(5, 8), USER_ID)
+        db.latency = latency
+
+        app = load_app(FakeAsyncOpenAI(), db)
+        reader = GoalReader(db)
+
+        async def warm_cache():
+            reader.cache.clear()
+            await reader.list_goals(USER_ID)
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+            etag = None
+
+            async def http_get():
+                nonlocal etag
+                response = await http.get(f"/users/{USER_ID}/goals", headers={"If-None-Match": etag} if etag else {})
+                etag = response.headers["etag"]
+                return response.json()["goals"] if response.status_code == 200 else None
+
+            async def cached():
+                return (await reader.list_goals(USER_ID))["goals"]
+
+            modes = [
+                ("client walk", lambda: client_walk(db, USER_ID), None),
+                ("tree queries", lambda: tree_queries(db, USER_ID), None),
+                ("snapshots", lambda: snapshots(db, USER_ID), None),
+                ("cached", cached, warm_cache),
+                ("http 200", http_get, warm_cache),
+                ("http 304", http_get, None),
+            ]
+            for mode, load, prepare in modes:
+                goals, round_trips, documents_read, elapsed = await measure(db, load, prepare)
+                if goals is not None:
+                    assert len(goals) == goal_count and all(len(goal['milestones']) == 5 for goal in goals)
+                print(f"{goal_count:>6} {mode:>14} {round_trips:>12} {documents_read:>10} {elapsed:>9.1f}")
+    await check_client_writes()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--goals", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per Firestore round trip")
+    args = parser.parse_args()
+    asyncio.run(run(args.goals, args.latency))
@@ -0,0 +1,98 @@
+"""
+Import time of api.index, checked against a stored baseline.
+
+Each run imports the app in a fresh interpreter with `-X importtime` and
+records the cumulative time; the median over runs is compared with
+benchmarks/baselines/import_time.json. Exits with status 1 when the import
+is slower than the baseline by more than the tolerance, so it can gate CI.
+It also fails if a module that should load lazily (OpenAI, Firebase,
+Pinecone) is imported with the app.
+
+Usage (from backend/):
+    python -m benchmarks.bench_import_time [--runs 7] [--tolerance 0.25] [--update]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+MODULE = "api.index"
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baselines", "import_time.json")
+# Heavy SDKs that must only be imported when a client is first needed
+LAZY_MODULES = ("openai", "firebase_admin", "google.cloud.firestore", "pinecone")
+CHECK_LAZY = "import sys, {module}; print(','.join(m for m in {lazy!r} if m in sys.modules))"
+
+
+def import_times(module: str):
+    """
+    Import `module` in a fresh interpreter and return {module: (self_us, cumulative_us)}.
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, check=True,
+        env={key: value for key, value in os.environ.items() if key != "PYTHONPROFILEIMPORTTIME"},
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times[name.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+def eagerly_imported(module: str):
+    result = subprocess.run(
+        [sys.executable, "-c", CHECK_LAZY.format(module=module, lazy=LAZY_MODULES)],
+        capture_output=True, text=True, check=True,
+    )
+    return [name for name in result.stdout.strip().split(",") if name]
+
+
+def run(runs: int, tolerance: float, update: bool, top: int) -> int:
+    samples = [import_times(MODULE) for _ in range(runs)]
+    median_ms = statistics.median(times[MODULE][1] for times in samples) / 1000
+
+    slowest = sorted(samples[-1].items(), key=lambda item: item[1][0], reverse=True)[:top]
+    print("Slowest modules by self time (last run):")
+    for name, (self_us, cumulative_us) in slowest:
+        print(f"  {name:<45} {self_us / 1000:>8.1f} ms self {cumulative_us / 1000:>8.1f} ms cumulative")
+    print(f"\nimport {MODULE}: median {median_ms:.1f} ms over {runs} runs")
+
+    eager = eagerly_imported(MODULE)
+    if eager:
+        print(f"FAIL: imported at startup but should be lazy: {', '.join(eager)}")
+        return 1
+
+    if update:
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump({"module": MODULE, "median_ms": round(median_ms, 1), "runs": runs}, f, indent=2)
+            f.write("\n")
+        print(f"Baseline updated: {BASELINE_PATH}")
+        return 0
+
+    if not os.path.exists(BASELINE_PATH):
+        print(f"No baseline at {BASELINE_PATH}; run with --update to record one")
+        return 1
+    with open(BASELINE_PATH) as f:
+        baseline_ms = json.load(f)["median_ms"]
+    limit_ms = baseline_ms * (1 + tolerance)
+    print(f"Baseline {baseline_ms:.1f} ms, limit {limit_ms:.1f} ms (+{tolerance:.0%})")
+    if median_ms > limit_ms:
+        print("FAIL: import time regressed")
+        return 1
+    print("OK")
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed slowdown over the baseline, as a fraction")
+    parser.add_argument("--update", action="store_true", help="Record the current median as the new baseline")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest modules to list")
+    args = parser.parse_args()
+    sys.exit(run(args.runs, args.tolerance, args.update, args.top))
@@ -0,0 +1,340 @@
+"""
+Load test of every endpoint of api/index.py against offline fakes.
+
+Each endpoint is driven on its own through an ASGI client, `--requests`
+requests with at most `--concurrency` in flight, against the fake OpenAI
+client (latency, output tokens, streaming), Firestore and Pinecone from
+benchmarks.fakes. For every endpoint it reports p50/p95/p99 latency,
+throughput, errors, and the round trips made per request to each fake.
+Round trips include the background work the requests queued (jobs are
+waited for before the counters are read). Peak RSS is the process high-water
+mark after each endpoint. No endpoint queries Pinecone yet; its column
+shows when one starts to. Admission control is off, so the per-user rate
+limits do not turn load into 429s; benchmarks.bench_admission covers it.
+
+Results are written as JSON, by default to benchmarks/results/, and
+`--compare` prints the changes against an earlier result file.
+
+Usage (from backend/):
+    python -m benchmarks.bench_load [--requests 200] [--concurrency 20] [--users 50] [--llm-latency 0.2]
+        [--seconds-per-token 0.0005] [--db-latency 0.005] [--pinecone-latency 0] [--layout documents]
+        [--only smart_goal list_goals] [--output PATH] [--compare PATH]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from typing import Callable, NamedTuple, Optional
+
+# Bulk jobs finish within the request instead of polling the fake Batch API every 30 s
+os.environ.setdefault('BULK_PLANNING_POLL_SECONDS', '0')
+
+import httpx
+
+from api.admission import admission_controller
+from api.jobs import job_queue
+from api.persistence import LAYOUTS, GoalTreeWriter, goal_storage
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, FakePinecone, install_pinecone, load_app, make_goal, write_wav
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+PERCENTILES = (50, 95, 99)
+PROFILE = {
+    "openness": "High", "conscientiousness": "Medium", "extraversion": "Low", "agreeableness": "High",
+    "neuroticism": "Low", "passions": "Running, reading", "life_goals": "Run a marathon",
+}
+
+
+class Endpoint(NamedTuple):
+    name: str
+    method: str
+    route: str
+    # (context, request index) -> keyword arguments of httpx.AsyncClient.request
+    request: Callable[["LoadContext", int], dict]
+    # Run before the measured requests, e.g. to fetch an ETag or create a job
+    prepare: Optional[Callable] = None
+
+
+class LoadContext:
+    """
+    Users with a saved goal each, and the ids the requests refer to.
+    """
+
+    def __init__(self, users: int, audio: bytes):
+        self.user_ids = [f"load-user-{index}" for index in range(users)]
+        self.goals = {}
+        self.etags = {}
+        self.audio = audio
+        self.job_id = None
+        self.bulk_job_id = None
+
+    async def seed(self, db):
+        writer = GoalTreeWriter(db)
+        for user_id in self.user_ids:
+            goal = make_goal(3, 4)
+            await writer.save_goal(goal, user_id)
+            self.goals[user_id] = goal
+
+    def user(self, index: int) -> str:
+        return self.user_ids[index % len(self.user_ids)]
+
+    def goal(self, index: int):
+        return self.goals[self.user(index)]
+
+    def task_path(self, index: int) -> str:
+        goal = self.goal(index)
+        tasks = [(milestone.muid, task.tuid) for milestone in goal.milestones for task in milestone.tasks]
+        # Successive requests of one user complete different tasks
+        muid, tuid = tasks[index // len(self.user_ids) % len(tasks)]
+        return f"/users/{self.user(index)}/goals/{goal.guid}/milestones/{muid}/tasks/{tuid}/completion"
+
+    def validated_goal(self, index: int) -> dict:
+        return {"user_id": self.user(index), "validated_goal": f"Run a marathon in under 4 hours by April 2027 ({index})."}
+
+
+async def fetch_etags(http, context: LoadContext):
+    for user_id in context.user_ids:
+        context.etags[user_id] = (await http.get(f"/users/{user_id}/goals")).headers["etag"]
+
+
+async def finished_job(http, context: LoadContext):
+    response = await http.post("/jobs/generate_milestones_and_tasks", json=context.validated_goal(-1))
+    context.job_id = response.json()["job_id"]
+    await http.get(f"/jobs/{context.job_id}/events")
+
+
+async def finished_bulk_job(http, context: LoadContext):
+    response = await http.post("/bulk/generate_milestones_and_tasks", json={"items": [context.validated_goal(-1)]})
+    context.bulk_job_id = response.json()["job_id"]
+
+
+def get(path: str) -> Callable:
+    return lambda context, index: {"url": path}
+
+
+ENDPOINTS = [
+    Endpoint("root", "GET", "/", get("/")),
+    *(Endpoint(f"stats_{name}", "GET", f"/stats/{name}", get(f"/stats/{name}"))
+      for name in ("profile_cache", "response_cache", "goal_reads", "priorities", "schedules", "upstream", "prompt_usage", "jobs", "embeddings")),
+    Endpoint("metrics", "GET", "/metrics", get("/metrics")),
+    Endpoint("transcribe_voice", "POST", "/transcribe_voice",
+             lambda context, index: {"url": "/transcribe_voice", "files": {"voice_memo": ("memo.wav", context.audio, "audio/wav")}}),
+    Endpoint("profile_definition", "POST", "/profile_definition",
+             lambda context, index: {"url": "/profile_definition", "json": {"user_id": context.user(index), "profile_data": PROFILE}}),
+    Endpoint("smart_goal", "POST", "/smart_goal",
+             lambda context, index: {"url": "/smart_goal", "json": {"user_id": context.user(index), "pre_goal_data": {"what": "Run a marathon", "why": "Health", "when": "April 2027"}}}),
+    Endpoint("generate_monolithic", "POST", "/generate_milestones_and_tasks",
+             lambda context, index: {"url": "/generate_milestones_and_tasks", "json": context.validated_goal(index)}),
+    Endpoint("generate_fan_out", "POST", "/generate_milestones_and_tasks",
+             lambda context, index: {"url": "/generate_milestones_and_tasks", "json": {**context.validated_goal(index), "planning_mode": "fan_out"}}),
+    Endpoint("generate_stream", "POST", "/generate_milestones_and_tasks/stream",
+             lambda context, index: {"url": "/generate_milestones_and_tasks/stream", "json": context.validated_goal(index)}),
+    Endpoint("list_goals", "GET", "/users/{user_id}/goals",
+             lambda context, index: {"url": f"/users/{context.user(index)}/goals"}),
+    Endpoint("list_goals_not_modified", "GET", "/users/{user_id}/goals",
+             lambda context, index: {"url": f"/users/{context.user(index)}/goals", "headers": {"If-None-Match": context.etags[context.user(index)]}},
+             fetch_etags),
+    Endpoint("get_goal", "GET", "/users/{user_id}/goals/{guid}",
+             lambda context, index: {"url": f"/users/{context.user(index)}/goals/{context.goal(index).guid}"}),
+    Endpoint("task_completion", "POST", "/users/{user_id}/goals/{guid}/milestones/{muid}/tasks/{tuid}/completion",
+             lambda context, index: {"url": context.task_path(index), "json": {"completed": True}}),
+    Endpoint("goal_progress", "GET", "/users/{user_id}/goals/{guid}/progress",
+             lambda context, index: {"url": f"/users/{context.user(index)}/goals/{context.goal(index).guid}/progress"}),
+    Endpoint("next_tasks", "GET", "/users/{user_id}/tasks/next",
+             lambda context, index: {"url": f"/users/{context.user(index)}/tasks/next", "params": {"k": 10}}),
+    Endpoint("schedule", "POST", "/users/{user_id}/schedule",
+             lambda context, index: {"url": f"/users/{context.user(index)}/schedule", "json": {"availability": {"weekly_hours": 10}}}),
+    Endpoint("replan_schedules", "POST", "/jobs/replan_schedules",
+             lambda context, index: {"url": "/jobs/replan_schedules", "json": {"user_ids": [context.user(index + offset) for offset in range(10)]}}),
+    Endpoint("reconcile_progress", "POST", "/users/{user_id}/progress/reconcile",
+             lambda context, index: {"url": f"/users/{context.user(index)}/progress/reconcile"}),
+    Endpoint("bulk_generate", "POST", "/bulk/generate_milestones_and_tasks",
+             lambda context, index: {"url": "/bulk/generate_milestones_and_tasks", "json": {"items": [context.validated_goal(index)]}}),
+    Endpoint("bulk_job_status", "GET", "/bulk/jobs/{job_id}",
+             lambda context, index: {"url": f"/bulk/jobs/{context.bulk_job_id}"}, finished_bulk_job),
+    Endpoint("enqueue_generate", "POST", "/jobs/generate_milestones_and_tasks",
+             lambda context, index: {"url": "/jobs/generate_milestones_and_tasks", "json": context.validated_goal(index)}),
+    Endpoint("job_status", "GET", "/jobs/{job_id}",
+             lambda context, index: {"url": f"/jobs/{context.job_id}"}, finished_job),
+    Endpoint("job_events", "GET", "/jobs/{job_id}/events",
+             lambda context, index: {"url": f"/jobs/{context.job_id}/events"}, finished_job),
+]
+
+
+def percentile(ordered: list, q: float) -> float:
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))]
+
+
+def peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+
+def counters(client, db, pinecone) -> dict:
+    return {
+        "firestore_round_trips": db.round_trips,
+        "firestore_documents_read": db.documents_read,
+        "openai_calls": client.calls,
+        "openai_output_tokens": client.completion_tokens,
+        "pinecone_round_trips": pinecone.round_trips,
+    }
+
+
+async def drive(http, endpoint: Endpoint, context: LoadContext, requests: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    statuses = Counter()
+    job_ids = set()
+
+    async def send(index):
+        async with semaphore:
+            start = time.perf_counter()
+            response = await http.request(endpoint.method, **endpoint.request(context, index))
+            latencies.append(time.perf_counter() - start)
+        statuses[response.status_code] += 1
+        if response.status_code == 202:
+            job_ids.add(response.json()["job_id"])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(index) for index in range(requests)))
+    wall = time.perf_counter() - start
+    for job_id in job_ids:
+        async for _ in job_queue.events(job_id):
+            pass
+    return sorted(latencies), statuses, wall
+
+
+async def run_endpoint(http, endpoint: Endpoint, context: LoadContext, client, db, pinecone, requests: int, concurrency: int) -> dict:
+    if endpoint.prepare is not None:
+        await endpoint.prepare(http, context)
+    before = counters(client, db, pinecone)
+    latencies, statuses, wall = await drive(http, endpoint, context, requests, concurrency)
+    after = counters(client, db, pinecone)
+    return {
+        "name": endpoint.name,
+        "method": endpoint.method,
+        "route": endpoint.route,
+        "requests": requests,
+        "concurrency": concurrency,
+        "errors": sum(count for status, count in statuses.items() if status >= 400),
+        "status_codes": {str(status): count for status, count in sorted(statuses.items())},
+        "latency_ms": {
+            **{f"p{q}": round(percentile(latencies, q) * 1000, 3) for q in PERCENTILES},
+            "mean": round(sum(latencies) / len(latencies) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3),
+        },
+        "throughput_rps": round(requests / wall, 2),
+        "per_request": {name: round((after[name] - before[name]) / requests, 3) for name in after},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def wav_bytes(seconds: int) -> bytes:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "memo.wav")
+        write_wav(path, seconds)
+        with open(path, "rb") as f:
+            return f.read()
+
+
+async def run(args) -> dict:
+    endpoints = [endpoint for endpoint in ENDPOINTS if not args.only or endpoint.name in args.only]
+    goal_storage.layout = args.layout
+    admission_controller.enabled = False
+    client = FakeAsyncOpenAI(latency=args.llm_latency, seconds_per_output_token=args.seconds_per_token)
+    db = FakeFirestore()
+    pinecone = FakePinecone(latency=args.pinecone_latency)
+    install_pinecone(pinecone)
+    app = load_app(client, db)
+    context = LoadContext(args.users, wav_bytes(args.audio_seconds))
+    await context.seed(db)
+    db.latency = args.db_latency
+
+    print(f"{'endpoint':>24} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>8} {'err':>4} {'fs rt':>6} {'llm':>5} {'pc rt':>6} {'rss MB':>7}")
+    results = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://load", timeout=None) as http:
+        for endpoint in endpoints:
+            result = await run_endpoint(http, endpoint, context, client, db, pinecone, args.requests, args.concurrency)
+            latency, per_request = result["latency_ms"], result["per_request"]
+            print(f"{endpoint.name:>24} {latency['p50']:>9.1f} {latency['p95']:>9.1f} {latency['p99']:>9.1f} {result['throughput_rps']:>8.1f} "
+                  f"{result['errors']:>4} {per_request['firestore_round_trips']:>6.2f} {per_request['openai_calls']:>5.2f} "
+                  f"{per_request['pinecone_round_trips']:>6.2f} {result['peak_rss_mb']:>7.1f}")
+            results.append(result)
+    await job_queue.stop()
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {key: value for key, value in vars(args).items() if key not in ("output", "compare")},
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+        "endpoints": results,
+    }
+
+
+def save(report: dict, path: Optional[str]) -> str:
+    if path is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now(timezone.utc).strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(RESULTS_DIR, f"load-{stamp}.json")
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    return path
+
+
+def compare(report: dict, path: str):
+    with open(path) as f:
+        previous = {result["name"]: result for result in json.load(f)["endpoints"]}
+    print()
+    print(f"Against {path}:")
+    print(f"{'endpoint':>24} {'p95 ms':>19} {'req/s':>17} {'fs rt':>13}")
+    for result in report["endpoints"]:
+        before = previous.get(result["name"])
+        if before is None:
+            continue
+        p95_before, p95 = before["latency_ms"]["p95"], result["latency_ms"]["p95"]
+        change = f"{(p95 - p95_before) / p95_before:+.0%}" if p95_before else "n/a"
+        print(f"{result['name']:>24} {p95_before:>8.1f} > {p95:>8.1f} {change:>5} "
+              f"{before['throughput_rps']:>7.1f} > {result['throughput_rps']:>7.1f} "
+              f"{before['per_request']['firestore_round_trips']:>5.2f} > {result['per_request']['firestore_round_trips']:>5.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=20, help="Requests in flight at once")
+    parser.add_argument("--users", type=int, default=50, help="Users with a saved goal the requests are spread over")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Simulated time to first token per LLM call, in seconds")
+    parser.add_argument("--seconds-per-token", type=float, default=0.0005, help="Simulated generation time per output token")
+    parser.add_argument("--db-latency", type=float, default=0.005, help="Simulated seconds per Firestore round trip")
+    parser.add_argument("--pinecone-latency", type=float, default=0.0, help="Simulated seconds per Pinecone call")
+    parser.add_argument("--audio-seconds", type=int, default=10, help="Length of the uploaded voice memo")
+    parser.add_argument("--layout", choices=LAYOUTS, default=LAYOUTS[0], help="Storage layout of goal trees")
+    parser.add_argument("--only", nargs="+", choices=[endpoint.name for endpoint in ENDPOINTS], help="Endpoints to run, all by default")
+    parser.add_argument("--output", help="Result file, benchmarks/results/load-<timestamp>.json by default")
+    parser.add_argument("--compare", help="Earlier result file to compare with")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print(f"\nPeak RSS {report['peak_rss_mb']} MB. Results saved to {save(report, args.output)}")
+    if args.compare:
+        compare(report, args.compare)
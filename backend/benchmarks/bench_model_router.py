@@ -0,0 +1,140 @@
+"""
+Model routing: hedged requests against a slow tail, fallback and budget-driven model choice.
+
+The fake model answers in `--latency` seconds, but a `--slow-share` of calls
+to the primary model take `--slow` seconds more. `--calls` smart goal
+completions run `--concurrency` at a time, with hedging off and on; the
+table shows the tail latencies and the extra upstream calls hedging cost.
+Then checks the other outcomes:
+
+- a primary model answering 500s, and one that stops answering within the route timeout: served by the fallback
+- a refusal: raised, without trying another model
+- a primary model whose p95 exceeds the latency budget: new requests routed to the fallback
+- a cost budget that the primary model's estimated cost exceeds for a large prompt: routed to the cheaper model
+
+Usage (from backend/):
+    python -m benchmarks.bench_model_router [--calls 400] [--concurrency 8] [--latency 0.05] [--slow 1.0] [--slow-share 0.03]
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from api.goal_to_tasks import GoalOutline, GoalToTasks
+from api.model_router import PLANNING_MODEL, SMART_GOAL_MODEL, Route, model_router
+from api.plan_validation import PlanValidationError
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, disable_response_cache, server_error
+
+MESSAGES = [{"role": "user", "content": "Write a SMART goal about running a marathon."}]
+
+
+def served_by(client: FakeAsyncOpenAI) -> dict:
+    """
+    Count the calls per model by wrapping the client's create.
+    """
+    counts = {}
+    create = client.chat.completions.create
+
+    async def counted(model, messages, **kwargs):
+        counts[model] = counts.get(model, 0) + 1
+        return await create(model=model, messages=messages, **kwargs)
+
+    client.chat.completions.create = counted
+    return counts
+
+
+async def timed_calls(client: FakeAsyncOpenAI, calls: int, concurrency: int):
+    goal_to_tasks = GoalToTasks(FakeFirestore(), client, "bench-user")
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one():
+        async with semaphore:
+            start = time.perf_counter()
+            await goal_to_tasks._complete("smart_goal", MESSAGES)
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(one() for _ in range(calls)))
+    latencies.sort()
+    return {q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 for q in (0.5, 0.95, 0.99)}, latencies[-1] * 1000
+
+
+async def compare_hedging(calls: int, concurrency: int, latency: float, slow: float, slow_share: float):
+    print(f"{calls} calls, {concurrency} at a time, {latency * 1000:.0f} ms per call, {slow_share:.0%} of primary calls {slow * 1000:.0f} ms slower")
+    print(f"{'hedging':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8} {'upstream calls':>15} {'hedges':>7} {'hedge wins':>11}")
+    for hedge_ratio in (0.0, 0.1):
+        rng = random.Random(7)
+        model_router.clear()
+        model_router.hedge_ratio = hedge_ratio
+        client = FakeAsyncOpenAI(latency=latency, fault=lambda model: slow if model == SMART_GOAL_MODEL and rng.random() < slow_share else None)
+        percentiles, worst = await timed_calls(client, calls, concurrency)
+        stats = model_router.stats()
+        print(f"{'on' if hedge_ratio else 'off':>8} {percentiles[0.5]:>8.1f} {percentiles[0.95]:>8.1f} {percentiles[0.99]:>8.1f} {worst:>8.1f} "
+              f"{client.calls:>15} {stats['hedges']:>7} {stats['hedge_wins']:>11}")
+    model_router.hedge_ratio = 0.1
+    print()
+
+
+async def check_outcomes(latency: float):
+    routes = dict(model_router.routes)
+    goal_to_tasks = lambda client: GoalToTasks(FakeFirestore(), client, "bench-user")
+
+    model_router.clear()
+    client = FakeAsyncOpenAI(latency=latency, fault=lambda model: server_error() if model == SMART_GOAL_MODEL else None)
+    counts = served_by(client)
+    await goal_to_tasks(client)._complete("smart_goal", MESSAGES)
+    assert counts == {SMART_GOAL_MODEL: 1, PLANNING_MODEL: 1} and model_router.stats()["fallbacks"] == 1, counts
+    print(f"primary answering 500: served by the fallback {PLANNING_MODEL} ({counts})")
+
+    model_router.clear()
+    model_router.routes["smart_goal"] = Route(**{**routes["smart_goal"].model_dump(), "timeout": 0.5})
+    client = FakeAsyncOpenAI(latency=latency, fault=lambda model: 60.0 if model == SMART_GOAL_MODEL else None)
+    start = time.perf_counter()
+    await goal_to_tasks(client)._complete("smart_goal", MESSAGES)
+    assert model_router.stats()["timeouts"] == 1
+    print(f"primary not answering: fallback answered after the 0.5 s route timeout, in {time.perf_counter() - start:.2f} s")
+    model_router.routes["smart_goal"] = routes["smart_goal"]
+
+    model_router.clear()
+    client = FakeAsyncOpenAI(latency=latency, parsed_factory=lambda response_format, messages: None)
+    try:
+        await goal_to_tasks(client)._parse("goal_to_milestones", MESSAGES, GoalOutline)
+        raise AssertionError("the refusal was not raised")
+    except PlanValidationError:
+        pass
+    assert client.calls == 1 and model_router.stats()["fallbacks"] == 0
+    print("refusal: raised, no other model tried")
+
+    model_router.clear()
+    client = FakeAsyncOpenAI(latency=latency, fault=lambda model: 0.3 if model == SMART_GOAL_MODEL else None)
+    model_router.routes["smart_goal"] = Route(**{**routes["smart_goal"].model_dump(), "latency_budget": 0.2})
+    for _ in range(10):
+        await goal_to_tasks(client)._complete("smart_goal", MESSAGES)
+    choice = model_router.choose("smart_goal", 20)
+    assert choice.model == PLANNING_MODEL, choice
+    print(f"primary p95 {model_router.p95('smart_goal', SMART_GOAL_MODEL) * 1000:.0f} ms over a 200 ms budget: new requests go to {choice.model}")
+    model_router.routes["smart_goal"] = routes["smart_goal"]
+
+    model_router.clear()
+    model_router.routes["generate_milestones_and_tasks"] = Route(**{**routes["generate_milestones_and_tasks"].model_dump(), "max_cost": 0.05})
+    small, large = model_router.choose("generate_milestones_and_tasks", 500), model_router.choose("generate_milestones_and_tasks", 20_000)
+    assert small.model == PLANNING_MODEL and large.model == SMART_GOAL_MODEL, (small, large)
+    print(f"$0.05 cost budget: a 500-token plan prompt goes to {small.model}, a 20000-token one to {large.model}")
+    model_router.routes["generate_milestones_and_tasks"] = routes["generate_milestones_and_tasks"]
+
+
+async def run(calls: int, concurrency: int, latency: float, slow: float, slow_share: float):
+    disable_response_cache()
+    await compare_hedging(calls, concurrency, latency, slow, slow_share)
+    await check_outcomes(latency)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.05, help="Simulated seconds per model call")
+    parser.add_argument("--slow", type=float, default=1.0, help="Extra seconds of a slow primary call")
+    parser.add_argument("--slow-share", type=float, default=0.03, help="Share of primary calls that are slow")
+    args = parser.parse_args()
+    asyncio.run(run(args.calls, args.concurrency, args.latency, args.slow, args.slow_share))
@@ -0,0 +1,174 @@
+"""
+Validation and repair of model plans: partial retries against regenerating the plan.
+
+The fake model returns a plan with out-of-range scores, messy deadlines and
+`--bad` milestones without tasks. "regenerate" is what a caller had to do
+before plans were validated: request the whole plan again (the fake's
+second answer is clean). "repair" fixes the fields in place and re-requests
+only the failing milestones. Then checks the other outcomes:
+
+- fields repaired locally without any retry
+- a milestone that fails its first retry and passes the second
+- a milestone that keeps failing, a refusal and a goal deadline that is not
+  a date, all answered with a 502
+- the same in the streaming path, answered with an error event
+
+Usage (from backend/):
+    python -m benchmarks.bench_plan_validation [--milestones 6] [--tasks 8] [--bad 1] [--latency 0.3] [--seconds-per-token 0.005]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from api.admission import admission_controller
+from api.goal_to_tasks import Goal, GoalToTasks, MilestoneTasks
+from api.tracing import metrics
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, default_parsed, disable_response_cache, load_app, make_goal
+
+SMART_GOAL = "Run a marathon in under 4 hours by April 2027."
+
+
+def messy_plan(milestones: int, tasks: int, bad: int) -> dict:
+    """
+    A plan as a careless model might write it.
+    """
+    plan = make_goal(milestones, tasks).dict()
+    plan["deadline"] = "April 1, 2027"
+    plan["progress"] = 150
+    for index, milestone in enumerate(plan["milestones"]):
+        milestone["deadline"] = ["2026/11/30", "2027-05", "2027-01-15T00:00:00Z", "next spring"][index % 4]
+        for task in milestone["tasks"]:
+            task.update(importance=7, urgency=0, duration_hours=2.5)
+        if index < bad:
+            milestone["tasks"] = []
+    return plan
+
+
+def scripted(milestones: int, tasks: int, bad: int, milestone_failures: int = 0, refuse: bool = False):
+    """
+    Parsed factory returning the messy plan first and a clean one after; milestone retries fail `milestone_failures` times first.
+    """
+    state = {"plans": 0, "milestones": 0}
+
+    def parsed_factory(response_format, messages):
+        if refuse:
+            return None
+        if response_format is Goal:
+            state["plans"] += 1
+            return Goal.model_validate(messy_plan(milestones, tasks, bad)) if state["plans"] == 1 else make_goal(milestones, tasks)
+        if response_format is MilestoneTasks:
+            state["milestones"] += 1
+            if state["milestones"] <= milestone_failures:
+                return MilestoneTasks(tasks=[])
+            return MilestoneTasks(tasks=make_goal(1, tasks).milestones[0].tasks)
+        return default_parsed(response_format, messages)
+    return parsed_factory
+
+
+def undated(milestones: int, tasks: int, validate: bool):
+    """
+    Parsed factory whose plan has a goal deadline that is not a date.
+
+    The SDK validates a parsed answer, so it raises; a stream is only validated by the caller, so its plan is built unvalidated.
+    """
+    def parsed_factory(response_format, messages):
+        if response_format is not Goal:
+            return default_parsed(response_format, messages)
+        if validate:
+            return Goal.model_validate({**make_goal(milestones, tasks).dict(), "deadline": "next spring"})
+        goal_plan = make_goal(milestones, tasks)
+        goal_plan.deadline = "next spring"
+        return goal_plan
+    return parsed_factory
+
+
+def counter(name: str) -> float:
+    return sum(metrics.counters.get(name, {}).values())
+
+
+async def compare(milestones: int, tasks: int, bad: int, latency: float, seconds_per_token: float):
+    print(f"{'mode':>11} {'calls':>6} {'wall s':>7} {'prompt tok':>11} {'output tok':>11}")
+    for mode in ("regenerate", "repair"):
+        client = FakeAsyncOpenAI(latency=latency, seconds_per_output_token=seconds_per_token, parsed_factory=scripted(milestones, tasks, bad))
+        goal_to_tasks = GoalToTasks(FakeFirestore(), client, "bench-user")
+        start = time.perf_counter()
+        if mode == "regenerate":
+            goal_to_tasks.user_profile_data = {}
+            await goal_to_tasks._parse("generate_milestones_and_tasks", [{"role": "user", "content": SMART_GOAL}], Goal)
+            goal_plan = await goal_to_tasks._parse("generate_milestones_and_tasks", [{"role": "user", "content": SMART_GOAL + " "}], Goal)
+        else:
+            goal_plan = await goal_to_tasks.generate_milestones_and_tasks(SMART_GOAL)
+        elapsed = time.perf_counter() - start
+        assert all(milestone.tasks for milestone in goal_plan.milestones)
+        print(f"{mode:>11} {client.calls:>6} {elapsed:>7.2f} {client.prompt_tokens:>11} {client.completion_tokens:>11}")
+    print(f"tokens saved (metric): {counter('plan_retry_tokens_saved_total'):.0f}, milestone retries: {counter('plan_milestone_retries_total'):.0f}")
+    print()
+
+
+async def check_outcomes(milestones: int, tasks: int):
+    metrics.clear()
+    client = FakeAsyncOpenAI(parsed_factory=scripted(milestones, tasks, bad=0))
+    goal_plan = await GoalToTasks(FakeFirestore(), client, "bench-user").generate_milestones_and_tasks(SMART_GOAL)
+    task = goal_plan.milestones[0].tasks[0]
+    assert client.calls == 1 and (task.importance, task.urgency, task.duration_hours) == (5, 1, 3)
+    assert goal_plan.deadline == "2027-04-01" and goal_plan.progress == 0
+    assert [milestone.deadline for milestone in goal_plan.milestones[:4]] == ["2026-11-30", "2027-04-01", "2027-01-15", None]
+    repairs = {dict(labels)["field"]: value for labels, value in metrics.counters["plan_repairs_total"].items()}
+    print(f"repaired locally, no retry: {repairs}")
+
+    client = FakeAsyncOpenAI(parsed_factory=scripted(milestones, tasks, bad=1, milestone_failures=1))
+    goal_plan = await GoalToTasks(FakeFirestore(), client, "bench-user").generate_milestones_and_tasks(SMART_GOAL)
+    assert client.calls == 3 and goal_plan.milestones[0].tasks
+    print("milestone failing its first retry: repaired on the second")
+
+    for label, factory in (("milestone failing every retry", scripted(milestones, tasks, bad=1, milestone_failures=99)),
+                           ("refusal", scripted(milestones, tasks, bad=0, refuse=True)),
+                           ("goal deadline that is not a date", undated(milestones, tasks, validate=True))):
+        db = FakeFirestore()
+        app = load_app(FakeAsyncOpenAI(parsed_factory=factory), db)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+            response = await http.post("/generate_milestones_and_tasks", json={"user_id": "bench-user", "validated_goal": SMART_GOAL})
+        assert response.status_code == 502 and not db.documents, response.text
+        print(f"{label}: 502 {response.json()['detail']!r}, nothing written")
+
+    client = FakeAsyncOpenAI(parsed_factory=scripted(milestones, tasks, bad=1))
+    events = [event async for event in GoalToTasks(FakeFirestore(), client, "bench-user").stream_milestones_and_tasks(SMART_GOAL)]
+    assert all(event["milestone"]["tasks"] for event in events if event["type"] == "milestone") and events[-1]["type"] == "done"
+    print("streaming: failing milestone re-requested before it is sent")
+
+    for label, factory in (("streaming refusal", scripted(milestones, tasks, bad=0, refuse=True)),
+                           ("streaming milestone failing every retry", scripted(milestones, tasks, bad=1, milestone_failures=99)),
+                           ("streaming goal deadline that is not a date", undated(milestones, tasks, validate=False))):
+        db = FakeFirestore()
+        app = load_app(FakeAsyncOpenAI(parsed_factory=factory), db)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+            response = await http.post("/generate_milestones_and_tasks/stream", json={"user_id": "bench-user", "validated_goal": SMART_GOAL})
+        events = [json.loads(line) for line in response.text.splitlines()]
+        error = events[-1]
+        assert response.status_code == 200 and error["type"] == "error" and error["detail"], events[-1]
+        # A goal already announced is kept, with its snapshot, so reads and the client agree
+        snapshots = [path for path in db.documents if path[2] == "goalSnapshots"]
+        assert (error["guid"] is None and not db.documents) or (error["guid"] is not None and len(snapshots) == 1), (error, list(db.documents))
+        print(f"{label}: error event {error['detail']!r}, goal kept: {error['guid'] is not None}")
+
+
+async def run(milestones: int, tasks: int, bad: int, latency: float, seconds_per_token: float):
+    disable_response_cache()
+    # One user's requests check the outcomes, not the planning rate limit
+    admission_controller.enabled = False
+    await compare(milestones, tasks, bad, latency, seconds_per_token)
+    await check_outcomes(milestones, tasks)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--milestones", type=int, default=6)
+    parser.add_argument("--tasks", type=int, default=8, help="Tasks per milestone")
+    parser.add_argument("--bad", type=int, default=1, help="Milestones returned without tasks")
+    parser.add_argument("--latency", type=float, default=0.3, help="Simulated time to first token per call, in seconds")
+    parser.add_argument("--seconds-per-token", type=float, default=0.005, help="Simulated generation time per output token")
+    args = parser.parse_args()
+    asyncio.run(run(args.milestones, args.tasks, args.bad, args.latency, args.seconds_per_token))
@@ -0,0 +1,62 @@
+"""
+Monolithic vs fan-out planning: wall-clock latency and token usage.
+
+The fake OpenAI client charges a fixed time-to-first-token plus a per-output-token
+generation time, so one big structured response is slower than several
+smaller ones generated in parallel.
+
+Usage (from backend/):
+    python -m benchmarks.bench_planning [--latency 0.5] [--seconds-per-token 0.01]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from api.goal_to_tasks import Goal, GoalOutline, GoalToTasks, MilestoneTasks
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, default_parsed, disable_response_cache, make_goal
+
+SMART_GOAL = "Run a marathon in under 4 hours by April 2027."
+
+
+def sized_parsed(milestones: int, tasks_per_milestone: int):
+    def parsed_factory(response_format, messages):
+        if response_format is Goal:
+            return make_goal(milestones, tasks_per_milestone)
+        if response_format is GoalOutline:
+            outline = default_parsed(GoalOutline, messages)
+            outline.milestones = [outline.milestones[0].model_copy(update={"name": f"{m + 1}. Milestone"}) for m in range(milestones)]
+            return outline
+        if response_format is MilestoneTasks:
+            return MilestoneTasks(tasks=make_goal(1, tasks_per_milestone).milestones[0].tasks)
+        return default_parsed(response_format, messages)
+    return parsed_factory
+
+
+async def plan(mode: str, milestones: int, tasks: int, latency: float, seconds_per_token: float):
+    client = FakeAsyncOpenAI(latency=latency, seconds_per_output_token=seconds_per_token, parsed_factory=sized_parsed(milestones, tasks))
+    goal_to_tasks = GoalToTasks(FakeFirestore(), client, "bench-user")
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        goal_plan = await goal_to_tasks.generate_milestones_and_tasks(SMART_GOAL, mode)
+    elapsed = time.perf_counter() - start
+    assert sum(len(milestone.tasks) for milestone in goal_plan.milestones) == milestones * tasks
+    return elapsed, client
+
+
+async def run(latency: float, seconds_per_token: float):
+    disable_response_cache()
+    print(f"{'plan':>6} {'mode':>11} {'calls':>6} {'wall s':>7} {'prompt tok':>11} {'output tok':>11}")
+    for milestones, tasks in [(3, 5), (5, 8), (8, 8)]:
+        for mode in ("monolithic", "fan_out"):
+            elapsed, client = await plan(mode, milestones, tasks, latency, seconds_per_token)
+            print(f"{f'{milestones}x{tasks}':>6} {mode:>11} {client.calls:>6} {elapsed:>7.2f} {client.prompt_tokens:>11} {client.completion_tokens:>11}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.5, help="Simulated time to first token per call, in seconds")
+    parser.add_argument("--seconds-per-token", type=float, default=0.01, help="Simulated generation time per output token")
+    args = parser.parse_args()
+    asyncio.run(run(args.latency, args.seconds_per_token))
@@ -0,0 +1,171 @@
+"""
+Task prioritization: scoring and ranking throughput, and the incremental index.
+
+1. Scores `--tasks` random tasks one by one in Python, then with the
+   NumPy batch path, and picks the top k by full sort and by argpartition.
+2. Rescores cached rankings holding `--tasks` tasks over 1000 users, the
+   overnight path used when the weights change.
+3. Top-k queries and completions on one user's ranking of `--user-tasks`
+   tasks, against re-sorting the user's tasks on every query.
+4. Checks GET /users/{user_id}/tasks/next against completions and new goals.
+
+Usage (from backend/):
+    python -m benchmarks.bench_prioritization [--tasks 1000000] [--user-tasks 5000] [--k 10]
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+import numpy as np
+
+from api.persistence import GoalTreeWriter
+from api.prioritization import PriorityIndex, PriorityScorer, SCORE_FIELDS, TaskRanking, priority_index, score_batch, top_k_batch
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, load_app, make_goal
+
+USER_ID = "bench-user"
+USERS = 1000
+
+
+def random_columns(rng, size: int) -> dict:
+    return {
+        'importance': rng.integers(1, 6, size),
+        'urgency': rng.integers(1, 6, size),
+        'simplicity': rng.integers(1, 6, size),
+        'duration_hours': rng.integers(1, 17, size) / 2,
+    }
+
+
+def random_tasks(rng, size: int, prefix: str = "task") -> list:
+    columns = {field: values.tolist() for field, values in random_columns(rng, size).items()}
+    return [
+        {'tuid': f"{prefix}-{i}", 'muid': "m", 'name': f"Task {i}", 'completed': False, **{field: columns[field][i] for field in SCORE_FIELDS}}
+        for i in range(size)
+    ]
+
+
+def timed(function, repeat: int = 1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def bench_batch(rng, size: int, k: int):
+    scorer = PriorityScorer()
+    columns = random_columns(rng, size)
+    rows = list(zip(*(columns[field].tolist() for field in SCORE_FIELDS)))
+
+    python_scores, python_ms = timed(lambda: [scorer(*row) for row in rows])
+    scores, numpy_ms = timed(lambda: score_batch(columns, scorer))
+    assert np.allclose(scores, python_scores, atol=1e-4)
+    sorted_top, sort_ms = timed(lambda: np.argsort(-scores, kind="stable")[:k])
+    top, partition_ms = timed(lambda: top_k_batch(scores, k))
+    assert np.allclose(scores[top], scores[sorted_top])
+
+    print(f"Scoring and top-{k} of {size:,} tasks")
+    print(f"{'python scoring':>22} {python_ms:>10.1f} ms")
+    print(f"{'numpy batch scoring':>22} {numpy_ms:>10.1f} ms  ({python_ms / numpy_ms:.0f}x)")
+    print(f"{'top-k by full sort':>22} {sort_ms:>10.1f} ms")
+    print(f"{'top-k by argpartition':>22} {partition_ms:>10.1f} ms")
+    print()
+
+
+def bench_rescore(rng, size: int, k: int):
+    index = PriorityIndex()
+    per_user = size // USERS
+    for user in range(USERS):
+        ranking = TaskRanking(index.scorer)
+        for task in random_tasks(rng, per_user):
+            ranking.tasks[task['tuid']] = task
+        index._rankings[f"user-{user}"] = ranking
+
+    _, rescore_ms = timed(lambda: index.rescore(PriorityScorer(importance=3.0, duration=0.0)))
+    ranking = index._rankings["user-0"]
+    expected = sorted((-index.scorer(**{field: task[field] for field in SCORE_FIELDS}) for task in ranking.tasks.values()))[:k]
+    assert np.allclose([-task['score'] for task in ranking.top(k)], expected, atol=1e-2)
+    print(f"Rescoring {USERS} cached rankings of {per_user:,} tasks ({USERS * per_user:,} tasks): {rescore_ms:.0f} ms")
+    print()
+
+
+def bench_ranking(rng, size: int, k: int, queries: int = 1000):
+    tasks = random_tasks(rng, size)
+    scorer = PriorityScorer()
+    ranking = TaskRanking(scorer)
+    _, build_ms = timed(lambda: [ranking.upsert(task) for task in tasks])
+
+    def resort():
+        open_tasks = [task for task in ranking.tasks.values() if not task.get('completed')]
+        return sorted(open_tasks, key=lambda task: -scorer(**{field: task[field] for field in SCORE_FIELDS}))[:k]
+
+    top, top_ms = timed(lambda: ranking.top(k), queries)
+    resorted, resort_ms = timed(resort, 20)
+    assert [task['tuid'] for task in top] == [task['tuid'] for task in resorted]
+
+    def complete_best():
+        best = ranking.top(1)[0]
+        ranking.set_completed(best['tuid'], True)
+
+    _, complete_ms = timed(complete_best, queries)
+    assert len(ranking) == size - queries
+
+    print(f"One user with {size:,} open tasks")
+    print(f"{'build ranking':>22} {build_ms:>10.2f} ms")
+    print(f"{'top-' + str(k) + ' from heap':>22} {top_ms:>10.3f} ms/query")
+    print(f"{'top-' + str(k) + ' by re-sorting':>22} {resort_ms:>10.3f} ms/query  ({resort_ms / top_ms:.0f}x)")
+    print(f"{'complete best task':>22} {complete_ms:>10.3f} ms/update")
+    print()
+
+
+async def check_endpoint(k: int):
+    db = FakeFirestore()
+    writer = GoalTreeWriter(db)
+    goal = make_goal(3, 4)
+    for index, task in enumerate(task for milestone in goal.milestones for task in milestone.tasks):
+        task.importance, task.urgency = 1 + index % 5, 1 + index * 3 % 5
+    await writer.save_goal(goal, USER_ID)
+    priority_index.clear()
+
+    app = load_app(FakeAsyncOpenAI(), db)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        async def next_tasks():
+            response = await http.get(f"/users/{USER_ID}/tasks/next", params={"k": k})
+            assert response.status_code == 200, response.text
+            return response.json()["tasks"]
+
+        ranked = await next_tasks()
+        assert [task['score'] for task in ranked] == sorted((task['score'] for task in ranked), reverse=True)
+        assert ranked[0]['quadrant'] == "do"
+
+        best = ranked[0]
+        response = await http.post(f"/users/{USER_ID}/goals/{best['guid']}/milestones/{best['muid']}/tasks/{best['tuid']}/completion", json={"completed": True})
+        assert response.status_code == 200
+        assert best['tuid'] not in [task['tuid'] for task in await next_tasks()]
+        await http.post(f"/users/{USER_ID}/goals/{best['guid']}/milestones/{best['muid']}/tasks/{best['tuid']}/completion", json={"completed": False})
+        assert best['tuid'] in [task['tuid'] for task in await next_tasks() if task['score'] == best['score']]
+
+        urgent = make_goal(1, 1)
+        urgent.milestones[0].tasks[0].importance = urgent.milestones[0].tasks[0].urgency = 5
+        urgent.milestones[0].tasks[0].duration_hours = 1
+        await writer.save_goal(urgent, USER_ID)
+        # Saved outside the app's save paths: the cached ranking only learns about it when told
+        priority_index.add_goal(USER_ID, urgent.dict())
+        assert (await next_tasks())[0]['tuid'] == urgent.milestones[0].tasks[0].tuid
+    print(f"GET /users/{{user_id}}/tasks/next: ranking follows completions and new goals ({priority_index.stats()})")
+
+
+def run(tasks: int, user_tasks: int, k: int):
+    rng = np.random.default_rng(0)
+    bench_batch(rng, tasks, k)
+    bench_rescore(rng, tasks, k)
+    bench_ranking(rng, user_tasks, k)
+    asyncio.run(check_endpoint(k))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=1_000_000)
+    parser.add_argument("--user-tasks", type=int, default=5000)
+    parser.add_argument("--k", type=int, default=10)
+    args = parser.parse_args()
+    run(args.tasks, args.user_tasks, args.k)
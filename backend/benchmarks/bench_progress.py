@@ -0,0 +1,117 @@
+"""
+Goal progress from incremental counters against rescanning the goal's tasks.
+
+"rescan" is how progress had to be computed without counters: load every
+task of the goal and sum their durations. "counters" reads the goal
+document. Then checks the counters under concurrency, through the
+completion endpoint:
+
+- every task of a goal completed at once, in concurrent requests
+- the same task completed by many concurrent requests (counted once)
+- half of the tasks reopened at once
+- reconciliation after the counters were corrupted
+
+Usage (from backend/):
+    python -m benchmarks.bench_progress [--milestones 10] [--tasks 20] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+
+from api.goal_reads import GoalReader
+from api.persistence import GoalTreeWriter, progress_counters, progress_percent
+from api.progress import ProgressTracker
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, load_app, make_goal
+
+USER_ID = "bench-user"
+
+
+async def rescan(db, guid: str) -> int:
+    goal = await GoalReader(db).load_tree(USER_ID, guid)
+    return progress_percent(progress_counters([task for milestone in goal['milestones'] for task in milestone['tasks']]))
+
+
+async def counters(db, guid: str) -> int:
+    return (await ProgressTracker(db).goal_progress(USER_ID, guid))['progress']
+
+
+async def measure(db, read, guid: str):
+    documents_read = db.documents_read
+    start = time.perf_counter()
+    progress = await read(db, guid)
+    return progress, db.documents_read - documents_read, (time.perf_counter() - start) * 1000
+
+
+def expected(db, guid: str) -> dict:
+    tasks = [data for path, data in db.documents.items() if path[-2] == 'tasks' and data['guid'] == guid]
+    return progress_counters(tasks)
+
+
+def check(db, guid: str, label: str):
+    goal = db.documents[('users', USER_ID, 'goals', guid)]
+    truth = expected(db, guid)
+    assert {field: goal[field] for field in truth} == truth, (label, goal, truth)
+    for path, milestone in db.documents.items():
+        if path[:4] == ('users', USER_ID, 'goals', guid) and path[-2] == 'milestones':
+            tasks = [data for task_path, data in db.documents.items() if task_path[:-2] == path]
+            assert milestone['completed_hours'] == progress_counters(tasks)['completed_hours'], (label, path)
+    print(f"{label:<38} ok  {truth['completed_tasks']:>4}/{truth['total_tasks']} tasks  {goal['completed_hours']:>7.1f}/{goal['total_hours']:.1f} h  aborted transactions: {db.aborted_transactions}")
+
+
+async def run(milestones: int, tasks: int, latency: float):
+    db = FakeFirestore()
+    goal = make_goal(milestones, tasks)
+    await GoalTreeWriter(db).save_goal(goal, USER_ID)
+    db.latency = latency
+
+    print(f"{'mode':>10} {'docs read':>10} {'ms':>9}")
+    for mode, read in (("rescan", rescan), ("counters", counters)):
+        progress, documents_read, elapsed = await measure(db, read, goal.guid)
+        assert progress == goal.progress
+        print(f"{mode:>10} {documents_read:>10} {elapsed:>9.1f}")
+    print()
+
+    db.latency = latency / 10
+    app = load_app(FakeAsyncOpenAI(), db)
+    paths = [f"/users/{USER_ID}/goals/{goal.guid}/milestones/{milestone.muid}/tasks/{task.tuid}/completion" for milestone in goal.milestones for task in milestone.tasks]
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+
+        async def complete(path, completed=True):
+            response = await http.post(path, json={"completed": completed})
+            assert response.status_code == 200, response.text
+            return response.json()
+
+        await asyncio.gather(*(complete(path) for path in paths))
+        check(db, goal.guid, "all tasks completed concurrently")
+        assert (await http.get(f"/users/{USER_ID}/goals/{goal.guid}/progress")).json()["progress"] == 100
+
+        results = await asyncio.gather(*(complete(paths[0], False) for _ in range(20)))
+        assert sum(result["changed"] for result in results) == 1
+        check(db, goal.guid, "one task reopened 20x concurrently")
+
+        await asyncio.gather(*(complete(path, False) for path in paths[1::2]))
+        check(db, goal.guid, "half the tasks reopened concurrently")
+
+        tree = (await http.get(f"/users/{USER_ID}/goals/{goal.guid}")).json()
+        completed = sum(task["completed"] for milestone in tree["milestones"] for task in milestone["tasks"])
+        assert completed == expected(db, goal.guid)["completed_tasks"]
+        assert tree["progress"] == progress_percent(expected(db, goal.guid))
+
+        assert (await http.post(paths[0].replace(goal.milestones[0].tasks[0].tuid, "missing"), json={"completed": True})).status_code == 404
+
+    goal_path = ('users', USER_ID, 'goals', goal.guid)
+    db.documents[goal_path] = {**db.documents[goal_path], 'completed_hours': -1.0, 'completed_tasks': 999}
+    progress = await ProgressTracker(db).reconcile_goal(USER_ID, goal.guid)
+    assert progress['progress'] == progress_percent(expected(db, goal.guid))
+    check(db, goal.guid, "reconciled after corruption")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--milestones", type=int, default=10)
+    parser.add_argument("--tasks", type=int, default=20, help="Tasks per milestone")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per Firestore round trip")
+    args = parser.parse_args()
+    asyncio.run(run(args.milestones, args.tasks, args.latency))
@@ -0,0 +1,121 @@
+"""
+Input tokens, cached share and latency of the planning and SMART goal prompts, before and after prompt compaction.
+
+"before" builds the messages the way the endpoints used to: the full
+GOAL_TO_TASK_SYS_MSG with all five example milestones, and the SMART goal
+template with the goal ahead of the profile, which is injected as a dict
+repr. "after" uses api.prompt_builder. The fake client caches prompt
+prefixes of 1024+ tokens like OpenAI does and charges
+`--seconds-per-prompt-token` for every uncached prompt token, so both the
+size of the prompt and the stability of its prefix show in the latency.
+
+Usage (from backend/):
+    python -m benchmarks.bench_prompts [--users 20] [--goals-per-user 5]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import random
+import time
+
+from api.goal_to_tasks import Goal, PLANNING_MODEL, PreGoal
+from api.prompt_builder import PromptUsage, goal_plan_messages, smart_goal_messages
+from api.prompts import ENRICHED_GOAL_SYS_MSG, GOAL_TO_TASK_SYS_MSG, GOAL_TO_TASK_USR_MSG
+from benchmarks.fakes import FakeAsyncOpenAI
+
+# ENRICHED_GOAL_USR_MSG as it was before the profile was moved first
+LEGACY_ENRICHED_GOAL_USR_MSG = """
+Input:
+Goal:
+What: $WHAT
+Why: $WHY
+When: $WHEN
+Profile:
+$PROFILE
+
+Let's think step by step
+
+Output:
+
+"""
+
+TRAITS = ["Curious and open to new experiences", "Organized but procrastinates on big projects", "Introverted, recharges alone",
+          "Cooperative, avoids conflict", "Calm under pressure, anxious about deadlines"]
+PASSIONS = ["trail running, cooking and jazz piano", "chess, astronomy and writing short stories", "climbing, photography and learning languages"]
+
+
+def make_profile(user: int) -> dict:
+    rng = random.Random(user)
+    return {
+        "summary": f"User {user}. " + " ".join(rng.sample(TRAITS, 3)) + f". Enjoys {rng.choice(PASSIONS)}.",
+        "opportunities": " ".join(f"Opportunity {index}: break long-term goals into weekly commitments and review them every Sunday." for index in range(rng.randint(5, 40))),
+    }
+
+
+def make_pre_goal(user: int, goal: int) -> PreGoal:
+    return PreGoal(what=f"Goal {goal} of user {user}: run a half marathon", why="To get fitter and prove I can stick to a plan", when="Within 6 months", profile={})
+
+
+def legacy_goal_plan_messages(validated_smart_goal: str):
+    return [
+        {"role": "system", "content": GOAL_TO_TASK_SYS_MSG},
+        {"role": "user", "content": GOAL_TO_TASK_USR_MSG.replace("$SMART_GOAL", validated_smart_goal)}
+    ]
+
+
+def legacy_smart_goal_messages(pre_goal: PreGoal, user_profile: dict):
+    return [
+        {"role": "system", "content": ENRICHED_GOAL_SYS_MSG},
+        {"role": "user", "content": LEGACY_ENRICHED_GOAL_USR_MSG.replace("$WHAT", str(pre_goal.what)).replace("$WHY", str(pre_goal.why)).replace("$WHEN", str(pre_goal.when)).replace("$PROFILE", str(user_profile))}
+    ]
+
+
+BUILDERS = {
+    "before": (legacy_goal_plan_messages, legacy_smart_goal_messages),
+    "after": (goal_plan_messages, smart_goal_messages),
+}
+
+
+async def run_mode(mode: str, users: int, goals_per_user: int, latency: float, seconds_per_prompt_token: float):
+    plan_messages, goal_messages = BUILDERS[mode]
+    client = FakeAsyncOpenAI(latency=latency, seconds_per_prompt_token=seconds_per_prompt_token)
+    usage = PromptUsage()
+    elapsed = {"smart_goal": 0.0, "generate_milestones_and_tasks": 0.0}
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        for user in range(users):
+            profile = make_profile(user)
+            for goal in range(goals_per_user):
+                pre_goal = make_pre_goal(user, goal)
+
+                start = time.perf_counter()
+                completion = await client.chat.completions.create(model="gpt-4o-mini", messages=goal_messages(pre_goal, profile), seed=42)
+                elapsed["smart_goal"] += time.perf_counter() - start
+                usage.record("smart_goal", completion.usage)
+
+                start = time.perf_counter()
+                completion = await client.beta.chat.completions.parse(model=PLANNING_MODEL, messages=plan_messages(completion.choices[0].message.content), response_format=Goal, seed=42)
+                elapsed["generate_milestones_and_tasks"] += time.perf_counter() - start
+                usage.record("generate_milestones_and_tasks", completion.usage)
+
+    return {endpoint: {**stats, "mean_ms": elapsed[endpoint] / stats["calls"] * 1000} for endpoint, stats in usage.stats().items()}
+
+
+async def run(users: int, goals_per_user: int, latency: float, seconds_per_prompt_token: float):
+    print(f"{users} users x {goals_per_user} goals")
+    print(f"{'endpoint':>30} {'mode':>7} {'calls':>6} {'prompt tok':>11} {'cached':>7} {'mean ms':>8}")
+    for endpoint in ("smart_goal", "generate_milestones_and_tasks"):
+        for mode in BUILDERS:
+            stats = (await run_mode(mode, users, goals_per_user, latency, seconds_per_prompt_token))[endpoint]
+            print(f"{endpoint:>30} {mode:>7} {stats['calls']:>6} {stats['mean_prompt_tokens']:>11.0f} {stats['cached_ratio']:>7.0%} {stats['mean_ms']:>8.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--goals-per-user", type=int, default=5)
+    parser.add_argument("--latency", type=float, default=0.01, help="Fixed seconds per call")
+    parser.add_argument("--seconds-per-prompt-token", type=float, default=0.0001, help="Simulated prefill time per uncached prompt token")
+    args = parser.parse_args()
+    asyncio.run(run(args.users, args.goals_per_user, args.latency, args.seconds_per_prompt_token))
@@ -0,0 +1,160 @@
+"""
+Throughput of the production server (api.runtime) with 1 to N workers.
+
+Starts `python -m api.runtime` serving the stub app below, whose /cpu
+endpoint spends about `--work-ms` of pure-Python CPU time per request, and
+drives it at `--concurrency` for `--seconds` per worker count. With one
+process, requests queue behind each other's CPU time; each worker adds a
+core's worth of throughput until the machine (client included) runs out of
+cores.
+
+Then checks draining: requests in flight when SIGTERM arrives still
+complete, and the server exits cleanly.
+
+Usage (from backend/):
+    python -m benchmarks.bench_runtime [--workers 1 2 4] [--seconds 5] [--concurrency 32] [--work-ms 5]
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+from fastapi import FastAPI
+
+from api.runtime import available_cpus
+
+app = FastAPI()
+
+
+@app.get("/")
+async def root():
+    return {"pid": os.getpid()}
+
+
+@app.get("/cpu")
+async def cpu(iterations: int = 50_000):
+    # Holds the GIL and the event loop, like JSON encoding or scoring would
+    return {"pid": os.getpid(), "sum": sum(index * index for index in range(iterations))}
+
+
+@app.get("/sleep")
+async def sleep(seconds: float = 1.0):
+    await asyncio.sleep(seconds)
+    return {"pid": os.getpid()}
+
+
+def calibrate(work_ms: float) -> int:
+    iterations = 100_000
+    start = time.perf_counter()
+    sum(index * index for index in range(iterations))
+    return max(1, int(iterations * work_ms / ((time.perf_counter() - start) * 1000)))
+
+
+def free_port() -> int:
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+async def start_server(workers: int, **env) -> tuple:
+    port = free_port()
+    environment = {**os.environ, "APP_MODULE": "benchmarks.bench_runtime:app", "HOST": "127.0.0.1", "PORT": str(port),
+                   "WEB_CONCURRENCY": str(workers), "LOG_LEVEL": "WARNING", **env}
+    process = subprocess.Popen([sys.executable, "-m", "api.runtime"], env=environment)
+    base_url = f"http://127.0.0.1:{port}"
+    async with httpx.AsyncClient(base_url=base_url) as http:
+        for _ in range(300):
+            try:
+                if (await http.get("/")).status_code == 200:
+                    return process, base_url
+            except httpx.TransportError:
+                await asyncio.sleep(0.05)
+    process.kill()
+    raise RuntimeError(f"Server with {workers} workers did not start")
+
+
+def stop_server(process) -> int:
+    process.send_signal(signal.SIGTERM)
+    return process.wait(timeout=30)
+
+
+async def drive(base_url: str, seconds: float, concurrency: int, iterations: int) -> dict:
+    latencies, errors, pids = [], 0, set()
+    deadline = time.perf_counter() + seconds
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=30) as http:
+        async def client():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await http.get("/cpu", params={"iterations": iterations})
+                    response.raise_for_status()
+                    pids.add(response.json()["pid"])
+                    latencies.append(time.perf_counter() - start)
+                except httpx.HTTPError:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": len(latencies), "errors": errors, "workers_seen": len(pids),
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000 if latencies else 0.0,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0.0,
+    }
+
+
+async def bench_throughput(worker_counts, seconds: float, concurrency: int, work_ms: float):
+    iterations = calibrate(work_ms)
+    print(f"{available_cpus()} CPUs available, {concurrency} concurrent clients, ~{work_ms} ms CPU per request ({iterations} iterations)")
+    print(f"{'workers':>8} {'req/s':>8} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7} {'served by':>10}")
+    baseline = None
+    for workers in worker_counts:
+        process, base_url = await start_server(workers)
+        try:
+            result = await drive(base_url, seconds, concurrency, iterations)
+        finally:
+            stop_server(process)
+        baseline = baseline or result["throughput"]
+        print(f"{workers:>8} {result['throughput']:>8.1f} {result['throughput'] / baseline:>7.2f}x {result['p50_ms']:>8.1f} "
+              f"{result['p99_ms']:>8.1f} {result['errors']:>7} {result['workers_seen']:>10}")
+    print()
+
+
+async def check_drain(workers: int):
+    process, base_url = await start_server(workers, GRACEFUL_SHUTDOWN_SECONDS="5")
+    async with httpx.AsyncClient(base_url=base_url, timeout=30) as http:
+        in_flight = [asyncio.ensure_future(http.get("/sleep", params={"seconds": 1})) for _ in range(8)]
+        await asyncio.sleep(0.3)
+        start = time.perf_counter()
+        process.send_signal(signal.SIGTERM)
+        responses = await asyncio.gather(*in_flight)
+        exit_code = await asyncio.get_running_loop().run_in_executor(None, process.wait, 30)
+    assert [response.status_code for response in responses] == [200] * len(in_flight)
+    assert exit_code == 0, exit_code
+    print(f"SIGTERM with {len(in_flight)} requests in flight on {workers} workers: all completed, "
+          f"server exited {exit_code} after {time.perf_counter() - start:.2f} s")
+
+
+async def run(worker_counts, seconds: float, concurrency: int, work_ms: float):
+    await bench_throughput(worker_counts, seconds, concurrency, work_ms)
+    await check_drain(max(worker_counts))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", nargs="+", type=int, default=sorted({1, 2, available_cpus()}), help="Worker counts to compare")
+    parser.add_argument("--seconds", type=float, default=5.0, help="Load duration per worker count")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent clients")
+    parser.add_argument("--work-ms", type=float, default=5.0, help="CPU time per request, in milliseconds")
+    args = parser.parse_args()
+    asyncio.run(run(args.workers, args.seconds, args.concurrency, args.work_ms))
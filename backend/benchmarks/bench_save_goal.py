@@ -0,0 +1,63 @@
+"""
+Round trips and wall time of GoalToTasks.save_goal_to_firestore, before and after batching.
+
+Usage (from backend/):
+    python -m benchmarks.bench_save_goal [--latency 0.02]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from api.goal_to_tasks import Goal, GoalToTasks
+from benchmarks.fakes import FakeFirestore, make_goal
+
+
+async def save_serial(db, goal_plan: Goal, user_id: str):
+    """The original one-set()-per-document implementation, kept as the baseline."""
+    goal_ref = db.collection('users', user_id, 'goals').document()
+    await goal_ref.set({
+        'guid': goal_ref.id,
+        'name': goal_plan.name,
+        'description': goal_plan.description,
+        'deadline': goal_plan.deadline,
+        'progress': goal_plan.progress
+    })
+    for milestone in goal_plan.milestones:
+        milestone.guid = goal_ref.id
+        milestone_ref = goal_ref.collection('milestones').document()
+        await milestone_ref.set({
+            'muid': milestone_ref.id,
+            'name': milestone.name,
+            'description': milestone.description,
+            'deadline': milestone.deadline
+        })
+        for task in milestone.tasks:
+            task.guid = goal_ref.id
+            task.muid = milestone_ref.id
+            await milestone_ref.collection('tasks').document().set(task.dict())
+
+
+async def save_batched(db, goal_plan: Goal, user_id: str):
+    with contextlib.redirect_stdout(io.StringIO()):
+        await GoalToTasks(db, None, user_id).save_goal_to_firestore(goal_plan, user_id)
+
+
+async def run(latency: float):
+    print(f"{'plan':>12} {'docs':>6} {'serial RT':>10} {'serial ms':>10} {'batched RT':>11} {'batched ms':>11}")
+    for milestones, tasks in [(3, 5), (5, 8), (8, 8), (50, 20)]:
+        row = []
+        for save in (save_serial, save_batched):
+            db = FakeFirestore(latency=latency)
+            start = time.perf_counter()
+            await save(db, make_goal(milestones, tasks), "bench-user")
+            row.append((db.round_trips, (time.perf_counter() - start) * 1000, len(db.documents)))
+        (serial_rt, serial_ms, docs), (batched_rt, batched_ms, _) = row
+        print(f"{f'{milestones}x{tasks}':>12} {docs:>6} {serial_rt:>10} {serial_ms:>10.1f} {batched_rt:>11} {batched_ms:>11.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per round trip")
+    asyncio.run(run(parser.parse_args().latency))
@@ -0,0 +1,173 @@
+"""
+Deadline-aware scheduling: single-user latency, incremental updates and batch replanning.
+
+1. Builds and reads the schedule of one user with `--tasks` open tasks,
+   then completes tasks one at a time, incrementally and by rebuilding the
+   schedule, and checks both give the same plan.
+2. Checks that infeasible plans are flagged, and that moving the start
+   date makes unfinished work slip.
+3. Replans `--users` users in batch mode through a fake Firestore.
+4. Checks POST /users/{user_id}/schedule against a task completion.
+
+Usage (from backend/):
+    python -m benchmarks.bench_scheduling [--tasks 300] [--users 1000] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import date, timedelta
+
+import httpx
+
+from api.persistence import GoalTreeWriter
+from api.scheduling import Availability, ScheduleIndex, build_schedule, schedule_index
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, load_app, make_goal
+
+USER_ID = "bench-user"
+START = date(2026, 1, 5)
+
+
+def make_goals(rng: random.Random, tasks: int, goals: int = 5, milestones: int = 6) -> list:
+    per_milestone = max(1, tasks // (goals * milestones))
+    plans = []
+    for goal_index in range(goals):
+        goal = make_goal(milestones, per_milestone)
+        goal.guid = f"goal-{goal_index}"
+        goal.deadline = (START + timedelta(days=300 + 30 * goal_index)).isoformat()
+        for milestone_index, milestone in enumerate(goal.milestones):
+            milestone.muid = f"{goal.guid}-m{milestone_index}"
+            milestone.deadline = (START + timedelta(days=rng.randint(20, 45) * (milestone_index + 1))).isoformat()
+            for task_index, task in enumerate(milestone.tasks):
+                task.tuid = f"{milestone.muid}-t{task_index}"
+                task.duration_hours = rng.randint(1, 4)
+        plans.append(goal.dict())
+    return plans
+
+
+def timed(function, repeat: int = 1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function()
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def bench_single_user(rng: random.Random, tasks: int, completions: int = 50):
+    availability = Availability(weekly_hours=30)
+    goals = make_goals(rng, tasks)
+    schedule, build_ms = timed(lambda: build_schedule(goals, availability, START), 20)
+    plan, plan_ms = timed(lambda: schedule.plan(), 20)
+    open_tasks = len(schedule)
+
+    keys = [task['tuid'] for task in plan['tasks']]
+    picked = rng.sample(keys, completions)
+    schedule.repacked = 0
+    _, incremental_ms = timed(lambda: [schedule.set_completed(key, True) for key in picked])
+    incremental_repacked = schedule.repacked
+
+    completed = set(picked)
+    remaining = [{**goal, 'milestones': [{**milestone, 'tasks': [{**task, 'completed': task['tuid'] in completed} for task in milestone['tasks']]}
+                                         for milestone in goal['milestones']]} for goal in goals]
+
+    def rebuild_each():
+        for _ in picked:
+            rebuilt = build_schedule(remaining, availability, START)
+        return rebuilt
+
+    rebuilt, rebuild_ms = timed(rebuild_each)
+    assert schedule.plan() == rebuilt.plan(), "incremental schedule differs from a rebuild"
+
+    print(f"One user, {open_tasks} open tasks in {len(goals)} goals, {availability.weekly_hours:g} h/week")
+    print(f"{'build schedule':>26} {build_ms:>9.2f} ms")
+    print(f"{'read plan with slots':>26} {plan_ms:>9.2f} ms   ({'feasible' if plan['feasible'] else str(plan['late_tasks']) + ' late tasks'}, finish {plan['finish']})")
+    print(f"{'complete task, incremental':>26} {incremental_ms / completions:>9.3f} ms   ({incremental_repacked / completions:.0f} tasks shifted per completion)")
+    print(f"{'complete task, rebuild':>26} {rebuild_ms / completions:>9.3f} ms   ({rebuild_ms / incremental_ms:.0f}x)")
+    print()
+
+
+def check_feasibility():
+    goal = make_goal(2, 5)
+    goal.deadline = "2026-02-01"
+    for index, milestone in enumerate(goal.milestones):
+        milestone.muid = f"m{index}"
+        milestone.deadline = (START + timedelta(days=7 * (index + 1))).isoformat()
+        for task_index, task in enumerate(milestone.tasks):
+            task.tuid = f"m{index}-t{task_index}"
+            task.duration_hours = 2
+
+    relaxed = build_schedule([goal.dict()], Availability(weekly_hours=14), START)
+    assert relaxed.plan()['feasible']
+    tight = build_schedule([goal.dict()], Availability(weekly_hours=7), START)
+    assert not tight.plan()['feasible'] and tight.plan()['late_tasks'] > 0
+
+    relaxed.advance(START + timedelta(days=4))
+    slipped = relaxed.plan()
+    assert not slipped['feasible'], "starting four days late should push the first milestone past its deadline"
+    relaxed.set_completed("m0-t0", True)
+    relaxed.set_completed("m0-t1", True)
+    assert relaxed.plan()['feasible'], "completing the slipped work should make the plan feasible again"
+    relaxed.slip("m0-t2", 6)
+    assert not relaxed.plan()['feasible']
+    print("Infeasible plans flagged; slips and completions reschedule as expected")
+    print()
+
+
+async def bench_batch(rng: random.Random, users: int, tasks: int, latency: float):
+    db = FakeFirestore()
+    writer = GoalTreeWriter(db)
+    user_ids = [f"user-{index}" for index in range(users)]
+    for user_id in user_ids:
+        for goal in make_goals(rng, tasks, goals=2, milestones=5):
+            await writer.commit([writer.snapshot_write(user_id, goal)])
+    db.latency = latency
+
+    index = ScheduleIndex()
+    round_trips = db.round_trips
+    start = time.perf_counter()
+    plans = await index.replan_users(db, user_ids, Availability(weekly_hours=25), START)
+    elapsed = time.perf_counter() - start
+    late = sum(not plan['feasible'] for plan in plans.values())
+    print(f"Batch replan of {users} users x {tasks} tasks: {elapsed:.2f} s ({elapsed * 1000 / users:.2f} ms/user, "
+          f"{late} infeasible, {db.round_trips - round_trips} round trips at {latency * 1000:.0f} ms)")
+    print()
+
+
+async def check_endpoint():
+    db = FakeFirestore()
+    goal = make_goal(2, 3)
+    goal.deadline = "2027-04-01"
+    await GoalTreeWriter(db).save_goal(goal, USER_ID)
+    schedule_index.clear()
+
+    app = load_app(FakeAsyncOpenAI(), db)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench") as http:
+        body = {"availability": {"weekly_hours": 10, "weekdays": [0, 1, 2, 3, 4]}, "start": START.isoformat()}
+        plan = (await http.post(f"/users/{USER_ID}/schedule", json=body)).json()
+        assert plan['open_tasks'] == 6 and plan['tasks'][0]['slots'][0]['date'] == START.isoformat()
+        first, second = plan['tasks'][0], plan['tasks'][1]
+
+        response = await http.post(f"/users/{USER_ID}/goals/{first['guid']}/milestones/{first['muid']}/tasks/{first['tuid']}/completion", json={"completed": True})
+        assert response.status_code == 200
+        plan = (await http.post(f"/users/{USER_ID}/schedule", json=body)).json()
+        assert plan['open_tasks'] == 5 and plan['tasks'][0]['tuid'] == second['tuid']
+        assert plan['tasks'][0]['slots'][0]['date'] == START.isoformat()
+        assert (await http.post(f"/users/{USER_ID}/schedule", json={"availability": {"weekly_hours": 0}})).status_code == 422
+    print(f"POST /users/{{user_id}}/schedule: completions reschedule the cached plan ({schedule_index.stats()})")
+
+
+def run(tasks: int, users: int, batch_tasks: int, latency: float):
+    rng = random.Random(0)
+    bench_single_user(rng, tasks)
+    check_feasibility()
+    asyncio.run(bench_batch(rng, users, batch_tasks, latency))
+    asyncio.run(check_endpoint())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tasks", type=int, default=300, help="Open tasks of the single user")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--batch-tasks", type=int, default=100, help="Tasks per user in batch mode")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per Firestore round trip")
+    args = parser.parse_args()
+    run(args.tasks, args.users, args.batch_tasks, args.latency)
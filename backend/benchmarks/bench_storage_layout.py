@@ -0,0 +1,163 @@
+"""
+Documents against compact goal storage: documents, bytes, reads and migration.
+
+For each tree size, saves `--goals` goals of one user in each layout and
+reports the documents and bytes stored (Firestore's storage size
+calculation), the fields Firestore indexes by default, then the latency and
+documents read of a dashboard load, a goal read and a task completion at
+`--latency` per round trip, with the read cache disabled. Nested map fields
+are indexed too, so the compact layout only saves index entries once
+`milestones` is exempted from single-field indexing.
+
+Then migrates `--users` users both ways and checks every tree reads back
+unchanged, and that a tree too large for one document is stored in the
+documents layout even with GOAL_STORAGE_LAYOUT=compact.
+
+Usage (from backend/):
+    python -m benchmarks.bench_storage_layout [--sizes 5x8 8x8 50x20] [--goals 10] [--users 50] [--latency 0.02]
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from api import persistence
+from api.goal_reads import GoalReader, goal_read_cache
+from api.persistence import COMPACT_LAYOUT, DOCUMENTS_LAYOUT, GoalTreeWriter, document_size, goal_storage
+from api.progress import ProgressTracker
+from api.storage_migration import StorageMigrator
+from benchmarks.fakes import FakeFirestore, make_goal
+
+USER_ID = "bench-user"
+
+
+def indexed_fields(data) -> int:
+    if isinstance(data, dict):
+        return sum(indexed_fields(value) for value in data.values())
+    return 1
+
+
+async def timed(db, operation):
+    round_trips, documents_read = db.round_trips, db.documents_read
+    start = time.perf_counter()
+    result = await operation()
+    return result, (time.perf_counter() - start) * 1000, db.round_trips - round_trips, db.documents_read - documents_read
+
+
+async def bench_layout(layout: str, milestones: int, tasks: int, goals: int, latency: float) -> dict:
+    goal_storage.layout = layout
+    db = FakeFirestore()
+    writer = GoalTreeWriter(db)
+    plans = [make_goal(milestones, tasks) for _ in range(goals)]
+    writes = 0
+    for plan in plans:
+        plan_writes = writer.build_writes(plan, USER_ID)
+        writes += len(plan_writes)
+        await writer.commit(plan_writes)
+
+    db.latency = latency
+    reader = GoalReader(db)
+    _, list_ms, _, list_read = await timed(db, lambda: reader.list_goals(USER_ID))
+    _, get_ms, _, get_read = await timed(db, lambda: reader.get_goal(USER_ID, plans[0].guid))
+    task = plans[0].milestones[-1].tasks[-1]
+    _, complete_ms, complete_trips, _ = await timed(db, lambda: ProgressTracker(db).set_task_completed(USER_ID, plans[0].guid, task.muid, task.tuid, True))
+    return {
+        "documents": len(db.documents),
+        "writes": writes,
+        "bytes": sum(document_size(path, data) for path, data in db.documents.items()),
+        "indexed": sum(indexed_fields(data) for data in db.documents.values()),
+        "list_ms": list_ms, "list_read": list_read,
+        "get_ms": get_ms, "get_read": get_read,
+        "complete_ms": complete_ms, "complete_trips": complete_trips,
+    }
+
+
+async def bench_sizes(sizes, goals: int, latency: float):
+    goal_read_cache.enabled = False
+    print(f"{goals} goals of one user, {latency * 1000:.0f} ms per round trip, read cache disabled")
+    print(f"{'tree':>7} {'layout':>10} {'docs':>6} {'writes':>7} {'KB':>8} {'indexed':>8} {'dashboard ms':>13} {'docs read':>10} "
+          f"{'goal ms':>8} {'docs read':>10} {'complete ms':>12} {'trips':>6}")
+    for milestones, tasks in sizes:
+        for layout in (DOCUMENTS_LAYOUT, COMPACT_LAYOUT):
+            result = await bench_layout(layout, milestones, tasks, goals, latency)
+            print(f"{milestones}x{tasks:<4} {layout:>10} {result['documents']:>6} {result['writes']:>7} {result['bytes'] / 1024:>8.1f} {result['indexed']:>8} "
+                  f"{result['list_ms']:>13.1f} {result['list_read']:>10} {result['get_ms']:>8.1f} {result['get_read']:>10} "
+                  f"{result['complete_ms']:>12.1f} {result['complete_trips']:>6}")
+    goal_read_cache.enabled = True
+    print()
+
+
+async def bench_migration(users: int, goals: int, latency: float):
+    goal_storage.layout = DOCUMENTS_LAYOUT
+    db = FakeFirestore()
+    writer = GoalTreeWriter(db)
+    user_ids = [f"user-{index}" for index in range(users)]
+    for user_id in user_ids:
+        for _ in range(goals):
+            await writer.save_goal(make_goal(5, 8), user_id)
+    tracker = ProgressTracker(db)
+    reader = GoalReader(db)
+    first = (await reader.list_goals(user_ids[0]))["goals"][0]
+    await tracker.set_task_completed(user_ids[0], first["guid"], first["milestones"][0]["muid"], first["milestones"][0]["tasks"][0]["tuid"], True)
+
+    async def trees():
+        goal_read_cache.clear()
+        return {user_id: json.dumps((await reader.list_goals(user_id))["goals"], sort_keys=True) for user_id in user_ids}
+
+    before = await trees()
+    db.latency = latency
+    migrator = StorageMigrator(db)
+    for layout in (COMPACT_LAYOUT, DOCUMENTS_LAYOUT):
+        goal_storage.layout = layout
+        documents, round_trips = len(db.documents), db.round_trips
+        start = time.perf_counter()
+        counts = {}
+        async for _, user_counts in migrator.migrate_users(user_ids, layout):
+            counts.update({status: counts.get(status, 0) + count for status, count in user_counts.items()})
+        elapsed = time.perf_counter() - start
+        db.latency = 0.0
+        assert await trees() == before, f"trees changed by the migration to {layout}"
+        db.latency = latency
+        print(f"Migrated {users} users x {goals} goals to {layout}: {elapsed:.2f} s, {counts}, "
+              f"{documents} > {len(db.documents)} documents, {db.round_trips - round_trips} round trips; trees unchanged")
+    rerun = [counts async for _, counts in migrator.migrate_users(user_ids[:1], DOCUMENTS_LAYOUT)]
+    assert rerun[0] == {"skipped": goals}
+    print("Rerunning a finished migration skips every goal")
+
+
+async def check_oversized_fallback():
+    goal_storage.layout = COMPACT_LAYOUT
+    goal_read_cache.clear()
+    db = FakeFirestore()
+    plan = make_goal(3, 4)
+    max_compact_bytes, persistence.MAX_COMPACT_BYTES = persistence.MAX_COMPACT_BYTES, 10
+    try:
+        await GoalTreeWriter(db).save_goal(plan, USER_ID)
+    finally:
+        persistence.MAX_COMPACT_BYTES = max_compact_bytes
+    goal_doc = await db.collection("users", USER_ID, "goals").document(plan.guid).get()
+    snapshot = await GoalReader(db).get_goal(USER_ID, plan.guid)
+    assert "layout" not in goal_doc.to_dict() and len(snapshot["goal"]["milestones"]) == 3, goal_doc.to_dict()
+    print("A tree over MAX_COMPACT_BYTES is saved in the documents layout and reads back whole")
+
+
+def parse_size(text: str):
+    milestones, tasks = text.split("x")
+    return int(milestones), int(tasks)
+
+
+async def run(sizes, goals: int, users: int, latency: float):
+    await bench_sizes(sizes, goals, latency)
+    await bench_migration(users, 5, latency)
+    await check_oversized_fallback()
+    goal_storage.layout = DOCUMENTS_LAYOUT
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[(5, 8), (8, 8), (50, 20)], help="Milestones x tasks per milestone")
+    parser.add_argument("--goals", type=int, default=10, help="Goals of the user in the per-size comparison")
+    parser.add_argument("--users", type=int, default=50, help="Users migrated, with 5 goals each")
+    parser.add_argument("--latency", type=float, default=0.02, help="Simulated seconds per Firestore round trip")
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.goals, args.users, args.latency))
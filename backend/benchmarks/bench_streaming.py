@@ -0,0 +1,54 @@
+"""
+Time-to-first-milestone of the streaming plan generation against the blocking one.
+
+Both code paths run against a fake OpenAI client whose structured output takes
+`--latency` seconds to arrive in full, and a fake Firestore.
+
+Usage (from backend/):
+    python -m benchmarks.bench_streaming [--latency 2.0]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+
+from api.goal_to_tasks import GoalToTasks
+from benchmarks.fakes import FakeAsyncOpenAI, FakeFirestore, disable_response_cache
+
+
+async def run(latency: float, firestore_latency: float):
+    disable_response_cache()
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = FakeFirestore(latency=firestore_latency)
+        goal_to_tasks = GoalToTasks(db, FakeAsyncOpenAI(latency=latency), "bench-user")
+        start = time.perf_counter()
+        blocking = await goal_to_tasks.generate_milestones_and_tasks("Run a marathon in under 4 hours by April 2027.")
+        blocking_s = time.perf_counter() - start
+        blocking_docs = len(db.documents)
+
+        db = FakeFirestore(latency=firestore_latency)
+        goal_to_tasks = GoalToTasks(db, FakeAsyncOpenAI(latency=latency), "bench-user")
+        start = time.perf_counter()
+        first_milestone_s = None
+        async for event in goal_to_tasks.stream_milestones_and_tasks("Run a marathon in under 4 hours by April 2027."):
+            if event["type"] == "milestone" and first_milestone_s is None:
+                first_milestone_s = time.perf_counter() - start
+        streaming_s = time.perf_counter() - start
+
+    assert event["type"] == "done"
+    assert len(event["goal"]["milestones"]) == len(blocking.milestones)
+    assert len(db.documents) == blocking_docs
+
+    print(f"{'mode':>10} {'first milestone s':>18} {'complete s':>11}")
+    print(f"{'blocking':>10} {blocking_s:>18.2f} {blocking_s:>11.2f}")
+    print(f"{'streaming':>10} {first_milestone_s:>18.2f} {streaming_s:>11.2f}")
+    print(f"reported metrics: {event['metrics']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=2.0, help="Simulated seconds for the full LLM response")
+    parser.add_argument("--firestore-latency", type=float, default=0.02, help="Simulated seconds per Firestore round trip")
+    args = parser.parse_args()
+    asyncio.run(run(args.latency, args.firestore_latency))
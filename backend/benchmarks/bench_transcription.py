@@ -0,0 +1,70 @@
+"""
+Peak memory and latency of /transcribe_voice: whole-file upload vs chunked transcription.
+
+"whole file" reads the upload into memory and sends it in one request, as
+the endpoint used to. "chunked" is api.transcription.transcribe_audio, which
+memory-maps the spooled upload and transcribes overlapping chunks
+concurrently. Audio is 16 kHz mono WAV (about 1.9 MB per minute); the fake
+client takes `--seconds-per-audio-second` per second of audio and rejects
+uploads over 25 MB like Whisper does. Peak memory is the Python heap peak
+measured with tracemalloc.
+
+Usage (from backend/):
+    python -m benchmarks.bench_transcription [--minutes 1 10 60]
+"""
+import argparse
+import asyncio
+import io
+import os
+import tempfile
+import time
+import tracemalloc
+
+from api.transcription import transcribe_audio
+from benchmarks.fakes import FakeAsyncOpenAI, write_wav
+
+
+async def whole_file(client, file, filename):
+    audio = file.read()
+    return await client.audio.transcriptions.create(model="whisper-1", file=(filename, io.BytesIO(audio)), response_format="text")
+
+
+async def measure(transcribe, client, path):
+    with open(path, "rb") as file:
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            transcript = await transcribe(client, file, os.path.basename(path))
+            error = None
+        except ValueError as e:
+            transcript, error = "", str(e)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return transcript, elapsed, peak / (1024 * 1024), error
+
+
+async def run(minutes_list, latency: float, seconds_per_audio_second: float):
+    print(f"{'minutes':>7} {'file MB':>8} {'mode':>10} {'requests':>8} {'seconds':>8} {'peak MB':>8}  result")
+    with tempfile.TemporaryDirectory() as directory:
+        for minutes in minutes_list:
+            path = os.path.join(directory, f"memo-{minutes}.wav")
+            write_wav(path, minutes * 60)
+            size_mb = os.path.getsize(path) / (1024 * 1024)
+            expected = " ".join(f"w{second}" for second in range(minutes * 60))
+
+            for mode, transcribe in (("whole file", whole_file), ("chunked", transcribe_audio)):
+                client = FakeAsyncOpenAI(latency=latency, seconds_per_audio_second=seconds_per_audio_second)
+                transcript, elapsed, peak_mb, error = await measure(transcribe, client, path)
+                result = error or ("transcript ok" if transcript == expected else "TRANSCRIPT MISMATCH")
+                print(f"{minutes:>7} {size_mb:>8.1f} {mode:>10} {client.calls:>8} {elapsed:>8.2f} {peak_mb:>8.2f}  {result}")
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--minutes", type=int, nargs="+", default=[1, 10, 60])
+    parser.add_argument("--latency", type=float, default=0.2, help="Fixed seconds per transcription request")
+    parser.add_argument("--seconds-per-audio-second", type=float, default=0.002)
+    args = parser.parse_args()
+    asyncio.run(run(args.minutes, args.latency, args.seconds_per_audio_second))
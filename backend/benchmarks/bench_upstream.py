@@ -0,0 +1,115 @@
+"""
+Bursts of chat completions against a rate-limited upstream: default client vs pooled, limited client.
+
+The upstream is an httpx.MockTransport that allows `--limit` requests per
+`--window` seconds, answers with OpenAI's `x-ratelimit-*` headers and
+returns 429 once the window is spent. "default" is a plain AsyncOpenAI
+client, which only backs off through its own per-request retries.
+"limited" uses api.http_clients.build_http_client, which caps concurrent
+calls and pauses every call until the window resets when the headers say
+it is nearly spent. Both use the SDK's default of 2 retries.
+
+Usage (from backend/):
+    python -m benchmarks.bench_upstream [--requests 300] [--limit 50] [--window 1.0]
+"""
+import argparse
+import asyncio
+import time
+
+import httpx
+from openai import AsyncOpenAI, RateLimitError
+
+from api.http_clients import build_http_client
+from api.upstream import UpstreamLimiter
+
+COMPLETION = {
+    "id": "chatcmpl-bench", "object": "chat.completion", "created": 0, "model": "gpt-4o-mini",
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "ok"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+}
+
+
+class RateLimitedUpstream:
+    """
+    Fixed-window request limit, like an OpenAI requests-per-minute limit scaled down.
+    """
+
+    def __init__(self, limit: int, window: float, latency: float):
+        self.limit = limit
+        self.window = window
+        self.latency = latency
+        self.window_start = time.monotonic()
+        self.used = 0
+        self.responses = {200: 0, 429: 0}
+
+    def _headers(self, now: float) -> dict:
+        reset_ms = max(1, int((self.window_start + self.window - now) * 1000))
+        return {
+            "x-ratelimit-limit-requests": str(self.limit),
+            "x-ratelimit-remaining-requests": str(max(0, self.limit - self.used)),
+            "x-ratelimit-reset-requests": f"{reset_ms}ms",
+        }
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        now = time.monotonic()
+        if now - self.window_start >= self.window:
+            self.window_start, self.used = now, 0
+        if self.used >= self.limit:
+            self.responses[429] += 1
+            return httpx.Response(429, headers=self._headers(now), json={"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}})
+        self.used += 1
+        await asyncio.sleep(self.latency)
+        self.responses[200] += 1
+        return httpx.Response(200, headers=self._headers(time.monotonic()), json=COMPLETION)
+
+
+def make_client(mode: str, upstream: RateLimitedUpstream, max_concurrency: int):
+    transport = httpx.MockTransport(upstream.handle)
+    if mode == "default":
+        return AsyncOpenAI(api_key="bench", http_client=httpx.AsyncClient(transport=transport)), None
+    limiter = UpstreamLimiter(max_concurrency)
+    return AsyncOpenAI(api_key="bench", http_client=build_http_client("bench", limiter=limiter, transport=transport)), limiter
+
+
+async def burst(mode: str, requests: int, limit: int, window: float, latency: float, max_concurrency: int):
+    upstream = RateLimitedUpstream(limit, window, latency)
+    client, limiter = make_client(mode, upstream, max_concurrency)
+    latencies = []
+    failed = 0
+
+    async def call():
+        nonlocal failed
+        start = time.perf_counter()
+        try:
+            await client.chat.completions.create(model="gpt-4o-mini", messages=[{"role": "user", "content": "hi"}])
+            latencies.append(time.perf_counter() - start)
+        except RateLimitError:
+            failed += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(call() for _ in range(requests)))
+    elapsed = time.perf_counter() - start
+    await client.close()
+    latencies.sort()
+    p95 = latencies[int(len(latencies) * 0.95) - 1] if latencies else 0.0
+    wait_ms = limiter.stats()["mean_wait_ms"] if limiter else 0.0
+    return len(latencies), failed, upstream.responses[429], elapsed, p95, wait_ms
+
+
+async def run(requests: int, limit: int, window: float, latency: float, max_concurrency: int):
+    print(f"{requests} requests, upstream limit {limit} per {window}s, {latency * 1000:.0f} ms per call")
+    print(f"{'mode':>8} {'ok':>5} {'failed':>7} {'429s':>6} {'wall s':>7} {'p95 s':>6} {'mean wait ms':>13}")
+    for mode in ("default", "limited"):
+        ok, failed, rate_limited, elapsed, p95, wait_ms = await burst(mode, requests, limit, window, latency, max_concurrency)
+        print(f"{mode:>8} {ok:>5} {failed:>7} {rate_limited:>6} {elapsed:>7.2f} {p95:>6.2f} {wait_ms:>13.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--limit", type=int, default=50, help="Requests allowed per window")
+    parser.add_argument("--window", type=float, default=1.0, help="Rate limit window in seconds")
+    parser.add_argument("--latency", type=float, default=0.1, help="Upstream seconds per successful call")
+    parser.add_argument("--max-concurrency", type=int, default=32)
+    args = parser.parse_args()
+    asyncio.run(run(args.requests, args.limit, args.window, args.latency, args.max_concurrency))
@@ -0,0 +1,73 @@
+"""
+Recall and latency of the LocalVectorStore: brute force vs the IVF index.
+
+Vectors are drawn from a Gaussian mixture so they cluster like real
+embeddings. Recall@k is measured against the brute-force results.
+
+Usage (from backend/):
+    python -m benchmarks.bench_vector_store [--sizes 10000 100000 1000000] [--dimension 128]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from api.vector_store import LocalVectorStore
+
+UPSERT_CHUNK = 10_000
+
+
+def make_vectors(rng, size: int, dimension: int, clusters: int = 256):
+    centers = rng.normal(size=(clusters, dimension)).astype(np.float32)
+    labels = rng.integers(0, clusters, size=size)
+    return centers[labels] + 1.5 * rng.normal(size=(size, dimension)).astype(np.float32)
+
+
+def timed_queries(store, queries, top_k, filter=None):
+    results = []
+    start = time.perf_counter()
+    for query in queries:
+        results.append(store.query(query, top_k, filter))
+    return results, (time.perf_counter() - start) * 1000 / len(queries)
+
+
+def recall(expected, actual) -> float:
+    hits = sum(len({r["id"] for r in e} & {r["id"] for r in a}) for e, a in zip(expected, actual))
+    return hits / sum(len(e) for e in expected)
+
+
+def run(sizes, dimension: int, queries: int, top_k: int, n_probe: int):
+    rng = np.random.default_rng(0)
+    print(f"{'vectors':>9} {'index':>12} {'build s':>8} {'ms/query':>9} {'filtered ms':>12} {'recall@' + str(top_k):>10}")
+    for size in sizes:
+        vectors = make_vectors(rng, size, dimension)
+        store = LocalVectorStore(dimension, capacity=size)
+        for start in range(0, size, UPSERT_CHUNK):
+            store.upsert([
+                {"id": f"task-{i}", "values": vectors[i], "metadata": {"user_id": f"user-{i % 1000}", "guid": f"goal-{i % 5000}"}}
+                for i in range(start, min(start + UPSERT_CHUNK, size))
+            ])
+        sample = vectors[rng.choice(size, size=queries, replace=False)] + 0.1 * rng.normal(size=(queries, dimension)).astype(np.float32)
+
+        exact, brute_ms = timed_queries(store, sample, top_k)
+        _, brute_filtered_ms = timed_queries(store, sample, top_k, {"user_id": "user-7"})
+        print(f"{size:>9} {'brute force':>12} {0:>8.2f} {brute_ms:>9.3f} {brute_filtered_ms:>12.3f} {1.0:>10.3f}")
+
+        start = time.perf_counter()
+        store.build_ivf(n_probe=n_probe)
+        build_s = time.perf_counter() - start
+        approximate, ivf_ms = timed_queries(store, sample, top_k)
+        _, ivf_filtered_ms = timed_queries(store, sample, top_k, {"user_id": "user-7"})
+        print(f"{size:>9} {f'ivf/{n_probe}':>12} {build_s:>8.2f} {ivf_ms:>9.3f} {ivf_filtered_ms:>12.3f} {recall(exact, approximate):>10.3f}")
+        del store, vectors
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dimension", type=int, default=128, help="Use 1024 to match production embeddings if memory allows")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--n-probe", type=int, default=8)
+    args = parser.parse_args()
+    run(args.sizes, args.dimension, args.queries, args.top_k, args.n_probe)
@@ -0,0 +1,772 @@
+"""
+In-process stand-ins for the backend services, used by the benchmarks.
+
+Every fake counts its network round trips and can inject a fixed latency per
+round trip, so benchmarks measure how many calls a code path makes as well
+as how long it takes.
+"""
+import asyncio
+import io
+import json
+import math
+import struct
+import time
+import uuid
+from types import SimpleNamespace
+
+from google.api_core.exceptions import Aborted
+from google.cloud.firestore import Increment
+
+from api.goal_to_tasks import Goal, GoalOutline, Milestone, MilestoneOutline, MilestoneTasks, Task
+from api.profiling import RefinedProfile
+from api.response_cache import response_cache
+
+# httpx streams file uploads in blocks of this size
+UPLOAD_BLOCK_SIZE = 64 * 1024
+WHISPER_MAX_BYTES = 25 * 1024 * 1024
+WAV_HEADER_SIZE = 44
+# OpenAI caches prompt prefixes from 1024 tokens, in 128-token increments
+PROMPT_CACHE_MIN_TOKENS = 1024
+PROMPT_CACHE_STEP_TOKENS = 128
+REFUSAL = "I'm sorry, I can't help with that."
+
+
+def _auto_id():
+    return uuid.uuid4().hex[:20]
+
+
+def make_goal(milestones: int = 5, tasks_per_milestone: int = 8) -> Goal:
+    return Goal(
+        guid="",
+        name="Run a marathon",
+        description="Finish a marathon in under 4 hours",
+        deadline="2027-04-01",
+        progress=0,
+        milestones=[
+            Milestone(
+                muid="",
+                guid="",
+                name=f"{m + 1}. Milestone",
+                description="Milestone description",
+                deadline="2027-01-01",
+                tasks=[
+                    Task(name=f"{t + 1}. Task", description="Task description", duration_hours=2,
+                         simplicity=3, importance=4, urgency=2, completed=False, guid="", muid="")
+                    for t in range(tasks_per_milestone)
+                ],
+            )
+            for m in range(milestones)
+        ],
+    )
+
+
+def disable_response_cache():
+    """
+    Benchmarks repeat identical inputs, which the LLM response cache would otherwise serve.
+    """
+    response_cache.enabled = False
+
+
+def load_app(client, db):
+    """
+    Return the FastAPI app with its OpenAI and Firestore dependencies replaced by the given fakes.
+
+    The shared clients are replaced too, for background jobs that run outside a request.
+    """
+    from api.dependencies import get_db, get_openai_client, set_clients
+    from api.index import app
+
+    async def fake_client():
+        return client
+
+    async def fake_db():
+        return db
+
+    app.dependency_overrides[get_openai_client] = fake_client
+    app.dependency_overrides[get_db] = fake_db
+    set_clients(client, db)
+    disable_response_cache()
+    return app
+
+
+# --------------------------------
+# Firestore
+
+class FakeDocumentSnapshot:
+
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeDocumentReference:
+
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollectionReference(self._db, self.path + (name,))
+
+    async def set(self, data, merge=False):
+        await self._db._round_trip()
+        self._db._write(self.path, data, merge)
+
+    async def delete(self):
+        await self._db._round_trip()
+        self._db._delete(self.path)
+
+    async def get(self, transaction=None):
+        await self._db._round_trip()
+        data = self._db.documents.get(self.path)
+        self._db.documents_read += data is not None
+        if transaction is not None:
+            transaction._read(self.path)
+        return FakeDocumentSnapshot(self, data)
+
+
+FILTER_OPERATORS = {
+    "==": lambda actual, expected: actual == expected,
+    "in": lambda actual, expected: actual in expected,
+}
+
+
+class FakeCollectionReference:
+
+    def __init__(self, db, path, limit=None, filters=(), group=False):
+        self._db = db
+        self.path = path
+        self.id = path[-1]
+        self._limit = limit
+        self._filters = filters
+        self._group = group
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._db, self.path + (document_id or _auto_id(),))
+
+    def limit(self, count):
+        return FakeCollectionReference(self._db, self.path, count, self._filters, self._group)
+
+    def where(self, field, op, value):
+        if op not in FILTER_OPERATORS:
+            raise NotImplementedError(f"Fake query operator {op}")
+        return FakeCollectionReference(self._db, self.path, self._limit, self._filters + ((field, op, value),), self._group)
+
+    async def stream(self, transaction=None):
+        await self._db._round_trip()
+        # Collection group queries match every collection with this id, at any depth
+        paths = [path for path in self._db.documents if path[-2] == self.id] if self._group else list(self._db.children(self.path))
+        documents = self._db.documents
+        matches = [
+            (path, documents[path]) for path in paths
+            if all(FILTER_OPERATORS[op](documents[path].get(field), value) for field, op, value in self._filters)
+        ]
+        self._db.documents_read += len(matches[:self._limit])
+        for path, data in matches[:self._limit]:
+            if transaction is not None:
+                transaction._read(path)
+            yield FakeDocumentSnapshot(FakeDocumentReference(self._db, path), data)
+
+
+class FakeWriteBatch:
+
+    def __init__(self, db):
+        self._db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference.path, data, merge))
+
+    def delete(self, reference):
+        self._writes.append((reference.path, None, False))
+
+    async def commit(self):
+        if len(self._writes) > 500:
+            raise ValueError("maximum 500 writes allowed per request")
+        await self._db._round_trip()
+        for path, data, merge in self._writes:
+            self._db._apply(path, data, merge)
+        self._writes = []
+
+
+class FakeTransaction:
+    """
+    Optimistic transaction that `google.cloud.firestore.async_transactional` can drive.
+
+    The commit aborts, and the decorator retries the function, when a
+    document read in the transaction was written since.
+    """
+
+    _max_attempts = 5
+    _read_only = False
+
+    def __init__(self, db):
+        self._db = db
+        self._id = None
+        self._reads = {}
+        self._writes = []
+
+    def _clean_up(self):
+        self._id = None
+        self._reads = {}
+        self._writes = []
+
+    async def _begin(self, retry_id=None):
+        self._id = _auto_id().encode()
+
+    def _read(self, path):
+        self._reads.setdefault(path, self._db.versions.get(path, 0))
+
+    def set(self, reference, data, merge=False):
+        self._writes.append((reference.path, data, merge))
+
+    def delete(self, reference):
+        self._writes.append((reference.path, None, False))
+
+    async def _commit(self):
+        if len(self._writes) > 500:
+            raise ValueError("maximum 500 writes allowed per request")
+        await self._db._round_trip()
+        if any(self._db.versions.get(path, 0) != version for path, version in self._reads.items()):
+            self._db.aborted_transactions += 1
+            raise Aborted("Transaction contention on a document read")
+        for path, data, merge in self._writes:
+            self._db._apply(path, data, merge)
+        self._clean_up()
+
+    async def _rollback(self):
+        self._clean_up()
+
+
+def _merge(existing: dict, data: dict) -> dict:
+    merged = dict(existing)
+    for key, value in data.items():
+        if isinstance(value, Increment):
+            merged[key] = merged.get(key, 0) + value.value
+        elif isinstance(value, dict):
+            # Merges apply to nested maps field by field, and a new map may hold increments too
+            merged[key] = _merge(merged.get(key) if isinstance(merged.get(key), dict) else {}, value)
+        else:
+            merged[key] = value
+    return merged
+
+
+class FakeFirestore:
+    """
+    Dictionary-backed stand-in for the async Firestore client, covering the subset of the API used by the backend.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.documents_read = 0
+        self.aborted_transactions = 0
+        self.documents = {}
+        self.versions = {}
+        # Document paths by collection path, so a query does not scan the whole store
+        self._children = {}
+        self._indexed = 0
+
+    async def _round_trip(self):
+        self.round_trips += 1
+        await asyncio.sleep(self.latency)
+
+    def _write(self, path, data, merge):
+        if path not in self.documents:
+            self.children(path[:-1])[path] = None
+            self._indexed += 1
+        self.documents[path] = _merge(self.documents.get(path, {}) if merge else {}, data)
+        self.versions[path] = self.versions.get(path, 0) + 1
+
+    def _delete(self, path):
+        if path in self.documents:
+            self.children(path[:-1]).pop(path)
+            del self.documents[path]
+            self._indexed -= 1
+        self.versions[path] = self.versions.get(path, 0) + 1
+
+    def _apply(self, path, data, merge):
+        if data is None:
+            self._delete(path)
+        else:
+            self._write(path, data, merge)
+
+    def children(self, collection_path) -> dict:
+        if self._indexed != len(self.documents):
+            # Benchmarks may add documents directly; rebuild the index then
+            self._children = {}
+            for path in self.documents:
+                self._children.setdefault(path[:-1], {})[path] = None
+            self._indexed = len(self.documents)
+        return self._children.setdefault(collection_path, {})
+
+    def collection(self, *path):
+        return FakeCollectionReference(self, tuple(path))
+
+    def document(self, *path):
+        return FakeDocumentReference(self, tuple(path))
+
+    def collection_group(self, collection_id):
+        return FakeCollectionReference(self, (collection_id,), group=True)
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts: int = 5):
+        transaction = FakeTransaction(self)
+        transaction._max_attempts = max_attempts
+        return transaction
+
+    def close(self):
+        pass
+
+
+# --------------------------------
+# Pinecone
+
+class FakePineconeIndex:
+    """
+    Dictionary-backed Pinecone index: cosine similarity by brute force, `$eq` metadata filters.
+
+    The Pinecone SDK is synchronous, so the latency blocks like a real call would.
+    """
+
+    def __init__(self, pinecone, dimension: int):
+        self._pinecone = pinecone
+        self.dimension = dimension
+        self.vectors = {}
+
+    def upsert(self, vectors):
+        self._pinecone._round_trip()
+        for vector in vectors:
+            if len(vector["values"]) != self.dimension:
+                raise ValueError(f"Vector dimension {len(vector['values'])} does not match the dimension of the index {self.dimension}")
+            norm = math.sqrt(sum(value * value for value in vector["values"])) or 1.0
+            self.vectors[vector["id"]] = ([value / norm for value in vector["values"]], dict(vector.get("metadata") or {}))
+        return SimpleNamespace(upserted_count=len(vectors))
+
+    def query(self, vector, top_k=10, filter=None, include_metadata=False):
+        self._pinecone._round_trip()
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        conditions = {field: condition["$eq"] for field, condition in (filter or {}).items()}
+        matches = [
+            SimpleNamespace(id=vector_id, score=sum(a * b for a, b in zip(values, vector)) / norm, metadata=metadata if include_metadata else None)
+            for vector_id, (values, metadata) in self.vectors.items()
+            if all(metadata.get(field) == value for field, value in conditions.items())
+        ]
+        matches.sort(key=lambda match: -match.score)
+        return SimpleNamespace(matches=matches[:top_k])
+
+    def delete(self, ids):
+        self._pinecone._round_trip()
+        for vector_id in ids:
+            self.vectors.pop(vector_id, None)
+
+
+class FakePinecone:
+    """
+    Stand-in for the Pinecone client, covering the index management and data plane calls used by api.rag.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.round_trips = 0
+        self.indexes = {}
+
+    def _round_trip(self):
+        self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def has_index(self, name):
+        self._round_trip()
+        return name in self.indexes
+
+    def create_index(self, name, dimension, metric="cosine", spec=None):
+        self._round_trip()
+        self.indexes[name] = FakePineconeIndex(self, dimension)
+
+    def describe_index(self, name):
+        self._round_trip()
+        return SimpleNamespace(name=name, dimension=self.indexes[name].dimension)
+
+    def Index(self, name):
+        if name not in self.indexes:
+            raise KeyError(f"No index {name}")
+        return self.indexes[name]
+
+
+def install_pinecone(pinecone):
+    """
+    Serve api.rag's vector stores from the given fake, creating its index like `get_pinecone` would.
+    """
+    from api import rag
+    from api.embeddings import EMBEDDING_DIMENSION
+
+    if not pinecone.has_index(rag.index_name):
+        pinecone.create_index(rag.index_name, EMBEDDING_DIMENSION)
+    rag._pinecone = pinecone
+    rag.vector_stores.clear()
+
+
+# --------------------------------
+# OpenAI
+
+def _usage(prompt_tokens, completion_tokens, cached_tokens=0):
+    return SimpleNamespace(
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        total_tokens=prompt_tokens + completion_tokens,
+        prompt_tokens_details=SimpleNamespace(cached_tokens=cached_tokens),
+    )
+
+
+def _count_tokens(text):
+    # Rough 4-characters-per-token estimate, good enough for relative comparisons
+    return len(text) // 4
+
+
+def server_error(status_code: int = 500):
+    """
+    The error the OpenAI SDK raises for a 5xx response.
+    """
+    import httpx
+    import openai
+
+    request = httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+    return openai.InternalServerError("Upstream error", response=httpx.Response(status_code, request=request), body=None)
+
+
+def default_parsed(response_format, messages):
+    if response_format is Goal:
+        return make_goal()
+    if response_format is GoalOutline:
+        goal = make_goal()
+        return GoalOutline(
+            name=goal.name,
+            description=goal.description,
+            deadline=goal.deadline,
+            progress=goal.progress,
+            milestones=[
+                MilestoneOutline(name=milestone.name, description=milestone.description, deadline=milestone.deadline)
+                for milestone in goal.milestones
+            ],
+        )
+    if response_format is MilestoneTasks:
+        return MilestoneTasks(tasks=make_goal(1).milestones[0].tasks)
+    if response_format is RefinedProfile:
+        return RefinedProfile(profile_summary="A curious, driven person.", growth_opportunities="Consistency.")
+    raise NotImplementedError(f"No fake response for {response_format.__name__}")
+
+
+class FakeAsyncOpenAI:
+    """
+    Stand-in for AsyncOpenAI. Each call takes `latency` seconds plus
+    `seconds_per_output_token` for every token of the generated output and
+    `seconds_per_prompt_token` for every prompt token not served from the
+    simulated prompt cache.
+
+    `parsed_factory(response_format, messages)` builds the structured output
+    returned by `beta.chat.completions.parse`. `beta.chat.completions.stream`
+    emits the JSON of that same output in `stream_chunk_size` deltas, spread
+    evenly over the call duration.
+
+    `files` and `batches` are served by a FakeBatchServer.
+
+    `fault(model)` can make a chat call slow or fail: it returns extra
+    seconds for the call, an exception it raises after `latency`, or None.
+
+    `audio.transcriptions.create` reads the upload in blocks like an HTTP
+    client would, rejects it above Whisper's 25 MB limit, and takes
+    `seconds_per_audio_second` for every second of audio. WAV uploads are
+    "transcribed" by `wav_words`.
+    """
+
+    def __init__(self, latency: float = 0.0, parsed_factory=default_parsed, seconds_per_output_token: float = 0.0, stream_chunk_size: int = 16, seconds_per_audio_second: float = 0.0, seconds_per_prompt_token: float = 0.0, fault=None):
+        self.latency = latency
+        self.fault = fault
+        self.seconds_per_output_token = seconds_per_output_token
+        self.seconds_per_prompt_token = seconds_per_prompt_token
+        self.seconds_per_audio_second = seconds_per_audio_second
+        self.stream_chunk_size = stream_chunk_size
+        self.parsed_factory = parsed_factory
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+        self._prompt_prefixes = set()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.beta = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(parse=self._parse, stream=self._stream)))
+        self.audio = SimpleNamespace(transcriptions=SimpleNamespace(create=self._transcribe))
+        self.embeddings = SimpleNamespace(create=self._embed)
+        self.batch_server = FakeBatchServer(parsed_factory)
+        self.files = SimpleNamespace(create=self.batch_server.create_file, content=self.batch_server.file_content)
+        self.batches = SimpleNamespace(create=self.batch_server.create_batch, retrieve=self.batch_server.retrieve_batch, list=self.batch_server.list_batches)
+
+    async def close(self):
+        pass
+
+    def _duration(self, output: str) -> float:
+        return self.latency + _count_tokens(output) * self.seconds_per_output_token
+
+    def _cached_prefix_tokens(self, prompt: str) -> int:
+        """
+        Tokens of the longest previously seen prompt prefix, in 128-token steps from 1024 tokens, like OpenAI prompt caching.
+        """
+        cached = 0
+        for tokens in range(PROMPT_CACHE_MIN_TOKENS, _count_tokens(prompt) + 1, PROMPT_CACHE_STEP_TOKENS):
+            prefix = prompt[:tokens * 4]
+            if prefix in self._prompt_prefixes:
+                cached = tokens
+            self._prompt_prefixes.add(prefix)
+        return cached
+
+    async def _call(self, messages, output: str, model: str = None):
+        self.calls += 1
+        fault = self.fault(model) if self.fault is not None and model is not None else None
+        if isinstance(fault, BaseException):
+            await asyncio.sleep(self.latency)
+            raise fault
+        prompt = "".join(message["content"] for message in messages)
+        prompt_tokens = _count_tokens(prompt)
+        cached_tokens = self._cached_prefix_tokens(prompt)
+        completion_tokens = _count_tokens(output)
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens
+        self.completion_tokens += completion_tokens
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self._duration(output) + (prompt_tokens - cached_tokens) * self.seconds_per_prompt_token + (fault or 0.0))
+        finally:
+            self.in_flight -= 1
+        return _usage(prompt_tokens, completion_tokens, cached_tokens)
+
+    async def _create(self, model, messages, **kwargs):
+        content = "Run a marathon in under 4 hours by April 2027."
+        usage = await self._call(messages, content, model)
+        message = SimpleNamespace(content=content, refusal=None)
+        return SimpleNamespace(model=model, choices=[SimpleNamespace(message=message)], usage=usage)
+
+    async def _parse(self, model, messages, response_format, **kwargs):
+        # A factory returning None stands for a refusal
+        parsed = self.parsed_factory(response_format, messages)
+        usage = await self._call(messages, parsed.model_dump_json() if parsed is not None else REFUSAL, model)
+        message = SimpleNamespace(parsed=parsed, refusal=None if parsed is not None else REFUSAL)
+        return SimpleNamespace(model=model, choices=[SimpleNamespace(message=message)], usage=usage)
+
+    def _stream(self, model, messages, response_format, **kwargs):
+        self.calls += 1
+        parsed = self.parsed_factory(response_format, messages)
+        return FakeChatCompletionStream(parsed, self._duration(parsed.model_dump_json() if parsed is not None else REFUSAL), self.stream_chunk_size)
+
+    async def _embed(self, input, model, dimensions=1536, **kwargs):
+        texts = [input] if isinstance(input, str) else input
+        usage = await self._call([{"content": text} for text in texts], "")
+        data = [SimpleNamespace(index=i, embedding=[1.0] + [0.0] * (dimensions - 1)) for i in range(len(texts))]
+        return SimpleNamespace(model=model, data=data, usage=usage)
+
+    async def _transcribe(self, model, file, **kwargs):
+        self.calls += 1
+        _, content = file
+        if isinstance(content, bytes):
+            content = io.BytesIO(content)
+        words, seconds = wav_words(content)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency + seconds * self.seconds_per_audio_second)
+        finally:
+            self.in_flight -= 1
+        return " ".join(words) if words else "transcribed text"
+
+
+def write_wav(path: str, seconds: int, sample_rate: int = 16_000):
+    """
+    Write a 16-bit mono WAV whose first sample of every second is that second's index.
+
+    `wav_words` reads these markers back, so a transcript of the file is
+    "w0 w1 ... w{seconds - 1}" and stitched chunk transcripts can be checked.
+    """
+    with open(path, "wb") as f:
+        data_size = seconds * sample_rate * 2
+        f.write(b"RIFF" + struct.pack("<I", 36 + data_size) + b"WAVE")
+        f.write(b"fmt " + struct.pack("<IHHIIHH", 16, 1, 1, sample_rate, sample_rate * 2, 2, 16))
+        f.write(b"data" + struct.pack("<I", data_size))
+        second = bytearray(sample_rate * 2)
+        for index in range(seconds):
+            second[0:2] = struct.pack("<h", index % 32768)
+            f.write(second)
+
+
+def wav_words(file, block_size: int = UPLOAD_BLOCK_SIZE):
+    """
+    Read an uploaded file in blocks and return (words, seconds of audio).
+
+    For a WAV file the words are the second markers written by `write_wav`.
+    Raises ValueError above the Whisper upload limit.
+    """
+    header = file.read(WAV_HEADER_SIZE)
+    size = len(header)
+    is_wav = header[:4] == b"RIFF" and header[8:12] == b"WAVE" and header[36:40] == b"data"
+    byte_rate = struct.unpack("<I", header[28:32])[0] if is_wav else 0
+    words = []
+    while True:
+        block = file.read(block_size)
+        if not block:
+            break
+        if is_wav:
+            # Data offsets of whole seconds that fall in this block
+            offset = size - WAV_HEADER_SIZE
+            first = -(-offset // byte_rate) * byte_rate
+            for marker in range(first, offset + len(block) - 1, byte_rate):
+                words.append(f"w{struct.unpack('<h', block[marker - offset:marker - offset + 2])[0]}")
+        size += len(block)
+        if size > WHISPER_MAX_BYTES:
+            raise ValueError(f"Maximum content size limit ({WHISPER_MAX_BYTES}) exceeded")
+    seconds = (size - WAV_HEADER_SIZE) / byte_rate if is_wav else 0.0
+    return words, seconds
+
+
+class FakeChatCompletionStream:
+    """
+    Async context manager mimicking the `content.delta` events of `beta.chat.completions.stream`.
+
+    With no parsed output it stands for a refusal, streamed as `refusal.delta` events.
+    """
+
+    def __init__(self, parsed, latency: float, chunk_size: int):
+        self.parsed = parsed
+        content = parsed.model_dump_json() if parsed is not None else REFUSAL
+        self.chunks = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
+        self.delay = latency / len(self.chunks)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        kind = "content" if self.parsed is not None else "refusal"
+        for i, chunk in enumerate(self.chunks):
+            # Sleep to an absolute schedule so per-chunk timer overhead does not accumulate
+            await asyncio.sleep(max(0.0, start + (i + 1) * self.delay - loop.time()))
+            yield SimpleNamespace(type=f"{kind}.delta", delta=chunk)
+        if self.parsed is not None:
+            yield SimpleNamespace(type="content.done", content="".join(self.chunks), parsed=self.parsed)
+        else:
+            yield SimpleNamespace(type="refusal.done", refusal=REFUSAL)
+
+    async def get_final_completion(self):
+        message = SimpleNamespace(parsed=self.parsed, refusal=None if self.parsed is not None else REFUSAL)
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=_usage(0, len(self.chunks)))
+
+
+STRUCTURED_OUTPUT_MODELS = {model.__name__: model for model in (Goal, GoalOutline, MilestoneTasks, RefinedProfile)}
+
+
+class FakeBatchServer:
+    """
+    In-memory OpenAI Batch API: `files.create`/`files.content` and `batches.create`/`retrieve`/`list`.
+
+    A batch is `in_progress` for `completion_seconds` after creation, then
+    its chat completion requests are answered with `parsed_factory` output
+    the first time it is retrieved. Requests whose custom_id is in
+    `failing_custom_ids` go to the error file. When `expire_next_batch_after`
+    is set, the next batch expires after answering that many requests.
+    """
+
+    def __init__(self, parsed_factory=default_parsed, completion_seconds: float = 0.0):
+        self.parsed_factory = parsed_factory
+        self.completion_seconds = completion_seconds
+        self.failing_custom_ids = set()
+        self.expire_next_batch_after = None
+        self.files = {}
+        self.batches = {}
+        self.requests_answered = 0
+
+    def _add_file(self, content: bytes, purpose: str):
+        file_id = f"file-{_auto_id()}"
+        self.files[file_id] = content
+        return SimpleNamespace(id=file_id, bytes=len(content), purpose=purpose)
+
+    async def create_file(self, file, purpose):
+        if isinstance(file, tuple):
+            file = file[1]
+        content = file if isinstance(file, bytes) else file.read()
+        return self._add_file(content, purpose)
+
+    async def file_content(self, file_id):
+        content = self.files[file_id]
+        return SimpleNamespace(content=content, text=content.decode())
+
+    async def create_batch(self, input_file_id, endpoint, completion_window, metadata=None):
+        lines = self.files[input_file_id].decode().splitlines()
+        batch = SimpleNamespace(
+            id=f"batch_{_auto_id()}", status="validating", input_file_id=input_file_id, endpoint=endpoint,
+            completion_window=completion_window, metadata=metadata, output_file_id=None, error_file_id=None,
+            request_counts=SimpleNamespace(total=len(lines), completed=0, failed=0),
+            created_at=time.time(), expire_after=self.expire_next_batch_after,
+        )
+        self.expire_next_batch_after = None
+        self.batches[batch.id] = batch
+        return batch
+
+    async def retrieve_batch(self, batch_id):
+        batch = self.batches[batch_id]
+        if batch.status in ("validating", "in_progress"):
+            if time.time() < batch.created_at + self.completion_seconds:
+                batch.status = "in_progress"
+            else:
+                self._run(batch)
+        return batch
+
+    async def list_batches(self, limit=20):
+        # Newest first, every page, like iterating the SDK's AsyncPaginator
+        for batch in reversed(list(self.batches.values())):
+            yield batch
+
+    def _run(self, batch):
+        requests = [json.loads(line) for line in self.files[batch.input_file_id].decode().splitlines()]
+        if batch.expire_after is not None:
+            requests = requests[:batch.expire_after]
+        output, errors = [], []
+        for request in requests:
+            self.requests_answered += 1
+            line = {"id": f"batch_req_{_auto_id()}", "custom_id": request["custom_id"], "error": None}
+            if request["custom_id"] in self.failing_custom_ids:
+                line["response"] = {"status_code": 400, "body": {"error": {"message": "Invalid request"}}}
+                errors.append(line)
+                continue
+            body = request["body"]
+            response_format = STRUCTURED_OUTPUT_MODELS[body["response_format"]["json_schema"]["name"]]
+            content = self.parsed_factory(response_format, body["messages"]).model_dump_json()
+            prompt_tokens = _count_tokens("".join(message["content"] for message in body["messages"]))
+            line["response"] = {"status_code": 200, "body": {
+                "id": f"chatcmpl-{_auto_id()}", "object": "chat.completion", "model": body["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content, "refusal": None}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": _count_tokens(content), "total_tokens": prompt_tokens + _count_tokens(content)},
+            }}
+            output.append(line)
+
+        if output:
+            batch.output_file_id = self._add_file("".join(json.dumps(line) + "\n" for line in output).encode(), "batch_output").id
+        if errors:
+            batch.error_file_id = self._add_file("".join(json.dumps(line) + "\n" for line in errors).encode(), "batch_output").id
+        batch.request_counts = SimpleNamespace(total=batch.request_counts.total, completed=len(output), failed=len(errors))
+        batch.status = "expired" if batch.expire_after is not None else "completed"
@@ -0,0 +1,37 @@
+"""
+Shared clients: the embedding service follows the OpenAI client, and Pinecone is checked at startup.
+"""
+import asyncio
+
+from api import rag
+from api.dependencies import close_clients, embedding_service, set_clients
+from benchmarks.fakes import FakeAsyncOpenAI
+
+
+def test_closing_the_clients_drops_the_embedding_service(monkeypatch):
+    monkeypatch.setenv("EMBEDDING_BACKEND", "openai")
+    first = FakeAsyncOpenAI()
+    set_clients(first)
+    assert embedding_service().backend.client is first
+
+    asyncio.run(close_clients())
+    second = FakeAsyncOpenAI()
+    set_clients(second)
+    assert embedding_service().backend.client is second
+    asyncio.run(close_clients())
+
+
+def test_pinecone_is_opened_at_startup_only_when_configured(monkeypatch):
+    opened = []
+    monkeypatch.setattr(rag, "get_pinecone", lambda: opened.append(True))
+
+    monkeypatch.delenv("PINECONE_API_KEY", raising=False)
+    rag.configure_vector_store()
+    monkeypatch.setenv("PINECONE_API_KEY", "key")
+    monkeypatch.setenv("VECTOR_STORE", "local")
+    rag.configure_vector_store()
+    assert opened == []
+
+    monkeypatch.delenv("VECTOR_STORE")
+    rag.configure_vector_store()
+    assert opened == [True]
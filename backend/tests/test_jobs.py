@@ -0,0 +1,93 @@
+"""
+JobQueue processes sharing one SQLiteJobBackend: leases keep a job with the process that holds it.
+"""
+import asyncio
+import time
+
+from api import jobs
+from api.jobs import JobQueue, SQLiteJobBackend
+
+
+def make_job(job_id: str, status: str = "queued") -> dict:
+    now = time.time()
+    return {
+        "job_id": job_id, "kind": "echo", "payload": {}, "dedup_key": job_id, "status": status,
+        "attempts": 0, "progress": None, "message": None, "result": None, "error": None,
+        "created_at": now, "updated_at": now,
+    }
+
+
+def test_claim_skips_jobs_leased_by_another_process(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    first, second = SQLiteJobBackend(path), SQLiteJobBackend(path)
+    first.save(make_job("held"), owner="first")
+    second.save(make_job("expired"), owner="second", lease=0)
+    first.save(make_job("done", status="succeeded"))
+
+    assert [job["job_id"] for job in second.claim("second")] == ["expired"]
+    assert first.claim("first") == []
+
+    first.release("first")
+    assert [job["job_id"] for job in second.claim("second")] == ["held"]
+    # An update keeps the lease of the job's holder
+    second.save({**make_job("held"), "status": "running"})
+    assert first.claim("first") == []
+
+
+def test_job_runs_once_across_queues(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_EVENTS_POLL_SECONDS", 0.05)
+    path = str(tmp_path / "jobs.sqlite3")
+    runs = []
+
+    async def echo(payload, progress):
+        runs.append(payload["n"])
+        await asyncio.sleep(0.2)
+        return payload["n"]
+
+    async def scenario():
+        first, second = JobQueue(SQLiteJobBackend(path)), JobQueue(SQLiteJobBackend(path))
+        for queue in (first, second):
+            queue.register("echo", echo)
+        job = await first.submit("echo", {"n": 1})
+        second.start()
+        # The second queue only learns of the job's progress by polling the shared store
+        events = [event async for event in second.events(job["job_id"])]
+        await asyncio.gather(first.stop(), second.stop())
+        return events
+
+    events = asyncio.run(scenario())
+    assert runs == [1]
+    assert events[-1]["status"] == "succeeded" and events[-1]["result"] == 1
+
+
+def test_stopped_queue_hands_its_jobs_over(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    runs = []
+
+    async def echo(payload, progress):
+        runs.append(payload["n"])
+        return payload["n"]
+
+    async def scenario():
+        first = JobQueue(SQLiteJobBackend(path), concurrency=1)
+        first.register("echo", echo)
+        first.start()
+        # Both jobs stay queued: the first queue stops before its worker picks them up
+        jobs_submitted = [await first.submit("echo", {"n": n}) for n in (1, 2)]
+        await first.stop()
+
+        second = JobQueue(SQLiteJobBackend(path))
+        second.register("echo", echo)
+        second.start()
+        results = [(await asyncio.wait_for(_finished(second, job["job_id"]), 5))["result"] for job in jobs_submitted]
+        await second.stop()
+        return results
+
+    assert asyncio.run(scenario()) == [1, 2]
+    assert sorted(runs) == [1, 2]
+
+
+async def _finished(queue: JobQueue, job_id: str) -> dict:
+    async for job in queue.events(job_id):
+        last = job
+    return last
@@ -0,0 +1,120 @@
+"""
+ProgressTracker against the in-memory FakeFirestore: concurrent completions, repeated reopens and transaction retries.
+
+Run from backend/ with `python -m pytest tests`.
+"""
+import asyncio
+
+import pytest
+
+from api.goal_reads import GoalReader, goal_read_cache
+from api.persistence import COMPACT_LAYOUT, DOCUMENTS_LAYOUT, GoalTreeWriter, goal_storage, progress_counters
+from api.progress import COUNTER_FIELDS, ProgressTracker
+from benchmarks.fakes import FakeFirestore, make_goal
+
+USER_ID = "test-user"
+
+
+@pytest.fixture(autouse=True)
+def documents_layout():
+    goal_read_cache.clear()
+    yield
+    goal_storage.layout = DOCUMENTS_LAYOUT
+    goal_read_cache.clear()
+
+
+async def saved_goal(db, milestones: int = 3, tasks: int = 4):
+    goal = make_goal(milestones, tasks)
+    await GoalTreeWriter(db).save_goal(goal, USER_ID)
+    return goal
+
+
+def task_paths(goal):
+    return [(milestone.muid, task.tuid) for milestone in goal.milestones for task in milestone.tasks]
+
+
+async def counters_and_truth(db, guid: str):
+    """
+    The goal's counters, and the counters recomputed from its tasks.
+    """
+    progress = await ProgressTracker(db).goal_progress(USER_ID, guid)
+    tree = await GoalReader(db).load_tree(USER_ID, guid)
+    truth = progress_counters([task for milestone in tree['milestones'] for task in milestone['tasks']])
+    return {field: progress[field] for field in COUNTER_FIELDS}, truth
+
+
+@pytest.mark.parametrize("layout", [DOCUMENTS_LAYOUT, COMPACT_LAYOUT])
+def test_concurrent_completions_are_all_counted(layout):
+    async def scenario():
+        goal_storage.layout = layout
+        db = FakeFirestore()
+        goal = await saved_goal(db)
+        tracker = ProgressTracker(db)
+        results = await asyncio.gather(*(tracker.set_task_completed(USER_ID, goal.guid, muid, tuid, True) for muid, tuid in task_paths(goal)))
+        assert all(result["changed"] for result in results)
+        counters, truth = await counters_and_truth(db, goal.guid)
+        assert counters == truth
+        assert truth["completed_tasks"] == truth["total_tasks"] == 12
+        assert (await tracker.goal_progress(USER_ID, goal.guid))["progress"] == 100
+
+    asyncio.run(scenario())
+
+
+def test_repeated_reopen_counts_once():
+    async def scenario():
+        db = FakeFirestore()
+        goal = await saved_goal(db)
+        tracker = ProgressTracker(db)
+        for muid, tuid in task_paths(goal):
+            await tracker.set_task_completed(USER_ID, goal.guid, muid, tuid, True)
+        muid, tuid = task_paths(goal)[0]
+        for _ in range(3):
+            results = await asyncio.gather(*(tracker.set_task_completed(USER_ID, goal.guid, muid, tuid, False) for _ in range(10)))
+            assert sum(result["changed"] for result in results) <= 1
+        counters, truth = await counters_and_truth(db, goal.guid)
+        assert counters == truth
+        assert truth["completed_tasks"] == truth["total_tasks"] - 1
+
+    asyncio.run(scenario())
+
+
+def test_contended_transactions_are_retried():
+    async def scenario():
+        db = FakeFirestore()
+        goal = await saved_goal(db)
+        # A round trip long enough for concurrent transactions on one task to overlap
+        db.latency = 0.005
+        tracker = ProgressTracker(db)
+        muid, tuid = task_paths(goal)[0]
+        results = await asyncio.gather(*(tracker.set_task_completed(USER_ID, goal.guid, muid, tuid, True) for _ in range(4)))
+        assert db.aborted_transactions > 0
+        assert sum(result["changed"] for result in results) == 1
+        counters, truth = await counters_and_truth(db, goal.guid)
+        assert counters == truth and truth["completed_tasks"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_missing_task_is_none():
+    async def scenario():
+        db = FakeFirestore()
+        goal = await saved_goal(db)
+        muid, _ = task_paths(goal)[0]
+        assert await ProgressTracker(db).set_task_completed(USER_ID, goal.guid, muid, "missing", True) is None
+
+    asyncio.run(scenario())
+
+
+def test_reconcile_repairs_corrupted_counters():
+    async def scenario():
+        db = FakeFirestore()
+        goal = await saved_goal(db)
+        tracker = ProgressTracker(db)
+        muid, tuid = task_paths(goal)[0]
+        await tracker.set_task_completed(USER_ID, goal.guid, muid, tuid, True)
+        await db.collection("users", USER_ID, "goals").document(goal.guid).set({"completed_hours": -1.0, "completed_tasks": 999}, merge=True)
+        await tracker.reconcile_goal(USER_ID, goal.guid)
+        counters, truth = await counters_and_truth(db, goal.guid)
+        assert counters == truth and truth["completed_tasks"] == 1
+
+    asyncio.run(scenario())
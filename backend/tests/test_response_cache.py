@@ -0,0 +1,57 @@
+"""
+ResponseCache on a DiskCacheBackend: reads off the event loop, expired entries swept periodically.
+"""
+import asyncio
+import threading
+import time
+
+from api.response_cache import DiskCacheBackend, ResponseCache
+
+
+def messages(index: int) -> list:
+    return [{"role": "user", "content": f"question {index}"}]
+
+
+def test_disk_backend_runs_off_the_event_loop(tmp_path, monkeypatch):
+    backend = DiskCacheBackend(str(tmp_path / "responses.sqlite3"))
+    threads = set()
+    get = backend.get
+
+    def recording_get(key):
+        threads.add(threading.get_ident())
+        return get(key)
+
+    monkeypatch.setattr(backend, "get", recording_get)
+    cache = ResponseCache(backend)
+
+    async def call():
+        return "model", "answer"
+
+    async def scenario():
+        first = await cache.get_or_call("endpoint", "model", messages(0), call)
+        second = await cache.get_or_call("endpoint", "model", messages(0), call)
+        return first, second
+
+    assert asyncio.run(scenario()) == ("answer", "answer")
+    assert threads and threading.get_ident() not in threads
+    assert cache.stats()["endpoints"]["endpoint"]["hits"] == 1
+
+
+def test_disk_backend_sweeps_periodically(tmp_path):
+    backend = DiskCacheBackend(str(tmp_path / "responses.sqlite3"), maxsize=3, ttl=60, sweep_interval=0.2)
+    for index in range(5):
+        backend.set(f"key-{index}", "value")
+    # Swept on the first set only, so the entries over maxsize stay until the next sweep
+    assert len(backend) == 5
+
+    time.sleep(0.2)
+    backend.set("key-5", "value")
+    assert len(backend) == 3
+    assert backend.get("key-5") == "value" and backend.get("key-0") is None
+
+
+def test_expired_entries_are_not_returned_before_the_sweep(tmp_path):
+    backend = DiskCacheBackend(str(tmp_path / "responses.sqlite3"), ttl=0.1, sweep_interval=60)
+    backend.set("key", "value")
+    time.sleep(0.15)
+    assert backend.get("key") is None and len(backend) == 1
@@ -0,0 +1,72 @@
+"""
+GoalStreamParser fed a streamed Goal JSON in chunks split at every position.
+"""
+import json
+
+from api.streaming import GoalStreamParser
+
+GOAL = {
+    "guid": "g1",
+    "name": "Ship {the} \"app\" [v2]",
+    "description": "Back\\slash, unicode é and a \"milestones\": [ key in text",
+    "deadline": "2027-04-01",
+    "progress": 0,
+    "milestones": [
+        {"muid": "m1", "name": "Design }", "description": None, "deadline": None, "guid": "g1", "tasks": [
+            {"name": "Sketch \"{\" and \"}\"", "duration_hours": 2, "completed": False, "milestones": [{"nested": "]"}]},
+        ]},
+        {"muid": "m2", "name": "Build \\", "description": "\\\"quoted\\\"", "deadline": "2027-01-01", "guid": "g1", "tasks": []},
+        {"muid": "m3", "name": "Launch", "description": "", "deadline": None, "guid": "g1", "tasks": [{"name": "Go", "duration_hours": 1.5, "completed": True}]},
+    ],
+}
+TEXT = json.dumps(GOAL)
+HEADER = {**{key: value for key, value in GOAL.items() if key != "milestones"}, "milestones": []}
+
+
+def feed_all(chunks):
+    parser = GoalStreamParser()
+    milestones = []
+    for chunk in chunks:
+        milestones.extend(parser.feed(chunk))
+    return parser, milestones
+
+
+def test_whole_text():
+    parser, milestones = feed_all([TEXT])
+    assert parser.header == HEADER
+    assert milestones == GOAL["milestones"]
+
+
+def test_every_split_point():
+    # Covers splits inside strings, between a backslash and the character it escapes, and next to braces
+    for split in range(len(TEXT) + 1):
+        parser, milestones = feed_all([TEXT[:split], TEXT[split:]])
+        assert parser.header == HEADER, split
+        assert milestones == GOAL["milestones"], split
+
+
+def test_escape_split_from_its_quote():
+    split = TEXT.index('\\"app')
+    parser, milestones = feed_all([TEXT[:split + 1], TEXT[split + 1:]])
+    assert milestones == GOAL["milestones"]
+
+
+def test_milestones_returned_at_their_closing_brace():
+    parser = GoalStreamParser()
+    returned = []
+    for position, char in enumerate(TEXT):
+        returned.extend((position, milestone["muid"]) for milestone in parser.feed(char))
+    ends = []
+    for milestone in GOAL["milestones"]:
+        text = json.dumps(milestone)
+        ends.append((TEXT.index(text) + len(text) - 1, milestone["muid"]))
+    assert returned == ends
+
+
+def test_header_once_the_milestones_array_opens():
+    opening = TEXT.index('"milestones": [') + len('"milestones": ')
+    parser = GoalStreamParser()
+    parser.feed(TEXT[:opening])
+    assert parser.header is None
+    parser.feed(TEXT[opening])
+    assert parser.header == HEADER
@@ -0,0 +1,27 @@
+"""
+VectorStore's interface and LocalVectorStore's IVF index on stores too small to cluster.
+"""
+import pytest
+
+from api.vector_store import LocalVectorStore, VectorStore
+
+
+def test_vector_store_is_abstract():
+    with pytest.raises(TypeError):
+        VectorStore()
+
+
+def test_ivf_on_an_empty_store_raises():
+    store = LocalVectorStore(4)
+    with pytest.raises(ValueError, match="empty"):
+        store.build_ivf()
+
+
+def test_ivf_with_more_lists_than_vectors():
+    store = LocalVectorStore(4)
+    store.upsert([
+        {"id": "a", "values": [1, 0, 0, 0], "metadata": {"user_id": "u"}},
+        {"id": "b", "values": [0, 1, 0, 0], "metadata": {"user_id": "u"}},
+    ])
+    store.build_ivf(n_lists=16)
+    assert [match["id"] for match in store.query([1, 0.1, 0, 0], top_k=1)] == ["a"]
@@ -94,6 +94,12 @@ const GoalTrackerApp: React.FC = () => {
     };
   }, [user, router]);
 
+  // The backend serves goals from snapshots it keeps; after writing a goal's documents directly, have it rebuild them
+  const reconcileGoal = async (guid: string) => {
+    if (!user) return;
+    await axios.post(`${process.env.NEXT_PUBLIC_BACKEND_API_URL}/users/${user.uid}/goals/${guid}/reconcile`);
+  }
+
   // CRUD operations for Goals
   const addGoal = async (goal: Omit<Goal, 'guid' | 'progress'>): Promise<string> => {
     if (!user) {
@@ -102,6 +108,7 @@ const GoalTrackerApp: React.FC = () => {
     }
     try {
       const docRef = await addDoc(collection(db, 'users', user.uid, 'goals'), { ...goal, progress: 0 })
+      await reconcileGoal(docRef.id)
       return docRef.id
     } catch (error) {
       console.error("Error adding goal:", error)
@@ -113,6 +120,7 @@ const GoalTrackerApp: React.FC = () => {
     if (!user) return ''
     try {
       const docRef = await addDoc(collection(db, 'users', user.uid, 'goals', milestone.guid, 'milestones'), milestone)
+      await reconcileGoal(milestone.guid)
       return docRef.id
     } catch (error) {
       console.error("Error adding milestone:", error)
@@ -124,6 +132,7 @@ const GoalTrackerApp: React.FC = () => {
     if (!user) return;
     try {
       await updateDoc(doc(db, 'users', user.uid, 'goals', id), updatedGoal);
+      await reconcileGoal(id);
     } catch (error) {
       console.error("Error updating goal:", error);
     }
@@ -132,29 +141,8 @@ const GoalTrackerApp: React.FC = () => {
   const deleteGoal = async (id: string) => {
     if (!user) return;
     try {
-      // Fetch milestones for the goal
-      const milestonesSnapshot = await getDocs(collection(db, 'users', user.uid, 'goals', id, 'milestones'));
-      
-      // Delete each milestone and its tasks
-      const deletePromises = milestonesSnapshot.docs.map(async (milestoneDoc) => {
-        const milestoneId = milestoneDoc.id;
-        
-        // Fetch tasks for the milestone
-        const tasksSnapshot = await getDocs(collection(db, 'users', user.uid, 'goals', id, 'milestones', milestoneId, 'tasks'));
-        
-        // Delete each task
-        const taskDeletePromises = tasksSnapshot.docs.map(taskDoc => deleteDoc(doc(db, 'users', user.uid, 'goals', id, 'milestones', milestoneId, 'tasks', taskDoc.id)));
-        await Promise.all(taskDeletePromises);
-        
-        // Delete the milestone
-        return deleteDoc(doc(db, 'users', user.uid, 'goals', id, 'milestones', milestoneId));
-      });
-
-      // Wait for all milestones and their tasks to be deleted
-      await Promise.all(deletePromises);
-      
-      // Finally, delete the goal
-      await deleteDoc(doc(db, 'users', user.uid, 'goals', id));
+      // The backend deletes the milestones, tasks and snapshot along with the goal
+      await axios.delete(`${process.env.NEXT_PUBLIC_BACKEND_API_URL}/users/${user.uid}/goals/${id}`);
     } catch (error) {
       console.error("Error deleting goal:", error);
     }
@@ -164,6 +152,7 @@ const GoalTrackerApp: React.FC = () => {
     if (!user) return ''
     try {
       const docRef = await addDoc(collection(db, 'users', user.uid, 'goals', task.guid, 'milestones', task.muid, 'tasks'), task)
+      await reconcileGoal(task.guid)
       return docRef.id
     } catch (error) {
       console.error("Error adding task:", error)
@@ -171,14 +160,29 @@ const GoalTrackerApp: React.FC = () => {
     }
   }
 
+  // The backend updates the task with its milestone and goal progress in one transaction
+  const setTaskCompletion = async (task: Omit<Task, 'id'>, completed: boolean) => {
+    if (!user) return;
+    await axios.post(`${process.env.NEXT_PUBLIC_BACKEND_API_URL}/users/${user.uid}/goals/${task.guid}/milestones/${task.muid}/tasks/${task.tuid}/completion`, {
+      completed
+    });
+  }
+
   const updateTask = async (task: Task, updatedTask: Partial<Task>): Promise<void> => {
     if (!user) {
       console.error("User not authenticated.");
       return;
     }
     try {
-      const taskDocRef = doc(db, 'users', user.uid, 'goals', task.guid, 'milestones', task.muid, 'tasks', task.tuid);
-      await updateDoc(taskDocRef, updatedTask);
+      const { completed, ...fields } = updatedTask;
+      if (completed !== undefined) {
+        await setTaskCompletion(task, completed);
+      }
+      if (Object.keys(fields).length > 0) {
+        const taskDocRef = doc(db, 'users', user.uid, 'goals', task.guid, 'milestones', task.muid, 'tasks', task.tuid);
+        await updateDoc(taskDocRef, fields);
+        await reconcileGoal(task.guid);
+      }
       console.log("Task updated successfully");
     } catch (error) {
       console.error("Error updating task:", error);
@@ -188,9 +192,8 @@ const GoalTrackerApp: React.FC = () => {
   const toggleTaskCompletion = async (task: Omit<Task, 'id'>) => {
     if (!user) return;
     try {
-      const taskDocRef = doc(db, 'users', user.uid, 'goals', task.guid, 'milestones', task.muid, 'tasks', task.tuid);
       const newCompletionStatus = !task.completed;
-      await updateDoc(taskDocRef, { completed: newCompletionStatus });
+      await setTaskCompletion(task, newCompletionStatus);
       console.log(`Task completion status updated to ${newCompletionStatus}`);
     } catch (error) {
       console.error("Error toggling task completion:", error);
@@ -202,6 +205,7 @@ const GoalTrackerApp: React.FC = () => {
     if (!user) return;
     try {
       await deleteDoc(doc(db, 'users', user.uid, 'goals', task.guid, 'milestones', task.muid, 'tasks', task.tuid));
+      await reconcileGoal(task.guid);
     } catch (error) {
       console.error("Error deleting task:", error);
     }